@@ -0,0 +1,118 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Hash algorithms with serializable state.
+
+hashlib objects can't be saved and restored in another process, so hashing of
+a file can't be split between several task queue tasks with them. The hashers
+here can, at a price: they are pure Python and thus much slower than hashlib.
+Use them only when hashing has to be resumed later.
+"""
+
+import binascii
+import struct
+
+
+class SHA1(object):
+  """SHA-1 hasher (FIPS 180-4) with state that can be saved and restored.
+
+  Has the same interface as hashlib.sha1 objects, plus get_state and
+  from_state.
+  """
+
+  name = 'sha1'
+  digest_size = 20
+  block_size = 64
+
+  # Serialized state header: 5 words of intermediate hash + message length.
+  _STATE_HEADER = struct.Struct('>5LQ')
+
+  def __init__(self, data=None):
+    self._h = (0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0)
+    # Total length of the data, in bytes.
+    self._length = 0
+    # Data not processed yet, always shorter than block_size.
+    self._tail = ''
+    if data:
+      self.update(data)
+
+  def get_state(self):
+    """Returns hasher state as a str, see from_state."""
+    return self._STATE_HEADER.pack(*(self._h + (self._length,))) + self._tail
+
+  @classmethod
+  def from_state(cls, state):
+    """Returns a new hasher with state returned by get_state."""
+    header_size = cls._STATE_HEADER.size
+    if len(state) < header_size or len(state) >= header_size + cls.block_size:
+      raise ValueError('Invalid SHA1 state')
+    values = cls._STATE_HEADER.unpack(state[:header_size])
+    hasher = cls()
+    hasher._h = values[:5]
+    hasher._length = values[5]
+    hasher._tail = state[header_size:]
+    if len(hasher._tail) != hasher._length % cls.block_size:
+      raise ValueError('Invalid SHA1 state')
+    return hasher
+
+  def copy(self):
+    return self.from_state(self.get_state())
+
+  def update(self, data):
+    data = self._tail + data
+    self._length += len(data) - len(self._tail)
+    h = self._h
+    end = len(data) - len(data) % self.block_size
+    for offset in xrange(0, end, self.block_size):
+      h = _compress(h, data[offset:offset + self.block_size])
+    self._h = h
+    self._tail = data[end:]
+
+  def digest(self):
+    bit_length = self._length * 8
+    padding = '\x80' + '\x00' * ((55 - self._length) % self.block_size)
+    final = self.copy()
+    final.update(padding + struct.pack('>Q', bit_length))
+    assert not final._tail
+    return struct.pack('>5L', *final._h)
+
+  def hexdigest(self):
+    return binascii.hexlify(self.digest())
+
+
+def _compress(h, block):
+  """Returns SHA-1 intermediate hash after processing a 64 byte block."""
+  w = list(struct.unpack('>16L', block))
+  for i in xrange(16, 80):
+    x = w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16]
+    w.append(((x << 1) | (x >> 31)) & 0xffffffff)
+
+  a, b, c, d, e = h
+  for i in xrange(80):
+    if i < 20:
+      f = d ^ (b & (c ^ d))
+      k = 0x5a827999
+    elif i < 40:
+      f = b ^ c ^ d
+      k = 0x6ed9eba1
+    elif i < 60:
+      f = (b & c) | (d & (b | c))
+      k = 0x8f1bbcdc
+    else:
+      f = b ^ c ^ d
+      k = 0xca62c1d6
+    t = (((a << 5) | (a >> 27)) + f + e + k + w[i]) & 0xffffffff
+    e = d
+    d = c
+    c = ((b << 30) | (b >> 2)) & 0xffffffff
+    b = a
+    a = t
+
+  return (
+    (h[0] + a) & 0xffffffff,
+    (h[1] + b) & 0xffffffff,
+    (h[2] + c) & 0xffffffff,
+    (h[3] + d) & 0xffffffff,
+    (h[4] + e) & 0xffffffff,
+  )
@@ -13,7 +13,9 @@ Upload protocol:
      authentication).
   4) Client finalizes the upload (thus making the temp file visible).
   5) Client notifies server that upload has finished.
-  6) Server starts hash verification task.
+  6) Server starts hash verification task. Large files are verified by a chain
+     of tasks, each hashing a part of the file and passing the hasher state
+     to the next one.
   7) On successful verification, server copies the file to the final location.
   8) Meanwhile client polls server for verification operation status.
   9) Once verification finishes, client polls 'PUBLISHED' status.
@@ -31,7 +33,7 @@ Features of Google Storage used or taken into consideration:
 Also this module is sensitive to implementation details of 'cloudstorage'
 library since it uses its non-public APIs:
   * StreamingBuffer._api.api_url and StreamingBuffer._path_with_token.
-  * ReadBuffer._etag.
+  * ReadBuffer._etag and ReadBuffer._file_size.
   * storage_api._get_storage_api(...) and _StorageApi it returns.
 """
 
@@ -61,6 +63,8 @@ from components import utils
 
 import config
 
+from . import hashing
+
 # TODO(vadimsh): Garbage collect expired UploadSession. Right know only public
 # upload_session_id expires, rendering sessions unreachable by clients. But the
 # entities themselves unnecessarily stay in the datastore.
@@ -74,11 +78,30 @@ SESSION_EXPIRATION_TIME_SEC = 6 * 60 * 60
 # Chunks to read when verifying the hash.
 READ_BUFFER_SIZE = 1024 * 1024
 
+# Verification tasks must finish within the 10 min task queue deadline. On a
+# Xeon with CPython 2.7, hashlib.sha1 hashes ~140 MB/s and hashing.SHA1 only
+# ~1.2 MB/s. The sizes below leave room for instances a few times slower and
+# for reading from Google Storage.
+
+# Files up to this size are verified in a single task using hashlib. Larger
+# files are verified by a chain of tasks using slower resumable hashers.
+# Reading 512 MB from GS dominates; hashing it takes ~4 sec.
+MAX_SINGLE_TASK_VERIFY_SIZE = 512 * 1024 * 1024
+
+# How many bytes a task of the verification chain hashes: ~55 sec of
+# hashing.SHA1, so a 1 GB file is verified by 16 tasks in ~15 min.
+VERIFY_CHUNK_SIZE = 64 * 1024 * 1024
+
 # Hash algorithms we are willing to accept: name -> (factory, hex digest len).
 SUPPORTED_HASH_ALGOS = {
   'SHA1': (hashlib.sha1, 40),
 }
 
+# Hashers with serializable state for SUPPORTED_HASH_ALGOS, see hashing.py.
+RESUMABLE_HASH_ALGOS = {
+  'SHA1': hashing.SHA1,
+}
+
 # Return values of task queue task handling function.
 TASK_DONE = 1
 TASK_RETRY = 2
@@ -332,12 +355,7 @@ class CASService(object):
       refreshed = upload_session.key.get()
       if refreshed.status != UploadSession.STATUS_UPLOADING:  # pragma: no cover
         return refreshed
-      success = utils.enqueue_task(
-          url='/internal/taskqueue/cas-verify/%d' % refreshed.key.id(),
-          queue_name='cas-verify',
-          transactional=True)
-      if not success:  # pragma: no cover
-        raise datastore_errors.TransactionFailedError()
+      self._enqueue_verify_task(refreshed.key.id())
       refreshed.status = UploadSession.STATUS_VERIFYING
       refreshed.put()
       return refreshed
@@ -347,6 +365,11 @@ class CASService(object):
   def verify_pending_upload(self, unsigned_upload_id):
     """Task queue task that checks the hash of a pending upload, finalizes it.
 
+    Files larger than MAX_SINGLE_TASK_VERIFY_SIZE are hashed VERIFY_CHUNK_SIZE
+    bytes per task. Each task stores the hasher state, the offset and the ETag
+    in UploadSession and enqueues the next one. The last task finalizes the
+    upload.
+
     Args:
       unsigned_upload_id: long int ID of upload session to check.
 
@@ -410,19 +433,30 @@ class CASService(object):
     etag = temp_file._etag.strip('"')
     assert etag
 
-    # TODO(vadimsh): This will always timeout for large files (gigabytes).
-    # Verification task can be split into multiple subsequent tasks with the
-    # hasher internal state (and file offset and ETag) transported between them.
     try:
-      hasher = SUPPORTED_HASH_ALGOS[upload_session.hash_algo][0]()
-      while True:
-        buf = temp_file.read(READ_BUFFER_SIZE)
-        if not buf:
-          break
-        hasher.update(buf)
-        # Help GC to collect this buffer before new one is allocated. Appengine
-        # is very memory constrained environment.
-        del buf
+      resumable = (
+          upload_session.verified_etag is not None or
+          temp_file._file_size > MAX_SINGLE_TASK_VERIFY_SIZE)
+      if not resumable:
+        hasher = SUPPORTED_HASH_ALGOS[upload_session.hash_algo][0]()
+        _hash_file(temp_file, hasher)
+      else:
+        # The file must not change between tasks of the chain.
+        if upload_session.verified_etag not in (None, etag):
+          set_error('Google Storage file was modified during verification.')
+          return TASK_DONE
+        hasher_cls = RESUMABLE_HASH_ALGOS[upload_session.hash_algo]
+        if upload_session.hasher_state:
+          hasher = hasher_cls.from_state(upload_session.hasher_state)
+        else:
+          hasher = hasher_cls()
+        offset = upload_session.verified_bytes
+        temp_file.seek(offset)
+        offset += _hash_file(temp_file, hasher, VERIFY_CHUNK_SIZE)
+        if offset < temp_file._file_size:
+          self._save_verification_progress(
+              upload_session, etag, offset, hasher.get_state())
+          return TASK_DONE
       digest = hasher.hexdigest()
     finally:
       temp_file.close()
@@ -455,6 +489,39 @@ class CASService(object):
     self._cleanup_temp(upload_session)
     return TASK_DONE
 
+  def _enqueue_verify_task(self, upload_id):
+    """Transactionally enqueues a task to verify the upload session."""
+    success = utils.enqueue_task(
+        url='/internal/taskqueue/cas-verify/%d' % upload_id,
+        queue_name='cas-verify',
+        transactional=True)
+    if not success:  # pragma: no cover
+      raise datastore_errors.TransactionFailedError()
+
+  def _save_verification_progress(
+      self, upload_session, etag, verified_bytes, hasher_state):
+    """Stores the hasher state and enqueues the next verification task.
+
+    Does nothing if the session has been verified further or finalized
+    concurrently, e.g. by a retry of the same task.
+    """
+    @ndb.transactional
+    def run():
+      refreshed = upload_session.key.get()
+      if (refreshed.status != UploadSession.STATUS_VERIFYING or
+          refreshed.verified_bytes !=
+              upload_session.verified_bytes):  # pragma: no cover
+        return
+      refreshed.verified_etag = etag
+      refreshed.verified_bytes = verified_bytes
+      refreshed.hasher_state = hasher_state
+      self._enqueue_verify_task(refreshed.key.id())
+      refreshed.put()
+    run()
+    logging.info(
+        'Verified %d bytes of upload session %d',
+        verified_bytes, upload_session.key.id())
+
   def _verified_gs_path(self, hash_algo, hash_digest):
     """Google Storage path to a verified file."""
     return str('%s/%s/%s' % (self._gs_path, hash_algo, hash_digest))
@@ -567,12 +634,41 @@ class UploadSession(ndb.Model):
   # For STATUS_ERROR may contain an error message.
   error_message = ndb.TextProperty(required=False)
 
+  # Progress of a verification split between several tasks. Number of bytes of
+  # the temp file hashed so far.
+  verified_bytes = ndb.IntegerProperty(default=0, indexed=False)
+  # ETag of the temp file when the verification started.
+  verified_etag = ndb.StringProperty(indexed=False)
+  # State of the resumable hasher, see RESUMABLE_HASH_ALGOS.
+  hasher_state = ndb.BlobProperty()
+
   # Who started the upload.
   created_by = auth.IdentityProperty(required=True)
   # When the entity was created.
   created_ts = ndb.DateTimeProperty(required=True, auto_now_add=True)
 
 
+def _hash_file(file_obj, hasher, limit=None):
+  """Feeds up to |limit| bytes of a file to |hasher|, returns number of bytes.
+
+  Reads until EOF if |limit| is None.
+  """
+  total = 0
+  while limit is None or total < limit:
+    size = READ_BUFFER_SIZE
+    if limit is not None:
+      size = min(size, limit - total)
+    buf = file_obj.read(size)
+    if not buf:
+      break
+    hasher.update(buf)
+    total += len(buf)
+    # Help GC to collect this buffer before new one is allocated. Appengine
+    # is very memory constrained environment.
+    del buf
+  return total
+
+
 class DirectUpload(object):
   """A wrapper around temp GCS file, used to upload data directly to CAS.
 
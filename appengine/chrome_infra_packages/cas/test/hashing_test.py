@@ -0,0 +1,59 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import hashlib
+import unittest
+
+from cas import hashing
+
+
+class SHA1Test(unittest.TestCase):
+  def test_matches_hashlib(self):
+    for size in (0, 1, 55, 56, 63, 64, 65, 119, 128, 1000):
+      data = ''.join(chr(i % 251) for i in xrange(size))
+      self.assertEqual(
+          hashing.SHA1(data).hexdigest(), hashlib.sha1(data).hexdigest())
+      self.assertEqual(hashing.SHA1(data).digest(), hashlib.sha1(data).digest())
+
+  def test_update_in_parts(self):
+    data = 'x' * 200
+    hasher = hashing.SHA1()
+    for i in xrange(0, len(data), 7):
+      hasher.update(data[i:i+7])
+    self.assertEqual(hasher.hexdigest(), hashlib.sha1(data).hexdigest())
+
+  def test_get_state_from_state(self):
+    data = 'abcdefgh' * 30
+    for cut in (0, 10, 64, 100, len(data)):
+      hasher = hashing.SHA1(data[:cut])
+      restored = hashing.SHA1.from_state(hasher.get_state())
+      restored.update(data[cut:])
+      self.assertEqual(restored.hexdigest(), hashlib.sha1(data).hexdigest())
+
+  def test_resume_at_unaligned_chunks(self):
+    # Like a chain of verification tasks with a chunk size that is not a
+    # multiple of the block size.
+    data = ''.join(chr(i % 251) for i in xrange(1000))
+    state = hashing.SHA1().get_state()
+    for offset in xrange(0, len(data), 100):
+      hasher = hashing.SHA1.from_state(state)
+      hasher.update(data[offset:offset+100])
+      state = hasher.get_state()
+    self.assertEqual(
+        hashing.SHA1.from_state(state).hexdigest(),
+        hashlib.sha1(data).hexdigest())
+
+  def test_digest_does_not_change_state(self):
+    hasher = hashing.SHA1('abc')
+    hasher.hexdigest()
+    hasher.update('def')
+    self.assertEqual(hasher.hexdigest(), hashlib.sha1('abcdef').hexdigest())
+
+  def test_from_state_invalid(self):
+    state = hashing.SHA1('abc').get_state()
+    with self.assertRaises(ValueError):
+      hashing.SHA1.from_state(state[:-1])
+    with self.assertRaises(ValueError):
+      hashing.SHA1.from_state('')
+
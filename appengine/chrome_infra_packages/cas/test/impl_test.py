@@ -246,6 +246,7 @@ class CASServiceImplTest(testing.AppengineTestCase):
   def test_verify_pending_upload_bad_hash(self):
     fake_file = StringIO.StringIO('test buffer')
     fake_file._etag = 'fake_etag'
+    fake_file._file_size = len('test buffer')
 
     obj = common.make_fake_session(
         status=impl.UploadSession.STATUS_VERIFYING,
@@ -276,6 +277,7 @@ class CASServiceImplTest(testing.AppengineTestCase):
   def test_verify_pending_upload_good_hash(self):
     fake_file = StringIO.StringIO('test buffer')
     fake_file._etag = 'fake_etag'
+    fake_file._file_size = len('test buffer')
 
     obj = common.make_fake_session(
         status=impl.UploadSession.STATUS_VERIFYING,
@@ -308,6 +310,128 @@ class CASServiceImplTest(testing.AppengineTestCase):
     obj = obj.key.get()
     self.assertEqual(obj.status, impl.UploadSession.STATUS_PUBLISHED)
 
+  def test_verify_pending_upload_in_chunks(self):
+    self.mock(impl, 'MAX_SINGLE_TASK_VERIFY_SIZE', 4)
+    self.mock(impl, 'VERIFY_CHUNK_SIZE', 5)
+    self.mock(impl, 'READ_BUFFER_SIZE', 2)
+    content = 'test buffer'
+    digest = hashlib.sha1(content).hexdigest()
+
+    obj = common.make_fake_session(
+        status=impl.UploadSession.STATUS_VERIFYING,
+        hash_algo='SHA1',
+        hash_digest=digest,
+        final_gs_location='/bucket/real/SHA1/' + digest,
+        temp_gs_location='/bucket/temp/temp_crap')
+    obj.put()
+
+    def mocked_open(filename, mode, read_buffer_size, retry_params):
+      fake_file = StringIO.StringIO(content)
+      fake_file._etag = '"fake_etag"'
+      fake_file._file_size = len(content)
+      return fake_file
+    self.mock(impl.cloudstorage, 'open', mocked_open)
+
+    tasks = []
+    def mocked_enqueue_task(**kwargs):
+      tasks.append(kwargs)
+      return True
+    self.mock(impl.utils, 'enqueue_task', mocked_enqueue_task)
+
+    service = impl.CASService('/bucket/real', '/bucket/temp')
+    copies = []
+    def mocked_copy(src, dst, src_etag):
+      copies.append((src, dst, src_etag))
+    self.mock(service, '_gs_copy', mocked_copy)
+
+    # First two tasks hash 5 bytes each and enqueue the next task.
+    for verified_bytes in (5, 10):
+      self.assertTrue(service.verify_pending_upload(obj.key.id()))
+      obj = obj.key.get()
+      self.assertEqual(obj.status, impl.UploadSession.STATUS_VERIFYING)
+      self.assertEqual(obj.verified_bytes, verified_bytes)
+      self.assertEqual(obj.verified_etag, 'fake_etag')
+    self.assertEqual(len(tasks), 2)
+    self.assertEqual(tasks[0], {
+      'queue_name': 'cas-verify',
+      'transactional': True,
+      'url': '/internal/taskqueue/cas-verify/666',
+    })
+
+    # The last one hashes the rest and publishes the file.
+    self.assertTrue(service.verify_pending_upload(obj.key.id()))
+    obj = obj.key.get()
+    self.assertEqual(obj.status, impl.UploadSession.STATUS_PUBLISHED)
+    self.assertEqual(len(tasks), 2)
+    self.assertEqual(copies, [
+      ('/bucket/temp/temp_crap', '/bucket/real/SHA1/' + digest, 'fake_etag'),
+    ])
+
+  def test_verify_pending_upload_in_unaligned_chunks(self):
+    # Chunk boundaries fall in the middle of SHA1 blocks.
+    self.mock(impl, 'MAX_SINGLE_TASK_VERIFY_SIZE', 4)
+    self.mock(impl, 'VERIFY_CHUNK_SIZE', 100)
+    self.mock(impl, 'READ_BUFFER_SIZE', 7)
+    content = ''.join(chr(i % 251) for i in xrange(250))
+    digest = hashlib.sha1(content).hexdigest()
+
+    obj = common.make_fake_session(
+        status=impl.UploadSession.STATUS_VERIFYING,
+        hash_algo='SHA1',
+        hash_digest=digest,
+        final_gs_location='/bucket/real/SHA1/' + digest,
+        temp_gs_location='/bucket/temp/temp_crap')
+    obj.put()
+
+    def mocked_open(filename, mode, read_buffer_size, retry_params):
+      fake_file = StringIO.StringIO(content)
+      fake_file._etag = '"fake_etag"'
+      fake_file._file_size = len(content)
+      return fake_file
+    self.mock(impl.cloudstorage, 'open', mocked_open)
+    self.mock(impl.utils, 'enqueue_task', lambda **_: True)
+
+    service = impl.CASService('/bucket/real', '/bucket/temp')
+    self.mock(service, '_gs_copy', lambda *_: None)
+
+    for verified_bytes in (100, 200):
+      self.assertTrue(service.verify_pending_upload(obj.key.id()))
+      self.assertEqual(obj.key.get().verified_bytes, verified_bytes)
+    self.assertTrue(service.verify_pending_upload(obj.key.id()))
+
+    # Published, i.e. the digest of resumed hashing matched.
+    obj = obj.key.get()
+    self.assertEqual(obj.status, impl.UploadSession.STATUS_PUBLISHED)
+
+  def test_verify_pending_upload_modified_between_chunks(self):
+    obj = common.make_fake_session(
+        status=impl.UploadSession.STATUS_VERIFYING,
+        hash_algo='SHA1',
+        hash_digest='a' * 40,
+        final_gs_location='/bucket/real/SHA1/' + 'a' * 40,
+        temp_gs_location='/bucket/temp/temp_crap',
+        verified_bytes=5,
+        verified_etag='old_etag',
+        hasher_state=impl.hashing.SHA1('test ').get_state())
+    obj.put()
+
+    def mocked_open(filename, mode, read_buffer_size, retry_params):
+      fake_file = StringIO.StringIO('test buffer')
+      fake_file._etag = 'new_etag'
+      fake_file._file_size = len('test buffer')
+      return fake_file
+    self.mock(impl.cloudstorage, 'open', mocked_open)
+
+    service = impl.CASService('/bucket/real', '/bucket/temp')
+    self.assertTrue(service.verify_pending_upload(obj.key.id()))
+
+    # Moved to ERROR.
+    obj = obj.key.get()
+    self.assertEqual(obj.status, impl.UploadSession.STATUS_ERROR)
+    self.assertEqual(
+        obj.error_message,
+        'Google Storage file was modified during verification.')
+
   def test_open_ok(self):
     service = impl.CASService('/bucket/real', '/bucket/temp')
     calls = []
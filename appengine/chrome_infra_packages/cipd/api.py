@@ -367,6 +367,8 @@ class SearchResponse(messages.Message):
 
   # For SUCCESS, list of instances found.
   instances = messages.MessageField(PackageInstance, 3, repeated=True)
+  # For SUCCESS of a paginated search, cursor of the next page if any.
+  cursor = messages.StringField(4, required=False)
 
 
 class ResolveVersionResponse(messages.Message):
@@ -906,19 +908,27 @@ class PackageRepositoryApi(remote.Service):
       endpoints.ResourceContainer(
           message_types.VoidMessage,
           tag=messages.StringField(1, required=True),
-          package_name=messages.StringField(2, required=False)),
+          package_name=messages.StringField(2, required=False),
+          cursor=messages.StringField(3, required=False),
+          page_size=messages.IntegerField(4, required=False)),
       SearchResponse,
       path='instance/search',
       http_method='GET',
       name='searchInstances')
   @auth.public  # ACL check is inside
   def search_instances(self, request):
-    """Returns package instances with given tag (in no particular order)."""
+    """Returns package instances with given tag (in no particular order).
+
+    Returns all of them, unless page_size or cursor is given.
+    """
     tag = validate_instance_tag(request.tag)
     if request.package_name:
       package_name = validate_package_name(request.package_name)
     else:
       package_name = None
+    paginated = request.page_size is not None or bool(request.cursor)
+    if request.page_size is not None and request.page_size <= 0:
+      raise ValidationError('page_size must be positive')
 
     caller = auth.get_current_identity()
     callback = None
@@ -935,8 +945,18 @@ class PackageRepositoryApi(remote.Service):
         return acl_cache[package_name]
       callback = check_readable
 
-    found = self.service.search_by_tag(tag, package_name, callback)
-    return SearchResponse(instances=[instance_to_proto(i) for i in found])
+    cursor = None
+    if paginated:
+      try:
+        found, cursor = self.service.search_by_tag_page(
+            tag, package_name, callback,
+            page_size=request.page_size, cursor=request.cursor)
+      except ValueError:
+        raise ValidationError('Invalid cursor')
+    else:
+      found = self.service.search_by_tag(tag, package_name, callback)
+    return SearchResponse(
+        instances=[instance_to_proto(i) for i in found], cursor=cursor)
 
 
   @endpoints_method(
@@ -101,6 +101,7 @@ import webapp2
 
 from google.appengine import runtime
 from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
 from components import auth
@@ -133,6 +134,12 @@ TAG_KEY_RE = re.compile(r'^[a-z0-9_\-]+$')
 # Hash algorithm used to derive package instance ID from package data.
 DIGEST_ALGO = 'SHA1'
 
+# Number of tags fetched by one query page in search_by_tag.
+SEARCH_BATCH_SIZE = 100
+
+# Maximum number of tags fetched by one search_by_tag_page call.
+MAX_SEARCH_PAGE_SIZE = 1000
+
 
 # Information about extract CIPD client binary, see get_client_binary_info.
 ClientBinaryInfo = collections.namedtuple(
@@ -625,6 +632,8 @@ class RepoService(object):
 
     Sorts by tagging time. Newest tags first.
 
+    Fetches instances of a page of tags while the next page is being queried.
+
     Args:
       tag: tag to search for.
       package_name: if given, limit search only to given package.
@@ -634,26 +643,90 @@ class RepoService(object):
     Returns:
       List of PackageInstance entities.
     """
-    # TODO(vadimsh): Support cursors.
+    q = self._search_by_tag_query(tag, package_name)
+    found = []
+    page_future = q.fetch_page_async(SEARCH_BATCH_SIZE, keys_only=True)
+    while page_future:
+      tag_keys, cursor, more = page_future.get_result()
+      page_future = None
+      if more:
+        page_future = q.fetch_page_async(
+            SEARCH_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+      found.extend(
+          self._get_tagged_instances_async(tag_keys, callback).get_result())
+    return found
+
+  def search_by_tag_page(
+      self, tag, package_name=None, callback=None, page_size=None,
+      cursor=None):
+    """Returns a page of package instances with a given tag.
+
+    Same as search_by_tag, but returns at most |page_size| instances, and
+    fewer if |callback| skips some.
+
+    Args:
+      tag: tag to search for.
+      package_name: if given, limit search only to given package.
+      callback: see search_by_tag.
+      page_size: maximum number of tags to look at, defaults to
+          SEARCH_BATCH_SIZE, at most MAX_SEARCH_PAGE_SIZE.
+      cursor: cursor returned by previous call, or None to start from the
+          beginning.
+
+    Returns:
+      Tuple (list of PackageInstance entities, cursor of the next page or None
+      if there are no more results).
+
+    Raises:
+      ValueError if cursor is invalid or belongs to another query.
+    """
+    q = self._search_by_tag_query(tag, package_name)
+    start_cursor = None
+    if cursor:
+      try:
+        start_cursor = datastore_query.Cursor(urlsafe=cursor)
+      except datastore_errors.BadValueError as exc:
+        raise ValueError(str(exc))
+    page_size = min(page_size or SEARCH_BATCH_SIZE, MAX_SEARCH_PAGE_SIZE)
+    try:
+      tag_keys, next_cursor, more = q.fetch_page(
+          page_size, keys_only=True, start_cursor=start_cursor)
+    except datastore_errors.BadRequestError as exc:
+      raise ValueError(str(exc))
+    found = self._get_tagged_instances_async(tag_keys, callback).get_result()
+    return found, next_cursor.urlsafe() if more and next_cursor else None
+
+  @staticmethod
+  def _search_by_tag_query(tag, package_name):
+    """Returns a query of InstanceTag keys for search_by_tag."""
     assert is_valid_instance_tag(tag), tag
     q = InstanceTag.query(
         InstanceTag.tag == tag,
         ancestor=package_key(package_name) if package_name else None)
-    q = q.order(-InstanceTag.registered_ts)
-    found = []
-    for tag_key in q.iter(keys_only=True):
+    return q.order(-InstanceTag.registered_ts)
+
+  @staticmethod
+  @ndb.tasklet
+  def _get_tagged_instances_async(tag_keys, callback):
+    """Fetches instances of a batch of InstanceTag keys in one RPC.
+
+    Instances rejected by |callback| are not fetched.
+    """
+    instance_keys = []
+    for tag_key in tag_keys:
       package_name = tag_key.parent().parent().string_id()
       instance_id = tag_key.parent().string_id()
       if callback and not callback(package_name, instance_id):
         continue
-      # TODO(vadimsh): This can be fetched asynchronously while next page of
-      # query results is being fetched.
-      inst = tag_key.parent().get()
+      instance_keys.append(tag_key.parent())
+    instances = yield ndb.get_multi_async(instance_keys)
+    found = []
+    for inst in instances:
       if inst is None:  # pragma: no cover
         continue
       assert isinstance(inst, PackageInstance), inst
       found.append(inst)
-    return found
+    raise ndb.Return(found)
 
   def resolve_version(self, package_name, version, limit):
     """Given an instance ID, a ref or a tag returns instance IDs that match it.
@@ -1154,6 +1154,54 @@ class PackageRepositoryApiTest(testing.EndpointsTestCase):
       'status': 'SUCCESS',
     }, resp.json_body)
 
+  def test_search_paginated(self):
+    self.set_tag('a/b', 'tag1:', datetime.datetime(2014, 1, 1), 'a'*40)
+    self.set_tag('a/b', 'tag1:', datetime.datetime(2015, 1, 1), 'b'*40)
+    self.set_tag('d/e', 'tag1:', datetime.datetime(2016, 1, 1), 'a'*40)
+
+    resp = self.call_api('search_instances', {'tag': 'tag1:', 'page_size': 2})
+    self.assertEqual('SUCCESS', resp.json_body['status'])
+    self.assertEqual(
+        [('d/e', 'a'*40), ('a/b', 'b'*40)],
+        [(i['package_name'], i['instance_id'])
+         for i in resp.json_body['instances']])
+    cursor = resp.json_body['cursor']
+    self.assertTrue(cursor)
+
+    resp = self.call_api('search_instances', {
+      'tag': 'tag1:',
+      'page_size': 2,
+      'cursor': cursor,
+    })
+    self.assertEqual({
+      'instances': [
+        {
+          'instance_id': 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+          'package_name': 'a/b',
+          'registered_by': 'user:abc@example.com',
+          'registered_ts': '1388534400000000',
+        },
+      ],
+      'status': 'SUCCESS',
+    }, resp.json_body)
+
+  def test_search_bad_cursor(self):
+    resp = self.call_api('search_instances', {
+      'tag': 'tag1:',
+      'cursor': 'bad cursor',
+    })
+    self.assertEqual({
+      'status': 'ERROR',
+      'error_message': 'Invalid cursor',
+    }, resp.json_body)
+
+  def test_search_bad_page_size(self):
+    resp = self.call_api('search_instances', {'tag': 'tag1:', 'page_size': 0})
+    self.assertEqual({
+      'status': 'ERROR',
+      'error_message': 'page_size must be positive',
+    }, resp.json_body)
+
   def test_resolve_version_works_instance_id(self):
     self.set_tag('a/b', 'tag1:', datetime.datetime(2014, 1, 1), 'a'*40)
     resp = self.call_api('resolve_version', {
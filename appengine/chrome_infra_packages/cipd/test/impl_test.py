@@ -8,6 +8,7 @@ import StringIO
 import unittest
 import zipfile
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from testing_utils import testing
 
@@ -641,6 +642,61 @@ class TestRepoService(testing.AppengineTestCase):
     found = self.service.search_by_tag('tag1:value1')
     self.assertFalse(found)
 
+  def test_search_by_tag_pages(self):
+    self.mock(impl, 'SEARCH_BATCH_SIZE', 2)
+    for i, iid in enumerate(['a'*40, 'b'*40, 'c'*40, 'd'*40, 'e'*40]):
+      self.service.register_instance(
+          package_name='a/b',
+          instance_id=iid,
+          caller=auth.Identity.from_bytes('user:abc@example.com'),
+          now=datetime.datetime(2014, 1, 1, 0, 0))
+      self.service.attach_tags(
+          package_name='a/b',
+          instance_id=iid,
+          tags=['tag1:value1'],
+          caller=auth.Identity.from_bytes('user:abc@example.com'),
+          now=datetime.datetime(2014, 1, 1 + i, 0, 0))
+
+    # Goes over all query pages. Newest first.
+    found = self.service.search_by_tag('tag1:value1')
+    self.assertEqual(
+        ['e', 'd', 'c', 'b', 'a'], [e.instance_id[0] for e in found])
+
+    # Callback is applied to each page.
+    found = self.service.search_by_tag(
+        'tag1:value1', callback=lambda _pkg, iid: iid[0] in 'bd')
+    self.assertEqual(['d', 'b'], [e.instance_id[0] for e in found])
+
+    # Explicit pagination.
+    pages = []
+    cursor = None
+    while True:
+      found, cursor = self.service.search_by_tag_page(
+          'tag1:value1', package_name='a/b', page_size=2, cursor=cursor)
+      pages.append([e.instance_id[0] for e in found])
+      if not cursor:
+        break
+    self.assertEqual([['e', 'd'], ['c', 'b'], ['a']], pages)
+
+    with self.assertRaises(ValueError):
+      self.service.search_by_tag_page('tag1:value1', cursor='bad cursor')
+
+  def test_search_by_tag_page_limits(self):
+    self.mock(impl, 'MAX_SEARCH_PAGE_SIZE', 2)
+    for iid in ('a'*40, 'b'*40, 'c'*40):
+      self.add_tagged_instance('a/b', iid, ['tag1:value1'])
+    found, cursor = self.service.search_by_tag_page(
+        'tag1:value1', page_size=1000)
+    self.assertEqual(2, len(found))
+    self.assertTrue(cursor)
+
+    # A cursor of another query.
+    def mocked_fetch_page(*_args, **_kwargs):
+      raise datastore_errors.BadRequestError('Cursor does not match query')
+    self.mock(impl.ndb.Query, 'fetch_page', mocked_fetch_page)
+    with self.assertRaises(ValueError):
+      self.service.search_by_tag_page('tag1:value1', cursor=cursor)
+
   def add_tagged_instance(self, package_name, instance_id, tags):
     self.service.register_instance(
         package_name=package_name,
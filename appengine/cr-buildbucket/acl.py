@@ -8,10 +8,13 @@ See Acl message in proto/project_config.proto.
 """
 
 import collections
+import datetime
 import logging
+import weakref
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from components import auth
+from components import utils
 from protorpc import messages
 from proto import project_config_pb2
 import config
@@ -98,6 +101,66 @@ can_delete_scheduled_builds = can_fn(Action.DELETE_SCHEDULED_BUILDS)
 ################################################################################
 ## Implementation.
 
+# How long roles of an identity are cached in a process.
+# Group membership changes take up to this long to apply.
+ROLE_CACHE_TTL = datetime.timedelta(minutes=1)
+MAX_ROLE_CACHE_SIZE = 1000
+
+# Maps (buckets version, identity) to (expiration time, {bucket: roles}).
+_role_cache = {}
+
+# Maps an ndb context to a dict of ACL decisions made within it.
+# A context lives as long as a request.
+_request_memos = weakref.WeakKeyDictionary()
+
+
+@ndb.tasklet
+def _get_roles_async(version, identity):
+  """Returns {bucket_name: frozenset of roles} of |identity|.
+
+  Roles are computed from bucket configs of |version| and cached for
+  ROLE_CACHE_TTL.
+  """
+  identity_str = identity.to_bytes()
+  cache_key = (version, identity_str)
+  now = utils.utcnow()
+  cached = _role_cache.get(cache_key)
+  if cached and cached[0] > now:
+    raise ndb.Return(cached[1])
+
+  group_membership = {}
+  roles = {}
+  buckets = yield config.get_buckets_async()
+  for bucket in buckets:
+    bucket_roles = set()
+    for rule in bucket.acls:
+      if rule.role in bucket_roles:
+        continue
+      if rule.identity == identity_str:
+        bucket_roles.add(rule.role)
+      elif rule.group:
+        if rule.group not in group_membership:
+          group_membership[rule.group] = auth.is_group_member(
+            rule.group, identity)
+        if group_membership[rule.group]:
+          bucket_roles.add(rule.role)
+    roles[bucket.name] = frozenset(bucket_roles)
+
+  if len(_role_cache) >= MAX_ROLE_CACHE_SIZE:  # pragma: no cover
+    _role_cache.clear()
+  _role_cache[cache_key] = (now + ROLE_CACHE_TTL, roles)
+  raise ndb.Return(roles)
+
+
+def _get_request_memo():
+  """Returns a dict of ACL decisions made in the current request."""
+  ctx = ndb.get_context()
+  memo = _request_memos.get(ctx)
+  if memo is None:
+    memo = {}
+    _request_memos[ctx] = memo
+  return memo
+
 
 @ndb.tasklet
 def has_any_of_roles_async(bucket, roles):
@@ -111,6 +174,11 @@ def has_any_of_roles_async(bucket, roles):
   if auth.is_admin():
     raise ndb.Return(True)
 
+  version = yield config.get_buckets_version_async()
+  if version is not None:
+    all_roles = yield _get_roles_async(version, auth.get_current_identity())
+    raise ndb.Return(bool(roles & all_roles.get(bucket, frozenset())))
+
   bucket_cfg = yield config.get_bucket_async(bucket)
   identity_str = auth.get_current_identity().to_bytes()
   if bucket_cfg:
@@ -130,6 +198,17 @@ def can_async(bucket, action):
   assert isinstance(action, Action)
 
   identity = auth.get_current_identity()
+  version = yield config.get_buckets_version_async()
+  if version is not None:
+    # Roles are cached in the process, so there is no need for memcache.
+    memo = _get_request_memo()
+    memo_key = (version, identity.to_bytes(), bucket, action)
+    result = memo.get(memo_key)
+    if result is None:
+      result = yield has_any_of_roles_async(bucket, ROLES_FOR_ACTION[action])
+      memo[memo_key] = result
+    raise ndb.Return(result)
+
   cache_key = 'acl_can/%s/%s/%s' % (bucket, identity.to_bytes(), action.name)
   ctx = ndb.get_context()
   result = yield ctx.memcache_get(cache_key)
@@ -148,7 +227,8 @@ def can(bucket, action):
 def get_available_buckets():
   """Returns buckets available to the current identity.
 
-  Results are memcached for 10 minutes per identity.
+  If bucket configs are versioned, results are computed from roles cached in
+  the process. Otherwise they are memcached for 10 minutes per identity.
 
   Returns:
     Set of bucket names or None if all buckets are available.
@@ -156,6 +236,12 @@ def get_available_buckets():
   if auth.is_admin():
     return None
 
+  version = config.get_buckets_version_async().get_result()
+  if version is not None:
+    roles = _get_roles_async(
+      version, auth.get_current_identity()).get_result()
+    return set(name for name, r in roles.iteritems() if r)
+
   identity = auth.get_current_identity().to_bytes()
   cache_key = 'available_buckets/%s' % identity
   available_buckets = memcache.get(cache_key)
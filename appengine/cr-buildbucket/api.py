@@ -138,6 +138,68 @@ def build_to_response_message(build, include_lease_key=False):
   return BuildResponseMessage(build=build_to_message(build, include_lease_key))
 
 
+class BuildBatchResponseMessage(messages.Message):
+  class OneResult(messages.Message):
+    build_id = messages.IntegerField(1, required=True)
+    build = messages.MessageField(BuildMessage, 2)
+    error = messages.MessageField(ErrorMessage, 3)
+
+  results = messages.MessageField(OneResult, 1, repeated=True)
+
+
+def batch_result_to_message(build_id, build, ex, include_lease_key=False):
+  """Converts one result of a service *_batch function to OneResult message.
+
+  Raises:
+    |ex| if it is not an errors.Error, e.g. an auth.AuthorizationError.
+  """
+  one_res = BuildBatchResponseMessage.OneResult(build_id=build_id)
+  if ex is None:
+    one_res.build = build_to_message(build, include_lease_key)
+  elif isinstance(ex, errors.Error):
+    one_res.error = exception_to_error_message(ex)
+  else:
+    raise ex
+  return one_res
+
+
+def batch_results_to_message(results):
+  """Converts (build_id, build, exception) tuples to BuildBatchResponseMessage.
+  """
+  return BuildBatchResponseMessage(
+    results=[batch_result_to_message(*r) for r in results])
+
+
+def run_batch(service_batch_fn, items, to_request):
+  """Calls a service *_batch function with the requests made from |items|.
+
+  An item that cannot be converted to a request, e.g. because it has invalid
+  JSON, gets an error result instead of failing the whole batch.
+
+  Args:
+    service_batch_fn: a service *_batch function.
+    items (list of messages.Message): request items that have build_id.
+    to_request (function): converts an item to a dict of kwargs of the
+      service function. May raise errors.InvalidInputError.
+
+  Returns:
+    List of (build_id, result, exception) tuples, one per item, in order.
+  """
+  results = [None] * len(items)
+  requests = []
+  request_indexes = []
+  for i, item in enumerate(items):
+    try:
+      requests.append(to_request(item))
+      request_indexes.append(i)
+    except errors.InvalidInputError as ex:
+      results[i] = (item.build_id, None, ex)
+  if requests:
+    for i, r in zip(request_indexes, service_batch_fn(requests)):
+      results[i] = r
+  return results
+
+
 def id_resource_container(body_message_class=message_types.VoidMessage):
   return endpoints.ResourceContainer(
     body_message_class,
@@ -259,17 +321,25 @@ class BuildBucketApi(remote.Service):
   @auth.public
   def put_batch(self, request):
     """Creates builds."""
-    build_futures = [
-      service.add_async(
+    def add_async(put_req):
+      try:
+        parameters = parse_json(put_req.parameters_json, 'parameters_json')
+        lease_expiration_date = parse_datetime(put_req.lease_expiration_ts)
+      except errors.InvalidInputError as ex:
+        # Fail only this build.
+        future = ndb.Future()
+        future.set_exception(ex)
+        return future
+      return service.add_async(
         bucket=put_req.bucket,
         tags=put_req.tags,
-        parameters=parse_json(put_req.parameters_json, 'parameters_json'),
-        lease_expiration_date=parse_datetime(put_req.lease_expiration_ts),
+        parameters=parameters,
+        lease_expiration_date=lease_expiration_date,
         client_operation_id=put_req.client_operation_id,
         pubsub_callback=pubsub_callback_from_message(put_req.pubsub_callback),
       )
-      for put_req in request.builds
-    ]
+
+    build_futures = map(add_async, request.builds)
 
     res = self.PutBatchResponseMessage()
 
@@ -383,6 +453,72 @@ class BuildBucketApi(remote.Service):
     assert build.lease_key is not None
     return build_to_response_message(build, include_lease_key=True)
 
+  ############################  PEEK AND LEASE  ################################
+
+  class PeekAndLeaseRequestMessage(messages.Message):
+    bucket = messages.StringField(1, required=True)
+    max_builds = messages.IntegerField(2, variant=messages.Variant.INT32)
+    lease_expiration_ts = messages.IntegerField(3)
+
+  class PeekAndLeaseResponseMessage(messages.Message):
+    builds = messages.MessageField(BuildMessage, 1, repeated=True)
+    error = messages.MessageField(ErrorMessage, 2)
+
+  @buildbucket_api_method(
+    PeekAndLeaseRequestMessage, PeekAndLeaseResponseMessage,
+    path='peek_and_lease', http_method='POST')
+  @auth.public
+  def peek_and_lease(self, request):
+    """Leases up to max_builds available builds in a bucket.
+
+    Returned builds include their lease keys. The list may be empty.
+    """
+    builds = service.peek_and_lease(
+      request.bucket,
+      max_builds=request.max_builds,
+      lease_expiration_date=parse_datetime(request.lease_expiration_ts),
+    )
+    return self.PeekAndLeaseResponseMessage(
+      builds=[build_to_message(b, include_lease_key=True) for b in builds])
+
+  ###############################  LEASE_BATCH  ###############################
+
+  class LeaseBatchRequestMessage(messages.Message):
+    class OneLease(messages.Message):
+      build_id = messages.IntegerField(1, required=True)
+      lease_expiration_ts = messages.IntegerField(2)
+
+    leases = messages.MessageField(OneLease, 1, repeated=True)
+
+  @buildbucket_api_method(
+    LeaseBatchRequestMessage, BuildBatchResponseMessage,
+    path='builds/lease', http_method='POST')
+  @auth.public
+  def lease_batch(self, request):
+    """Leases builds.
+
+    Results of builds that could not be leased have CANNOT_LEASE_BUILD error.
+    """
+    results = run_batch(service.lease_batch, request.leases, lambda l: {
+      'build_id': l.build_id,
+      'lease_expiration_date': parse_datetime(l.lease_expiration_ts),
+    })
+
+    res = BuildBatchResponseMessage()
+    for build_id, lease_result, ex in results:
+      if ex is None and not lease_result[0]:
+        res.results.append(res.OneResult(
+          build_id=build_id,
+          error=ErrorMessage(
+            message='Could not lease build',
+            reason=ErrorReason.CANNOT_LEASE_BUILD,
+          )))
+      else:
+        build = lease_result[1] if ex is None else None
+        res.results.append(batch_result_to_message(
+          build_id, build, ex, include_lease_key=True))
+    return res
+
   #################################  RESET  ####################################
 
   @buildbucket_api_method(
@@ -409,6 +545,27 @@ class BuildBucketApi(remote.Service):
     build = service.start(request.id, request.lease_key, url=request.url)
     return build_to_response_message(build)
 
+  class StartBatchRequestMessage(messages.Message):
+    class OneStart(messages.Message):
+      build_id = messages.IntegerField(1, required=True)
+      lease_key = messages.IntegerField(2)
+      url = messages.StringField(3)
+
+    builds = messages.MessageField(OneStart, 1, repeated=True)
+
+  @buildbucket_api_method(
+    StartBatchRequestMessage, BuildBatchResponseMessage,
+    path='builds/start', http_method='POST')
+  @auth.public
+  def start_batch(self, request):
+    """Marks builds as started."""
+    return batch_results_to_message(run_batch(
+      service.start_batch, request.builds, lambda b: {
+        'build_id': b.build_id,
+        'lease_key': b.lease_key,
+        'url': b.url,
+      }))
+
   #################################  HEARTBEAT  ################################
 
   class HeartbeatRequestBodyMessage(messages.Message):
@@ -498,6 +655,30 @@ class BuildBucketApi(remote.Service):
       url=request.url)
     return build_to_response_message(build)
 
+  class SucceedBatchRequestMessage(messages.Message):
+    class OneSucceed(messages.Message):
+      build_id = messages.IntegerField(1, required=True)
+      lease_key = messages.IntegerField(2)
+      result_details_json = messages.StringField(3)
+      url = messages.StringField(4)
+
+    builds = messages.MessageField(OneSucceed, 1, repeated=True)
+
+  @buildbucket_api_method(
+    SucceedBatchRequestMessage, BuildBatchResponseMessage,
+    path='builds/succeed', http_method='POST')
+  @auth.public
+  def succeed_batch(self, request):
+    """Marks builds as succeeded."""
+    return batch_results_to_message(run_batch(
+      service.succeed_batch, request.builds, lambda b: {
+        'build_id': b.build_id,
+        'lease_key': b.lease_key,
+        'result_details': parse_json(
+          b.result_details_json, 'result_details_json'),
+        'url': b.url,
+      }))
+
   ###################################  FAIL  ###################################
 
   class FailRequestBodyMessage(messages.Message):
@@ -521,6 +702,32 @@ class BuildBucketApi(remote.Service):
     )
     return build_to_response_message(build)
 
+  class FailBatchRequestMessage(messages.Message):
+    class OneFail(messages.Message):
+      build_id = messages.IntegerField(1, required=True)
+      lease_key = messages.IntegerField(2)
+      result_details_json = messages.StringField(3)
+      failure_reason = messages.EnumField(model.FailureReason, 4)
+      url = messages.StringField(5)
+
+    builds = messages.MessageField(OneFail, 1, repeated=True)
+
+  @buildbucket_api_method(
+    FailBatchRequestMessage, BuildBatchResponseMessage,
+    path='builds/fail', http_method='POST')
+  @auth.public
+  def fail_batch(self, request):
+    """Marks builds as failed."""
+    return batch_results_to_message(run_batch(
+      service.fail_batch, request.builds, lambda b: {
+        'build_id': b.build_id,
+        'lease_key': b.lease_key,
+        'result_details': parse_json(
+          b.result_details_json, 'result_details_json'),
+        'failure_reason': b.failure_reason,
+        'url': b.url,
+      }))
+
   ##################################  CANCEL  ##################################
 
   @buildbucket_api_method(
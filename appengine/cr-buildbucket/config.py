@@ -8,6 +8,7 @@ Stores bucket list in datastore, synchronizes it with bucket configs in
 project repositories: `projects/<project_id>:<buildbucket-app-id>.cfg`.
 """
 
+import datetime
 import hashlib
 import logging
 
@@ -127,10 +128,102 @@ def parse_bucket_config(text):
   return cfg
 
 
+class BucketsVersion(ndb.Model):
+  """Identifies the current set of Bucket entities.
+
+  Updated by cron_update_buckets() whenever a bucket is added, changed or
+  deleted. Processes use it to invalidate their bucket caches.
+
+  Entity key:
+    Root entity. Id is 1.
+  """
+  # SHA1 of names, project ids and revisions of all buckets.
+  version = ndb.StringProperty(required=True, indexed=False)
+  # Names of all buckets.
+  bucket_names = ndb.StringProperty(repeated=True, indexed=False)
+
+  @classmethod
+  def key_for(cls):
+    return ndb.Key(cls, 1)
+
+
+def compute_buckets_version(buckets):
+  """Returns a version string for a list of Bucket entities."""
+  h = hashlib.sha1()
+  for b in sorted(buckets, key=lambda b: b.key.id()):
+    h.update('%s\0%s\0%s\0' % (b.key.id(), b.project_id, b.revision))
+  return h.hexdigest()
+
+
+# How often a process checks that its bucket cache is up to date.
+BUCKET_CACHE_CHECK_INTERVAL = datetime.timedelta(seconds=30)
+
+
+class _BucketCache(object):
+  """Parsed bucket configs of one BucketsVersion."""
+
+  def __init__(self):
+    self.version = None
+    # Maps a bucket name to a project_config_pb2.Bucket.
+    self.buckets = {}
+    self.checked_at = None
+
+
+_bucket_cache = _BucketCache()
+
+
+@ndb.tasklet
+def _get_bucket_cache_async():
+  """Returns an up-to-date _BucketCache or None if buckets are not versioned.
+
+  The version is checked at most once per BUCKET_CACHE_CHECK_INTERVAL, so a
+  process may serve configs that are that much older than datastore.
+  """
+  cache = _bucket_cache
+  now = utils.utcnow()
+  if (cache.checked_at is not None and
+      now - cache.checked_at < BUCKET_CACHE_CHECK_INTERVAL):
+    raise ndb.Return(cache)
+
+  version = yield BucketsVersion.key_for().get_async()
+  if version is None:
+    raise ndb.Return(None)
+  if version.version != cache.version:
+    keys = [ndb.Key(Bucket, name) for name in version.bucket_names]
+    buckets = yield ndb.get_multi_async(keys)
+    cache.buckets = {
+      b.key.id(): parse_bucket_config(b.config_content)
+      for b in buckets
+      if b
+    }
+    cache.version = version.version
+    logging.info('Loaded bucket configs of version %s', cache.version)
+  cache.checked_at = now
+  raise ndb.Return(cache)
+
+
+@ndb.non_transactional
+@ndb.tasklet
+def get_buckets_version_async():
+  """Returns version of bucket configs served by this process.
+
+  Returns None if buckets are not versioned yet, i.e. cron_update_buckets()
+  did not run since BucketsVersion was introduced.
+  """
+  cache = yield _get_bucket_cache_async()
+  raise ndb.Return(cache.version if cache else None)
+
+
 @ndb.non_transactional
 @ndb.tasklet
 def get_buckets_async():
-  """Returns a list of project_config_pb2.Bucket objects."""
+  """Returns a list of project_config_pb2.Bucket objects.
+
+  The objects may be shared with other callers and must not be modified.
+  """
+  cache = yield _get_bucket_cache_async()
+  if cache:
+    raise ndb.Return([cache.buckets[name] for name in sorted(cache.buckets)])
   buckets = yield Bucket.query().fetch_async()
   raise ndb.Return([parse_bucket_config(b.config_content) for b in buckets])
 
@@ -138,7 +231,13 @@ def get_buckets_async():
 @ndb.non_transactional
 @ndb.tasklet
 def get_bucket_async(name):
-  """Returns a project_config_pb2.Bucket by name."""
+  """Returns a project_config_pb2.Bucket by name.
+
+  The object may be shared with other callers and must not be modified.
+  """
+  cache = yield _get_bucket_cache_async()
+  if cache:
+    raise ndb.Return(cache.buckets.get(name))
   bucket = yield Bucket.get_by_id_async(name)
   if bucket is None:
     raise ndb.Return(None)
@@ -213,3 +312,15 @@ def cron_update_buckets():
     logging.warning(
       'Deleting buckets: %s', ', '.join(k.id() for k in to_delete))
     ndb.delete_multi(to_delete)
+
+  # Bump the version so that processes reload their bucket caches.
+  buckets = [b for b in ndb.get_multi(set(existing_bucket_keys)) if b]
+  version = compute_buckets_version(buckets)
+  current = BucketsVersion.key_for().get()
+  if not current or current.version != version:
+    BucketsVersion(
+      key=BucketsVersion.key_for(),
+      version=version,
+      bucket_names=sorted(b.key.id() for b in buckets),
+    ).put()
+    logging.info('Updated buckets version to %s', version)
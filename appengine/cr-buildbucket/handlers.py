@@ -30,6 +30,30 @@ class CronResetExpiredBuilds(webapp2.RequestHandler):
     service.reset_expired_builds()
 
 
+class CronBackfillReadyQueue(webapp2.RequestHandler):
+  """Adds builds created before the ready queue existed to it."""
+
+  @decorators.require_cronjob
+  def get(self):
+    service.backfill_ready_queue()
+
+
+class CronBackfillTagIndex(webapp2.RequestHandler):
+  """Adds builds created before TagIndex existed to TagIndex."""
+
+  @decorators.require_cronjob
+  def get(self):
+    service.backfill_tag_index()
+
+
+class CronReconcileBuildCounters(webapp2.RequestHandler):
+  """Fixes build counters used for metrics by counting builds."""
+
+  @decorators.require_cronjob
+  def get(self):
+    metrics.reconcile_build_counters()
+
+
 class CronUpdateBuckets(webapp2.RequestHandler):  # pragma: no cover
   """Updates buckets from configs."""
 
@@ -58,6 +82,15 @@ def get_backend_routes():
     webapp2.Route(
       r'/internal/cron/buildbucket/reset_expired_builds',
       CronResetExpiredBuilds),
+    webapp2.Route(
+      r'/internal/cron/buildbucket/backfill_ready_queue',
+      CronBackfillReadyQueue),
+    webapp2.Route(
+      r'/internal/cron/buildbucket/backfill_tag_index',
+      CronBackfillTagIndex),
+    webapp2.Route(
+      r'/internal/cron/buildbucket/reconcile_build_counters',
+      CronReconcileBuildCounters),
     webapp2.Route(
       r'/internal/cron/buildbucket/update_buckets',
       CronUpdateBuckets),
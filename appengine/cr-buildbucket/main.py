@@ -46,6 +46,7 @@ def create_backend_app():  # pragma: no cover
       metrics.CURRENTLY_RUNNING,
       metrics.LEASE_LATENCY,
       metrics.SCHEDULING_LATENCY,
+      metrics.EXPIRATION_BACKLOG_LAG,
   ])
   gae_ts_mon.register_global_metrics_callback(
       'send_metrics', metrics.send_all_metrics)
@@ -2,8 +2,11 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import collections
 import logging
+import random
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 from components import metrics
@@ -104,16 +107,24 @@ SCHEDULING_LATENCY = gae_ts_mon.NonCumulativeDistributionMetric(
   'buildbucket/builds/scheduling_duration',
   description='Duration of a build remaining in SCHEDULED state',
 )
+EXPIRATION_LAG = gae_ts_mon.CumulativeDistributionMetric(
+  'buildbucket/builds/expiration_lag',
+  description=(
+    'Seconds between a lease expiration or build timeout deadline and the '
+    'moment the build was processed'),
+)
+EXPIRATION_BACKLOG_LAG = gae_ts_mon.FloatMetric(
+  'buildbucket/builds/expiration_backlog_lag',
+  description=(
+    'Seconds past the deadline of the oldest build whose lease expiration or '
+    'timeout is not processed yet'),
+)
 
 
 GAUGE_OF_CLOUD_METRIC = {
   METRIC_PENDING_BUILDS: CURRENTLY_PENDING,
   METRIC_RUNNING_BUILDS: CURRENTLY_RUNNING,
 }
-DISTRIBUTION_OF_CLOUD_METRIC = {
-  METRIC_LEASE_BUILD_LATENCY: LEASE_LATENCY,
-  METRIC_SCHEDULING_LATENCY: SCHEDULING_LATENCY,
-}
 
 def fields_for(build, **extra):
   fields = extra
@@ -151,56 +162,209 @@ def set_gauge(buf, bucket, metric, value):
         value, {FIELD_BUCKET: bucket}, target_fields=GLOBAL_TARGET_FIELDS)
 
 
+# What a build contributes to build counters of its bucket.
+BuildCounterState = collections.namedtuple(
+  'BuildCounterState', ['bucket', 'status', 'never_leased', 'create_time'])
+
+
+def build_counter_state(build):
+  """Returns BuildCounterState of |build| or None if it is not counted."""
+  if not build or build.status == model.BuildStatus.COMPLETED:
+    return None
+  return BuildCounterState(
+    build.bucket, build.status, bool(build.never_leased), build.create_time)
+
+
+def _to_seconds(dt):
+  return utils.datetime_to_timestamp(dt) // 1000000
+
+
+def _counter_deltas(state, sign):
+  """Returns {counter: delta} for adding (sign=1) or removing (sign=-1).
+
+  Histogram bins are keyed by (histogram, bin) tuples.
+  """
+  deltas = {}
+  if state and state.status == model.BuildStatus.SCHEDULED:
+    create_time = _to_seconds(state.create_time)
+    create_time_bin = str(create_time // model.BUILD_COUNTER_BIN_SECONDS)
+    deltas['scheduled'] = sign
+    deltas['scheduled_create_time_sum'] = sign * create_time
+    deltas[('scheduled_create_time_bins', create_time_bin)] = sign
+    if state.never_leased:
+      deltas['never_leased'] = sign
+      deltas['never_leased_create_time_sum'] = sign * create_time
+      deltas[('never_leased_create_time_bins', create_time_bin)] = sign
+  elif state and state.status == model.BuildStatus.STARTED:
+    deltas['started'] = sign
+  return deltas
+
+
+def _counter_values(counters):
+  """Returns {counter: value} of a BuildCounterShard, like _counter_deltas."""
+  values = {
+    name: getattr(counters, name)
+    for name in model.BuildCounterShard.COUNTERS
+  }
+  for name in model.BuildCounterShard.HISTOGRAMS:
+    for create_time_bin, count in (getattr(counters, name) or {}).iteritems():
+      values[(name, create_time_bin)] = count
+  return values
+
+
+def _add_deltas(counters, deltas):
+  """Adds deltas returned by _counter_deltas to a BuildCounterShard."""
+  histograms = {}
+  for name, delta in deltas.iteritems():
+    if isinstance(name, tuple):
+      name, create_time_bin = name
+      if name not in histograms:
+        histograms[name] = dict(getattr(counters, name) or {})
+      hist = histograms[name]
+      hist[create_time_bin] = hist.get(create_time_bin, 0) + delta
+      if not hist[create_time_bin]:
+        del hist[create_time_bin]
+    else:
+      setattr(counters, name, getattr(counters, name) + delta)
+  for name, hist in histograms.iteritems():
+    setattr(counters, name, hist)
+
+
+@ndb.transactional_tasklet
+def _add_to_build_counters_async(bucket, deltas):
+  key = model.BuildCounterShard.key_for(
+    bucket, random.randrange(model.BUILD_COUNTER_SHARDS))
+  shard = yield key.get_async()
+  shard = shard or model.BuildCounterShard(key=key, bucket=bucket)
+  _add_deltas(shard, deltas)
+  yield shard.put_async()
+
+
+@ndb.non_transactional
 @ndb.tasklet
-def send_build_status_metric(buf, bucket, metric, status):
-  q = model.Build.query(
-    model.Build.bucket == bucket,
-    model.Build.status == status)
-  value = yield q.count_async()
-  set_gauge(buf, bucket, metric, value)
+def record_transition_async(old_state, new_state):
+  """Updates build counters after a build changed.
+
+  Must be called after the transaction that changed the build is committed.
+  Counters are updated on a best-effort basis, reconcile_build_counters()
+  fixes them.
+
+  Args:
+    old_state (BuildCounterState): state of the build before the
+      transaction, or None if the build did not exist or was completed.
+    new_state (BuildCounterState): state of the build after the transaction,
+      or None if the build was deleted or completed.
+  """
+  deltas = collections.Counter(_counter_deltas(old_state, -1))
+  deltas.update(_counter_deltas(new_state, 1))
+  deltas = {name: d for name, d in deltas.iteritems() if d}
+  if not deltas:
+    return
+  bucket = (old_state or new_state).bucket
+  try:
+    yield _add_to_build_counters_async(bucket, deltas)
+  except datastore_errors.Error:  # pragma: no cover
+    logging.exception('Failed to update build counters of %s', bucket)
+
+
+@ndb.tasklet
+def get_build_counters_async(bucket):
+  """Returns a BuildCounterShard with counters of all shards of |bucket|."""
+  shards = yield ndb.get_multi_async(model.BuildCounterShard.all_keys(bucket))
+  total = model.BuildCounterShard(bucket=bucket)
+  for shard in shards:
+    if shard:
+      _add_deltas(total, _counter_values(shard))
+  raise ndb.Return(total)
 
 
 @ndb.tasklet
-def send_build_latency(buf, metric, bucket, must_be_never_leased):
+def _count_builds_async(bucket):
+  """Returns {counter: value} of |bucket| computed by querying builds."""
+  counts = collections.Counter()
   q = model.Build.query(
     model.Build.bucket == bucket,
-    model.Build.status == model.BuildStatus.SCHEDULED,
-  )
-  if must_be_never_leased:
-    q = q.filter(model.Build.never_leased == True)
-  else:
-    # Reuse the index that has never_leased
-    q = q.filter(model.Build.never_leased.IN((True, False)))
+    model.Build.status == model.BuildStatus.SCHEDULED)
+  started_future = model.Build.query(
+    model.Build.bucket == bucket,
+    model.Build.status == model.BuildStatus.STARTED).count_async()
+  projection = [model.Build.never_leased, model.Build.create_time]
+  for b in (yield q.fetch_async(projection=projection)):
+    state = BuildCounterState(
+      bucket, model.BuildStatus.SCHEDULED, b.never_leased, b.create_time)
+    counts.update(_counter_deltas(state, 1))
+  counts['started'] = yield started_future
+  raise ndb.Return(counts)
 
-  now = utils.utcnow()
-  avg_latency = 0.0
-  count = 0
+
+def reconcile_build_counters():
+  """Fixes build counters of all buckets by counting builds.
+
+  Counters drift if a counter update fails after a build transaction.
+  Builds that change while they are counted may leave a counter off by a few
+  until the next reconciliation.
+  """
+  for b in config.get_buckets_async().get_result():
+    actual_future = _count_builds_async(b.name)
+    counters = _counter_values(get_build_counters_async(b.name).get_result())
+    actual = actual_future.get_result()
+    deltas = {}
+    for name in set(counters) | set(actual):
+      delta = actual[name] - counters.get(name, 0)
+      if delta:
+        deltas[name] = delta
+    if deltas:
+      logging.warning('Fixing build counters of %s: %r', b.name, deltas)
+      _add_to_build_counters_async(b.name, deltas).get_result()
+
+
+def _average_age(now, count, create_time_sum):
+  """Returns average age in seconds of |count| builds."""
+  if count <= 0:
+    return 0.0
+  return max(0.0, _to_seconds(now) - float(create_time_sum) / count)
+
+
+def _age_distribution(now, hist):
+  """Returns a distribution of ages in seconds of builds in a histogram.
+
+  A build's age is measured from the middle of its create_time bin, so it is
+  off by at most BUILD_COUNTER_BIN_SECONDS / 2.
+  """
   dist = gae_ts_mon.Distribution(gae_ts_mon.GeometricBucketer())
-  for e in q.iter(projection=[model.Build.create_time]):
-    latency = (now - e.create_time).total_seconds()
-    dist.add(latency)
-    avg_latency += latency
-    count += 1
-  if count > 0:
-    avg_latency /= count
-  set_gauge(buf, bucket, metric, avg_latency)
-  DISTRIBUTION_OF_CLOUD_METRIC[metric].set(
-      dist, {FIELD_BUCKET: bucket}, target_fields=GLOBAL_TARGET_FIELDS)
+  now = _to_seconds(now)
+  for create_time_bin, count in (hist or {}).iteritems():
+    if count <= 0:
+      # Counters drifted, reconcile_build_counters() will fix them.
+      continue
+    age = max(
+      0.0, now - (int(create_time_bin) + 0.5) * model.BUILD_COUNTER_BIN_SECONDS)
+    dist.bucket_counts[dist.bucketer.bucket_for_value(age)] += count
+    dist.count += count
+    dist.sum += age * count
+  return dist
 
 
 def send_all_metrics():
   buf = metrics.Buffer()
-  futures = []
-  for b in config.get_buckets_async().get_result():
-    futures.extend([
-      send_build_status_metric(
-        buf, b.name, METRIC_PENDING_BUILDS, model.BuildStatus.SCHEDULED),
-      send_build_status_metric(
-        buf, b.name, METRIC_RUNNING_BUILDS, model.BuildStatus.STARTED),
-      send_build_latency(buf, METRIC_LEASE_BUILD_LATENCY, b.name, True),
-      send_build_latency(buf, METRIC_SCHEDULING_LATENCY, b.name, False),
-    ])
-  ndb.Future.wait_all(futures)
+  now = utils.utcnow()
+  buckets = [b.name for b in config.get_buckets_async().get_result()]
+  futures = [get_build_counters_async(b) for b in buckets]
+  for bucket, f in zip(buckets, futures):
+    counters = f.get_result()
+    set_gauge(
+      buf, bucket, METRIC_PENDING_BUILDS, max(0, counters.scheduled))
+    set_gauge(buf, bucket, METRIC_RUNNING_BUILDS, max(0, counters.started))
+    lease_latency = _average_age(
+      now, counters.never_leased, counters.never_leased_create_time_sum)
+    set_gauge(buf, bucket, METRIC_LEASE_BUILD_LATENCY, lease_latency)
+    LEASE_LATENCY.set(
+      _age_distribution(now, counters.never_leased_create_time_bins),
+      {FIELD_BUCKET: bucket}, target_fields=GLOBAL_TARGET_FIELDS)
+    scheduling_latency = _average_age(
+      now, counters.scheduled, counters.scheduled_create_time_sum)
+    set_gauge(buf, bucket, METRIC_SCHEDULING_LATENCY, scheduling_latency)
+    SCHEDULING_LATENCY.set(
+      _age_distribution(now, counters.scheduled_create_time_bins),
+      {FIELD_BUCKET: bucket}, target_fields=GLOBAL_TARGET_FIELDS)
   buf.flush()
-  for f in futures:
-    f.check_success()
@@ -14,6 +14,15 @@ from protorpc import messages
 
 BEGINING_OF_THE_WORLD = datetime.datetime(2010, 1, 1, 0, 0, 0, 0)
 BUILD_TIMEOUT = datetime.timedelta(days=1)
+# Number of shards of a bucket's ready queue, see ReadyBuild.
+READY_QUEUE_SHARDS = 16
+# Keys of tags indexed in TagIndex.
+INDEXED_TAG_KEYS = frozenset(['buildset'])
+# Number of TagIndex entities per tag.
+TAG_INDEX_SHARDS = 16
+BUILD_COUNTER_SHARDS = 16
+# Width of create_time bins of BuildCounterShard histograms, in seconds.
+BUILD_COUNTER_BIN_SECONDS = 60
 
 
 class BuildStatus(messages.Enum):
@@ -171,6 +180,175 @@ class Build(ndb.Model):
     self.leasee = None
 
 
+def is_ready(build):
+  """Returns True if |build| can be leased."""
+  return build.status == BuildStatus.SCHEDULED and not build.is_leased
+
+
+class ReadyBuild(ndb.Model):
+  """An entry of a bucket's ready queue: a build available for leasing.
+
+  A ReadyBuild exists iff its parent Build is SCHEDULED and not leased. Being a
+  child of the Build, it is added and removed in the same transactions that
+  change the build, so peeking can query these small entities instead of
+  Build.
+
+  Each bucket's queue is split into READY_QUEUE_SHARDS shards, so that
+  builders calling peek_and_lease concurrently mostly compete for different
+  builds.
+
+  Key: ndb.Key(Build, build_id, ReadyBuild, 1). Sorting by key sorts by build
+  id, i.e. newest build first.
+  """
+  bucket = ndb.StringProperty(required=True)
+  shard = ndb.IntegerProperty(required=True)
+
+  @classmethod
+  def key_for(cls, build_key):
+    return ndb.Key(cls, 1, parent=build_key)
+
+  @classmethod
+  def for_build(cls, build):
+    """Returns a new ReadyBuild for |build|."""
+    # Bits 4-19 of a build id are random, see Build.
+    shard = (build.key.id() >> 4) % READY_QUEUE_SHARDS
+    return cls(key=cls.key_for(build.key), bucket=build.bucket, shard=shard)
+
+
+def is_indexed_tag(tag):
+  """Returns True if builds with |tag| are listed in TagIndex."""
+  return tag.split(':', 1)[0] in INDEXED_TAG_KEYS
+
+
+class TagIndexEntry(ndb.Model):
+  """A build listed in a TagIndex."""
+  bucket = ndb.StringProperty(required=True, indexed=False)
+  build_id = ndb.IntegerProperty(required=True, indexed=False)
+
+
+class TagIndex(ndb.Model):
+  """A shard of the list of builds that have a tag.
+
+  Search resolves an indexed tag (see INDEXED_TAG_KEYS) through these entities
+  instead of querying Build, so that it does not scan builds of buckets the
+  caller cannot see. An entry is added before its build is stored, so entries
+  may refer to builds that do not exist.
+
+  The list of a tag is split into TAG_INDEX_SHARDS entities, so that builds
+  with the same tag scheduled concurrently mostly update different entities.
+
+  Key: ndb.Key(TagIndex, '<shard>:<tag>').
+  """
+  # Maximum number of entries in one shard.
+  MAX_ENTRIES = 1000
+
+  # True if the shard overflowed MAX_ENTRIES and its entries were dropped.
+  # Such tags are searched by querying Build.
+  permanently_incomplete = ndb.BooleanProperty(indexed=False)
+  entries = ndb.LocalStructuredProperty(TagIndexEntry, repeated=True)
+
+  @classmethod
+  def key_for(cls, tag, build_id):
+    """Returns key of the TagIndex shard that lists build |build_id|."""
+    return ndb.Key(cls, '%d:%s' % ((build_id >> 4) % TAG_INDEX_SHARDS, tag))
+
+  @classmethod
+  def all_keys(cls, tag):
+    """Returns keys of all TagIndex shards of |tag|."""
+    return [
+      ndb.Key(cls, '%d:%s' % (i, tag)) for i in xrange(TAG_INDEX_SHARDS)]
+
+
+class ReadyQueueBackfill(ndb.Model):
+  """State of adding builds created before ReadyBuild existed to the queue.
+
+  Until it is done, peek and peek_and_lease query builds instead of the ready
+  queue.
+
+  Key: ndb.Key(ReadyQueueBackfill, 1).
+  """
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  # Urlsafe cursor of Build query to resume from.
+  cursor = ndb.StringProperty(indexed=False)
+
+  @classmethod
+  def key_for(cls):
+    return ndb.Key(cls, 1)
+
+
+class TagIndexBackfill(ndb.Model):
+  """State of adding builds created before TagIndex existed to TagIndex.
+
+  Until it is done, search does not use TagIndex.
+
+  Key: ndb.Key(TagIndexBackfill, 1).
+  """
+  done = ndb.BooleanProperty(default=False, indexed=False)
+  # Urlsafe cursor of Build query to resume from.
+  cursor = ndb.StringProperty(indexed=False)
+
+  @classmethod
+  def key_for(cls):
+    return ndb.Key(cls, 1)
+
+
+class BuildCounterShard(ndb.Model):
+  """A shard of a bucket's counters of incomplete builds.
+
+  Counters are updated after each transaction that changes a build status or
+  never_leased, so metrics can be reported without querying builds. Each
+  bucket's counters are split into BUILD_COUNTER_SHARDS shards, so that
+  concurrent updates mostly write to different entities.
+
+  Counter values are sums across shards; a single shard may be negative.
+  Histograms of create_time keep how many builds were created in each
+  BUILD_COUNTER_BIN_SECONDS interval, so ages can be reported as
+  distributions.
+
+  Key: ndb.Key(BuildCounterShard, '<bucket>:<shard>').
+  """
+  # Names of counter properties.
+  COUNTERS = (
+    'scheduled',
+    'scheduled_create_time_sum',
+    'never_leased',
+    'never_leased_create_time_sum',
+    'started',
+  )
+  # Names of histogram properties. A histogram is a dict
+  # {str(create_time // BUILD_COUNTER_BIN_SECONDS): number of builds}, where
+  # create_time is in seconds since epoch. Empty bins are removed.
+  HISTOGRAMS = (
+    'scheduled_create_time_bins',
+    'never_leased_create_time_bins',
+  )
+
+  bucket = ndb.StringProperty(required=True)
+  # Number of SCHEDULED builds.
+  scheduled = ndb.IntegerProperty(default=0, indexed=False)
+  # Sum of create_time of SCHEDULED builds, in seconds since epoch.
+  scheduled_create_time_sum = ndb.IntegerProperty(default=0, indexed=False)
+  # Number of SCHEDULED builds that were never leased.
+  never_leased = ndb.IntegerProperty(default=0, indexed=False)
+  # Sum of create_time of never leased builds, in seconds since epoch.
+  never_leased_create_time_sum = ndb.IntegerProperty(
+    default=0, indexed=False)
+  # Number of STARTED builds.
+  started = ndb.IntegerProperty(default=0, indexed=False)
+  # Histogram of create_time of SCHEDULED builds.
+  scheduled_create_time_bins = ndb.JsonProperty()
+  # Histogram of create_time of never leased builds.
+  never_leased_create_time_bins = ndb.JsonProperty()
+
+  @classmethod
+  def key_for(cls, bucket, shard):
+    return ndb.Key(cls, '%s:%d' % (bucket, shard))
+
+  @classmethod
+  def all_keys(cls, bucket):
+    return [cls.key_for(bucket, i) for i in xrange(BUILD_COUNTER_SHARDS)]
+
+
 def new_build_id():
   """Returns a valid ndb.Key for a new Build.
 
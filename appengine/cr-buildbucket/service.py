@@ -4,10 +4,12 @@
 
 import datetime
 import logging
+import random
 import urlparse
 
 from google.appengine.api import taskqueue
 from google.appengine.api import modules
+from google.appengine.api import datastore_errors
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 from google.appengine.ext import ndb
@@ -25,6 +27,14 @@ import swarming
 MAX_RETURN_BUILDS = 100
 MAX_LEASE_DURATION = datetime.timedelta(hours=2)
 DEFAULT_LEASE_DURATION = datetime.timedelta(minutes=1)
+# Prefix of search cursors of results found via TagIndex.
+TAG_INDEX_CURSOR_PREFIX = 'id>'
+TAG_INDEX_BACKFILL_PAGE_SIZE = 100
+READY_QUEUE_BACKFILL_PAGE_SIZE = 100
+# Number of builds reset_expired_builds processes concurrently.
+EXPIRATION_BATCH_SIZE = 50
+# reset_expired_builds runs every minute.
+EXPIRATION_TIME_LIMIT = datetime.timedelta(seconds=50)
 
 validate_bucket_name = errors.validate_bucket_name
 
@@ -84,6 +94,19 @@ def validate_tags(tags):
       raise errors.InvalidInputError('Invalid tag "%s": does not contain ":"')
 
 
+def _update_ready_queue_async(build):
+  """Adds |build| to its bucket's ready queue or removes it from there.
+
+  Must be called in the transaction that changes |build|.
+
+  Returns:
+    A Future.
+  """
+  if model.is_ready(build):
+    return model.ReadyBuild.for_build(build).put_async()
+  return model.ReadyBuild.key_for(build.key).delete_async()
+
+
 def current_identity_cannot(action_format, *args):
   action = action_format % args
   msg = 'User %s cannot %s' % (auth.get_current_identity().to_bytes(), action)
@@ -157,12 +180,20 @@ def add_async(
     build.leasee = auth.get_current_identity()
     build.regenerate_lease_key()
 
+  # Index the build before storing it, so that a stored build is never missing
+  # from TagIndex.
+  yield _add_to_tag_index_async(build)
+
   for_swarming = yield swarming.is_for_swarming_async(build)
   if for_swarming:  # pragma: no cover
     yield swarming.create_task_async(build)
 
+  @ndb.transactional_tasklet
+  def put_new_build():
+    yield build.put_async(), _update_ready_queue_async(build)
+
   try:
-    yield build.put_async()
+    yield put_new_build()
   except:  # pragma: no cover
     # Best effort.
     if for_swarming:
@@ -171,12 +202,94 @@ def add_async(
   logging.info(
     'Build %s was created by %s', build.key.id(), identity.to_bytes())
   metrics.increment(metrics.CREATE_COUNT, build)
+  yield metrics.record_transition_async(
+    None, metrics.build_counter_state(build))
 
   if client_operation_id is not None:
     yield ctx.memcache_set(client_operation_cache_key, build.key.id(), 60)
   raise ndb.Return(build)
 
 
+@ndb.tasklet
+def _add_to_tag_index_async(build):
+  """Lists |build| in TagIndex of each of its indexed tags. Idempotent.
+
+  If a TagIndex shard cannot be updated, e.g. because of contention, a task
+  adds the build to it later, so that build creation does not fail.
+  """
+  @ndb.tasklet
+  def add_or_defer(tag):
+    try:
+      yield _add_to_tag_index_shard_async(tag, build.bucket, build.key.id())
+    except datastore_errors.Error as ex:
+      logging.warning(
+        'Could not add build %s to TagIndex of %s: %s; deferring',
+        build.key.id(), tag, ex)
+      deferred.defer(
+        _task_add_to_tag_index, tag, build.bucket, build.key.id())
+
+  yield [
+    add_or_defer(t)
+    for t in set(build.tags) if model.is_indexed_tag(t)
+  ]
+
+
+@ndb.transactional_tasklet
+def _add_to_tag_index_shard_async(tag, bucket, build_id):
+  key = model.TagIndex.key_for(tag, build_id)
+  idx = (yield key.get_async()) or model.TagIndex(key=key)
+  if idx.permanently_incomplete:
+    return
+  if any(e.build_id == build_id for e in idx.entries):
+    return
+  if len(idx.entries) >= model.TagIndex.MAX_ENTRIES:
+    logging.warning(
+      'TagIndex %s has too many entries; marking it incomplete', key.id())
+    idx.permanently_incomplete = True
+    idx.entries = []
+  else:
+    idx.entries.append(model.TagIndexEntry(bucket=bucket, build_id=build_id))
+  yield idx.put_async()
+
+
+def _task_add_to_tag_index(tag, bucket, build_id):
+  _add_to_tag_index_shard_async(tag, bucket, build_id).get_result()
+
+
+@ndb.tasklet
+def _remove_from_tag_index_async(build):
+  """Removes |build| from TagIndex of each of its indexed tags.
+
+  Best effort: search skips entries of builds that do not exist.
+  """
+  build_id = build.key.id()
+
+  @ndb.transactional_tasklet
+  def remove(tag):
+    key = model.TagIndex.key_for(tag, build_id)
+    idx = yield key.get_async()
+    if idx is None:
+      return
+    entries = [e for e in idx.entries if e.build_id != build_id]
+    if len(entries) < len(idx.entries):
+      idx.entries = entries
+      yield idx.put_async()
+
+  @ndb.tasklet
+  def remove_or_log(tag):
+    try:
+      yield remove(tag)
+    except datastore_errors.Error as ex:
+      logging.warning(
+        'Could not remove build %s from TagIndex of %s: %s',
+        build_id, tag, ex)
+
+  yield [
+    remove_or_log(t)
+    for t in set(build.tags) if model.is_indexed_tag(t)
+  ]
+
+
 def add(*args, **kwargs):
   """Sync version of add_async."""
   return add_async(*args, **kwargs).get_result()
@@ -280,8 +393,36 @@ def search(
     buckets = set(buckets)
   assert buckets is None or buckets
 
+  indexed_tags = [t for t in tags if model.is_indexed_tag(t)]
+  if (indexed_tags and
+      (not start_cursor or
+       start_cursor.startswith(TAG_INDEX_CURSOR_PREFIX)) and
+      _is_tag_index_complete()):
+
+    def matches(build):
+      return (
+        set(tags).issubset(build.tags) and
+        (buckets is None or build.bucket in buckets) and
+        (status is None or build.status == status) and
+        (result is None or build.result == result) and
+        (failure_reason is None or build.failure_reason == failure_reason) and
+        (cancelation_reason is None or
+         build.cancelation_reason == cancelation_reason) and
+        (created_by is None or build.created_by == created_by))
+
+    res = _tag_index_search(
+      indexed_tags[0], buckets, matches, max_builds, start_cursor)
+    if res is not None:
+      return res
+
   check_buckets_locally = False
   q = model.Build.query()
+  if start_cursor and start_cursor.startswith(TAG_INDEX_CURSOR_PREFIX):
+    # The cursor was returned by a TagIndex search, but TagIndex of the tag
+    # became incomplete since then. Continue after the same build.
+    start_id = _parse_tag_index_cursor(start_cursor)
+    q = q.filter(model.Build.key > ndb.Key(model.Build, start_id))
+    start_cursor = None
   for t in tags:
     if t.startswith('buildset:'):
       check_buckets_locally = True
@@ -313,6 +454,77 @@ def search(
     q, max_builds, start_cursor, predicate=local_predicate)
 
 
+def _is_tag_index_complete():
+  """Returns True if all builds are listed in TagIndex."""
+  backfill = model.TagIndexBackfill.key_for().get()
+  return bool(backfill and backfill.done)
+
+
+def _parse_tag_index_cursor(cursor):
+  """Returns the build id that a TagIndex search cursor points to."""
+  try:
+    return int(cursor[len(TAG_INDEX_CURSOR_PREFIX):])
+  except ValueError:
+    raise errors.InvalidInputError('Bad cursor "%s"' % cursor)
+
+
+def _tag_index_search(tag, buckets, predicate, max_builds, start_cursor):
+  """Searches for builds with |tag| via TagIndex.
+
+  Fetches only builds that have |tag| and are in |buckets|, so latency depends
+  on the number of such builds rather than the number of builds in buckets
+  the caller cannot see.
+
+  Args:
+    tag (str): an indexed tag.
+    buckets (set of str): buckets to search in. None means all buckets.
+    predicate (function(Build)): returns True if a build must be returned.
+    max_builds (int): maximum number of builds to return.
+    start_cursor (str): a cursor returned by a previous call.
+
+  Returns:
+    Same as search(), or None if TagIndex of |tag| is incomplete.
+  """
+  start_id = None
+  if start_cursor:
+    start_id = _parse_tag_index_cursor(start_cursor)
+
+  build_ids = set()
+  for idx in ndb.get_multi(model.TagIndex.all_keys(tag)):
+    if idx is None:
+      continue
+    if idx.permanently_incomplete:
+      return None
+    build_ids.update(
+      e.build_id for e in idx.entries
+      if (buckets is None or e.bucket in buckets) and
+      (start_id is None or e.build_id > start_id))
+
+  # Build ids decrease with time, so this is newest first, like Build queries
+  # ordered by key.
+  build_ids = sorted(build_ids)
+  builds = []
+  for i in xrange(0, len(build_ids), max_builds):
+    chunk = build_ids[i:i + max_builds]
+    fetched = ndb.get_multi([ndb.Key(model.Build, b) for b in chunk])
+    for j, build in enumerate(fetched):
+      # Entries are added before builds are stored, so a build may be absent.
+      if build and predicate(build):
+        builds.append(build)
+        if len(builds) == max_builds:
+          next_cursor = None
+          if i + j + 1 < len(build_ids):
+            next_cursor = '%s%d' % (TAG_INDEX_CURSOR_PREFIX, chunk[j])
+          return builds, next_cursor
+  return builds, None
+
+
+def _is_ready_queue_complete():
+  """Returns True if all available builds are in the ready queue."""
+  backfill = model.ReadyQueueBackfill.key_for().get()
+  return bool(backfill and backfill.done)
+
+
 def peek(buckets, max_builds=None, start_cursor=None):
   """Returns builds available for leasing in the specified |buckets|.
 
@@ -333,34 +545,147 @@ def peek(buckets, max_builds=None, start_cursor=None):
   _check_search_acls(buckets)
   max_builds = fix_max_builds(max_builds)
 
-  q = model.Build.query(
-    model.Build.status == model.BuildStatus.SCHEDULED,
-    model.Build.is_leased == False,
-    model.Build.bucket.IN(buckets),
+  if not _is_ready_queue_complete():
+    # Builds created before the ready queue existed may be missing from it.
+    q = model.Build.query(
+      model.Build.status == model.BuildStatus.SCHEDULED,
+      model.Build.is_leased == False,
+      model.Build.bucket.IN(buckets),
+    )
+    q = q.order(-model.Build.key)  # oldest first.
+    # Check once again locally because an ndb query may return an entity not
+    # satisfying the query.
+    def local_predicate(b):
+      return model.is_ready(b) and b.bucket in buckets
+    return _fetch_page(
+      q, max_builds, start_cursor, predicate=local_predicate)
+
+  q = model.ReadyBuild.query(
+    model.ReadyBuild.bucket.IN(buckets),
+    default_options=ndb.QueryOptions(keys_only=True),
   )
-  q = q.order(-model.Build.key)  # oldest first.
+  q = q.order(-model.ReadyBuild.key)  # oldest first.
+  ready_keys, next_cursor = _fetch_page(q, max_builds, start_cursor)
 
-  # Check once again locally because an ndb query may return an entity not
-  # satisfying the query.
-  def local_predicate(b):
-    return (b.status == model.BuildStatus.SCHEDULED and
-            not b.is_leased and
-            b.bucket in buckets)
+  # Check the builds because the ready queue query is eventually consistent.
+  builds = ndb.get_multi([k.parent() for k in ready_keys])
+  builds = [
+    b for b in builds
+    if b and model.is_ready(b) and b.bucket in buckets]
+  return builds, next_cursor
 
-  return _fetch_page(
-    q, max_builds, start_cursor, predicate=local_predicate)
 
+@ndb.tasklet
+def _try_lease_async(build_key, bucket, lease_expiration_date, identity):
+  """Leases the build if it is still available.
 
-def _get_leasable_build(build_id):
-  build = model.Build.get_by_id(build_id)
+  Returns:
+    A Future of the leased Build, or None if it could not be leased.
+  """
+  @ndb.transactional_tasklet
+  def txn():
+    build = yield build_key.get_async()
+    if not build or build.bucket != bucket or not model.is_ready(build):
+      raise ndb.Return((None, None))
+    old_state = metrics.build_counter_state(build)
+    build.lease_expiration_date = lease_expiration_date
+    build.regenerate_lease_key()
+    build.leasee = identity
+    build.never_leased = False
+    yield build.put_async(), _update_ready_queue_async(build)
+    raise ndb.Return((build, old_state))
+
+  try:
+    build, old_state = yield txn()
+  except datastore_errors.TransactionFailedError:
+    # Another builder is leasing it.
+    build = None
+  if build:
+    yield metrics.record_transition_async(
+      old_state, metrics.build_counter_state(build))
+  raise ndb.Return(build)
+
+
+def peek_and_lease(bucket, max_builds=None, lease_expiration_date=None):
+  """Leases up to |max_builds| builds available in |bucket|.
+
+  Tries the oldest builds of a random shard of the bucket's ready queue first,
+  then the oldest builds of the whole queue, so that concurrent callers mostly
+  compete for different builds. Each build is leased in its own transaction.
+
+  Args:
+    bucket (str): bucket to lease builds from.
+    max_builds (int): maximum number of builds to lease. Defaults to 10.
+    lease_expiration_date (datetime.datetime): lease expiration date.
+      Defaults to DEFAULT_LEASE_DURATION from now.
+
+  Returns:
+    List of leased Builds, possibly empty.
+  """
+  validate_bucket_name(bucket)
+  validate_lease_expiration_date(lease_expiration_date)
+  max_builds = fix_max_builds(max_builds)
+  if lease_expiration_date is None:
+    lease_expiration_date = utils.utcnow() + DEFAULT_LEASE_DURATION
+  if not acl.can(bucket, acl.Action.LEASE_BUILD):
+    raise current_identity_cannot('lease builds in bucket %s', bucket)
+  identity = auth.get_current_identity()
+
+  if _is_ready_queue_complete():
+    shard = random.randrange(model.READY_QUEUE_SHARDS)
+    queries = [
+      model.ReadyBuild.query(
+        model.ReadyBuild.bucket == bucket, model.ReadyBuild.shard == shard),
+      model.ReadyBuild.query(model.ReadyBuild.bucket == bucket),
+    ]
+  else:
+    # Builds created before the ready queue existed may be missing from it.
+    queries = [
+      model.Build.query(
+        model.Build.status == model.BuildStatus.SCHEDULED,
+        model.Build.is_leased == False,
+        model.Build.bucket == bucket),
+    ]
+  leased = []
+  tried = set()
+  for q in queries:
+    q = q.order(-ndb.Model.key)  # oldest first.
+    # Keys of ReadyBuilds are children of their builds' keys.
+    build_keys = [
+      k.parent() or k
+      for k in q.fetch(max_builds - len(leased), keys_only=True)]
+    build_keys = [k for k in build_keys if k not in tried]
+    tried.update(build_keys)
+    futures = [
+      _try_lease_async(k, bucket, lease_expiration_date, identity)
+      for k in build_keys]
+    leased.extend(b for b in (f.get_result() for f in futures) if b)
+    if len(leased) >= max_builds:
+      break
+
+  for build in leased:
+    logging.info(
+      'Build %s was leased by %s', build.key.id(), build.leasee.to_bytes())
+    metrics.increment(metrics.LEASE_COUNT, build)
+  return leased
+
+
+@ndb.tasklet
+def _get_leasable_build_async(build_id):
+  build = yield model.Build.get_by_id_async(build_id)
   if build is None:
     raise errors.BuildNotFoundError()
-  if not acl.can_lease_build(build):
+  if not (yield acl.can_async(build.bucket, acl.Action.LEASE_BUILD)):
     raise current_identity_cannot('lease build %s', build.key.id())
-  return build
+  raise ndb.Return(build)
 
 
-def lease(build_id, lease_expiration_date=None):
+def _get_leasable_build(build_id):
+  return _get_leasable_build_async(build_id).get_result()
+
+
+@ndb.tasklet
+def lease_async(build_id, lease_expiration_date=None):
   """Leases the build, makes it unavailable for the leasing.
 
   Changes lease_key to a different value.
@@ -373,7 +698,7 @@ def lease(build_id, lease_expiration_date=None):
       Defaults to 10 seconds from now.
 
   Returns:
-    Tuple:
+    Future of a tuple:
       success (bool): True if the build was leased
       build (ndb.Build)
   """
@@ -381,26 +706,47 @@ def lease(build_id, lease_expiration_date=None):
   if lease_expiration_date is None:
     lease_expiration_date = utils.utcnow() + DEFAULT_LEASE_DURATION
 
-  @ndb.transactional
+  @ndb.transactional_tasklet
   def try_lease():
-    build = _get_leasable_build(build_id)
+    build = yield _get_leasable_build_async(build_id)
 
     if build.status != model.BuildStatus.SCHEDULED or build.is_leased:
-      return False, build
+      raise ndb.Return((False, build, None))
 
+    old_state = metrics.build_counter_state(build)
     build.lease_expiration_date = lease_expiration_date
     build.regenerate_lease_key()
     build.leasee = auth.get_current_identity()
     build.never_leased = False
-    build.put()
-    return True, build
+    yield build.put_async(), _update_ready_queue_async(build)
+    raise ndb.Return((True, build, old_state))
 
-  leased, build = try_lease()
+  leased, build, old_state = yield try_lease()
   if leased:
     logging.info(
       'Build %s was leased by %s', build.key.id(), build.leasee.to_bytes())
     metrics.increment(metrics.LEASE_COUNT, build)
-  return leased, build
+    yield metrics.record_transition_async(
+      old_state, metrics.build_counter_state(build))
+  raise ndb.Return((leased, build))
+
+
+def lease(build_id, lease_expiration_date=None):
+  """Sync version of lease_async."""
+  return lease_async(build_id, lease_expiration_date).get_result()
+
+
+def lease_batch(leases):
+  """Leases builds in a batch.
+
+  Args:
+    leases (list of dict): list of builds to lease. Each dict is kwargs
+    for lease() method.
+
+  Returns:
+    List of (build_id, (success, build), exception) tuples.
+  """
+  return _run_batch(lease_async, leases)
 
 
 def _check_lease(build, lease_key):
@@ -410,7 +756,6 @@ def _check_lease(build, lease_key):
       build.key.id())
 
 
-@ndb.transactional
 def reset(build_id):
   """Forcibly unleases the build and resets its state. Idempotent.
 
@@ -419,24 +764,34 @@ def reset(build_id):
   Returns:
     The reset Build.
   """
-  build = _get_leasable_build(build_id)
-  if not acl.can_reset_build(build):
-    raise current_identity_cannot('reset build %s', build.key.id())
-  if build.status == model.BuildStatus.COMPLETED:
-    raise errors.BuildIsCompletedError('Cannot reset a completed build')
-  build.status = model.BuildStatus.SCHEDULED
-  build.status_changed_time = utils.utcnow()
-  build.clear_lease()
-  build.url = None
-  build.put()
-  notifications.enqueue_callback_task_if_needed(build)
+  @ndb.transactional
+  def txn():
+    build = _get_leasable_build(build_id)
+    if not acl.can_reset_build(build):
+      raise current_identity_cannot('reset build %s', build.key.id())
+    if build.status == model.BuildStatus.COMPLETED:
+      raise errors.BuildIsCompletedError('Cannot reset a completed build')
+    old_state = metrics.build_counter_state(build)
+    build.status = model.BuildStatus.SCHEDULED
+    build.status_changed_time = utils.utcnow()
+    build.clear_lease()
+    build.url = None
+    build.put()
+    _update_ready_queue_async(build).get_result()
+    notifications.enqueue_callback_task_if_needed(build)
+    return build, old_state
+
+  build, old_state = txn()
   logging.info(
     'Build %s was reset by %s',
     build.key.id(), auth.get_current_identity().to_bytes())
+  metrics.record_transition_async(
+    old_state, metrics.build_counter_state(build)).get_result()
   return build
 
 
-def start(build_id, lease_key, url=None):
+@ndb.tasklet
+def start_async(build_id, lease_key, url=None):
   """Marks build as STARTED. Idempotent.
 
   Args:
@@ -445,20 +800,21 @@ def start(build_id, lease_key, url=None):
     url (str): a URL to a build-system-specific build, viewable by a human.
 
   Returns:
-    The updated Build.
+    The updated Build as Future.
   """
   validate_lease_key(lease_key)
   validate_url(url)
 
-  @ndb.transactional
+  @ndb.transactional_tasklet
   def txn():
-    build = _get_leasable_build(build_id)
+    build = yield _get_leasable_build_async(build_id)
 
+    old_state = metrics.build_counter_state(build)
     if build.status == model.BuildStatus.STARTED:
       if build.url != url:
         build.url = url
-        build.put()
-      return build
+        yield build.put_async()
+      raise ndb.Return((build, old_state))
     elif build.status == model.BuildStatus.COMPLETED:
       raise errors.BuildIsCompletedError('Cannot start a completed build')
     assert build.status == model.BuildStatus.SCHEDULED
@@ -467,14 +823,34 @@ def start(build_id, lease_key, url=None):
     build.status = model.BuildStatus.STARTED
     build.status_changed_time = utils.utcnow()
     build.url = url
-    build.put()
+    yield build.put_async()
     notifications.enqueue_callback_task_if_needed(build)
-    return build
+    raise ndb.Return((build, old_state))
 
-  build = txn()
+  build, old_state = yield txn()
   logging.info('Build %s was started. URL: %s', build.key.id(), url)
   metrics.increment(metrics.START_COUNT, build)
-  return build
+  yield metrics.record_transition_async(
+    old_state, metrics.build_counter_state(build))
+  raise ndb.Return(build)
+
+
+def start(build_id, lease_key, url=None):
+  """Sync version of start_async."""
+  return start_async(build_id, lease_key, url=url).get_result()
+
+
+def start_batch(starts):
+  """Marks builds as STARTED in a batch.
+
+  Args:
+    starts (list of dict): list of builds to start. Each dict is kwargs
+    for start() method.
+
+  Returns:
+    List of (build_id, build, exception) tuples.
+  """
+  return _run_batch(start_async, starts)
 
 
 @ndb.tasklet
@@ -530,20 +906,31 @@ def heartbeat_batch(heartbeats):
   Returns:
     List of (build_id, build, exception) tuples.
   """
-  futures = [(h, heartbeat_async(**h)) for h in heartbeats]
+  return _run_batch(heartbeat_async, heartbeats)
+
+
+def _run_batch(fn_async, requests):
+  """Calls fn_async(**request) for all |requests| concurrently.
 
-  def get_result(hb, future):
-    build_id = hb['build_id']
+  Returns:
+    List of (build_id, result, exception) tuples, one per request.
+  """
+  futures = [(r, fn_async(**r)) for r in requests]
+  ndb.Future.wait_all([f for _, f in futures])
+
+  def get_result(req, future):
+    build_id = req['build_id']
     exc = future.get_exception()
     if not exc:
       return build_id, future.get_result(), None
     else:
       return build_id, None, exc
 
-  return [get_result(h, f) for h, f in futures]
+  return [get_result(r, f) for r, f in futures]
 
 
-def _complete(
+@ndb.tasklet
+def _complete_async(
     build_id, lease_key, result, result_details, failure_reason=None,
     url=None):
   """Marks a build as completed. Used by succeed and fail methods."""
@@ -551,20 +938,21 @@ def _complete(
   validate_url(url)
   assert result in (model.BuildResult.SUCCESS, model.BuildResult.FAILURE)
 
-  @ndb.transactional
+  @ndb.transactional_tasklet
   def txn():
-    build = _get_leasable_build(build_id)
+    build = yield _get_leasable_build_async(build_id)
 
     if build.status == model.BuildStatus.COMPLETED:
       if (build.result == result and
           build.failure_reason == failure_reason and
           build.result_details == result_details and
           build.url == url):
-        return build
+        raise ndb.Return((build, None))
       raise errors.BuildIsCompletedError(
         'Build %s has already completed' % build_id)
     _check_lease(build, lease_key)
 
+    old_state = metrics.build_counter_state(build)
     build.status = model.BuildStatus.COMPLETED
     build.status_changed_time = utils.utcnow()
     build.complete_time = utils.utcnow()
@@ -574,19 +962,20 @@ def _complete(
     build.result_details = result_details
     build.failure_reason = failure_reason
     build.clear_lease()
-    build.put()
+    yield build.put_async(), _update_ready_queue_async(build)
     notifications.enqueue_callback_task_if_needed(build)
-    return build
+    raise ndb.Return((build, old_state))
 
-  build = txn()
+  build, old_state = yield txn()
   logging.info(
     'Build %s was completed. Status: %s. Result: %s',
     build.key.id(), build.status, build.result)
   metrics.increment_complete_count(build)
-  return build
+  yield metrics.record_transition_async(old_state, None)
+  raise ndb.Return(build)
 
 
-def succeed(build_id, lease_key, result_details=None, url=None):
+def succeed_async(build_id, lease_key, result_details=None, url=None):
   """Marks a build as succeeded. Idempotent.
 
   Args:
@@ -595,13 +984,32 @@ def succeed(build_id, lease_key, result_details=None, url=None):
     result_details (dict): build result description.
 
   Returns:
-    The succeeded Build.
+    The succeeded Build as Future.
   """
-  return _complete(
+  return _complete_async(
     build_id, lease_key, model.BuildResult.SUCCESS, result_details, url=url)
 
 
-def fail(
+def succeed(build_id, lease_key, result_details=None, url=None):
+  """Sync version of succeed_async."""
+  return succeed_async(
+    build_id, lease_key, result_details=result_details, url=url).get_result()
+
+
+def succeed_batch(builds):
+  """Marks builds as succeeded in a batch.
+
+  Args:
+    builds (list of dict): list of builds to complete. Each dict is kwargs
+    for succeed() method.
+
+  Returns:
+    List of (build_id, build, exception) tuples.
+  """
+  return _run_batch(succeed_async, builds)
+
+
+def fail_async(
     build_id, lease_key, result_details=None, failure_reason=None,
     url=None):
   """Marks a build as failed. Idempotent.
@@ -614,14 +1022,36 @@ def fail(
     result_details (dict): build result description.
 
   Returns:
-    The failed Build.
+    The failed Build as Future.
   """
   failure_reason = failure_reason or model.FailureReason.BUILD_FAILURE
-  return _complete(
+  return _complete_async(
     build_id, lease_key, model.BuildResult.FAILURE, result_details,
     failure_reason, url=url)
 
 
+def fail(
+    build_id, lease_key, result_details=None, failure_reason=None,
+    url=None):
+  """Sync version of fail_async."""
+  return fail_async(
+    build_id, lease_key, result_details=result_details,
+    failure_reason=failure_reason, url=url).get_result()
+
+
+def fail_batch(builds):
+  """Marks builds as failed in a batch.
+
+  Args:
+    builds (list of dict): list of builds to complete. Each dict is kwargs
+    for fail() method.
+
+  Returns:
+    List of (build_id, build, exception) tuples.
+  """
+  return _run_batch(fail_async, builds)
+
+
 def cancel(build_id):
   """Cancels build. Does not require a lease key.
 
@@ -640,8 +1070,9 @@ def cancel(build_id):
       raise current_identity_cannot('cancel build %s', build.key.id())
     if build.status == model.BuildStatus.COMPLETED:
       if build.result == model.BuildResult.CANCELED:
-        return build
+        return build, None
       raise errors.BuildIsCompletedError('Cannot cancel a completed build')
+    old_state = metrics.build_counter_state(build)
     now = utils.utcnow()
     build.status = model.BuildStatus.COMPLETED
     build.status_changed_time = now
@@ -650,14 +1081,16 @@ def cancel(build_id):
     build.complete_time = now
     build.clear_lease()
     build.put()
+    _update_ready_queue_async(build).get_result()
     notifications.enqueue_callback_task_if_needed(build)
-    return build
+    return build, old_state
 
-  build = txn()
+  build, old_state = txn()
   logging.info(
     'Build %s was cancelled by %s', build.key.id(),
     auth.get_current_identity().to_bytes())
   metrics.increment_complete_count(build)
+  metrics.record_transition_async(old_state, None).get_result()
   return build
 
 
@@ -666,65 +1099,217 @@ def _reset_expired_build_async(build_id):
   @ndb.transactional_tasklet
   def txn():
     build = yield model.Build.get_by_id_async(build_id)
-    if not build or build.lease_expiration_date is None:  # pragma: no cover
-      return
+    if not build or build.lease_expiration_date is None:
+      raise ndb.Return((None, None))
     is_expired = build.lease_expiration_date <= utils.utcnow()
     if not is_expired:  # pragma: no cover
-      return
+      raise ndb.Return((None, None))
 
     assert build.status != model.BuildStatus.COMPLETED, (
       'Completed build is leased')
+    old_state = metrics.build_counter_state(build)
     build.clear_lease()
     build.status = model.BuildStatus.SCHEDULED
     build.status_changed_time = utils.utcnow()
     build.url = None
-    yield build.put_async()
-    raise ndb.Return(build)
+    yield build.put_async(), _update_ready_queue_async(build)
+    raise ndb.Return((build, old_state))
 
-  build = yield txn()
-  logging.info('Expired build %s was reset', build_id)
-  metrics.increment(metrics.LEASE_EXPIRATION_COUNT, build)
+  build, old_state = yield txn()
+  if build:
+    logging.info('Expired build %s was reset', build_id)
+    metrics.increment(metrics.LEASE_EXPIRATION_COUNT, build)
+    yield metrics.record_transition_async(
+      old_state, metrics.build_counter_state(build))
 
 
-@ndb.transactional_tasklet
+@ndb.tasklet
 def _timeout_async(build_id):
-  build = yield model.Build.get_by_id_async(build_id)
-  if not build or build.status == model.BuildStatus.COMPLETED:
-    return  # pragma: no cover
-
-  build.clear_lease()
-  build.status = model.BuildStatus.COMPLETED
-  build.status_changed_time = utils.utcnow()
-  build.result = model.BuildResult.CANCELED
-  build.cancelation_reason = model.CancelationReason.TIMEOUT
-  yield build.put_async()
-  logging.info('Build %s: timeout', build_id)
-  notifications.enqueue_callback_task_if_needed(build)
-  metrics.increment_complete_count(build)
+  @ndb.transactional_tasklet
+  def txn():
+    build = yield model.Build.get_by_id_async(build_id)
+    if not build or build.status == model.BuildStatus.COMPLETED:
+      raise ndb.Return((None, None))  # pragma: no cover
 
+    old_state = metrics.build_counter_state(build)
+    build.clear_lease()
+    build.status = model.BuildStatus.COMPLETED
+    build.status_changed_time = utils.utcnow()
+    build.result = model.BuildResult.CANCELED
+    build.cancelation_reason = model.CancelationReason.TIMEOUT
+    yield build.put_async(), _update_ready_queue_async(build)
+    notifications.enqueue_callback_task_if_needed(build)
+    raise ndb.Return((build, old_state))
 
-def reset_expired_builds():
-  """For all building expired builds, resets their lease_key and state."""
-  futures = []
+  build, old_state = yield txn()
+  if build:  # pragma: no branch
+    logging.info('Build %s: timeout', build_id)
+    metrics.increment_complete_count(build)
+    yield metrics.record_transition_async(old_state, None)
 
-  q = model.Build.query(
+
+def reset_expired_builds(time_limit=EXPIRATION_TIME_LIMIT):
+  """Resets builds with expired leases and times out builds running too long.
+
+  Builds are processed in the order of their deadlines, in batches of
+  EXPIRATION_BATCH_SIZE, until no build is overdue or |time_limit| passes.
+  A processed build no longer matches the queries, so the next call resumes
+  from the oldest deadline that is still unprocessed.
+
+  Expired leases are processed during the first half of |time_limit| at
+  most, so that a backlog of them does not stop builds from timing out.
+  """
+  now = utils.utcnow()
+
+  leases = model.Build.query(
     model.Build.is_leased == True,
-    model.Build.lease_expiration_date <= datetime.datetime.utcnow(),
+    model.Build.lease_expiration_date <= now,
+  ).order(model.Build.lease_expiration_date)
+  _process_overdue_builds(
+    'lease', [leases], model.Build.lease_expiration_date,
+    lambda b: b.lease_expiration_date,
+    _reset_expired_build_async, now + time_limit / 2)
+
+  # One query per status: a status.IN query is a multi-query, and those
+  # cannot be paged with cursors unless ordered by key.
+  timeouts = [
+    model.Build.query(
+      model.Build.create_time < now - model.BUILD_TIMEOUT,
+      model.Build.status == status,
+    ).order(model.Build.create_time)
+    for status in (model.BuildStatus.SCHEDULED, model.BuildStatus.STARTED)
+  ]
+  _process_overdue_builds(
+    'timeout', timeouts, model.Build.create_time,
+    lambda b: b.create_time + model.BUILD_TIMEOUT,
+    _timeout_async, now + time_limit)
+
+
+def _process_overdue_builds(
+    kind, queries, deadline_property, get_deadline, process_async, stop_time):
+  """Calls process_async(build_id) for builds matching |queries|.
+
+  Reports lag behind the deadline to metrics.
+
+  Args:
+    kind (str): value of "kind" metric field.
+    queries (list of ndb.Query): overdue builds, each ordered by
+      |deadline_property|.
+    deadline_property (ndb.Property): the only property get_deadline reads.
+    get_deadline (function(Build)): returns deadline of a build.
+    process_async (function(int)): processes a build, returns a Future.
+    stop_time (datetime.datetime): when to stop processing.
+  """
+  fields = {'kind': kind}
+  query_options = ndb.QueryOptions(
+    projection=[deadline_property],
+    batch_size=EXPIRATION_BATCH_SIZE,
   )
-  for key in q.iter(keys_only=True):
-    futures.append(_reset_expired_build_async(key.id()))
+  for query in queries:
+    curs = None
+    more = True
+    while more and utils.utcnow() < stop_time:
+      builds, curs, more = query.fetch_page(
+        EXPIRATION_BATCH_SIZE, start_cursor=curs, options=query_options)
+      now = utils.utcnow()
+      futures = [(b.key.id(), process_async(b.key.id())) for b in builds]
+      ndb.Future.wait_all([f for _, f in futures])
+      for build, (build_id, f) in zip(builds, futures):
+        if f.get_exception():  # pragma: no cover
+          logging.warning(
+            'Could not process %s of build %s: %s',
+            kind, build_id, f.get_exception())
+        else:
+          lag = (now - get_deadline(build)).total_seconds()
+          metrics.EXPIRATION_LAG.add(lag, fields)
+
+  # Builds that failed or were not reached are still in the queries.
+  backlog_lag = 0.0
+  for query in queries:
+    oldest = query.get(options=query_options)
+    if oldest:
+      backlog_lag = max(
+        backlog_lag, (utils.utcnow() - get_deadline(oldest)).total_seconds())
+  if backlog_lag:
+    logging.warning('%s processing is %.0fs behind', kind, backlog_lag)
+  metrics.EXPIRATION_BACKLOG_LAG.set(
+    backlog_lag, fields, target_fields=metrics.GLOBAL_TARGET_FIELDS)
+
+
+def backfill_ready_queue(time_limit=datetime.timedelta(minutes=5)):
+  """Adds builds created before the ready queue existed to it.
+
+  Resumes where the previous call stopped and returns after |time_limit|.
+  peek and peek_and_lease start using the ready queue when all builds are
+  processed.
+  """
+  backfill = (
+    model.ReadyQueueBackfill.key_for().get() or
+    model.ReadyQueueBackfill(key=model.ReadyQueueBackfill.key_for()))
+  if backfill.done:
+    return
 
-  too_long_ago = utils.utcnow() - model.BUILD_TIMEOUT
+  @ndb.transactional_tasklet
+  def add_if_ready(key):
+    build = yield key.get_async()
+    ready_key = model.ReadyBuild.key_for(key)
+    if build and model.is_ready(build):  # pragma: no branch
+      ready = yield ready_key.get_async()
+      if not ready:
+        yield _update_ready_queue_async(build)
+        logging.info('Added build %s to the ready queue', key.id())
+
+  # Oldest first, so that builds created by instances still running the
+  # previous version are processed too if they are created before the end.
   q = model.Build.query(
-    model.Build.create_time < too_long_ago,
-    # Cannot use >1 inequality fitlers per query.
-    model.Build.status.IN(
-      [model.BuildStatus.SCHEDULED, model.BuildStatus.STARTED]),
-  )
-  for key in q.iter(keys_only=True):
-    futures.append(_timeout_async(key.id()))
+    model.Build.status == model.BuildStatus.SCHEDULED,
+    model.Build.is_leased == False,
+  ).order(-model.Build.key)
+  curs = None
+  if backfill.cursor:
+    curs = ndb.Cursor(urlsafe=backfill.cursor)
+  start = utils.utcnow()
+  while utils.utcnow() - start < time_limit:
+    keys, curs, more = q.fetch_page(
+      READY_QUEUE_BACKFILL_PAGE_SIZE, start_cursor=curs, keys_only=True)
+    for f in [add_if_ready(k) for k in keys]:
+      f.get_result()
+    backfill.done = not more
+    backfill.cursor = curs.urlsafe() if more else None
+    backfill.put()
+    if backfill.done:
+      logging.info('Ready queue backfill is done')
+      break
+
 
-  ndb.Future.wait_all(futures)
+def backfill_tag_index(time_limit=datetime.timedelta(minutes=5)):
+  """Adds builds created before TagIndex existed to TagIndex.
+
+  Resumes where the previous call stopped and returns after |time_limit|.
+  Search starts using TagIndex when all builds are processed.
+  """
+  backfill = (
+    model.TagIndexBackfill.key_for().get() or
+    model.TagIndexBackfill(key=model.TagIndexBackfill.key_for()))
+  if backfill.done:
+    return
+
+  q = model.Build.query().order(model.Build.key)
+  curs = None
+  if backfill.cursor:
+    curs = ndb.Cursor(urlsafe=backfill.cursor)
+  start = utils.utcnow()
+  while utils.utcnow() - start < time_limit:
+    builds, curs, more = q.fetch_page(
+      TAG_INDEX_BACKFILL_PAGE_SIZE, start_cursor=curs)
+    for f in [_add_to_tag_index_async(b) for b in builds]:
+      f.get_result()
+    backfill.done = not more
+    backfill.cursor = curs.urlsafe() if more else None
+    backfill.put()
+    if backfill.done:
+      logging.info('TagIndex backfill is done')
+      break
 
 
 def delete_many_builds(bucket, status, tags=None, created_by=None):
@@ -757,8 +1342,18 @@ def _task_delete_many_builds(bucket, status, tags=None, created_by=None):
   def del_if_unchanged(key):
     build = yield key.get_async()
     if build and build.status == status:  # pragma: no branch
-      yield key.delete_async()
+      yield ndb.delete_multi_async([key, model.ReadyBuild.key_for(key)])
       logging.debug('Deleted %s', key.id())
+      raise ndb.Return(build)
+
+  @ndb.tasklet
+  def delete_async(key):
+    build = yield del_if_unchanged(key)
+    if build:  # pragma: no branch
+      yield (
+        metrics.record_transition_async(
+          metrics.build_counter_state(build), None),
+        _remove_from_tag_index_async(build))
 
   assert status in (model.BuildStatus.SCHEDULED, model.BuildStatus.STARTED)
   tags = tags or []
@@ -770,7 +1365,7 @@ def _task_delete_many_builds(bucket, status, tags=None, created_by=None):
     q = q.filter(model.Build.tags == t)
   if created_by:
     q = q.filter(model.Build.created_by == created_by)
-  q.map(del_if_unchanged, keys_only=True)
+  q.map(delete_async, keys_only=True)
 
 
 def parse_identity(identity):
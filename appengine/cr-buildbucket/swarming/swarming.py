@@ -22,12 +22,15 @@ task status updates to the topic and buildbucket will sync its state.
 Eventually both swarming task and buildbucket build will complete.
 
 Swarming does not guarantee notification delivery, so there is also a cron job
-that checks task results of all incomplete builds every 10 min.
+that checks task results of incomplete builds every 10 min, except builds
+that were updated by a notification since the previous run.
 """
 
 import base64
+import collections
 import copy
 import datetime
+import hashlib
 import json
 import logging
 import string
@@ -39,11 +42,13 @@ from components import net
 from components import utils
 from components.auth import tokens
 from google.appengine.api import app_identity
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 import webapp2
 
 import config
 import errors
+import metrics
 import model
 import notifications
 
@@ -51,6 +56,22 @@ PUBSUB_TOPIC = 'swarming'
 BUILDER_PARAMETER = 'builder_name'
 PROPERTIES_PARAMETER = 'properties'
 DEFAULT_URL_FORMAT = 'https://{swarming_hostname}/user/task/{task_id}'
+# auth.delegate_async returns tokens valid for at least 5 min.
+DELEGATION_TOKEN_TTL = datetime.timedelta(minutes=4)
+# Maximum number of concurrent task result requests CronUpdateBuilds sends to
+# one swarming server.
+MAX_CONCURRENT_RPCS_PER_HOST = 20
+# Number of builds CronUpdateBuilds loads and updates at a time.
+UPDATE_BUILDS_PAGE_SIZE = 500
+# CronUpdateBuilds skips tasks that swarming notified about within this period.
+# It is less than the cron period, so a task is polled at least every other
+# run.
+NOTIFICATION_FRESHNESS = datetime.timedelta(minutes=9)
+# Task template parameters that are the same for all builds of a builder.
+BUILDER_TEMPLATE_PARAMS = frozenset([
+  'bucket', 'builder', 'repository', 'recipe'])
+# Maximum number of compiled task templates cached in memory.
+MAX_COMPILED_TEMPLATES = 1000
 
 
 ################################################################################
@@ -61,7 +82,7 @@ DEFAULT_URL_FORMAT = 'https://{swarming_hostname}/user/task/{task_id}'
 def get_task_template_async():
   """Returns a task template (dict) if it exists, otherwise None.
 
-  A template may contain $parameters that must be expanded using format_obj().
+  A template may contain $parameters, see compile_task_template().
 
   It is stored in luci-config, services/<appid>:swarming_task_template.json.
   """
@@ -132,7 +153,6 @@ def create_task_def_async(swarming_cfg, builder_cfg, build):
   validate_swarming_param(swarming_param)
 
   # Render task template.
-  task_template = yield get_task_template_async()
   task_template_params = {
     'bucket': build.bucket,
     'builder': builder_cfg.name,
@@ -156,7 +176,11 @@ def create_task_def_async(swarming_cfg, builder_cfg, build):
 
   task_template_params = {
     k: v or '' for k, v in task_template_params.iteritems()}
-  task = format_obj(task_template, task_template_params)
+  compiled = yield _get_compiled_task_template_async({
+    k: v for k, v in task_template_params.iteritems()
+    if k in BUILDER_TEMPLATE_PARAMS
+  })
+  task = render_task_template(compiled, task_template_params)
 
   if builder_cfg.priority > 0:  # pragma: no branch
     task['priority'] = builder_cfg.priority
@@ -192,6 +216,91 @@ def create_task_def_async(swarming_cfg, builder_cfg, build):
   raise ndb.Return(task)
 
 
+def compile_task_template(template, builder_params):
+  """Prepares a task template for rendering builds of one builder.
+
+  Strings of |template| whose $parameters are all in |builder_params| are
+  expanded now. The other strings with $parameters become slots, expanded by
+  render_task_template().
+
+  Returns:
+    A tuple (template_json, slots), where template_json is a JSON string of the
+    template with the builder parameters expanded and slots is a list of
+    (path, string) tuples. A path is a list of keys and indexes of a slot.
+  """
+  slots = []
+
+  def compile_obj(obj, path):
+    if isinstance(obj, list):
+      return [compile_obj(x, path + [i]) for i, x in enumerate(obj)]
+    elif isinstance(obj, dict):
+      return {k: compile_obj(v, path + [k]) for k, v in obj.iteritems()}
+    elif isinstance(obj, basestring) and '$' in obj:
+      names = set(
+        m.group('named') or m.group('braced')
+        for m in string.Template.pattern.finditer(obj))
+      names.discard(None)
+      if names.issubset(builder_params):
+        return string.Template(obj).safe_substitute(builder_params)
+      slots.append((path, obj))
+      return obj
+    else:
+      return obj
+
+  template = compile_obj(template, [])
+  return json.dumps(template, sort_keys=True), slots
+
+
+def render_task_template(compiled, params):
+  """Returns a task definition from a compile_task_template() result.
+
+  |params| must include the builder parameters that the template was
+  compiled with.
+  """
+  template_json, slots = compiled
+  task = json.loads(template_json)
+  for path, text in slots:
+    value = string.Template(text).safe_substitute(params)
+    if not path:
+      return value
+    obj = task
+    for p in path[:-1]:
+      obj = obj[p]
+    obj[path[-1]] = value
+  return task
+
+
+# Maps (template revision, builder params hash) to a compiled task template.
+_compiled_templates = {}
+
+
+@ndb.tasklet
+def _get_compiled_task_template_async(builder_params):
+  """Returns the task template compiled for |builder_params|.
+
+  Compiled templates are cached in memory and memcache by template revision.
+  """
+  revision, text = yield component_config.get_self_config_async(
+    'swarming_task_template.json', store_last_good=True)
+  revision = revision or hashlib.sha1(text).hexdigest()
+  params_hash = hashlib.sha1(
+    json.dumps(builder_params, sort_keys=True)).hexdigest()
+  cache_key = (revision, params_hash)
+
+  compiled = _compiled_templates.get(cache_key)
+  if compiled is None:
+    ctx = ndb.get_context()
+    memcache_key = 'swarming/compiled_task_template/%s/%s' % cache_key
+    compiled = yield ctx.memcache_get(memcache_key)
+    if compiled is None:
+      compiled = compile_task_template(json.loads(text), builder_params)
+      yield ctx.memcache_set(memcache_key, compiled, time=60 * 60)
+    if len(_compiled_templates) >= MAX_COMPILED_TEMPLATES:  # pragma: no cover
+      _compiled_templates.clear()
+    _compiled_templates[cache_key] = compiled
+  raise ndb.Return(compiled)
+
+
 @ndb.tasklet
 def create_task_async(build):
   """Creates a swarming task for the build and mutates the build.
@@ -404,18 +513,26 @@ class SubNotify(webapp2.RequestHandler):
     # Update build.
     result = _load_task_result_async(
       hostname, task_id, identity=build.created_by).get_result()
+    memcache.set(
+      _notified_memcache_key(hostname, task_id), True,
+      time=NOTIFICATION_FRESHNESS.total_seconds())
 
     @ndb.transactional
     def txn(build_key):
       build = build_key.get()
       if build is None:  # pragma: no cover
-        return
+        return None, None
+      old_state = metrics.build_counter_state(build)
       if _update_build(build, result):  # pragma: no branch
         build.put()
         if build.status == model.BuildStatus.COMPLETED:  # pragma: no branch
           notifications.enqueue_callback_task_if_needed(build)
+      return build, old_state
 
-    txn(build.key)
+    build, old_state = txn(build.key)
+    if build:  # pragma: no branch
+      metrics.record_transition_async(
+        old_state, metrics.build_counter_state(build)).get_result()
 
   def stop(self, msg, *args, **kwargs):
     """Logs error, responds with HTTP 200 and stops request processing.
@@ -458,8 +575,9 @@ class CronUpdateBuilds(webapp2.RequestHandler):
     def txn(build_key):
       build = yield build_key.get_async()
       if build.status != model.BuildStatus.STARTED:  # pragma: no cover
-        return
+        raise ndb.Return((None, None))
 
+      old_state = metrics.build_counter_state(build)
       if not result:
         logging.error(
             'Task %s/%s referenced by build %s is not found',
@@ -481,15 +599,90 @@ class CronUpdateBuilds(webapp2.RequestHandler):
         yield build.put_async()
       elif _update_build(build, result):  # pragma: no branch
         yield build.put_async()
+      raise ndb.Return((build, old_state))
 
-    yield txn(build.key)
+    build, old_state = yield txn(build.key)
+    if build:  # pragma: no branch
+      yield metrics.record_transition_async(
+        old_state, metrics.build_counter_state(build))
 
-  @decorators.require_cronjob
-  def get(self):  # pragma: no cover
+  @ndb.tasklet
+  def update_builds_async(self, builds):
+    """Updates |builds| from their task results.
+
+    Skips tasks that swarming notified about recently. Requests task results
+    of builds with the same swarming server and creator with one delegation
+    token, and sends at most MAX_CONCURRENT_RPCS_PER_HOST requests to a
+    swarming server at a time.
+    """
+    notified = memcache.get_multi([
+      _notified_memcache_key(b.swarming_hostname, b.swarming_task_id)
+      for b in builds
+    ])
+    groups = collections.defaultdict(list)
+    for b in builds:
+      key = _notified_memcache_key(b.swarming_hostname, b.swarming_task_id)
+      if key not in notified:
+        groups[(b.swarming_hostname, b.created_by)].append(b)
+    logging.info(
+      'Updating %d builds, skipped %d recently notified',
+      sum(len(g) for g in groups.itervalues()), len(notified))
+
+    # Mint one token per creator before requesting task results.
+    yield [
+      _get_delegation_token_async(identity or auth.get_current_identity())
+      for identity in set(identity for _, identity in groups)
+    ]
+
+    by_host = collections.defaultdict(list)
+    for (hostname, _), group in groups.iteritems():
+      by_host[hostname].extend(group)
+
+    @ndb.tasklet
+    def update_host_builds(pending):
+      @ndb.tasklet
+      def worker():
+        while pending:
+          build = pending.pop()
+          try:
+            yield self.update_build_async(build)
+          except Exception:  # pragma: no cover
+            logging.exception('Could not update build %s', build.key.id())
+
+      workers = min(MAX_CONCURRENT_RPCS_PER_HOST, len(pending))
+      yield [worker() for _ in xrange(workers)]
+
+    yield [update_host_builds(bs) for bs in by_host.itervalues()]
+
+  @ndb.tasklet
+  def update_started_builds_async(self):
+    """Updates all started builds associated with swarming tasks.
+
+    Loads UPDATE_BUILDS_PAGE_SIZE builds at a time and loads the next page
+    while the previous one is updated, so at most two pages are in memory.
+    """
     q = model.Build.query(
       model.Build.status == model.BuildStatus.STARTED,
       model.Build.swarming_task_id != None)
-    q.map_async(self.update_build_async).get_result()
+    # The != filter makes it a multi-query, which can't be paged with
+    # cursors, so iterate over keys instead.
+    it = q.iter(keys_only=True, batch_size=UPDATE_BUILDS_PAGE_SIZE)
+    updating = None
+    while (yield it.has_next_async()):
+      keys = []
+      while len(keys) < UPDATE_BUILDS_PAGE_SIZE and (
+          yield it.has_next_async()):
+        keys.append(it.next())
+      builds = yield ndb.get_multi_async(keys)
+      if updating:
+        yield updating
+      updating = self.update_builds_async([b for b in builds if b])
+    if updating:
+      yield updating
+
+  @decorators.require_cronjob
+  def get(self):  # pragma: no cover
+    self.update_started_builds_async().get_result()
 
 
 def get_routes():  # pragma: no cover
@@ -507,13 +700,40 @@ def get_routes():  # pragma: no cover
 # Utility functions
 
 
+def _notified_memcache_key(hostname, task_id):
+  return 'swarming/notified/%s/%s' % (hostname, task_id)
+
+
+# Maps identity to (delegation token, expiration time).
+_delegation_tokens = {}
+
+
 @ndb.tasklet
-def _call_api_async(hostname, path, method='GET', payload=None, identity=None):
-  identity = identity or auth.get_current_identity()
-  delegation_token = yield auth.delegate_async(
+def _get_delegation_token_async(identity):
+  """Returns a delegation token impersonating |identity|.
+
+  Tokens are cached in memory for DELEGATION_TOKEN_TTL.
+  """
+  now = utils.utcnow()
+  cached = _delegation_tokens.get(identity)
+  if cached and cached[1] > now:
+    raise ndb.Return(cached[0])
+
+  token = yield auth.delegate_async(
     audience=[_self_identity()],
     impersonate=identity,
   )
+  for i, (_, expiration) in _delegation_tokens.items():
+    if expiration <= now:
+      del _delegation_tokens[i]
+  _delegation_tokens[identity] = (token, now + DELEGATION_TOKEN_TTL)
+  raise ndb.Return(token)
+
+
+@ndb.tasklet
+def _call_api_async(hostname, path, method='GET', payload=None, identity=None):
+  identity = identity or auth.get_current_identity()
+  delegation_token = yield _get_delegation_token_async(identity)
   url = 'https://%s/_ah/api/swarming/v1/%s' % (hostname, path)
   try:
     res = yield net.json_request_async(
@@ -536,22 +756,6 @@ def _self_identity():
   return auth.Identity('user', app_identity.get_service_account_name())
 
 
-def format_obj(obj, params):
-  """Evaluates all strings in a JSON-like object as a template."""
-
-  def transform(obj):
-    if isinstance(obj, list):
-      return map(transform, obj)
-    elif isinstance(obj, dict):
-      return {k: transform(v) for k, v in obj.iteritems()}
-    elif isinstance(obj, basestring):
-      return string.Template(obj).safe_substitute(params)
-    else:
-      return obj
-
-  return transform(obj)
-
-
 def _extend_unique(target, items):
   for x in items:
     if x not in target:  # pragma: no branch
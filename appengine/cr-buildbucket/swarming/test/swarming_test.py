@@ -3,6 +3,7 @@
 # found in the LICENSE file.
 
 import base64
+import collections
 import contextlib
 import datetime
 import json
@@ -11,6 +12,7 @@ from components import auth
 from components import config as config_component
 from components import net
 from components import utils
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from testing_utils import testing
 from webob import exc
@@ -89,6 +91,8 @@ class SwarmingTest(testing.AppengineTestCase):
 
     self.mock(auth, 'delegate_async', mock.Mock())
     auth.delegate_async.return_value = futuristic('blah')
+    self.mock(swarming, '_delegation_tokens', {})
+    self.mock(swarming, '_compiled_templates', {})
 
   def test_is_for_swarming(self):
     build = model.Build(
@@ -234,6 +238,69 @@ class SwarmingTest(testing.AppengineTestCase):
     self.assertEqual(
       build.url, 'https://example.com/chromium-swarm.appspot.com/deadbeef')
 
+  def test_compile_task_template(self):
+    template = {
+      'name': 'buildbucket-$bucket-${builder}',
+      'static': 'no params',
+      'escaped': '$$bucket',
+      'number': 42,
+      'args': ['-revision', '$revision', '-recipe', '$recipe'],
+      'nested': {'props': '$builder:$properties_json'},
+    }
+    builder_params = {'bucket': 'b', 'builder': 'linux', 'recipe': 'r'}
+    compiled = swarming.compile_task_template(template, builder_params)
+
+    template_json, slots = compiled
+    self.assertEqual(
+      sorted(slots),
+      [
+        (['args', 1], '$revision'),
+        (['nested', 'props'], '$builder:$properties_json'),
+      ])
+    self.assertEqual(json.loads(template_json)['name'], 'buildbucket-b-linux')
+
+    params = dict(builder_params, revision='deadbeef', properties_json='{}')
+    self.assertEqual(
+      swarming.render_task_template(compiled, params),
+      {
+        'name': 'buildbucket-b-linux',
+        'static': 'no params',
+        'escaped': '$bucket',
+        'number': 42,
+        'args': ['-revision', 'deadbeef', '-recipe', 'r'],
+        'nested': {'props': 'linux:{}'},
+      })
+
+  def test_render_task_template_string(self):
+    compiled = swarming.compile_task_template('$revision', {})
+    self.assertEqual(
+      swarming.render_task_template(compiled, {'revision': 'a'}), 'a')
+
+  def test_create_task_def_async_caches_compiled_template(self):
+    build = model.Build(
+      bucket='bucket',
+      parameters={'builder_name': 'builder'},
+    )
+    bucket_cfg = config.get_bucket_async('bucket').get_result()
+    builder_cfg = bucket_cfg.swarming.builders[0]
+    compile_task_template = mock.Mock(wraps=swarming.compile_task_template)
+    self.mock(swarming, 'compile_task_template', compile_task_template)
+
+    def create_task_def():
+      return swarming.create_task_def_async(
+        bucket_cfg.swarming, builder_cfg, build).get_result()
+
+    task1 = create_task_def()
+    task2 = create_task_def()
+    self.assertEqual(compile_task_template.call_count, 1)
+    self.assertEqual(task1['name'], 'buildbucket-bucket-builder')
+    self.assertEqual(task1['properties'], task2['properties'])
+
+    # Another instance reads it from memcache.
+    swarming._compiled_templates.clear()
+    create_task_def()
+    self.assertEqual(compile_task_template.call_count, 1)
+
   def test_create_task_async_on_leased_build(self):
     build = model.Build(
       bucket='bucket',
@@ -475,6 +542,8 @@ class SubNotifyTest(testing.AppengineTestCase):
     build = build.key.get()
     self.assertEqual(build.status, model.BuildStatus.COMPLETED)
     self.assertEqual(build.result, model.BuildResult.SUCCESS)
+    self.assertTrue(memcache.get(swarming._notified_memcache_key(
+      'chromium-swarm.appspot.com', 'deadbeef')))
 
   def test_post_without_valid_auth_token(self):
     self.handler.request = mock.Mock(json={
@@ -547,6 +616,9 @@ class CronUpdateTest(testing.AppengineTestCase):
       leasee=auth.Anonymous,
     )
     self.build.put()
+    self.mock(swarming, '_delegation_tokens', {})
+    self.mock(auth, 'delegate_async', mock.Mock())
+    auth.delegate_async.return_value = futuristic('token')
 
   def test_update_build_async(self):
     self.mock(swarming, '_load_task_result_async', mock.Mock())
@@ -576,6 +648,116 @@ class CronUpdateTest(testing.AppengineTestCase):
     self.assertIsNone(build.lease_key)
     self.assertIsNotNone(build.complete_time)
 
+  def put_build(self, hostname, task_id, created_by):
+    build = model.Build(
+      bucket='bucket',
+      swarming_hostname=hostname,
+      swarming_task_id=task_id,
+      status=model.BuildStatus.STARTED,
+      created_by=auth.Identity('user', created_by),
+    )
+    build.put()
+    return build
+
+  def test_update_builds_async(self):
+    self.build.key.delete()
+    builds = [
+      self.put_build('a.example.com', 'a1', 'john@example.com'),
+      self.put_build('a.example.com', 'a2', 'john@example.com'),
+      self.put_build('a.example.com', 'a3', 'jane@example.com'),
+      self.put_build('b.example.com', 'b1', 'john@example.com'),
+      self.put_build('b.example.com', 'b2', 'jane@example.com'),
+    ]
+    memcache.set(swarming._notified_memcache_key('b.example.com', 'b2'), True)
+
+    results = {
+      'a1': {'state': 'COMPLETED'},
+      'a2': {'state': 'RUNNING'},
+      'a3': {'state': 'COMPLETED', 'failure': True},
+      'b1': {'state': 'CANCELED'},
+    }
+    self.mock(swarming, '_load_task_result_async', mock.Mock(
+      side_effect=lambda hostname, task_id, identity: futuristic(
+        results[task_id])))
+
+    swarming.CronUpdateBuilds().update_builds_async(builds).get_result()
+
+    self.assertEqual(
+      sorted(c[0][1] for c in swarming._load_task_result_async.call_args_list),
+      ['a1', 'a2', 'a3', 'b1'])
+    # One token per creator.
+    self.assertEqual(auth.delegate_async.call_count, 2)
+
+    builds = [b.key.get() for b in builds]
+    self.assertEqual(builds[0].result, model.BuildResult.SUCCESS)
+    self.assertEqual(builds[1].status, model.BuildStatus.STARTED)
+    self.assertEqual(builds[2].result, model.BuildResult.FAILURE)
+    self.assertEqual(builds[3].result, model.BuildResult.CANCELED)
+    self.assertEqual(builds[4].status, model.BuildStatus.STARTED)
+
+  def test_update_builds_async_limits_concurrency(self):
+    self.mock(swarming, 'MAX_CONCURRENT_RPCS_PER_HOST', 2)
+    builds = [
+      self.put_build('a.example.com', 'a%d' % i, 'john@example.com')
+      for i in xrange(5)
+    ]
+    in_flight = collections.Counter()
+    max_in_flight = collections.Counter()
+
+    @ndb.tasklet
+    def load_task_result_async(hostname, task_id, identity):
+      in_flight[hostname] += 1
+      max_in_flight[hostname] = max(
+        max_in_flight[hostname], in_flight[hostname])
+      yield ndb.sleep(0)
+      in_flight[hostname] -= 1
+      raise ndb.Return({'state': 'RUNNING'})
+
+    self.mock(swarming, '_load_task_result_async', load_task_result_async)
+    swarming.CronUpdateBuilds().update_builds_async(builds).get_result()
+    self.assertEqual(max_in_flight['a.example.com'], 2)
+
+  def test_update_started_builds_async(self):
+    self.mock(swarming, 'UPDATE_BUILDS_PAGE_SIZE', 2)
+    self.build.key.delete()
+    builds = [
+      self.put_build('a.example.com', 'a%d' % i, 'john@example.com')
+      for i in xrange(5)
+    ]
+    model.Build(bucket='chromium', status=model.BuildStatus.STARTED).put()
+    completed = self.put_build('a.example.com', 'c', 'john@example.com')
+    completed.status = model.BuildStatus.COMPLETED
+    completed.result = model.BuildResult.SUCCESS
+    completed.put()
+
+    pages = []
+    handler = swarming.CronUpdateBuilds()
+    def update_builds_async(page):
+      pages.append(sorted(b.key.id() for b in page))
+      return futuristic(None)
+    self.mock(handler, 'update_builds_async', update_builds_async)
+
+    handler.update_started_builds_async().get_result()
+    self.assertEqual([2, 2, 1], map(len, pages))
+    self.assertEqual(
+      sorted(b.key.id() for b in builds), sorted(sum(pages, [])))
+
+  def test_delegation_token_cache(self):
+    identity = auth.Identity('user', 'john@example.com')
+    now = datetime.datetime(2015, 11, 30)
+    self.mock(utils, 'utcnow', lambda: now)
+
+    get_token = lambda: (
+      swarming._get_delegation_token_async(identity).get_result())
+    self.assertEqual(get_token(), 'token')
+    self.assertEqual(get_token(), 'token')
+    self.assertEqual(auth.delegate_async.call_count, 1)
+
+    now += swarming.DELEGATION_TOKEN_TTL
+    auth.delegate_async.return_value = futuristic('token2')
+    self.assertEqual(get_token(), 'token2')
+    self.assertEqual(auth.delegate_async.call_count, 2)
+
 
 def b64json(data):
   return base64.b64encode(json.dumps(data))
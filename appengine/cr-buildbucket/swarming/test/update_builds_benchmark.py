@@ -0,0 +1,181 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark of CronUpdateBuilds polling against a fake Swarming server.
+
+Compares updating builds one by one with a new delegation token per task, as
+CronUpdateBuilds.get used to do, with CronUpdateBuilds.update_builds_async, and
+with CronUpdateBuilds.update_started_builds_async that also loads the builds
+page by page.
+
+Usage (from appengine/cr-buildbucket, with the App Engine SDK in PYTHONPATH):
+  python -m swarming.test.update_builds_benchmark --builds 1000
+"""
+
+import argparse
+import collections
+import datetime
+import random
+import time
+import urlparse
+
+from components import auth
+from components import net
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from swarming import swarming
+import model
+
+
+class FakeSwarming(object):
+  """Serves task results with a fixed latency and limited capacity per host.
+
+  Requests above the capacity of a host wait until a slot is free, like on an
+  overloaded server.
+  """
+
+  def __init__(self, latency, capacity):
+    self.latency = latency
+    self.capacity = capacity
+    self.requests = 0
+    self.in_flight = collections.Counter()
+    self.max_in_flight = collections.Counter()
+
+  @ndb.tasklet
+  def json_request_async(self, url, **_kwargs):
+    hostname = urlparse.urlparse(url).netloc
+    self.requests += 1
+    while self.in_flight[hostname] >= self.capacity:
+      yield ndb.sleep(self.latency / 10)
+    self.in_flight[hostname] += 1
+    self.max_in_flight[hostname] = max(
+        self.max_in_flight[hostname], self.in_flight[hostname])
+    try:
+      yield ndb.sleep(self.latency)
+    finally:
+      self.in_flight[hostname] -= 1
+    raise ndb.Return({'state': 'RUNNING'})
+
+
+class FakeTokenServer(object):
+  """Mints delegation tokens with a fixed latency."""
+
+  def __init__(self, latency):
+    self.latency = latency
+    self.tokens = 0
+
+  @ndb.tasklet
+  def delegate_async(self, **_kwargs):
+    self.tokens += 1
+    yield ndb.sleep(self.latency)
+    raise ndb.Return('token%d' % self.tokens)
+
+
+def put_builds(count, hosts, identities, notified_fraction):
+  builds = []
+  for i in xrange(count):
+    builds.append(model.Build(
+        bucket='bucket',
+        status=model.BuildStatus.STARTED,
+        swarming_hostname='swarming%d.example.com' % (i % hosts),
+        swarming_task_id='task%d' % i,
+        created_by=auth.Identity(
+            'user', 'user%d@example.com' % random.randrange(identities)),
+    ))
+  ndb.put_multi(builds)
+  for b in random.sample(builds, int(count * notified_fraction)):
+    memcache.set(
+        swarming._notified_memcache_key(b.swarming_hostname,
+                                        b.swarming_task_id),
+        True)
+  return builds
+
+
+def update_one_by_one(builds):
+  # Disable the delegation token cache.
+  ttl = swarming.DELEGATION_TOKEN_TTL
+  swarming.DELEGATION_TOKEN_TTL = datetime.timedelta(0)
+  try:
+    handler = swarming.CronUpdateBuilds()
+    ndb.Future.wait_all([handler.update_build_async(b) for b in builds])
+  finally:
+    swarming.DELEGATION_TOKEN_TTL = ttl
+
+
+def update_batched(builds):
+  swarming.CronUpdateBuilds().update_builds_async(builds).get_result()
+
+
+def update_paged(_builds):
+  # Loads the builds from the datastore page by page, like
+  # CronUpdateBuilds.get.
+  swarming.CronUpdateBuilds().update_started_builds_async().get_result()
+
+
+MODES = collections.OrderedDict([
+    ('one_by_one', update_one_by_one),
+    ('batched', update_batched),
+    ('paged', update_paged),
+])
+
+
+def run_benchmark(mode, args):
+  """Returns (seconds, FakeSwarming, FakeTokenServer) of one run."""
+  tb = testbed.Testbed()
+  tb.activate()
+  try:
+    tb.init_app_identity_stub()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+
+    swarming._delegation_tokens.clear()
+    server = FakeSwarming(args.latency, args.capacity)
+    token_server = FakeTokenServer(args.token_latency)
+    orig_request, orig_delegate = net.json_request_async, auth.delegate_async
+    net.json_request_async = server.json_request_async
+    auth.delegate_async = token_server.delegate_async
+    try:
+      builds = put_builds(
+          args.builds, args.hosts, args.identities, args.notified_fraction)
+      start = time.time()
+      MODES[mode](builds)
+      return time.time() - start, server, token_server
+    finally:
+      net.json_request_async = orig_request
+      auth.delegate_async = orig_delegate
+  finally:
+    tb.deactivate()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--builds', type=int, default=1000)
+  parser.add_argument('--hosts', type=int, default=2,
+                      help='number of swarming servers')
+  parser.add_argument('--identities', type=int, default=20,
+                      help='number of distinct build creators')
+  parser.add_argument('--notified-fraction', type=float, default=0.5,
+                      help='fraction of tasks recently updated via PubSub')
+  parser.add_argument('--latency', type=float, default=0.05,
+                      help='swarming response time, in seconds')
+  parser.add_argument('--capacity', type=int, default=50,
+                      help='concurrent requests a swarming server serves')
+  parser.add_argument('--token-latency', type=float, default=0.1,
+                      help='delegation token minting time, in seconds')
+  args = parser.parse_args()
+
+  print '%-12s %10s %10s %8s %16s' % (
+      'mode', 'seconds', 'requests', 'tokens', 'max in flight')
+  for mode in MODES:
+    elapsed, server, token_server = run_benchmark(mode, args)
+    print '%-12s %10.3f %10d %8d %16d' % (
+        mode, elapsed, server.requests, token_server.tokens,
+        max(server.max_in_flight.values() or [0]))
+
+
+if __name__ == '__main__':
+  main()
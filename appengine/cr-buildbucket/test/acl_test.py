@@ -2,7 +2,11 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import datetime
+import weakref
+
 from components import auth
+from components import utils
 from testing_utils import testing
 import mock
 
@@ -24,6 +28,10 @@ class AclTest(testing.AppengineTestCase):
     self.current_identity = auth.Identity.from_bytes('user:a@example.com')
     self.mock(auth, 'get_current_identity', lambda: self.current_identity)
     self.mock(auth, 'is_admin', lambda: False)
+    self.mock(acl, '_role_cache', {})
+    self.mock(acl, '_request_memos', weakref.WeakKeyDictionary())
+    self.now = datetime.datetime(2016, 1, 1)
+    self.mock(utils, 'utcnow', lambda: self.now)
 
     self.mock(config, 'get_buckets_async', mock.Mock())
     bucket_a = Bucket(
@@ -80,6 +88,45 @@ class AclTest(testing.AppengineTestCase):
     self.mock(auth, 'is_admin', lambda *_: True)
     self.assertTrue(has_any_of_roles('a', [Acl.WRITER]))
 
+  def mock_buckets_version(self):
+    self.mock(config, 'get_buckets_version_async', lambda: future('v1'))
+
+  def test_has_any_of_roles_versioned(self):
+    self.mock_buckets_version()
+    self.mock_is_group_member(['a-readers'])
+
+    has_any_of_roles = (
+      lambda *args: acl.has_any_of_roles_async(*args).get_result())
+
+    self.assertTrue(has_any_of_roles('a', [Acl.READER]))
+    self.assertTrue(has_any_of_roles('a', [Acl.READER, Acl.WRITER]))
+    self.assertFalse(has_any_of_roles('a', [Acl.WRITER]))
+    self.assertFalse(has_any_of_roles('b', [Acl.READER]))
+    self.assertTrue(has_any_of_roles('c', [Acl.READER]))
+    self.assertFalse(has_any_of_roles('c', [Acl.WRITER]))
+    self.assertFalse(has_any_of_roles('non.existing', [Acl.READER]))
+
+    # Roles are cached for ROLE_CACHE_TTL.
+    self.mock_is_group_member([])
+    self.assertTrue(has_any_of_roles('a', [Acl.READER]))
+    self.now += acl.ROLE_CACHE_TTL
+    self.assertFalse(has_any_of_roles('a', [Acl.READER]))
+
+  def test_has_any_of_roles_new_version(self):
+    self.mock_buckets_version()
+    self.mock_is_group_member(['a-readers'])
+    self.assertTrue(acl.has_any_of_roles_async('a', [Acl.READER]).get_result())
+
+    self.mock(config, 'get_buckets_version_async', lambda: future('v2'))
+    config.get_buckets_async.return_value = future([Bucket(name='a')])
+    self.assertFalse(
+      acl.has_any_of_roles_async('a', [Acl.READER]).get_result())
+
+  def test_get_available_buckets_versioned(self):
+    self.mock_buckets_version()
+    self.mock_is_group_member(['a-readers'])
+    self.assertEqual(acl.get_available_buckets(), {'a', 'c'})
+
   def test_get_available_buckets(self):
     self.mock_is_group_member(['xxx', 'yyy'])
 
@@ -143,6 +190,18 @@ class AclTest(testing.AppengineTestCase):
     for action in acl.Action:
       self.assertFalse(acl.can('bucket', action))
 
+  def test_can_versioned(self):
+    self.mock_buckets_version()
+    self.mock_has_any_of_roles([Acl.READER])
+    self.assertTrue(acl.can('bucket', acl.Action.VIEW_BUILD))
+    self.assertFalse(acl.can('bucket', acl.Action.CANCEL_BUILD))
+
+    # Decisions are memoized for the rest of the request.
+    self.mock_has_any_of_roles([Acl.WRITER])
+    self.assertTrue(acl.can('bucket', acl.Action.VIEW_BUILD))
+    self.assertFalse(acl.can('bucket', acl.Action.CANCEL_BUILD))
+    self.assertTrue(acl.can('bucket', acl.Action.LEASE_BUILD))
+
   def test_can_bad_input(self):
     with self.assertRaises(errors.InvalidInputError):
       acl.can('bad bucket name', acl.Action.VIEW_BUILD)
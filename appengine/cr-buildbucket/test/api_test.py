@@ -204,6 +204,30 @@ class BuildBucketApiTest(testing.EndpointsTestCase):
       'error': {'reason': 'INVALID_INPUT', 'message': 'Just bad'},
     })
 
+  def test_put_batch_with_malformed_parameters_json(self):
+    build_future = ndb.Future()
+    build_future.set_result(self.test_build)
+    service.add_async.return_value = build_future
+    req = {
+      'builds': [
+        {
+          'bucket': self.test_build.bucket,
+          'client_operation_id': '0',
+        },
+        {
+          'bucket': self.test_build.bucket,
+          'parameters_json': '}non-json',
+          'client_operation_id': '1',
+        },
+      ],
+    }
+    resp = self.call_api('put_batch', req).json_body
+    self.assertEqual(1, service.add_async.call_count)
+    res0, res1 = resp['results']
+    self.assertEqual(res0['build']['id'], str(self.test_build.key.id()))
+    self.assertEqual(res1['client_operation_id'], '1')
+    self.assertEqual(res1['error']['reason'], 'INVALID_INPUT')
+
   #################################### SEARCH ##################################
 
   def test_search(self):
@@ -290,6 +314,91 @@ class BuildBucketApiTest(testing.EndpointsTestCase):
     }
     self.expect_error('lease', req, 'CANNOT_LEASE_BUILD')
 
+  ################################# LEASE_BATCH ################################
+
+  def test_lease_batch(self):
+    self.test_build.lease_expiration_date = self.future_date
+    self.test_build.lease_key = 42
+    build2 = model.Build(id=2, bucket='chromium')
+    service.lease_batch.return_value = [
+      (self.test_build.key.id(), (True, self.test_build), None),
+      (build2.key.id(), (False, build2), None),
+      (3, None, errors.BuildNotFoundError()),
+    ]
+
+    req = {
+      'leases': [{
+        'build_id': self.test_build.key.id(),
+        'lease_expiration_ts': self.future_ts,
+      }, {
+        'build_id': build2.key.id(),
+      }, {
+        'build_id': 3,
+      }],
+    }
+    res = self.call_api('lease_batch', req).json_body
+    service.lease_batch.assert_called_once_with([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_expiration_date': self.future_date,
+      },
+      {'build_id': build2.key.id(), 'lease_expiration_date': None},
+      {'build_id': 3, 'lease_expiration_date': None},
+    ])
+
+    res0 = res['results'][0]
+    self.assertEqual(int(res0['build_id']), self.test_build.key.id())
+    self.assertEqual(res0['build']['lease_key'], '42')
+    self.assertIsNone(res0.get('error'))
+
+    res1 = res['results'][1]
+    self.assertEqual(int(res1['build_id']), build2.key.id())
+    self.assertIsNone(res1.get('build'))
+    self.assertEqual(res1['error']['reason'], 'CANNOT_LEASE_BUILD')
+
+    res2 = res['results'][2]
+    self.assertEqual(int(res2['build_id']), 3)
+    self.assertEqual(res2['error']['reason'], 'BUILD_NOT_FOUND')
+
+  def test_lease_batch_with_internal_server_error(self):
+    service.lease_batch.return_value = [
+      (self.test_build.key.id(), None, ValueError())
+    ]
+    req = {
+      'leases': [{'build_id': self.test_build.key.id()}],
+    }
+    with self.call_should_fail(500):
+      self.call_api('lease_batch', req)
+
+  ############################### PEEK AND LEASE ###############################
+
+  def test_peek_and_lease(self):
+    self.test_build.lease_expiration_date = self.future_date
+    self.test_build.lease_key = 42
+    service.peek_and_lease.return_value = [self.test_build]
+
+    req = {
+      'bucket': 'chromium',
+      'max_builds': 5,
+      'lease_expiration_ts': self.future_ts,
+    }
+    res = self.call_api('peek_and_lease', req).json_body
+    service.peek_and_lease.assert_called_once_with(
+      'chromium',
+      max_builds=5,
+      lease_expiration_date=self.future_date,
+    )
+    self.assertIsNone(res.get('error'))
+    self.assertEqual(len(res['builds']), 1)
+    self.assertEqual(res['builds'][0]['id'], str(self.test_build.key.id()))
+    self.assertEqual(res['builds'][0]['lease_key'], '42')
+
+  def test_peek_and_lease_nothing(self):
+    service.peek_and_lease.return_value = []
+    res = self.call_api('peek_and_lease', {'bucket': 'chromium'}).json_body
+    self.assertIsNone(res.get('error'))
+    self.assertNotIn('builds', res)
+
   #################################### RESET ###################################
 
   def test_reset(self):
@@ -328,6 +437,41 @@ class BuildBucketApiTest(testing.EndpointsTestCase):
     res = self.call_api('start', req).json_body
     self.assertEqual(res['error']['reason'], 'BUILD_IS_COMPLETED')
 
+  def test_start_batch(self):
+    self.test_build.url = 'http://localhost/build/1'
+    service.start_batch.return_value = [
+      (self.test_build.key.id(), self.test_build, None),
+      (2, None, errors.BuildIsCompletedError()),
+    ]
+    req = {
+      'builds': [{
+        'build_id': self.test_build.key.id(),
+        'lease_key': 42,
+        'url': self.test_build.url,
+      }, {
+        'build_id': 2,
+        'lease_key': 42,
+      }],
+    }
+    res = self.call_api('start_batch', req).json_body
+    service.start_batch.assert_called_once_with([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_key': 42,
+        'url': self.test_build.url,
+      },
+      {'build_id': 2, 'lease_key': 42, 'url': None},
+    ])
+
+    res0 = res['results'][0]
+    self.assertEqual(int(res0['build']['id']), self.test_build.key.id())
+    self.assertEqual(res0['build']['url'], self.test_build.url)
+    self.assertIsNone(res0['build'].get('lease_key'))
+
+    res1 = res['results'][1]
+    self.assertEqual(int(res1['build_id']), 2)
+    self.assertEqual(res1['error']['reason'], 'BUILD_IS_COMPLETED')
+
   #################################### HEATBEAT ################################
 
   def test_heartbeat(self):
@@ -429,6 +573,85 @@ class BuildBucketApiTest(testing.EndpointsTestCase):
     self.assertEqual(
       res['build']['result_details_json'], req['result_details_json'])
 
+  def test_succeed_batch(self):
+    self.test_build.result_details = {'test_coverage': 100}
+    service.succeed_batch.return_value = [
+      (self.test_build.key.id(), self.test_build, None),
+      (2, None, errors.LeaseExpiredError()),
+    ]
+    req = {
+      'builds': [{
+        'build_id': self.test_build.key.id(),
+        'lease_key': 42,
+        'result_details_json': json.dumps(self.test_build.result_details),
+      }, {
+        'build_id': 2,
+        'lease_key': 42,
+      }],
+    }
+    res = self.call_api('succeed_batch', req).json_body
+    service.succeed_batch.assert_called_once_with([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_key': 42,
+        'result_details': self.test_build.result_details,
+        'url': None,
+      },
+      {
+        'build_id': 2,
+        'lease_key': 42,
+        'result_details': None,
+        'url': None,
+      },
+    ])
+
+    res0 = res['results'][0]
+    self.assertEqual(int(res0['build']['id']), self.test_build.key.id())
+    self.assertEqual(
+      res0['build']['result_details_json'],
+      req['builds'][0]['result_details_json'])
+
+    res1 = res['results'][1]
+    self.assertEqual(int(res1['build_id']), 2)
+    self.assertEqual(res1['error']['reason'], 'LEASE_EXPIRED')
+
+  def test_succeed_batch_with_invalid_result_details(self):
+    service.succeed_batch.return_value = [(2, self.test_build, None)]
+    req = {
+      'builds': [{
+        'build_id': self.test_build.key.id(),
+        'result_details_json': '{',
+      }, {
+        'build_id': 2,
+        'lease_key': 42,
+      }],
+    }
+    res = self.call_api('succeed_batch', req).json_body
+    service.succeed_batch.assert_called_once_with([{
+      'build_id': 2,
+      'lease_key': 42,
+      'result_details': None,
+      'url': None,
+    }])
+
+    res0, res1 = res['results']
+    self.assertEqual(int(res0['build_id']), self.test_build.key.id())
+    self.assertIsNone(res0.get('build'))
+    self.assertEqual(res0['error']['reason'], 'INVALID_INPUT')
+    self.assertEqual(int(res1['build_id']), 2)
+    self.assertIsNone(res1.get('error'))
+
+  def test_succeed_batch_with_only_invalid_items(self):
+    req = {
+      'builds': [{
+        'build_id': self.test_build.key.id(),
+        'result_details_json': '{',
+      }],
+    }
+    res = self.call_api('succeed_batch', req).json_body
+    self.assertFalse(service.succeed_batch.called)
+    self.assertEqual(res['results'][0]['error']['reason'], 'INVALID_INPUT')
+
   #################################### FAIL ####################################
 
   def test_infra_failure(self):
@@ -452,6 +675,66 @@ class BuildBucketApiTest(testing.EndpointsTestCase):
     self.assertEqual(
       res['build']['result_details_json'], req['result_details_json'])
 
+  def test_fail_batch(self):
+    self.test_build.failure_reason = model.FailureReason.INFRA_FAILURE
+    service.fail_batch.return_value = [
+      (self.test_build.key.id(), self.test_build, None),
+      (2, None, errors.BuildNotFoundError()),
+    ]
+    req = {
+      'builds': [{
+        'build_id': self.test_build.key.id(),
+        'lease_key': 42,
+        'failure_reason': 'INFRA_FAILURE',
+      }, {
+        'build_id': 2,
+      }],
+    }
+    res = self.call_api('fail_batch', req).json_body
+    service.fail_batch.assert_called_once_with([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_key': 42,
+        'result_details': None,
+        'failure_reason': model.FailureReason.INFRA_FAILURE,
+        'url': None,
+      },
+      {
+        'build_id': 2,
+        'lease_key': None,
+        'result_details': None,
+        'failure_reason': None,
+        'url': None,
+      },
+    ])
+
+    res0 = res['results'][0]
+    self.assertEqual(int(res0['build']['id']), self.test_build.key.id())
+    self.assertEqual(res0['build']['failure_reason'], 'INFRA_FAILURE')
+
+    res1 = res['results'][1]
+    self.assertEqual(int(res1['build_id']), 2)
+    self.assertEqual(res1['error']['reason'], 'BUILD_NOT_FOUND')
+
+  def test_fail_batch_with_invalid_result_details(self):
+    service.fail_batch.return_value = [
+      (self.test_build.key.id(), self.test_build, None),
+    ]
+    req = {
+      'builds': [{
+        'build_id': self.test_build.key.id(),
+      }, {
+        'build_id': 2,
+        'result_details_json': '{',
+      }],
+    }
+    res = self.call_api('fail_batch', req).json_body
+    self.assertEqual(1, len(service.fail_batch.call_args[0][0]))
+    res0, res1 = res['results']
+    self.assertEqual(int(res0['build']['id']), self.test_build.key.id())
+    self.assertEqual(int(res1['build_id']), 2)
+    self.assertEqual(res1['error']['reason'], 'INVALID_INPUT')
+
   #################################### CANCEL ##################################
 
   def test_cancel(self):
@@ -2,9 +2,11 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import datetime
 import logging
 
 from components import config as config_component
+from components import utils
 from components.config import validation_context
 from testing_utils import testing
 import mock
@@ -66,6 +68,20 @@ acls {
 
 
 class ConfigTest(testing.AppengineTestCase):
+  def setUp(self):
+    super(ConfigTest, self).setUp()
+    self.mock(config, '_bucket_cache', config._BucketCache())
+    self.now = datetime.datetime(2016, 1, 1)
+    self.mock(utils, 'utcnow', lambda: self.now)
+
+  def put_buckets_version(self):
+    buckets = config.Bucket.query().fetch()
+    config.BucketsVersion(
+      key=config.BucketsVersion.key_for(),
+      version=config.compute_buckets_version(buckets),
+      bucket_names=[b.key.id() for b in buckets],
+    ).put()
+
   def test_get_bucket_async(self):
     config.Bucket(
       id='master.tryserver.chromium.linux',
@@ -206,6 +222,76 @@ class ConfigTest(testing.AppengineTestCase):
     ]
     self.assertEqual(actual, expected)
 
+    version = config.BucketsVersion.key_for().get()
+    self.assertEqual(version.version, config.compute_buckets_version(actual))
+    self.assertEqual(version.bucket_names, [
+      'master.tryserver.chromium.linux',
+      'master.tryserver.chromium.win',
+      'master.tryserver.test',
+      'master.tryserver.v8',
+    ])
+    self.assertEqual(
+      config.get_buckets_version_async().get_result(), version.version)
+
+    # Nothing changed, the version stays the same.
+    self.mock(config.BucketsVersion, 'put', mock.Mock())
+    config.cron_update_buckets()
+    self.assertFalse(config.BucketsVersion.put.called)
+
+  def test_get_bucket_async_cached(self):
+    bucket = config.Bucket(
+      id='master.tryserver.chromium.linux',
+      project_id='chromium',
+      revision='deadbeef',
+      config_content=MASTER_TRYSERVER_CHROMIUM_LINUX_CONFIG_TEXT)
+    bucket.put()
+    self.put_buckets_version()
+    cfg = config.get_bucket_async(
+      'master.tryserver.chromium.linux').get_result()
+    self.assertEqual(cfg.acls[1].group, 'tryjob-access')
+    self.assertIsNone(config.get_bucket_async('non.existing').get_result())
+
+    # A new revision is not visible until the version changes.
+    bucket.revision = 'beefdead'
+    bucket.config_content = MASTER_TRYSERVER_CHROMIUM_LINUX_CONFIG_TEXT.replace(
+      'tryjob-access', 'tryjob-access2')
+    bucket.put()
+    cfg = config.get_bucket_async(
+      'master.tryserver.chromium.linux').get_result()
+    self.assertEqual(cfg.acls[1].group, 'tryjob-access')
+
+    # The version is not rechecked until BUCKET_CACHE_CHECK_INTERVAL passes.
+    self.put_buckets_version()
+    cfg = config.get_bucket_async(
+      'master.tryserver.chromium.linux').get_result()
+    self.assertEqual(cfg.acls[1].group, 'tryjob-access')
+
+    self.now += config.BUCKET_CACHE_CHECK_INTERVAL
+    cfg = config.get_bucket_async(
+      'master.tryserver.chromium.linux').get_result()
+    self.assertEqual(cfg.acls[1].group, 'tryjob-access2')
+
+  def test_get_buckets_async_cached(self):
+    for name, text in [
+        ('master.tryserver.chromium.win',
+         MASTER_TRYSERVER_CHROMIUM_WIN_CONFIG_TEXT),
+        ('master.tryserver.chromium.linux',
+         MASTER_TRYSERVER_CHROMIUM_LINUX_CONFIG_TEXT)]:
+      config.Bucket(
+        id=name, project_id='chromium', revision='deadbeef',
+        config_content=text).put()
+    self.put_buckets_version()
+
+    self.mock(config.Bucket, 'query', mock.Mock())
+    actual = config.get_buckets_async().get_result()
+    self.assertEqual(
+      [b.name for b in actual],
+      ['master.tryserver.chromium.linux', 'master.tryserver.chromium.win'])
+    self.assertFalse(config.Bucket.query.called)
+
+  def test_get_buckets_version_async_unversioned(self):
+    self.assertIsNone(config.get_buckets_version_async().get_result())
+
   def test_cron_update_buckets_with_existing(self):
     config.Bucket(
       id='master.tryserver.chromium.linux',
@@ -7,6 +7,7 @@ import mock
 from testing_utils import testing
 import handlers
 import main
+import metrics
 import service
 
 
@@ -21,3 +22,24 @@ class BuildBucketBackendHandlersTest(testing.AppengineTestCase):
     response = self.test_app.get(path, headers={'X-AppEngine-Cron': 'true'})
     self.assertEquals(200, response.status_int)
     service.reset_expired_builds.assert_called_once_with()
+
+  def test_backfill_ready_queue(self):
+    self.mock(service, 'backfill_ready_queue', mock.Mock())
+    path = '/internal/cron/buildbucket/backfill_ready_queue'
+    response = self.test_app.get(path, headers={'X-AppEngine-Cron': 'true'})
+    self.assertEquals(200, response.status_int)
+    service.backfill_ready_queue.assert_called_once_with()
+
+  def test_backfill_tag_index(self):
+    self.mock(service, 'backfill_tag_index', mock.Mock())
+    path = '/internal/cron/buildbucket/backfill_tag_index'
+    response = self.test_app.get(path, headers={'X-AppEngine-Cron': 'true'})
+    self.assertEquals(200, response.status_int)
+    service.backfill_tag_index.assert_called_once_with()
+
+  def test_reconcile_build_counters(self):
+    self.mock(metrics, 'reconcile_build_counters', mock.Mock())
+    path = '/internal/cron/buildbucket/reconcile_build_counters'
+    response = self.test_app.get(path, headers={'X-AppEngine-Cron': 'true'})
+    self.assertEquals(200, response.status_int)
+    metrics.reconcile_build_counters.assert_called_once_with()
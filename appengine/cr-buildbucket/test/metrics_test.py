@@ -10,6 +10,7 @@ import mock
 from components import metrics as metrics_component
 from components import utils
 from testing_utils import testing
+import gae_ts_mon
 from proto import project_config_pb2
 from test import future
 import config
@@ -18,80 +19,185 @@ import model
 
 
 class MerticsTest(testing.AppengineTestCase):
-  def test_send_build_status_metric(self):
-    buf = mock.Mock()
+  def setUp(self):
+    super(MerticsTest, self).setUp()
+    self.now = datetime.datetime(2015, 1, 4)
+    self.mock(utils, 'utcnow', lambda: self.now)
 
-    ndb.put_multi([
-      model.Build(bucket='chromium', status=model.BuildStatus.SCHEDULED),
-      model.Build(bucket='chromium', status=model.BuildStatus.SCHEDULED),
-      model.Build(bucket='v8', status=model.BuildStatus.SCHEDULED),
-      model.Build(bucket='chromium', status=model.BuildStatus.STARTED),
-    ])
-    send_future = metrics.send_build_status_metric(
-      buf, 'chromium', metrics.METRIC_PENDING_BUILDS,
-      model.BuildStatus.SCHEDULED)
-    send_future.get_result()
-    buf.set_gauge.assert_called_once_with(
-      metrics.METRIC_PENDING_BUILDS, 2,
-      {metrics.LABEL_BUCKET: 'chromium'})
-
-  def test_send_build_lease_latency(self):
-    buf = mock.Mock()
-    now = datetime.datetime(2015, 1, 4)
-    self.mock(utils, 'utcnow', lambda: now)
+  def state(self, status, never_leased=False, day=1):
+    return metrics.BuildCounterState(
+      'chromium', status, never_leased, datetime.datetime(2015, 1, day))
+
+  def counters(self, bucket='chromium'):
+    counters = metrics.get_build_counters_async(bucket).get_result()
+    return {
+      name: getattr(counters, name)
+      for name in model.BuildCounterShard.COUNTERS
+    }
+
+  def histograms(self, bucket='chromium'):
+    counters = metrics.get_build_counters_async(bucket).get_result()
+    return {
+      name: getattr(counters, name)
+      for name in model.BuildCounterShard.HISTOGRAMS
+    }
+
+  def test_build_counter_state(self):
+    build = model.Build(
+      bucket='chromium',
+      status=model.BuildStatus.SCHEDULED,
+      never_leased=True,
+      create_time=datetime.datetime(2015, 1, 1))
+    self.assertEqual(
+      metrics.build_counter_state(build),
+      self.state(model.BuildStatus.SCHEDULED, never_leased=True))
+
+    build.status = model.BuildStatus.COMPLETED
+    self.assertIsNone(metrics.build_counter_state(build))
+    self.assertIsNone(metrics.build_counter_state(None))
+
+  def test_record_transition(self):
+    day_secs = 24 * 3600
+    jan1 = 1420070400
+    record = lambda old, new: metrics.record_transition_async(
+      old, new).get_result()
+
+    scheduled = self.state(model.BuildStatus.SCHEDULED, never_leased=True)
+    record(None, scheduled)
+    record(None, self.state(model.BuildStatus.SCHEDULED, day=3))
+    self.assertEqual(self.counters(), {
+      'scheduled': 2,
+      'scheduled_create_time_sum': 2 * jan1 + 2 * day_secs,
+      'never_leased': 1,
+      'never_leased_create_time_sum': jan1,
+      'started': 0,
+    })
+    jan1_bin = str(jan1 // 60)
+    jan3_bin = str((jan1 + 2 * day_secs) // 60)
+    self.assertEqual(self.histograms(), {
+      'scheduled_create_time_bins': {jan1_bin: 1, jan3_bin: 1},
+      'never_leased_create_time_bins': {jan1_bin: 1},
+    })
+
+    leased = self.state(model.BuildStatus.SCHEDULED)
+    record(scheduled, leased)
+
+    started = self.state(model.BuildStatus.STARTED)
+    record(leased, started)
+    record(started, None)
+
+    self.assertEqual(self.counters(), {
+      'scheduled': 1,
+      'scheduled_create_time_sum': jan1 + 2 * day_secs,
+      'never_leased': 0,
+      'never_leased_create_time_sum': 0,
+      'started': 0,
+    })
+    self.assertEqual(self.histograms(), {
+      'scheduled_create_time_bins': {jan3_bin: 1},
+      'never_leased_create_time_bins': {},
+    })
+    self.assertEqual(self.counters('v8')['scheduled'], 0)
 
+  def test_reconcile_build_counters(self):
+    self.mock(config, 'get_buckets_async', mock.Mock())
+    config.get_buckets_async.return_value = future([
+      project_config_pb2.Bucket(name='chromium'),
+      project_config_pb2.Bucket(name='v8'),
+    ])
     ndb.put_multi([
       model.Build(
         bucket='chromium',
         status=model.BuildStatus.SCHEDULED,
         never_leased=True,
-        create_time=datetime.datetime(2015, 1, 1)
-      ),
+        create_time=datetime.datetime(2015, 1, 1)),
       model.Build(
         bucket='chromium',
         status=model.BuildStatus.SCHEDULED,
-        never_leased=True,
-        create_time=datetime.datetime(2015, 1, 3)
-      ),
+        never_leased=False,
+        create_time=datetime.datetime(2015, 1, 1)),
       model.Build(
         bucket='chromium',
-        status=model.BuildStatus.COMPLETED,
-        result=model.BuildResult.CANCELED,
-        cancelation_reason=model.CancelationReason.TIMEOUT,
-        never_leased=True,
-        create_time=datetime.datetime(2015, 1, 3)
-      ),
-      model.Build(bucket='chromium', status=model.BuildStatus.SCHEDULED),
+        status=model.BuildStatus.STARTED,
+        never_leased=False,
+        create_time=datetime.datetime(2015, 1, 1)),
       model.Build(
-        bucket='v8',
-        status=model.BuildStatus.SCHEDULED,
-        never_leased=True,
-        create_time=datetime.datetime(2015, 1, 3)
-      ),
+        bucket='chromium',
+        status=model.BuildStatus.COMPLETED,
+        result=model.BuildResult.SUCCESS,
+        never_leased=False,
+        create_time=datetime.datetime(2015, 1, 1)),
     ])
-    metrics.send_build_latency(
-      buf, metrics.METRIC_LEASE_BUILD_LATENCY, 'chromium', True).get_result()
-    buf.set_gauge.assert_called_once_with(
-      metrics.METRIC_LEASE_BUILD_LATENCY,
-      2.0 * 24 * 3600,  # 2 days,
-      {metrics.LABEL_BUCKET: 'chromium'})
+    metrics.record_transition_async(
+      None, self.state(model.BuildStatus.STARTED)).get_result()
+    metrics.record_transition_async(
+      None, self.state(model.BuildStatus.STARTED)).get_result()
+    metrics.record_transition_async(
+      None, self.state(model.BuildStatus.SCHEDULED, day=2)).get_result()
+
+    metrics.reconcile_build_counters()
+    jan1 = 1420070400
+    self.assertEqual(self.counters(), {
+      'scheduled': 2,
+      'scheduled_create_time_sum': 2 * jan1,
+      'never_leased': 1,
+      'never_leased_create_time_sum': jan1,
+      'started': 1,
+    })
+    self.assertEqual(self.histograms(), {
+      'scheduled_create_time_bins': {str(jan1 // 60): 2},
+      'never_leased_create_time_bins': {str(jan1 // 60): 1},
+    })
+    self.assertEqual(self.counters('v8')['started'], 0)
 
   def test_send_all_metrics(self):
+    gae_ts_mon.reset_for_unittest()
     buf = mock.Mock()
     self.mock(metrics_component, 'Buffer', lambda: buf)
-
     self.mock(config, 'get_buckets_async', mock.Mock())
     config.get_buckets_async.return_value = future([
-      project_config_pb2.Bucket(name='x')
+      project_config_pb2.Bucket(name='chromium'),
+      project_config_pb2.Bucket(name='v8'),
     ])
-    self.mock(metrics, 'send_build_status_metric', mock.Mock())
+    for state in [
+        self.state(model.BuildStatus.SCHEDULED, never_leased=True, day=1),
+        self.state(model.BuildStatus.SCHEDULED, day=3),
+        self.state(model.BuildStatus.STARTED)]:
+      metrics.record_transition_async(None, state).get_result()
 
     metrics.send_all_metrics()
 
-    metrics.send_build_status_metric.assert_any_call(
-      buf, 'x', metrics.METRIC_PENDING_BUILDS, model.BuildStatus.SCHEDULED)
-    metrics.send_build_status_metric.assert_any_call(
-      buf, 'x', metrics.METRIC_RUNNING_BUILDS, model.BuildStatus.STARTED)
+    label = {metrics.LABEL_BUCKET: 'chromium'}
+    buf.set_gauge.assert_any_call(metrics.METRIC_PENDING_BUILDS, 2, label)
+    buf.set_gauge.assert_any_call(metrics.METRIC_RUNNING_BUILDS, 1, label)
+    buf.set_gauge.assert_any_call(
+      metrics.METRIC_LEASE_BUILD_LATENCY, 3.0 * 24 * 3600, label)
+    buf.set_gauge.assert_any_call(
+      metrics.METRIC_SCHEDULING_LATENCY, 2.0 * 24 * 3600, label)
+    buf.set_gauge.assert_any_call(
+      metrics.METRIC_PENDING_BUILDS, 0, {metrics.LABEL_BUCKET: 'v8'})
+    buf.flush.assert_called_once_with()
+
+    fields = {metrics.FIELD_BUCKET: 'chromium'}
+    lease_latency = metrics.LEASE_LATENCY.get(
+      fields, target_fields=metrics.GLOBAL_TARGET_FIELDS)
+    # Ages are measured from the middle of one minute bins.
+    self.assertEqual(lease_latency.count, 1)
+    self.assertEqual(lease_latency.sum, 3.0 * 24 * 3600 - 30)
+    scheduling_latency = metrics.SCHEDULING_LATENCY.get(
+      fields, target_fields=metrics.GLOBAL_TARGET_FIELDS)
+    self.assertEqual(scheduling_latency.count, 2)
+    self.assertEqual(scheduling_latency.sum, 4.0 * 24 * 3600 - 60)
+    bucketer = scheduling_latency.bucketer
+    self.assertEqual(scheduling_latency.buckets, {
+      bucketer.bucket_for_value(1.0 * 24 * 3600 - 30): 1,
+      bucketer.bucket_for_value(3.0 * 24 * 3600 - 30): 1,
+    })
+    self.assertEqual(
+      metrics.SCHEDULING_LATENCY.get(
+        {metrics.FIELD_BUCKET: 'v8'},
+        target_fields=metrics.GLOBAL_TARGET_FIELDS).count,
+      0)
 
   def test_fields_for(self):
     self.assertEqual(
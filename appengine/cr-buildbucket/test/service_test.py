@@ -7,13 +7,16 @@ import datetime
 
 from components import auth
 from components import utils
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from testing_utils import testing
+import gae_ts_mon
 import mock
 
 from test import future
 import acl
 import errors
+import metrics
 import model
 import notifications
 import service
@@ -52,10 +55,22 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     swarming.is_for_swarming_async.return_value = ndb.Future()
     swarming.is_for_swarming_async.return_value.set_result(False)
 
+  def put_ready_build(self, build):
+    """Puts |build| and its ready queue entry, like service.add does."""
+    build.put()
+    model.ReadyBuild.for_build(build).put()
+
+  def is_in_ready_queue(self, build):
+    return model.ReadyBuild.key_for(build.key).get() is not None
+
+  def complete_ready_queue_backfill(self):
+    model.ReadyQueueBackfill(
+      key=model.ReadyQueueBackfill.key_for(), done=True).put()
+
   def put_many_builds(self):
     for _ in xrange(100):
       b = model.Build(bucket=self.test_build.bucket)
-      b.put()
+      self.put_ready_build(b)
 
   #################################### ADD #####################################
 
@@ -71,6 +86,18 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     self.assertEqual(build.parameters, params)
     self.assertEqual(build.created_by, auth.get_current_identity())
 
+  def test_add_adds_to_ready_queue(self):
+    build = service.add(bucket='chromium')
+    ready = model.ReadyBuild.key_for(build.key).get()
+    self.assertEqual(ready.bucket, 'chromium')
+    self.assertTrue(0 <= ready.shard < model.READY_QUEUE_SHARDS)
+
+  def test_add_leased_build_is_not_ready(self):
+    build = service.add(
+      bucket='chromium',
+      lease_expiration_date=utils.utcnow() + datetime.timedelta(minutes=1))
+    self.assertFalse(self.is_in_ready_queue(build))
+
   def test_add_with_client_operation_id(self):
     build = service.add(
       bucket='chromium',
@@ -128,9 +155,10 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
   ################################### CANCEL ###################################
 
   def test_cancel(self):
-    self.test_build.put()
+    self.put_ready_build(self.test_build)
     build = service.cancel(self.test_build.key.id())
     self.assertEqual(build.status, model.BuildStatus.COMPLETED)
+    self.assertFalse(self.is_in_ready_queue(build))
     self.assertEqual(build.status_changed_time, utils.utcnow())
     self.assertEqual(build.complete_time, utils.utcnow())
     self.assertEqual(build.result, model.BuildResult.CANCELED)
@@ -231,6 +259,180 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     builds, _ = service.search(tags=['buildset:x'])
     self.assertEqual(builds, [self.test_build])
 
+  def complete_tag_index_backfill(self):
+    model.TagIndexBackfill(
+      key=model.TagIndexBackfill.key_for(), done=True).put()
+
+  def test_add_to_tag_index(self):
+    build = service.add(
+      bucket='chromium', tags=['buildset:x', 'buildset:x', 'builder:linux'])
+    idx = model.TagIndex.key_for('buildset:x', build.key.id()).get()
+    self.assertEqual(len(idx.entries), 1)
+    self.assertEqual(idx.entries[0].bucket, 'chromium')
+    self.assertEqual(idx.entries[0].build_id, build.key.id())
+    self.assertIsNone(
+      model.TagIndex.key_for('builder:linux', build.key.id()).get())
+
+  def test_add_to_full_tag_index(self):
+    build = model.Build(id=1, bucket='chromium', tags=['buildset:x'])
+    key = model.TagIndex.key_for('buildset:x', build.key.id())
+    model.TagIndex(
+      key=key,
+      entries=[
+        model.TagIndexEntry(bucket='chromium', build_id=i + 2)
+        for i in xrange(model.TagIndex.MAX_ENTRIES)
+      ]).put()
+    service._add_to_tag_index_async(build).get_result()
+    idx = key.get()
+    self.assertTrue(idx.permanently_incomplete)
+    self.assertEqual(idx.entries, [])
+
+    # Does not add entries to an incomplete index.
+    service._add_to_tag_index_async(build).get_result()
+    self.assertEqual(key.get().entries, [])
+
+  def test_add_with_contended_tag_index(self):
+    self.complete_tag_index_backfill()
+    add_to_shard = service._add_to_tag_index_shard_async
+    self.mock(
+      service, '_add_to_tag_index_shard_async',
+      mock.Mock(side_effect=datastore_errors.TransactionFailedError()))
+    deferred_calls = []
+    self.mock(
+      service.deferred, 'defer',
+      lambda *args, **kwargs: deferred_calls.append(args))
+
+    build = service.add(bucket='chromium', tags=['buildset:x'])
+    self.assertIsNotNone(build.key.get())
+    self.assertEqual(deferred_calls, [
+      (service._task_add_to_tag_index, 'buildset:x', 'chromium',
+       build.key.id()),
+    ])
+    key = model.TagIndex.key_for('buildset:x', build.key.id())
+    self.assertIsNone(key.get())
+
+    # The task adds the build, and does not mark the index incomplete.
+    self.mock(service, '_add_to_tag_index_shard_async', add_to_shard)
+    service._task_add_to_tag_index(*deferred_calls[0][1:])
+    idx = key.get()
+    self.assertFalse(idx.permanently_incomplete)
+    self.assertEqual([e.build_id for e in idx.entries], [build.key.id()])
+    builds, _ = service.search(tags=['buildset:x'])
+    self.assertEqual(builds, [build])
+
+  def test_search_by_buildset_via_tag_index(self):
+    self.complete_tag_index_backfill()
+    build = service.add(bucket='chromium', tags=['buildset:x', 'a:b'])
+    service.add(bucket='secret.bucket', tags=['buildset:x'])
+    service.add(bucket='chromium', tags=['buildset:x'])
+    service.add(bucket='chromium', tags=['buildset:y', 'a:b'])
+
+    get_available_buckets = mock.Mock(return_value=['chromium'])
+    self.mock(acl, 'get_available_buckets', get_available_buckets)
+    query = mock.Mock(side_effect=AssertionError('must not query builds'))
+    self.mock(model.Build, 'query', query)
+    builds, next_cursor = service.search(tags=['buildset:x', 'a:b'])
+    self.assertEqual(builds, [build])
+    self.assertIsNone(next_cursor)
+
+  def test_search_by_buildset_via_tag_index_with_paging(self):
+    self.complete_tag_index_backfill()
+    builds = [
+      service.add(bucket='chromium', tags=['buildset:x'])
+      for _ in xrange(5)
+    ]
+    builds.sort(key=lambda b: b.key.id())
+
+    page1, cursor = service.search(tags=['buildset:x'], max_builds=3)
+    self.assertEqual(page1, builds[:3])
+    self.assertTrue(cursor.startswith(service.TAG_INDEX_CURSOR_PREFIX))
+    page2, cursor = service.search(
+      tags=['buildset:x'], max_builds=3, start_cursor=cursor)
+    self.assertEqual(page2, builds[3:])
+    self.assertIsNone(cursor)
+
+  def test_search_by_buildset_via_tag_index_with_bad_cursor(self):
+    self.complete_tag_index_backfill()
+    with self.assertRaises(errors.InvalidInputError):
+      service.search(tags=['buildset:x'], start_cursor='id>foo')
+
+  def test_search_by_buildset_with_tag_index_cursor_after_overflow(self):
+    self.complete_tag_index_backfill()
+    builds = [
+      service.add(bucket='chromium', tags=['buildset:x'])
+      for _ in xrange(3)
+    ]
+    builds.sort(key=lambda b: b.key.id())
+    page1, cursor = service.search(tags=['buildset:x'], max_builds=2)
+    self.assertEqual(page1, builds[:2])
+    self.assertTrue(cursor.startswith(service.TAG_INDEX_CURSOR_PREFIX))
+
+    # The index overflows, so the next page comes from a Build query.
+    for key in model.TagIndex.all_keys('buildset:x'):
+      model.TagIndex(key=key, permanently_incomplete=True).put()
+    page2, cursor = service.search(
+      tags=['buildset:x'], max_builds=2, start_cursor=cursor)
+    self.assertEqual(page2, builds[2:])
+    self.assertIsNone(cursor)
+
+  def test_search_by_buildset_with_incomplete_tag_index(self):
+    self.complete_tag_index_backfill()
+    self.test_build.tags = ['buildset:x']
+    self.test_build.put()
+    model.TagIndex(
+      key=model.TagIndex.key_for('buildset:x', self.test_build.key.id()),
+      permanently_incomplete=True).put()
+    builds, _ = service.search(tags=['buildset:x'])
+    self.assertEqual(builds, [self.test_build])
+
+  def test_backfill_tag_index(self):
+    self.test_build.tags = ['buildset:x']
+    self.test_build.put()
+    model.Build(bucket='chromium', tags=['a:b']).put()
+    self.assertFalse(service._is_tag_index_complete())
+
+    service.backfill_tag_index()
+    self.assertTrue(service._is_tag_index_complete())
+    idx = model.TagIndex.key_for('buildset:x', self.test_build.key.id()).get()
+    self.assertEqual(
+      [e.build_id for e in idx.entries], [self.test_build.key.id()])
+
+    # A completed backfill is a noop.
+    self.test_build.key.delete()
+    service.backfill_tag_index()
+
+  def test_backfill_tag_index_resumes(self):
+    self.mock(service, 'TAG_INDEX_BACKFILL_PAGE_SIZE', 1)
+    builds = [
+      model.Build(bucket='chromium', tags=['buildset:x']) for _ in xrange(2)]
+    ndb.put_multi(builds)
+
+    def indexed_build_ids():
+      return set(
+        e.build_id
+        for idx in ndb.get_multi(model.TagIndex.all_keys('buildset:x'))
+        if idx
+        for e in idx.entries)
+
+    # Each call processes one page.
+    now = [datetime.datetime(2015, 1, 1)]
+    def utcnow():
+      now[0] += datetime.timedelta(minutes=1)
+      return now[0]
+    self.mock(utils, 'utcnow', utcnow)
+    time_limit = datetime.timedelta(seconds=90)
+
+    service.backfill_tag_index(time_limit=time_limit)
+    backfill = model.TagIndexBackfill.key_for().get()
+    self.assertFalse(backfill.done)
+    self.assertIsNotNone(backfill.cursor)
+    self.assertEqual(len(indexed_build_ids()), 1)
+
+    for _ in xrange(2):
+      service.backfill_tag_index(time_limit=time_limit)
+    self.assertTrue(service._is_tag_index_complete())
+    self.assertEqual(indexed_build_ids(), set(b.key.id() for b in builds))
+
   def test_search_bucket(self):
     self.test_build.put()
     build2 = model.Build(
@@ -321,23 +523,35 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
   #################################### PEEK ####################################
 
   def test_peek(self):
+    self.complete_ready_queue_backfill()
+    self.put_ready_build(self.test_build)
+    builds, _ = service.peek(buckets=[self.test_build.bucket])
+    self.assertEqual(builds, [self.test_build])
+
+  def test_peek_with_incomplete_ready_queue(self):
     self.test_build.put()
+    model.Build(
+      bucket=self.test_build.bucket,
+      lease_expiration_date=utils.utcnow() + datetime.timedelta(minutes=1),
+      lease_key=1,
+      leasee=self.current_identity).put()
     builds, _ = service.peek(buckets=[self.test_build.bucket])
     self.assertEqual(builds, [self.test_build])
 
   def test_peek_multi(self):
     self.test_build.key = ndb.Key(model.Build, model.new_build_id())
-    self.test_build.put()
+    self.put_ready_build(self.test_build)
     # We test that peek returns builds in decreasing order of the build key. The
     # build key is derived from the inverted current time, so later builds get
     # smaller ids. Only exception: if the time is the same, randomness decides
     # the order. So artificially create an id here to avoid flakiness.
     build2 = model.Build(id=self.test_build.key.id() - 1, bucket='bucket2')
-    build2.put()
+    self.put_ready_build(build2)
     builds, _ = service.peek(buckets=[self.test_build.bucket, 'bucket2'])
     self.assertEqual(builds, [self.test_build, build2])
 
   def test_peek_with_paging(self):
+    self.complete_ready_queue_backfill()
     self.put_many_builds()
     first_page, next_cursor = service.peek(
       buckets=[self.test_build.bucket])
@@ -365,14 +579,31 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
       service.peek(buckets=[self.test_build.bucket])
 
   def test_peek_does_not_return_leased_builds(self):
-    self.test_build.put()
+    self.put_ready_build(self.test_build)
     self.lease()
     builds, _ = service.peek([self.test_build.bucket])
     self.assertFalse(builds)
 
+  def test_peek_skips_stale_ready_queue_entries(self):
+    self.complete_ready_queue_backfill()
+    self.put_ready_build(self.test_build)
+    # Lease the build without updating the ready queue.
+    self.test_build.lease_expiration_date = utils.utcnow()
+    self.test_build.lease_key = 1
+    self.test_build.leasee = self.current_identity
+    self.test_build.put()
+    builds, _ = service.peek([self.test_build.bucket])
+    self.assertFalse(builds)
+
+  def test_peek_ignores_builds_missing_from_ready_queue(self):
+    self.complete_ready_queue_backfill()
+    self.test_build.put()
+    builds, _ = service.peek([self.test_build.bucket])
+    self.assertFalse(builds)
+
   def test_peek_200_builds(self):
     for _ in xrange(200):
-      model.Build(bucket=self.test_build.bucket).put()
+      self.put_ready_build(model.Build(bucket=self.test_build.bucket))
     builds, _ = service.peek([self.test_build.bucket], max_builds=200)
     self.assertTrue(len(builds) <= 100)
 
@@ -394,6 +625,11 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     self.assertGreater(self.test_build.lease_expiration_date, utils.utcnow())
     self.assertEqual(self.test_build.leasee, self.current_identity)
 
+  def test_lease_removes_from_ready_queue(self):
+    self.put_ready_build(self.test_build)
+    self.assertTrue(self.lease())
+    self.assertFalse(self.is_in_ready_queue(self.test_build))
+
   def test_lease_build_with_auth_error(self):
     self.mock_cannot(acl.Action.LEASE_BUILD)
     build = self.test_build
@@ -411,6 +647,32 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     with self.assertRaises(errors.BuildNotFoundError):
       service.lease(build_id=42)
 
+  def test_lease_batch(self):
+    self.test_build.put()
+    leased_build = model.Build(bucket=self.test_build.bucket, lease_key=1)
+    leased_build.put()
+    results = service.lease_batch([
+      {'build_id': self.test_build.key.id()},
+      {'build_id': leased_build.key.id()},
+      {'build_id': 42},
+    ])
+    self.assertEqual(len(results), 3)
+
+    build_id, (success, build), ex = results[0]
+    self.assertEqual(build_id, self.test_build.key.id())
+    self.assertTrue(success)
+    self.assertTrue(build.is_leased)
+    self.assertIsNone(ex)
+
+    build_id, (success, _), ex = results[1]
+    self.assertEqual(build_id, leased_build.key.id())
+    self.assertFalse(success)
+    self.assertIsNone(ex)
+
+    self.assertEqual(results[2][0], 42)
+    self.assertIsNone(results[2][1])
+    self.assertIsInstance(results[2][2], errors.BuildNotFoundError)
+
   def test_cannot_lease_for_whole_day(self):
     with self.assertRaises(errors.InvalidInputError):
       self.lease(
@@ -437,6 +699,71 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     build.put()
     self.assertFalse(self.lease())
 
+  ############################### PEEK AND LEASE ###############################
+
+  def test_peek_and_lease(self):
+    self.complete_ready_queue_backfill()
+    builds = [model.Build(bucket='chromium') for _ in xrange(3)]
+    for b in builds:
+      self.put_ready_build(b)
+    self.put_ready_build(model.Build(bucket='other'))
+
+    leased = service.peek_and_lease('chromium', max_builds=2)
+    self.assertEqual(2, len(leased))
+    for b in leased:
+      self.assertEqual(b.bucket, 'chromium')
+      self.assertTrue(b.is_leased)
+      self.assertEqual(b.leasee, self.current_identity)
+      self.assertFalse(b.never_leased)
+      self.assertFalse(self.is_in_ready_queue(b))
+      self.assertEqual(b.lease_key, b.key.get().lease_key)
+
+    leased += service.peek_and_lease('chromium', max_builds=2)
+    self.assertEqual(
+      sorted(b.key for b in builds), sorted(b.key for b in leased))
+    self.assertEqual([], service.peek_and_lease('chromium'))
+
+  def test_peek_and_lease_with_incomplete_ready_queue(self):
+    self.test_build.put()
+    model.Build(bucket='other').put()
+    leased = service.peek_and_lease('chromium')
+    self.assertEqual([self.test_build.key], [b.key for b in leased])
+    self.assertTrue(leased[0].is_leased)
+    self.assertEqual([], service.peek_and_lease('chromium'))
+
+  def test_peek_and_lease_expiration_date(self):
+    self.put_ready_build(self.test_build)
+    expiration_date = utils.utcnow() + datetime.timedelta(minutes=5)
+    leased = service.peek_and_lease(
+      'chromium', lease_expiration_date=expiration_date)
+    self.assertEqual(1, len(leased))
+    self.assertEqual(expiration_date, leased[0].lease_expiration_date)
+
+  def test_peek_and_lease_skips_stale_entries(self):
+    self.complete_ready_queue_backfill()
+    self.put_ready_build(self.test_build)
+    self.test_build.status = model.BuildStatus.COMPLETED
+    self.test_build.result = model.BuildResult.SUCCESS
+    self.test_build.put()
+    self.assertEqual([], service.peek_and_lease('chromium'))
+
+  def test_peek_and_lease_transaction_failure(self):
+    self.put_ready_build(self.test_build)
+    with mock.patch(
+        'service._update_ready_queue_async', autospec=True,
+        side_effect=service.datastore_errors.TransactionFailedError()):
+      self.assertEqual([], service.peek_and_lease('chromium'))
+    self.assertFalse(self.test_build.key.get().is_leased)
+
+  def test_peek_and_lease_with_auth_error(self):
+    self.mock_cannot(acl.Action.LEASE_BUILD)
+    with self.assertRaises(auth.AuthorizationError):
+      service.peek_and_lease('chromium')
+
+  def test_peek_and_lease_with_bad_bucket(self):
+    with self.assertRaises(errors.InvalidInputError):
+      service.peek_and_lease('bad bucket name')
+
   ################################### UNELASE ##################################
 
   def test_reset(self):
@@ -444,6 +771,7 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     build = service.reset(self.test_build.key.id())
     self.assertEqual(build.status, model.BuildStatus.SCHEDULED)
     self.assertEqual(build.status_changed_time, utils.utcnow())
+    self.assertTrue(self.is_in_ready_queue(build))
     self.assertIsNone(build.lease_key)
     self.assertIsNone(build.lease_expiration_date)
     self.assertIsNone(build.leasee)
@@ -525,6 +853,26 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     with self.assertRaises(errors.InvalidInputError):
       service.start(1, None)
 
+  def test_start_batch(self):
+    self.lease()
+    results = service.start_batch([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_key': self.test_build.lease_key,
+        'url': 'http://localhost',
+      },
+      {'build_id': 42, 'lease_key': 42},
+    ])
+    self.assertEqual(len(results), 2)
+
+    self.test_build = self.test_build.key.get()
+    self.assertEqual(self.test_build.status, model.BuildStatus.STARTED)
+    self.assertEqual(
+      results[0], (self.test_build.key.id(), self.test_build, None))
+
+    self.assertIsNone(results[1][1])
+    self.assertIsInstance(results[1][2], errors.BuildNotFoundError)
+
   @contextlib.contextmanager
   def callback_test(self):
     self.mock(notifications, 'enqueue_callback_task_if_needed', mock.Mock())
@@ -605,6 +953,24 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     self.test_build = service.succeed(
       self.test_build.key.id(), self.test_build.lease_key, **kwargs)
 
+  def test_build_counters(self):
+    counters = lambda: metrics.get_build_counters_async(
+      'chromium').get_result()
+    build = service.add(bucket='chromium')
+    self.assertEqual(counters().scheduled, 1)
+    self.assertEqual(counters().never_leased, 1)
+
+    _, build = service.lease(build.key.id())
+    self.assertEqual(counters().scheduled, 1)
+    self.assertEqual(counters().never_leased, 0)
+
+    build = service.start(build.key.id(), build.lease_key)
+    self.assertEqual(counters().scheduled, 0)
+    self.assertEqual(counters().started, 1)
+
+    service.succeed(build.key.id(), build.lease_key)
+    self.assertEqual(counters().started, 0)
+
   def test_succeed(self):
     self.lease()
     self.start()
@@ -649,6 +1015,51 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
       result_details=result_details)
     self.assertEqual(self.test_build.result_details, result_details)
 
+  def test_succeed_batch(self):
+    self.lease()
+    self.start()
+    results = service.succeed_batch([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_key': self.test_build.lease_key,
+        'result_details': {'x': 1},
+      },
+      {'build_id': 42, 'lease_key': None},
+    ])
+    self.assertEqual(len(results), 2)
+
+    self.test_build = self.test_build.key.get()
+    self.assertEqual(self.test_build.result, model.BuildResult.SUCCESS)
+    self.assertEqual(self.test_build.result_details, {'x': 1})
+    self.assertEqual(
+      results[0], (self.test_build.key.id(), self.test_build, None))
+
+    self.assertIsNone(results[1][1])
+    self.assertIsInstance(results[1][2], errors.InvalidInputError)
+
+  def test_fail_batch(self):
+    self.lease()
+    self.start()
+    results = service.fail_batch([
+      {
+        'build_id': self.test_build.key.id(),
+        'lease_key': self.test_build.lease_key,
+        'failure_reason': model.FailureReason.INFRA_FAILURE,
+      },
+      {'build_id': 42, 'lease_key': 42},
+    ])
+    self.assertEqual(len(results), 2)
+
+    self.test_build = self.test_build.key.get()
+    self.assertEqual(self.test_build.result, model.BuildResult.FAILURE)
+    self.assertEqual(
+      self.test_build.failure_reason, model.FailureReason.INFRA_FAILURE)
+    self.assertEqual(
+      results[0], (self.test_build.key.id(), self.test_build, None))
+
+    self.assertIsNone(results[1][1])
+    self.assertIsInstance(results[1][2], errors.BuildNotFoundError)
+
   def test_complete_with_url(self):
     self.lease()
     self.start()
@@ -678,6 +1089,7 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     build = self.test_build.key.get()
     self.assertEqual(build.status, model.BuildStatus.SCHEDULED)
     self.assertIsNone(build.lease_key)
+    self.assertTrue(self.is_in_ready_queue(build))
 
   def test_completed_builds_are_not_reset(self):
     self.test_build.status = model.BuildStatus.COMPLETED
@@ -689,7 +1101,7 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
 
   def test_build_timeout(self):
     self.test_build.create_time = utils.utcnow() - datetime.timedelta(days=365)
-    self.test_build.put()
+    self.put_ready_build(self.test_build)
 
     service.reset_expired_builds()
     build = self.test_build.key.get()
@@ -697,11 +1109,166 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     self.assertEqual(build.result, model.BuildResult.CANCELED)
     self.assertEqual(build.cancelation_reason, model.CancelationReason.TIMEOUT)
     self.assertIsNone(build.lease_key)
+    self.assertFalse(self.is_in_ready_queue(build))
+
+  def test_build_timeout_in_batches(self):
+    self.mock(service, 'EXPIRATION_BATCH_SIZE', 1)
+    create_time = utils.utcnow() - model.BUILD_TIMEOUT
+    builds = []
+    for i, status in enumerate([
+        model.BuildStatus.SCHEDULED, model.BuildStatus.STARTED,
+        model.BuildStatus.SCHEDULED, model.BuildStatus.STARTED]):
+      build = model.Build(
+        bucket='chromium',
+        status=status,
+        create_time=create_time - datetime.timedelta(seconds=i + 1),
+      )
+      build.put()
+      builds.append(build)
+
+    service.reset_expired_builds()
+    for build in builds:
+      build = build.key.get()
+      self.assertEqual(build.status, model.BuildStatus.COMPLETED)
+      self.assertEqual(
+        build.cancelation_reason, model.CancelationReason.TIMEOUT)
+    self.assertEqual(
+      metrics.EXPIRATION_BACKLOG_LAG.get(
+        {'kind': 'timeout'}, target_fields=metrics.GLOBAL_TARGET_FIELDS),
+      0.0)
+
+  def put_expired_build(self, expired_for):
+    build = model.Build(
+      bucket='chromium',
+      lease_expiration_date=utils.utcnow() - expired_for,
+      lease_key=1,
+      leasee=self.current_identity,
+    )
+    build.put()
+    return build
+
+  def test_reset_expired_builds_in_deadline_order(self):
+    self.mock(service, 'EXPIRATION_BATCH_SIZE', 1)
+    newer = self.put_expired_build(datetime.timedelta(seconds=10))
+    older = self.put_expired_build(datetime.timedelta(seconds=20))
+
+    # The clock moves one second per call, so only one batch fits.
+    now = [utils.utcnow()]
+    def utcnow():
+      now[0] += datetime.timedelta(seconds=1)
+      return now[0]
+    self.mock(utils, 'utcnow', utcnow)
+
+    service.reset_expired_builds(time_limit=datetime.timedelta(seconds=3))
+    self.assertFalse(older.key.get().is_leased)
+    self.assertTrue(newer.key.get().is_leased)
+
+    service.reset_expired_builds(time_limit=datetime.timedelta(seconds=3))
+    self.assertFalse(newer.key.get().is_leased)
+
+  def test_lease_backlog_does_not_stop_timeouts(self):
+    self.mock(service, 'EXPIRATION_BATCH_SIZE', 1)
+    expired = [
+      self.put_expired_build(datetime.timedelta(seconds=10 + i))
+      for i in xrange(10)]
+    timed_out = model.Build(
+      bucket='chromium',
+      status=model.BuildStatus.STARTED,
+      create_time=utils.utcnow() - model.BUILD_TIMEOUT,
+    )
+    timed_out.put()
+
+    now = [utils.utcnow()]
+    def utcnow():
+      now[0] += datetime.timedelta(seconds=1)
+      return now[0]
+    self.mock(utils, 'utcnow', utcnow)
+
+    service.reset_expired_builds(time_limit=datetime.timedelta(seconds=10))
+    self.assertTrue(any(b.key.get().is_leased for b in expired))
+    self.assertEqual(timed_out.key.get().status, model.BuildStatus.COMPLETED)
+
+  def test_reset_expired_build_that_was_deleted(self):
+    build = self.put_expired_build(datetime.timedelta(seconds=10))
+    build.key.delete()
+    self.mock(metrics, 'increment', mock.Mock())
+    service._reset_expired_build_async(build.key.id()).get_result()
+    self.assertFalse(metrics.increment.called)
+
+  def test_reset_expired_builds_reports_lag(self):
+    gae_ts_mon.reset_for_unittest()
+    self.put_expired_build(datetime.timedelta(seconds=10))
+    fields = {'kind': 'lease'}
+
+    service.reset_expired_builds(time_limit=datetime.timedelta(0))
+    self.assertEqual(
+      metrics.EXPIRATION_BACKLOG_LAG.get(
+        fields, target_fields=metrics.GLOBAL_TARGET_FIELDS),
+      10.0)
+    self.assertIsNone(metrics.EXPIRATION_LAG.get(fields))
+
+    service.reset_expired_builds()
+    self.assertEqual(
+      metrics.EXPIRATION_BACKLOG_LAG.get(
+        fields, target_fields=metrics.GLOBAL_TARGET_FIELDS),
+      0.0)
+    lag = metrics.EXPIRATION_LAG.get(fields)
+    self.assertEqual(lag.count, 1)
+    self.assertEqual(lag.sum, 10.0)
+
+  ########################## BACKFILL READY QUEUE ##############################
+
+  def test_backfill_ready_queue(self):
+    self.test_build.put()
+    ready_build = model.Build(bucket='chromium')
+    self.put_ready_build(ready_build)
+    leased_build = model.Build(
+      bucket='chromium',
+      lease_expiration_date=utils.utcnow() + datetime.timedelta(minutes=1),
+      lease_key=1,
+      leasee=self.current_identity)
+    leased_build.put()
+
+    self.assertFalse(service._is_ready_queue_complete())
+    service.backfill_ready_queue()
+    self.assertTrue(service._is_ready_queue_complete())
+    self.assertTrue(self.is_in_ready_queue(self.test_build))
+    self.assertTrue(self.is_in_ready_queue(ready_build))
+    self.assertFalse(self.is_in_ready_queue(leased_build))
+
+    # A completed backfill is a noop.
+    build = model.Build(bucket='chromium')
+    build.put()
+    service.backfill_ready_queue()
+    self.assertFalse(self.is_in_ready_queue(build))
+
+  def test_backfill_ready_queue_resumes(self):
+    self.mock(service, 'READY_QUEUE_BACKFILL_PAGE_SIZE', 1)
+    builds = [model.Build(bucket='chromium') for _ in xrange(3)]
+    ndb.put_multi(builds)
+
+    # Each call processes two pages.
+    now = [datetime.datetime(2015, 1, 1)]
+    def utcnow():
+      now[0] += datetime.timedelta(minutes=1)
+      return now[0]
+    self.mock(utils, 'utcnow', utcnow)
+    time_limit = datetime.timedelta(seconds=150)
+
+    service.backfill_ready_queue(time_limit=time_limit)
+    backfill = model.ReadyQueueBackfill.key_for().get()
+    self.assertFalse(backfill.done)
+    self.assertIsNotNone(backfill.cursor)
+    self.assertEqual(2, sum(self.is_in_ready_queue(b) for b in builds))
+
+    service.backfill_ready_queue(time_limit=time_limit)
+    self.assertTrue(service._is_ready_queue_complete())
+    self.assertTrue(all(self.is_in_ready_queue(b) for b in builds))
 
   ########################## RESET EXPIRED BUILDS ##############################
 
   def test_delete_many_scheduled_builds(self):
-    self.test_build.put()
+    self.put_ready_build(self.test_build)
     completed_build = model.Build(
       bucket=self.test_build.bucket,
       status=model.BuildStatus.COMPLETED,
@@ -713,6 +1280,22 @@ class BuildBucketServiceTest(testing.AppengineTestCase):
     service._task_delete_many_builds(
       self.test_build.bucket, model.BuildStatus.SCHEDULED)
     self.assertIsNone(self.test_build.key.get())
+    self.assertFalse(self.is_in_ready_queue(self.test_build))
+    self.assertIsNotNone(completed_build.key.get())
+
+  def test_delete_many_builds_removes_from_tag_index(self):
+    build = service.add(bucket='chromium', tags=['buildset:x'])
+    other = service.add(bucket='chromium', tags=['buildset:x'])
+    other.status = model.BuildStatus.STARTED
+    other.put()
+    service._task_delete_many_builds('chromium', model.BuildStatus.SCHEDULED)
+    self.assertIsNone(build.key.get())
+    entries = [
+      e.build_id
+      for idx in ndb.get_multi(model.TagIndex.all_keys('buildset:x'))
+      if idx
+      for e in idx.entries]
+    self.assertEqual(entries, [other.key.id()])
     self.assertIsNotNone(completed_build.key.get())
 
   def test_delete_many_started_builds(self):
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Compares throughput of single-build and batch lease/start/succeed APIs.
+
+Schedules builds in a test bucket, then drives each build through
+lease -> start -> succeed, once with one request per build and once with the
+batch endpoints, and prints builds per second for each step.
+
+Usage:
+  tools/load_test.py --host cr-buildbucket-dev.appspot.com \\
+      --bucket luci.infra.loadtest --builds 200 --batch-size 50 \\
+      --access-token "$ACCESS_TOKEN"
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import urllib2
+
+
+class Client(object):
+  def __init__(self, host, access_token=None):
+    scheme = 'http' if host.startswith('localhost') else 'https'
+    self.base_url = '%s://%s/_ah/api/buildbucket/v1/' % (scheme, host)
+    self.access_token = access_token
+
+  def call(self, method, path, body=None):
+    req = urllib2.Request(
+        self.base_url + path,
+        data=json.dumps(body) if body is not None else None,
+        headers={'Content-Type': 'application/json'})
+    req.get_method = lambda: method
+    if self.access_token:
+      req.add_header('Authorization', 'Bearer %s' % self.access_token)
+    res = json.load(urllib2.urlopen(req))
+    if res.get('error'):
+      raise Exception('%s %s failed: %s' % (method, path, res['error']))
+    return res
+
+
+def schedule_builds(client, bucket, count):
+  """Returns ids of |count| new builds in |bucket|."""
+  ids = []
+  while len(ids) < count:
+    n = min(count - len(ids), 100)
+    res = client.call('PUT', 'builds/batch', {
+      'builds': [{'bucket': bucket, 'tags': ['load_test:1']}] * n,
+    })
+    for r in res['results']:
+      if r.get('error'):
+        raise Exception('could not schedule a build: %s' % r['error'])
+      ids.append(int(r['build']['id']))
+  return ids
+
+
+def run_parallel(fn, items, concurrency):
+  """Calls fn(item) for each item using |concurrency| threads.
+
+  Returns elapsed seconds.
+  """
+  items = list(items)
+  lock = threading.Lock()
+  errors = []
+
+  def worker():
+    while True:
+      with lock:
+        if not items:
+          return
+        item = items.pop()
+      try:
+        fn(item)
+      except Exception as ex:  # pylint: disable=broad-except
+        with lock:
+          errors.append(ex)
+
+  threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+  if errors:
+    print >> sys.stderr, '%d requests failed, e.g. %s' % (
+        len(errors), errors[0])
+  return elapsed
+
+
+def chunks(items, size):
+  return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def check_batch_results(res):
+  for r in res['results']:
+    if r.get('error'):
+      raise Exception('build %s: %s' % (r['build_id'], r['error']))
+  return res['results']
+
+
+def run_single(client, build_ids, concurrency):
+  """Returns {step: elapsed seconds} for the single-build APIs."""
+  lease_keys = {}
+  times = {}
+
+  def lease(build_id):
+    res = client.call('POST', 'builds/%d/lease' % build_id, {})
+    lease_keys[build_id] = res['build']['lease_key']
+
+  def start(build_id):
+    client.call('POST', 'builds/%d/start' % build_id, {
+      'lease_key': lease_keys[build_id],
+    })
+
+  def succeed(build_id):
+    client.call('POST', 'builds/%d/succeed' % build_id, {
+      'lease_key': lease_keys[build_id],
+    })
+
+  for step, fn in (('lease', lease), ('start', start), ('succeed', succeed)):
+    times[step] = run_parallel(fn, build_ids, concurrency)
+  return times
+
+
+def run_batch(client, build_ids, batch_size, concurrency):
+  """Returns {step: elapsed seconds} for the batch APIs."""
+  lease_keys = {}
+  times = {}
+
+  def lease(ids):
+    res = client.call('POST', 'builds/lease', {
+      'leases': [{'build_id': i} for i in ids],
+    })
+    for r in check_batch_results(res):
+      lease_keys[int(r['build_id'])] = r['build']['lease_key']
+
+  def start(ids):
+    check_batch_results(client.call('POST', 'builds/start', {
+      'builds': [{'build_id': i, 'lease_key': lease_keys[i]} for i in ids],
+    }))
+
+  def succeed(ids):
+    check_batch_results(client.call('POST', 'builds/succeed', {
+      'builds': [{'build_id': i, 'lease_key': lease_keys[i]} for i in ids],
+    }))
+
+  batches = chunks(build_ids, batch_size)
+  for step, fn in (('lease', lease), ('start', start), ('succeed', succeed)):
+    times[step] = run_parallel(fn, batches, concurrency)
+  return times
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--host', default='localhost:8080',
+                      help='buildbucket host, e.g. '
+                           'cr-buildbucket-dev.appspot.com')
+  parser.add_argument('--bucket', required=True,
+                      help='bucket to schedule test builds in. The caller '
+                           'must be able to schedule and lease builds in it')
+  parser.add_argument('--access-token',
+                      help='OAuth2 access token to send as a bearer token')
+  parser.add_argument('--builds', type=int, default=200,
+                      help='number of builds per mode')
+  parser.add_argument('--batch-size', type=int, default=50)
+  parser.add_argument('--concurrency', type=int, default=10,
+                      help='number of requests in flight')
+  args = parser.parse_args()
+
+  client = Client(args.host, args.access_token)
+  results = {}
+
+  ids = schedule_builds(client, args.bucket, args.builds)
+  results['single'] = run_single(client, ids, args.concurrency)
+
+  ids = schedule_builds(client, args.bucket, args.builds)
+  results['batch'] = run_batch(
+      client, ids, args.batch_size, args.concurrency)
+
+  print '%-8s %-8s %10s %12s' % ('mode', 'step', 'seconds', 'builds/sec')
+  for mode in ('single', 'batch'):
+    for step in ('lease', 'start', 'succeed'):
+      elapsed = results[mode][step]
+      print '%-8s %-8s %10.3f %12.1f' % (
+          mode, step, elapsed, args.builds / max(elapsed, 1e-9))
+
+
+if __name__ == '__main__':
+  main()
@@ -10,9 +10,11 @@ from appengine_module.testing_utils import testing
 from appengine_module.test_results import main
 from appengine_module.test_results.handlers import master_config
 from appengine_module.test_results.handlers import testfilehandler
+from appengine_module.test_results.model import jsonresults
 from appengine_module.test_results.model.jsonresults import (
   JSON_RESULTS_HIERARCHICAL_VERSION
 )
+from appengine_module.test_results.model.pendingresults import PendingResults
 
 
 class TestFileHandlerTest(testing.AppengineTestCase):
@@ -55,6 +57,15 @@ class TestFileHandlerTest(testing.AppengineTestCase):
         '/testfile/upload', params=params, upload_files=upload_files)
     self.assertEqual(response.status_int, 200)
 
+    # Merge the upload into the stored aggregate files.
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url=jsonresults.MERGE_PENDING_URL)
+    self.assertEqual(1, len(tasks))
+    response = self.test_app.post(tasks[0].url, tasks[0].payload)
+    self.assertEqual(response.status_int, 200)
+    self.assertFalse(PendingResults.count(
+        master['url_name'], builder, test_type, 1))
+
     # test aggregated results.json got generated
     params = collections.OrderedDict([
         (testfilehandler.PARAM_BUILDER, builder),
@@ -236,6 +236,8 @@ class GetFile(webapp2.RequestHandler):  # pylint: disable=W0232
         json = JsonResults.get_test_list(builder, json)
 
     if json:
+      # Aggregate results are stored packed, convert them on the way out.
+      json = JsonResults.get_json_data(json)
       json = _replace_jsonp_callback(json, callback_name)
 
     self._serve_json(json, date)
@@ -293,7 +295,7 @@ class Upload(webapp2.RequestHandler):  # pylint: disable=W0232
         logging.info(("incremental_results.json received from master: %s, "
                       "builder: %s, test_type: %s."),
             master, builder, test_type)
-        status_string, status_code = JsonResults.update(master, builder,
+        status_string, status_code = JsonResults.queue_update(master, builder,
             test_type, file_json, deprecated_master=deprecated_master,
             is_full_results_format=False)
       else:
@@ -314,7 +316,7 @@ class Upload(webapp2.RequestHandler):  # pylint: disable=W0232
           final_status_code = status_code
 
       if status_code == 200 and record.filename == "full_results.json":
-        status_string, status_code = JsonResults.update(master, builder,
+        status_string, status_code = JsonResults.queue_update(master, builder,
             test_type, file_json, deprecated_master=deprecated_master,
             is_full_results_format=True)
         BuilderState.incremental_update(master, builder, test_type,
@@ -338,6 +340,26 @@ class Upload(webapp2.RequestHandler):  # pylint: disable=W0232
       self.response.out.write("OK")
 
 
+class MergePendingResults(webapp2.RequestHandler):  # pylint: disable=W0232
+
+  """Merge uploaded results into aggregate files, in a task queue task."""
+
+  def post(self):
+    master = self.request.get(PARAM_MASTER)
+    builder = self.request.get(PARAM_BUILDER)
+    test_type = self.request.get(PARAM_TEST_TYPE)
+    status_string, status_code = JsonResults.merge_pending(
+        master, builder, test_type)
+    # Failed merges and merges that ran into another one are retried by the
+    # task queue.
+    if status_code == 200:
+      logging.info(status_string)
+    else:
+      logging.error(status_string)
+    self.response.set_status(status_code)
+    self.response.out.write(status_string)
+
+
 class UploadForm(webapp2.RequestHandler):  # pylint: disable=W0232
 
   """Show a form so user can upload a file."""
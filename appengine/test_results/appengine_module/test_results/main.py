@@ -42,6 +42,7 @@ routes = [
     ('/testfile/upload', testfilehandler.Upload),
     ('/testfile/uploadform', testfilehandler.UploadForm),
     ('/testfile/?', testfilehandler.GetFile),
+    ('/internal/testfile/merge', testfilehandler.MergePendingResults),
     ('/builders', buildershandler.GetBuilders),
     ('/updatebuilders', buildershandler.UpdateBuilders),
     ('/builderstate', builderstatehandler.GetBuilderState),
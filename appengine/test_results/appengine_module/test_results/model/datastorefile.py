@@ -26,29 +26,85 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import math
+import collections
+import hashlib
 import logging
+import math
+import threading
+import uuid
+import zlib
 
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
 
 MAX_DATA_ENTRY_PER_FILE = 30
 MAX_ENTRY_LEN = 1000 * 1000
+# Data is compressed in chunks of up to this many bytes. Chunks that are still
+# longer than MAX_ENTRY_LEN once compressed are split further.
+MAX_RAW_CHUNK_LEN = 8 * MAX_ENTRY_LEN
+# Number of chunks iter_data fetches ahead of the one it returns.
+PREFETCH_CHUNKS = 4
+# Max total size of compressed chunks cached by an instance. Kept small: the
+# app runs on F1 instances (128MB) and serves concurrent requests.
+CHUNK_CACHE_SIZE = 4 * MAX_ENTRY_LEN
+
+
+class MissingDataError(Exception):
+  """A data entry of a file does not exist."""
+
+
+class ChunkCache(object):
+  """LRU cache of compressed chunks, by DataEntry key.
+
+  Only content addressed chunks are cached, they never change once written.
+  """
+
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._size = 0
+    self._chunks = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      data = self._chunks.pop(key, None)
+      if data is not None:
+        self._chunks[key] = data
+      return data
+
+  def put(self, key, data):
+    with self._lock:
+      self._pop(key)
+      self._chunks[key] = data
+      self._size += len(data)
+      while self._size > self._max_size:
+        _, evicted = self._chunks.popitem(last=False)
+        self._size -= len(evicted)
+
+  def pop(self, key):
+    with self._lock:
+      self._pop(key)
 
+  def _pop(self, key):
+    data = self._chunks.pop(key, None)
+    if data is not None:
+      self._size -= len(data)
 
-class ChunkData:
+  def clear(self):
+    with self._lock:
+      self._chunks.clear()
+      self._size = 0
 
-  def __init__(self):
-    self.reused_key = None
-    self.data_entry = None
-    self.entry_future = None
-    self.index = None
+
+_chunk_cache = ChunkCache(CHUNK_CACHE_SIZE)
 
 
 class DataEntry(db.Model):  # pylint: disable=W0232
 
   """Datastore entry that stores one segmant of file data
      (<1000*1000 bytes).
+
+     Entries of compressed files are named "<sha1 of data>-<unique id>".
   """
 
   data = db.BlobProperty()
@@ -69,23 +125,49 @@ class DataEntry(db.Model):  # pylint: disable=W0232
 class DataStoreFile(db.Model):  # pylint: disable=W0232
 
   """This class stores file in datastore.
-     If a file is oversize (>1000*1000 bytes), the file is split into
-     multiple segments and stored in multiple datastore entries.
+     The file is compressed with zlib, split into segments and stored in
+     multiple datastore entries, named after the hash of their content. On
+     save, segments that did not change are neither rewritten nor deleted.
   """
 
   name = db.StringProperty()
   data_keys = db.ListProperty(db.Key)
-  # keys to the data store entries that can be reused for new data.
-  # If it is emtpy, create new DataEntry.
+  # Keys of data store entries of the previous version of the file that are
+  # not used by data_keys. They are deleted on the next save, so that the
+  # stored file stays readable if saving the file entity fails.
   new_data_keys = db.ListProperty(db.Key)
   date = db.DateTimeProperty(auto_now_add=True)
+  # Files saved before compression was added are not compressed.
+  compressed = db.BooleanProperty(default=False)
 
   data = None
 
   @staticmethod
-  def _get_chunk_indices(data_length):
-    nchunks = math.ceil(float(data_length) / MAX_ENTRY_LEN)
-    return xrange(0, int(nchunks) * MAX_ENTRY_LEN, MAX_ENTRY_LEN)
+  def _get_chunk_indices(data_length, chunk_length=MAX_ENTRY_LEN):
+    nchunks = math.ceil(float(data_length) / chunk_length)
+    return xrange(0, int(nchunks) * chunk_length, chunk_length)
+
+  @classmethod
+  def _compress_chunks(cls, data):
+    """Returns [(sha1 of chunk, compressed chunk)] for data.
+
+    Each compressed chunk fits in a DataEntry.
+    """
+    compressed = zlib.compress(data)
+    if len(compressed) <= MAX_ENTRY_LEN:
+      return [(hashlib.sha1(data).hexdigest(), compressed)]
+    chunk_length = int(math.ceil(
+        float(len(data)) / (len(compressed) // MAX_ENTRY_LEN + 1)))
+    chunks = []
+    for index in cls._get_chunk_indices(len(data), chunk_length):
+      chunks.extend(cls._compress_chunks(data[index:index + chunk_length]))
+    return chunks
+
+  @staticmethod
+  def _chunk_digest(key):
+    """Returns sha1 of the data of a content addressed entry, or None."""
+    name = key.name()
+    return name.split('-')[0] if name else None
 
   @staticmethod
   def _convert_blob_keys(keys):
@@ -100,7 +182,8 @@ class DataStoreFile(db.Model):  # pylint: disable=W0232
 
   def delete_data(self, keys=None):
     if not keys:
-      keys = self._convert_blob_keys(self.data_keys)
+      keys = self._convert_blob_keys(self.data_keys + self.new_data_keys)
+    keys = list(set(keys))
     logging.info('Doing async delete of keys: %s', keys)
 
     get_futures = [DataEntry.get_async(k) for k in keys]
@@ -112,6 +195,8 @@ class DataStoreFile(db.Model):  # pylint: disable=W0232
 
     for delete_future in delete_futures:
       delete_future.get_result()
+    for key in keys:
+      _chunk_cache.pop(key)
 
   def save_data(self, data):
     if not data:
@@ -123,83 +208,92 @@ class DataStoreFile(db.Model):  # pylint: disable=W0232
                     len(data) / 1024)
       return False
 
-    # Use the new_data_keys to store new data. If all new data are saved
-    # successfully, swap new_data_keys and data_keys so we can reuse the
-    # data_keys entries in next run. If unable to save new data for any
-    # reason, only the data pointed by new_data_keys may be corrupted,
-    # the existing data_keys data remains untouched. The corrupted data
-    # in new_data_keys will be overwritten in next update.
-    keys = self._convert_blob_keys(self.new_data_keys)
-    self.new_data_keys = []
-
-    chunk_indices = self._get_chunk_indices(len(data))
-    logging.info('Saving file in %s chunks', len(chunk_indices))
-
-    chunk_data = []
-    for chunk_index in chunk_indices:
-      chunk = ChunkData()
-      chunk.index = chunk_index
-      if keys:
-        chunk.reused_key = keys.pop()
-        chunk.entry_future = DataEntry.get_async(chunk.reused_key)
-      else:
-        chunk.data_entry = DataEntry()
-      chunk_data.append(chunk)
-
-    put_futures = []
-    for chunk in chunk_data:
-      if chunk.entry_future:
-        data_entry = chunk.entry_future.get_result()
-        if not data_entry:  # pragma: no cover
-          logging.warning("Found key, but no data entry: %s", chunk.reused_key)
-          data_entry = DataEntry()
-        chunk.data_entry = data_entry
-
-      chunk.data_entry.data = db.Blob(
-          data[chunk.index: chunk.index + MAX_ENTRY_LEN])
-      put_futures.append(db.put_async(chunk.data_entry))
-
+    chunks = []
+    for index in self._get_chunk_indices(len(data), MAX_RAW_CHUNK_LEN):
+      chunks.extend(
+          self._compress_chunks(data[index:index + MAX_RAW_CHUNK_LEN]))
+
+    # Reuse the entries of chunks that did not change.
+    old_keys = self._convert_blob_keys(self.data_keys)
+    keys_by_digest = {}
+    if self.compressed:
+      keys_by_digest = {self._chunk_digest(k): k for k in old_keys}
+    keys = []
+    new_entries = []
+    for digest, compressed in chunks:
+      key = keys_by_digest.get(digest)
+      if key is None:
+        key = db.Key.from_path(
+            'DataEntry', '%s-%s' % (digest, uuid.uuid4().hex))
+        keys_by_digest[digest] = key
+        new_entries.append(DataEntry(key=key, data=db.Blob(compressed)))
+      keys.append(key)
+    logging.info('Saving file in %d chunks, %d of them changed',
+                 len(keys), len(new_entries))
+
+    put_futures = [db.put_async(entry) for entry in new_entries]
     for future in put_futures:
-      key = None
       try:
-        key = future.get_result()
-        self.new_data_keys.append(key)
+        future.get_result()
       except Exception, err:  # pragma: no cover
         logging.error("Failed to save data store entry: %s", err)
-        self.delete_data(keys)
+        self.delete_data([entry.key() for entry in new_entries])
         return False
 
-    if keys:
-      self.delete_data(keys)
-
-    temp_keys = self._convert_blob_keys(self.data_keys)
-    self.data_keys = self.new_data_keys
-    self.new_data_keys = temp_keys
+    # Entries of the previous version can be deleted now, the stored file
+    # does not use them anymore.
+    used_keys = set(keys)
+    unused_keys = [k for k in self._convert_blob_keys(self.new_data_keys)
+                   if k not in used_keys]
+    if unused_keys:
+      self.delete_data(unused_keys)
+
+    self.new_data_keys = list(set(old_keys) - used_keys)
+    self.data_keys = keys
+    self.compressed = True
     self.data = data
 
     return True
 
+  def iter_data(self):
+    """Yields file data in parts, fetching the following parts meanwhile.
+
+    Raises:
+      MissingDataError if a part of the data is missing.
+    """
+    fetches = collections.deque()
+    for key in self._convert_blob_keys(self.data_keys):
+      cached = _chunk_cache.get(key) if key.name() else None
+      fetches.append(
+          (key, cached, None if cached else DataEntry.get_async(key)))
+      if len(fetches) > PREFETCH_CHUNKS:
+        yield self._read_chunk(*fetches.popleft())
+    while fetches:
+      yield self._read_chunk(*fetches.popleft())
+
+  def _read_chunk(self, key, cached, future):
+    data = cached
+    if data is None:
+      entry = future.get_result()
+      if not entry:
+        raise MissingDataError("No data found for key: %s." % key)
+      data = entry.data
+      if key.name():
+        _chunk_cache.put(key, data)
+    return zlib.decompress(data) if self.compressed else data
+
   def load_data(self):
     if not self.data_keys:
       logging.warning("No data to load.")
       return None
 
-    data_futures = [(k, DataEntry.get_async(k))
-                    for k in self._convert_blob_keys(self.data_keys)]
-
-    data = []
-    for key, future in data_futures:
-      result = future.get_result()
-      if not result:
-        logging.error("No data found for key: %s.", key)
-        # FIXME: This really shouldn't happen, but it seems to be happening in
-        # practice. Figure out how and then change this back to returning None.
-        # In the meantime, return empty string so we at least start collecting
-        # results from new runs even though it'll mean that the old data is
-        # lost. crbug.com/377594
-        self.data = ""
-        return
-
-      data.append(result)
-
-    self.data = "".join([d.data for d in data])
+    try:
+      self.data = "".join(self.iter_data())
+    except MissingDataError as e:
+      logging.error(e)
+      # FIXME: This really shouldn't happen, but it seems to be happening in
+      # practice. Figure out how and then change this back to returning None.
+      # In the meantime, return empty string so we at least start collecting
+      # results from new runs even though it'll mean that the old data is
+      # lost. crbug.com/377594
+      self.data = ""
@@ -26,13 +26,24 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import array
 import collections
+import copy
+import hashlib
 import json
 import logging
 import re
+import struct
 import sys
+import time
 import traceback
 
+from google.appengine.api import taskqueue
+
+from appengine_module.test_results.model.pendingresults import (
+    PendingResults,
+    PendingResultsLog,
+)
 from appengine_module.test_results.model.testfile import TestFile
 
 JSON_RESULTS_FILE = "results.json"
@@ -45,6 +56,13 @@ JSON_RESULTS_HIERARCHICAL_VERSION = 4
 JSON_RESULTS_MAX_BUILDS = 500
 JSON_RESULTS_MAX_BUILDS_SMALL = 100
 
+# Uploads are merged into aggregate files by a task that runs this many seconds
+# after the first upload it merges, so that it merges several at once.
+MERGE_PENDING_DELAY = 60
+MERGE_PENDING_URL = "/internal/testfile/merge"
+# Uploads merge the pending results themselves once there are this many.
+MAX_PENDING_RESULTS = 20
+
 ACTUAL_KEY = "actual"
 BUG_KEY = "bugs"
 BUILD_NUMBERS_KEY = "buildNumbers"
@@ -129,6 +147,430 @@ def _is_directory(subtree):  # pragma: no cover
       or not isinstance(subtree[RESULTS_KEY], collections.Sequence))
 
 
+# Header of packed aggregate results, see PackedResults.to_string.
+PACKED_RESULTS_MAGIC = "PACKEDRESULTS\x01"
+
+# Result values a test can have and still be pruned from aggregate results.
+_DELETABLE_RESULTS = (PASS, NO_DATA, NOTRUN)
+
+
+class PackedResults(object):
+  """Aggregated results of one builder, stored in flat columns.
+
+  Aggregate results.json files are a tree of tests whose leaves have run-length
+  encoded lists of results and times, newest build first. Parsing, merging and
+  serializing the tree takes seconds for builders with 100k+ tests, so the
+  aggregate files are stored in this form instead:
+
+    - Test paths are lists of indices into an interned table of path
+      components (directory and file names).
+    - Results are (count, value) runs, where value is an index into an
+      interned table of result strings, e.g. "P" or "FP".
+    - Times are (count, time) runs, with time in whole seconds.
+
+  Runs of the test with index i are column[offsets[i]:offsets[i + 1]]. All
+  columns are arrays of unsigned 32 bit integers. Expected results and bugs
+  are rare and kept in dicts keyed by test index. Non-test data of the builder
+  (build numbers, revisions, failure counts) is kept as parsed json in info.
+
+  The json tree is only built by to_json, for clients reading the legacy
+  format.
+  """
+
+  _COLUMNS = (
+      "path_offsets", "path_names",
+      "result_offsets", "result_counts", "result_values",
+      "time_offsets", "time_counts", "time_values",
+  )
+  _LENGTH_FORMAT = ">I"
+  _LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+  def __init__(self, builder, info=None):
+    self.builder = builder
+    self.info = info if info is not None else {}
+    self.names = []
+    self.values = []
+    self.expected = {}
+    self.bugs = {}
+    for column in self._COLUMNS:
+      initial = [0] if column.endswith("_offsets") else []
+      setattr(self, column, array.array("I", initial))
+    assert self.path_names.itemsize == 4
+    self._name_ids = {}
+    self._value_ids = {}
+
+  @property
+  def num_tests(self):
+    return len(self.path_offsets) - 1
+
+  @staticmethod
+  def _intern(table, ids, item):
+    item_id = ids.get(item)
+    if item_id is None:
+      item_id = ids[item] = len(table)
+      table.append(item)
+    return item_id
+
+  def _intern_name(self, name):
+    return self._intern(self.names, self._name_ids, name)
+
+  def _intern_value(self, value):
+    return self._intern(self.values, self._value_ids, value)
+
+  @staticmethod
+  def _time(value):
+    return value if isinstance(value, int) else int(round(value))
+
+  def _add_test(self, path, result_runs, time_runs, expected=None, bugs=None):
+    """Adds a test with |path| of component indices and json runs."""
+    index = self.num_tests
+    self.path_names.extend(path)
+    self.path_offsets.append(len(self.path_names))
+    for count, value in result_runs:
+      self.result_counts.append(count)
+      self.result_values.append(self._intern_value(value))
+    self.result_offsets.append(len(self.result_counts))
+    for count, time in time_runs:
+      self.time_counts.append(count)
+      self.time_values.append(self._time(time))
+    self.time_offsets.append(len(self.time_counts))
+    if expected is not None:
+      self.expected[index] = expected
+    if bugs is not None:
+      self.bugs[index] = bugs
+
+  def _iter_leaves(self, tests, path=()):
+    """Yields (path of component indices, leaf) of a json tree of tests."""
+    for name, subtree in tests.iteritems():
+      if not isinstance(subtree, dict):
+        continue
+      subtree_path = path + (self._intern_name(name),)
+      if _is_directory(subtree):
+        for leaf in self._iter_leaves(subtree, subtree_path):
+          yield leaf
+      else:
+        yield subtree_path, subtree
+
+  @classmethod
+  def from_json(cls, builder, aggregated_json):
+    """Returns PackedResults of |builder| in a parsed results.json file."""
+    builder_json = aggregated_json[builder]
+    info = {k: v for k, v in builder_json.iteritems()
+            if k not in (TESTS_KEY, FAILURE_MAP_KEY)}
+    packed = cls(builder, info)
+    for path, leaf in packed._iter_leaves(builder_json.get(TESTS_KEY) or {}):
+      packed._add_test(
+          path, leaf.get(RESULTS_KEY, []), leaf.get(TIMES_KEY, []),
+          leaf.get(EXPECTED_KEY), leaf.get(BUG_KEY))
+    return packed
+
+  def _build_tree(self, make_leaf):
+    tests = {}
+    names = self.names
+    path_offsets = self.path_offsets
+    path_names = self.path_names
+    for index in xrange(self.num_tests):
+      node = tests
+      path = path_names[path_offsets[index]:path_offsets[index + 1]]
+      for name_id in path[:-1]:
+        node = node.setdefault(names[name_id], {})
+      node[names[path[-1]]] = make_leaf(index)
+    return tests
+
+  def _leaf_metadata(self, index):
+    leaf = {}
+    if index in self.expected:
+      leaf[EXPECTED_KEY] = self.expected[index]
+    if index in self.bugs:
+      leaf[BUG_KEY] = self.bugs[index]
+    return leaf
+
+  def _json_leaf(self, index):
+    leaf = self._leaf_metadata(index)
+    values = self.values
+    start, end = self.result_offsets[index], self.result_offsets[index + 1]
+    leaf[RESULTS_KEY] = [
+        [self.result_counts[i], values[self.result_values[i]]]
+        for i in xrange(start, end)]
+    start, end = self.time_offsets[index], self.time_offsets[index + 1]
+    leaf[TIMES_KEY] = [
+        [self.time_counts[i], self.time_values[i]] for i in xrange(start, end)]
+    return leaf
+
+  def to_json(self):
+    """Returns results in the results.json format."""
+    builder_json = dict(self.info)
+    builder_json[TESTS_KEY] = self._build_tree(self._json_leaf)
+    builder_json[FAILURE_MAP_KEY] = CHAR_TO_FAILURE
+    return {
+        self.builder: builder_json,
+        VERSIONS_KEY: JSON_RESULTS_HIERARCHICAL_VERSION,
+    }
+
+  def to_test_list_json(self):
+    """Returns the tree of tests, without results and times."""
+    return {self.builder: {TESTS_KEY: self._build_tree(self._leaf_metadata)}}
+
+  def merge(self, incremental_tests, num_runs, run_time_pruning_threshold):
+    """Returns new PackedResults with one build of results prepended.
+
+    Tests missing from |incremental_tests| get a NO_DATA result. Like
+    normalize, drops runs over |num_runs| builds and tests that only passed
+    quickly. Does not modify self, except for its interned names.
+
+    Args:
+      incremental_tests: json tree of tests of the build.
+      num_runs: max number of builds to keep.
+      run_time_pruning_threshold: tests that ran for this long are kept.
+    """
+    incoming = dict(self._iter_leaves(incremental_tests))
+    return self._rebuild(incoming, num_runs, run_time_pruning_threshold)
+
+  def normalize(self, num_runs, run_time_pruning_threshold):
+    """Returns new PackedResults with old runs and uninteresting tests dropped.
+
+    See merge for arguments.
+    """
+    return self._rebuild(None, num_runs, run_time_pruning_threshold)
+
+  def _rebuild(self, incoming, num_runs, run_time_pruning_threshold):
+    """Copies tests to new PackedResults in one pass over the columns.
+
+    Prepends the runs of |incoming| leaves, if given, keyed by path, then
+    drops old runs and tests that can be pruned.
+    """
+    out = PackedResults(self.builder, copy.deepcopy(self.info))
+    name_map = [None] * len(self.names)
+    value_map = [out._intern_value(v) for v in self.values]
+    no_data_results = [[1, NO_DATA]]
+    no_data_times = [[1, 0]]
+    for index in xrange(self.num_tests):
+      path_start = self.path_offsets[index]
+      path = self.path_names[path_start:self.path_offsets[index + 1]]
+      results_start = self.result_offsets[index]
+      results_end = self.result_offsets[index + 1]
+      times_start = self.time_offsets[index]
+      times_end = self.time_offsets[index + 1]
+
+      if incoming is None:
+        new_results = new_times = ()
+        expected = self.expected.get(index)
+        bugs = self.bugs.get(index)
+      else:
+        leaf = incoming.pop(tuple(path), None)
+        if leaf:
+          new_results = leaf[RESULTS_KEY]
+          new_times = leaf[TIMES_KEY]
+          expected = leaf.get(EXPECTED_KEY)
+          if expected == PASS_STRING:
+            expected = None
+          bugs = leaf.get(BUG_KEY)
+        else:
+          new_results = no_data_results
+          new_times = no_data_times
+          expected = bugs = None
+
+      for i, name_id in enumerate(path):
+        if name_map[name_id] is None:
+          name_map[name_id] = out._intern_name(self.names[name_id])
+        path[i] = name_map[name_id]
+
+      # Check that the test data is present and reset it if either results or
+      # times are missing. This shouldn't happen but it has at least once.
+      # See crbug.com/573343.
+      if incoming is not None and (results_start == results_end or
+                                   times_start == times_end):
+        out._add_json_runs(path, new_results, new_times, None, None,
+                           num_runs, run_time_pruning_threshold)
+        continue
+
+      out._append_runs(
+          out.result_counts, out.result_values,
+          [[c, out._intern_value(v)] for c, v in new_results],
+          self.result_counts, self.result_values, results_start, results_end,
+          value_map, num_runs)
+      out._append_runs(
+          out.time_counts, out.time_values,
+          [[c, self._time(t)] for c, t in new_times],
+          self.time_counts, self.time_values, times_start, times_end,
+          None, num_runs)
+      out._finish_test(path, expected, bugs, run_time_pruning_threshold)
+
+    # Tests that are new in this build.
+    for path, leaf in sorted((incoming or {}).iteritems()):
+      path = array.array("I", [out._intern_name(self.names[n]) for n in path])
+      out._add_json_runs(
+          path, leaf[RESULTS_KEY], leaf[TIMES_KEY], leaf.get(EXPECTED_KEY),
+          leaf.get(BUG_KEY), num_runs, run_time_pruning_threshold)
+    return out
+
+  def _add_json_runs(self, path, result_runs, time_runs, expected, bugs,
+                     num_runs, run_time_pruning_threshold):
+    """Adds a test with runs copied from json, unless it should be pruned."""
+    self._append_runs(
+        self.result_counts, self.result_values, (),
+        [c for c, _ in result_runs],
+        [self._intern_value(v) for _, v in result_runs],
+        0, len(result_runs), None, num_runs)
+    self._append_runs(
+        self.time_counts, self.time_values, (),
+        [c for c, _ in time_runs],
+        [self._time(t) for _, t in time_runs],
+        0, len(time_runs), None, num_runs)
+    self._finish_test(path, expected, bugs, run_time_pruning_threshold)
+
+  @staticmethod
+  def _append_runs(out_counts, out_values, new_runs, counts, values, start,
+                   end, value_map, num_runs):
+    """Appends new_runs followed by counts/values[start:end] to out columns.
+
+    Each of new_runs is prepended in turn, and merged with the first run if
+    they have the same value. Stops after the run that reaches num_runs
+    builds.
+    """
+    # Runs that end up before counts/values[start:], last one first.
+    front = []
+    for run in new_runs:
+      if front:
+        if front[-1][1] == run[1]:
+          front[-1][0] = min(front[-1][0] + run[0], num_runs)
+          continue
+      elif start < end:
+        value = value_map[values[start]] if value_map else values[start]
+        if value == run[1]:
+          front.append([min(counts[start] + run[0], num_runs), value])
+          start += 1
+          continue
+      front.append(run)
+
+    num_builds = 0
+    for count, value in reversed(front):
+      out_counts.append(count)
+      out_values.append(value)
+      num_builds += count
+      if num_builds >= num_runs:
+        return
+    for i in xrange(start, end):
+      out_counts.append(counts[i])
+      out_values.append(value_map[values[i]] if value_map else values[i])
+      num_builds += counts[i]
+      if num_builds >= num_runs:
+        return
+
+  def _finish_test(self, path, expected, bugs, run_time_pruning_threshold):
+    """Adds a test whose runs were appended, unless it should be pruned."""
+    results_start = self.result_offsets[-1]
+    times_start = self.time_offsets[-1]
+    if (expected in (None, PASS_STRING) and bugs is None and
+        all(self.values[v] in _DELETABLE_RESULTS
+            for v in self.result_values[results_start:]) and
+        all(t < run_time_pruning_threshold
+            for t in self.time_values[times_start:])):
+      del self.result_counts[results_start:]
+      del self.result_values[results_start:]
+      del self.time_counts[times_start:]
+      del self.time_values[times_start:]
+      return
+    index = self.num_tests
+    self.path_names.extend(path)
+    self.path_offsets.append(len(self.path_names))
+    self.result_offsets.append(len(self.result_counts))
+    self.time_offsets.append(len(self.time_counts))
+    if expected is not None:
+      self.expected[index] = expected
+    if bugs is not None:
+      self.bugs[index] = bugs
+
+  @staticmethod
+  def is_packed(data):
+    return bool(data) and data.startswith(PACKED_RESULTS_MAGIC)
+
+  def to_string(self):
+    """Returns results serialized to a str.
+
+    The format is PACKED_RESULTS_MAGIC, then a json header with builder, info,
+    interned tables, expected results and bugs, then each of the columns. The
+    header and columns are prefixed with their length. Column items are big
+    endian.
+    """
+    header = json.dumps({
+        "builder": self.builder,
+        "info": self.info,
+        "names": self.names,
+        "values": self.values,
+        "expected": self.expected,
+        "bugs": self.bugs,
+    }, separators=(',', ':'), sort_keys=True)
+    parts = [
+        PACKED_RESULTS_MAGIC,
+        struct.pack(self._LENGTH_FORMAT, len(header)),
+        header,
+    ]
+    for column in self._COLUMNS:
+      items = getattr(self, column)
+      if sys.byteorder == "little":
+        items = array.array("I", items)
+        items.byteswap()
+      parts.append(struct.pack(self._LENGTH_FORMAT, len(items)))
+      parts.append(items.tostring())
+    return "".join(parts)
+
+  @classmethod
+  def from_string(cls, data):
+    """Returns PackedResults serialized by to_string.
+
+    Raises:
+      ValueError if the data is corrupted.
+    """
+    if not cls.is_packed(data):
+      raise ValueError("Not packed results")
+    offset = len(PACKED_RESULTS_MAGIC)
+
+    def read(size):
+      if offset + size > len(data):
+        raise ValueError("Truncated packed results")
+      return data[offset:offset + size]
+
+    try:
+      size, = struct.unpack(cls._LENGTH_FORMAT, read(cls._LENGTH_SIZE))
+      offset += cls._LENGTH_SIZE
+      header = json.loads(read(size))
+      offset += size
+      packed = cls(header["builder"], header["info"])
+      packed.names = header["names"]
+      packed.values = header["values"]
+      packed.expected = {int(k): v for k, v in header["expected"].iteritems()}
+      packed.bugs = {int(k): v for k, v in header["bugs"].iteritems()}
+    except (KeyError, TypeError, struct.error) as e:
+      raise ValueError("Invalid packed results header: %s" % e)
+
+    for column in cls._COLUMNS:
+      size, = struct.unpack(cls._LENGTH_FORMAT, read(cls._LENGTH_SIZE))
+      offset += cls._LENGTH_SIZE
+      items = array.array("I")
+      items.fromstring(read(size * items.itemsize))
+      offset += size * items.itemsize
+      if sys.byteorder == "little":
+        items.byteswap()
+      setattr(packed, column, items)
+    if offset != len(data):
+      raise ValueError("Trailing data in packed results")
+
+    num_tests = packed.num_tests
+    for offsets, column in (("path_offsets", "path_names"),
+                            ("result_offsets", "result_counts"),
+                            ("result_offsets", "result_values"),
+                            ("time_offsets", "time_counts"),
+                            ("time_offsets", "time_values")):
+      offsets = getattr(packed, offsets)
+      if (len(offsets) != num_tests + 1 or
+          offsets[-1] != len(getattr(packed, column))):
+        raise ValueError("Inconsistent packed results columns")
+    packed._name_ids = {n: i for i, n in enumerate(packed.names)}
+    packed._value_ids = {v: i for i, v in enumerate(packed.values)}
+    return packed
+
+
 class JsonResults(object):
 
   @staticmethod
@@ -161,31 +603,6 @@ class JsonResults(object):
          traceback.print_exception(*sys.exc_info()))
       return None
 
-  @classmethod
-  def _merge_json(cls, aggregated_json, incremental_json,
-        num_runs):  # pragma: no cover
-    # We have to delete expected entries because the incremental json may not
-    # have any entry for every test in the aggregated json. But, the incremental
-    # json will have all the correct expected entries for that run.
-    cls._delete_expected_entries(aggregated_json[TESTS_KEY])
-    cls._merge_non_test_data(aggregated_json, incremental_json, num_runs)
-    incremental_tests = incremental_json[TESTS_KEY]
-    if incremental_tests:
-      aggregated_tests = aggregated_json[TESTS_KEY]
-      cls._merge_tests(aggregated_tests, incremental_tests, num_runs)
-
-  @classmethod
-  def _delete_expected_entries(cls, aggregated_json):  # pragma: no cover
-    for key in aggregated_json:
-      item = aggregated_json[key]
-      if _is_directory(item):
-        cls._delete_expected_entries(item)
-      else:
-        if EXPECTED_KEY in item:
-          del item[EXPECTED_KEY]
-        if BUG_KEY in item:
-          del item[BUG_KEY]
-
   @classmethod
   def _merge_non_test_data(cls, aggregated_json, incremental_json,
         num_runs):  # pragma: no cover
@@ -222,137 +639,6 @@ class JsonResults(object):
       else:
         aggregated_json[key] = incremental_json[key]
 
-  @classmethod
-  def _merge_tests(cls, aggregated_json, incremental_json,
-        num_runs):  # pragma: no cover
-    # FIXME: Some data got corrupted and has results/times at the directory
-    # level. Once the data is fixed, this should assert that the directory
-    # level does not have
-    # results or times and just return "RESULTS_KEY not in subtree".
-    if RESULTS_KEY in aggregated_json:
-      del aggregated_json[RESULTS_KEY]
-    if TIMES_KEY in aggregated_json:
-      del aggregated_json[TIMES_KEY]
-
-    all_tests = set(aggregated_json.iterkeys())
-    if incremental_json:
-      all_tests |= set(incremental_json.iterkeys())
-
-    for test_name in all_tests:
-      if test_name not in aggregated_json:
-        aggregated_json[test_name] = incremental_json[test_name]
-        continue
-
-      incremental_sub_result = None
-      if incremental_json and test_name in incremental_json:
-        incremental_sub_result = incremental_json[test_name]
-      if _is_directory(aggregated_json[test_name]):
-        cls._merge_tests(
-            aggregated_json[test_name], incremental_sub_result, num_runs)
-        continue
-
-      aggregated_test = aggregated_json[test_name]
-
-      if incremental_sub_result:
-        results = incremental_sub_result[RESULTS_KEY]
-        times = incremental_sub_result[TIMES_KEY]
-        if (EXPECTED_KEY in incremental_sub_result
-          and incremental_sub_result[EXPECTED_KEY] != PASS_STRING):
-          aggregated_test[EXPECTED_KEY] = incremental_sub_result[EXPECTED_KEY]
-        if BUG_KEY in incremental_sub_result:
-          aggregated_test[BUG_KEY] = incremental_sub_result[BUG_KEY]
-      else:
-        results = [[1, NO_DATA]]
-        times = [[1, 0]]
-
-      # Check that the test data is present and reset it if either results or
-      # times are missing. This shouldn't happen but it has at least once.
-      # See crbug.com/573343.
-      if TIMES_KEY not in aggregated_test or RESULTS_KEY not in aggregated_test:
-        aggregated_json[test_name] = {
-            RESULTS_KEY: results,
-            TIMES_KEY: times,
-        }
-        continue
-
-      cls._insert_item_run_length_encoded(
-          results, aggregated_test[RESULTS_KEY], num_runs)
-      cls._insert_item_run_length_encoded(
-          times, aggregated_test[TIMES_KEY], num_runs)
-
-  @classmethod
-  def _insert_item_run_length_encoded(cls, incremental_items, aggregated_items,
-      num_runs):  # pragma: no cover
-    """Prepend incremental items to the aggregates list.
-
-    Args:
-      incremental_items: List to read of 2-item lists, [[count, value], ...]
-      aggregated_items: List to modify of 2-item lists, [[count, value], ...]
-      num_runs: Max number of runs for a single item.
-    """
-    for item in incremental_items:
-      if len(aggregated_items) and item[1] == aggregated_items[0][1]:
-        aggregated_items[0][0] = min(aggregated_items[0][0] + item[0], num_runs)
-      else:
-        aggregated_items.insert(0, item)
-
-  @classmethod
-  def _normalize_results(cls, aggregated_json, num_runs,
-      run_time_pruning_threshold):  # pragma: no cover
-    names_to_delete = []
-    for test_name in aggregated_json:
-      if _is_directory(aggregated_json[test_name]):
-        cls._normalize_results(
-            aggregated_json[test_name], num_runs, run_time_pruning_threshold)
-        # If normalizing deletes all the children of this directory, also
-        # delete the directory.
-        if not aggregated_json[test_name]:
-          names_to_delete.append(test_name)
-      else:
-        leaf = aggregated_json[test_name]
-        leaf[RESULTS_KEY] = cls._remove_items_over_max_number_of_builds(
-            leaf[RESULTS_KEY], num_runs)
-        leaf[TIMES_KEY] = cls._remove_items_over_max_number_of_builds(
-            leaf[TIMES_KEY], num_runs)
-        if cls._should_delete_leaf(leaf, run_time_pruning_threshold):
-          names_to_delete.append(test_name)
-
-    for test_name in names_to_delete:
-      del aggregated_json[test_name]
-
-  @classmethod
-  def _should_delete_leaf(cls, leaf,
-        run_time_pruning_threshold):  # pragma: no cover
-    if leaf.get(EXPECTED_KEY, PASS_STRING) != PASS_STRING:
-      return False
-
-    if BUG_KEY in leaf:
-      return False
-
-    deletable_types = set((PASS, NO_DATA, NOTRUN))
-    for result in leaf[RESULTS_KEY]:
-      if result[1] not in deletable_types:
-        return False
-
-    for time in leaf[TIMES_KEY]:
-      if time[1] >= run_time_pruning_threshold:
-        return False
-
-    return True
-
-  @classmethod
-  def _remove_items_over_max_number_of_builds(cls, encoded_list,
-        num_runs):  # pragma: no cover
-    num_builds = 0
-    index = 0
-    for result in encoded_list:
-      num_builds = num_builds + result[0]
-      index = index + 1
-      if num_builds >= num_runs:
-        return encoded_list[:index]
-
-    return encoded_list
-
   @classmethod
   def _convert_gtest_json_to_aggregate_results_format(cls,
         json_dict):  # pragma: no cover
@@ -495,40 +781,107 @@ class JsonResults(object):
 
     return aggregated_json, 200
 
+  @classmethod
+  def _get_aggregated_results(cls, builder, aggregated_data):
+    """Returns (PackedResults or error string, status code).
+
+    Accepts both packed and json aggregate results, returns (None, 200) if
+    there are none yet.
+    """
+    if not aggregated_data:
+      return None, 200
+    if not PackedResults.is_packed(aggregated_data):
+      aggregated_json, status_code = cls._get_aggregated_json(
+          builder, aggregated_data)
+      if not aggregated_json or status_code != 200:
+        return aggregated_json, status_code
+      return PackedResults.from_json(builder, aggregated_json), 200
+
+    logging.info("Loading existing packed results.")
+    try:
+      packed = PackedResults.from_string(aggregated_data)
+    except ValueError as e:
+      logging.error("Failed to load packed results: %s", e)
+      return None, 200
+    if packed.builder != builder:
+      return "Builder '%s' is not in json results." % builder, 500
+    if not BUILD_NUMBERS_KEY in packed.info:
+      return "Missing build number in json results.", 500
+    return packed, 200
+
+  @staticmethod
+  def _get_run_time_pruning_threshold(builder):
+    if re.search(r"(Debug|Dbg)", builder, re.I):
+      return 3 * JSON_RESULTS_MIN_TIME
+    return JSON_RESULTS_MIN_TIME
+
+  @classmethod
+  def merge_packed(cls, builder, aggregated_data, incremental_json, num_runs):
+    """Merges one build of results into aggregate results.
+
+    Args:
+      builder: name of the builder.
+      aggregated_data: existing aggregate results, packed or json.
+      incremental_json: parsed json of the build, in the aggregate format.
+      num_runs: max number of builds to keep.
+
+    Returns:
+      (PackedResults or error string, status code).
+    """
+    aggregated, status_code = cls._get_aggregated_results(
+        builder, aggregated_data)
+    if status_code != 200:
+      return aggregated, status_code
+    return cls._merge_into(builder, aggregated, incremental_json, num_runs)
+
+  @classmethod
+  def _merge_into(cls, builder, aggregated, incremental_json, num_runs):
+    """Like merge_packed, but |aggregated| is PackedResults or None.
+
+    Does not modify |aggregated|.
+    """
+    run_time_pruning_threshold = cls._get_run_time_pruning_threshold(builder)
+    if not aggregated:
+      aggregated = PackedResults.from_json(builder, incremental_json)
+      return aggregated.normalize(num_runs, run_time_pruning_threshold), 200
+
+    if (aggregated.info[BUILD_NUMBERS_KEY][0]
+          == incremental_json[builder][BUILD_NUMBERS_KEY][0]):
+      status_string = ("Incremental JSON's build number %s is the latest "
+                       "build number in the aggregated JSON.") % str(
+          aggregated.info[BUILD_NUMBERS_KEY][0])
+      return status_string, 409
+
+    logging.info("Merging json results.")
+    try:
+      incremental = incremental_json[builder]
+      if incremental[TESTS_KEY]:
+        merged = aggregated.merge(
+            incremental[TESTS_KEY], num_runs, run_time_pruning_threshold)
+      else:
+        merged = aggregated.normalize(num_runs, run_time_pruning_threshold)
+      cls._merge_non_test_data(merged.info, incremental, num_runs)
+    except: # FIXME: This should be specific! # pylint: disable=W0702
+      return ("Failed to merge json results: %s" %
+          traceback.print_exception(*sys.exc_info()), 500)
+    return merged, 200
+
   @classmethod
   def merge(cls, builder, aggregated_string, incremental_json, num_runs,
-        sort_keys=False):  # pragma: no cover
-    aggregated_json, status_code = cls._get_aggregated_json(
-        builder, aggregated_string)
-    if not aggregated_json:
-      aggregated_json = incremental_json
-    elif status_code != 200:
-      return aggregated_json, status_code
-    else:
-      if (aggregated_json[builder][BUILD_NUMBERS_KEY][0]
-            == incremental_json[builder][BUILD_NUMBERS_KEY][0]):
-        status_string = ("Incremental JSON's build number %s is the latest "
-                         "build number in the aggregated JSON.") % str(
-            aggregated_json[builder][BUILD_NUMBERS_KEY][0])
-        return status_string, 409
-
-      logging.info("Merging json results.")
-      try:
-        cls._merge_json(aggregated_json[builder],
-            incremental_json[builder], num_runs)
-      except: # FIXME: This should be specific! # pylint: disable=W0702
-        return ("Failed to merge json results: %s" %
-            traceback.print_exception(*sys.exc_info()), 500)
-
-    aggregated_json[VERSIONS_KEY] = JSON_RESULTS_HIERARCHICAL_VERSION
-    aggregated_json[builder][FAILURE_MAP_KEY] = CHAR_TO_FAILURE
-
-    is_debug_builder = re.search(r"(Debug|Dbg)", builder, re.I)
-    run_time_pruning_threshold = 3 * \
-        JSON_RESULTS_MIN_TIME if is_debug_builder else JSON_RESULTS_MIN_TIME
-    cls._normalize_results(aggregated_json[builder][TESTS_KEY], num_runs,
-        run_time_pruning_threshold)
-    return cls._generate_file_data(aggregated_json, sort_keys), 200
+        sort_keys=False):
+    merged, status_code = cls.merge_packed(
+        builder, aggregated_string, incremental_json, num_runs)
+    if status_code != 200:
+      return merged, status_code
+    return cls._generate_file_data(merged.to_json(), sort_keys), 200
+
+  @classmethod
+  def get_json_data(cls, file_data):
+    """Returns file data in json, converting packed aggregate results."""
+    if not PackedResults.is_packed(file_data):
+      return file_data
+    return cls._generate_file_data(
+        PackedResults.from_string(file_data).to_json())
 
   @classmethod
   def _get_aggregate_file(cls, master, builder, test_type, filename,
@@ -636,6 +989,134 @@ class JsonResults(object):
     return cls.update_files(builder, results_json, small_file, large_file,
         is_full_results_format)
 
+  @classmethod
+  def queue_update(cls, master, builder, test_type, results_json,
+        deprecated_master, is_full_results_format):
+    """Like update, but only appends the results to the pending results log.
+
+    The log is merged into the aggregate files by a task, see merge_pending,
+    so uploads don't have to load and rewrite the aggregate files.
+    """
+    if (is_full_results_format and
+        not cls.is_valid_full_results_json(results_json)):
+      return ('Invalid full_results.json file.', 403)
+    incremental_json, status_code = cls._get_incremental_json(
+        builder, results_json, is_full_results_format)
+    if status_code != 200:
+      return incremental_json, status_code
+
+    record = PendingResults.add(master, builder, test_type, deprecated_master,
+        cls._generate_file_data(incremental_json))
+    if not record:
+      return ("Couldn't save pending results. master: %s, builder: %s, "
+              "test_type: %s." % (master, builder, test_type), 500)
+
+    if (PendingResults.count(master, builder, test_type, MAX_PENDING_RESULTS)
+          >= MAX_PENDING_RESULTS):
+      logging.warning("Too many pending results, merging them now.")
+      status_string, status_code = cls.merge_pending(
+          master, builder, test_type)
+      if status_code != 503:
+        return status_string, status_code
+      # Another merge is in progress, the task added below merges the rest.
+
+    cls._enqueue_merge_pending(master, builder, test_type)
+    return "Queued results for merging. %s" % record.file_information, 200
+
+  @staticmethod
+  def _enqueue_merge_pending(master, builder, test_type):
+    # Only one task is added per builder in each MERGE_PENDING_DELAY window.
+    # It runs after the window ends, so it merges all uploads of the window.
+    log_hash = hashlib.sha1(
+        str(PendingResults.log_key(master, builder, test_type))).hexdigest()
+    window = int(time.time()) // MERGE_PENDING_DELAY
+    try:
+      taskqueue.add(
+          url=MERGE_PENDING_URL,
+          name="merge-%s-%d" % (log_hash, window),
+          params={
+              "master": master,
+              "builder": builder,
+              "testtype": test_type,
+          },
+          countdown=MERGE_PENDING_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+  @classmethod
+  def _merge_pending_into(cls, builder, aggregated, incremental_jsons,
+        num_runs):
+    """Returns |aggregated| with builds in |incremental_jsons| merged in.
+
+    Skips builds that fail to merge or are in |aggregated| already, e.g.
+    because a previous merge_pending saved the aggregate files but failed to
+    delete the pending results.
+    """
+    for incremental_json in incremental_jsons:
+      if not incremental_json:
+        continue
+      build_number = incremental_json[builder][BUILD_NUMBERS_KEY][0]
+      if aggregated and build_number in aggregated.info[BUILD_NUMBERS_KEY]:
+        logging.warning("Build %s is merged already.", build_number)
+        continue
+      merged, status_code = cls._merge_into(
+          builder, aggregated, incremental_json, num_runs)
+      if status_code != 200:
+        logging.error("Failed to merge build %s: %s", build_number, merged)
+        continue
+      aggregated = merged
+    return aggregated
+
+  @classmethod
+  def merge_pending(cls, master, builder, test_type):
+    """Merges pending results of a builder into its aggregate files.
+
+    Merges of a builder are serialized by PendingResultsLog. Returns status
+    code 503 if another merge is in progress.
+    """
+    lease = PendingResultsLog.acquire(master, builder, test_type)
+    if not lease:
+      return ("Pending results are being merged already. master: %s, "
+              "builder: %s, test_type: %s." % (master, builder, test_type),
+              503)
+    try:
+      return cls._merge_pending(master, builder, test_type)
+    finally:
+      lease.release()
+
+  @classmethod
+  def _merge_pending(cls, master, builder, test_type):
+    pending = PendingResults.get_log(
+        master, builder, test_type, MAX_PENDING_RESULTS)
+    if not pending:
+      return "No pending results.", 200
+    incremental_jsons = [cls.load_json(p.data) for p in pending]
+    deprecated_master = next(
+        (p.deprecated_master for p in pending if p.deprecated_master), None)
+
+    for filename, num_runs in (
+        (JSON_RESULTS_FILE_SMALL, JSON_RESULTS_MAX_BUILDS_SMALL),
+        (JSON_RESULTS_FILE, JSON_RESULTS_MAX_BUILDS)):
+      record = cls._get_aggregate_file(
+          master, builder, test_type, filename, deprecated_master)
+      aggregated, status_code = cls._get_aggregated_results(
+          builder, record.data)
+      if status_code != 200:
+        return aggregated, status_code
+      merged = cls._merge_pending_into(
+          builder, aggregated, incremental_jsons, num_runs)
+      if merged is None:
+        continue
+      status_string, status_code = TestFile.save_file(
+          record, merged.to_string())
+      if status_code != 200:
+        return status_string, status_code
+
+    for p in pending:
+      p.delete_all()
+    return ("Merged %d pending results. master: %s, builder: %s, "
+            "test_type: %s." % (len(pending), master, builder, test_type), 200)
+
   @classmethod
   def update_files(cls, builder, results_json, small_file, large_file,
         is_full_results_format):  # pragma: no cover
@@ -655,11 +1136,11 @@ class JsonResults(object):
   @classmethod
   def update_file(cls, builder, record, incremental_json,
         num_runs):  # pragma: no cover
-    new_results, status_code = cls.merge(
+    new_results, status_code = cls.merge_packed(
         builder, record.data, incremental_json, num_runs)
     if status_code != 200:
       return new_results, status_code
-    return TestFile.save_file(record, new_results)
+    return TestFile.save_file(record, new_results.to_string())
 
   @classmethod
   def _delete_results_and_times(cls, tests):  # pragma: no cover
@@ -671,6 +1152,12 @@ class JsonResults(object):
 
   @classmethod
   def get_test_list(cls, builder, json_file_data):  # pragma: no cover
+    if PackedResults.is_packed(json_file_data):
+      packed = PackedResults.from_string(json_file_data)
+      if packed.builder != builder:
+        return None
+      return cls._generate_file_data(packed.to_test_list_json())
+
     logging.debug("Loading test results json...")
     json_dict = cls.load_json(json_file_data)
     if not json_dict:
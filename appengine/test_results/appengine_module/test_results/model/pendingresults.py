@@ -0,0 +1,115 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import datetime
+import json
+import uuid
+
+from google.appengine.ext import db
+
+from appengine_module.test_results.model.datastorefile import DataStoreFile
+
+
+class PendingResults(DataStoreFile):  # pylint: disable=W0232
+  """Incremental results of one build, not merged into aggregate files yet.
+
+  Uploads only append to a log of PendingResults per builder and test type;
+  JsonResults.merge_pending merges the log into results.json and
+  results-small.json later. All entries of a log have the same parent key, so
+  that the log can be read with a strongly consistent ancestor query.
+
+  data is the incremental results json, in the aggregate format.
+  """
+
+  master = db.StringProperty()
+  builder = db.StringProperty()
+  test_type = db.StringProperty()
+  # Master name the aggregate files may still be stored under, see
+  # JsonResults.update.
+  deprecated_master = db.StringProperty()
+
+  @property
+  def file_information(self):
+    return "master: %s, builder: %s, test_type: %s, date: %s." % (
+        self.master, self.builder, self.test_type, self.date)
+
+  @staticmethod
+  def log_key(master, builder, test_type):
+    return db.Key.from_path(
+        'PendingResultsLog', json.dumps([master, builder, test_type]))
+
+  @classmethod
+  def add(cls, master, builder, test_type, deprecated_master, data):
+    """Appends results json to the log, returns the new entry or None."""
+    record = cls(
+        parent=cls.log_key(master, builder, test_type),
+        master=master,
+        builder=builder,
+        test_type=test_type,
+        deprecated_master=deprecated_master)
+    if not record.save_data(data):
+      return None
+    record.put()
+    return record
+
+  @classmethod
+  def count(cls, master, builder, test_type, limit):
+    query = cls.all(keys_only=True).ancestor(
+        cls.log_key(master, builder, test_type))
+    return query.count(limit)
+
+  @classmethod
+  def get_log(cls, master, builder, test_type, limit):
+    """Returns up to |limit| oldest entries of a log, with data loaded."""
+    query = cls.all().ancestor(cls.log_key(master, builder, test_type))
+    entries = query.order('date').fetch(limit)
+    for entry in entries:
+      entry.load_data()
+    return entries
+
+  def delete_all(self):
+    self.delete_data()
+    self.delete()
+
+
+class PendingResultsLog(db.Model):  # pylint: disable=W0232
+  """Lease that serializes merges of a log of PendingResults.
+
+  Two concurrent merges of a log could both load an aggregate file, and the
+  one that saves it last would drop the results merged by the other one.
+  The key of the lease is the parent key of the log entries, see
+  PendingResults.log_key.
+  """
+
+  # As long as a task queue task may run.
+  LEASE_DURATION = datetime.timedelta(minutes=10)
+
+  owner = db.StringProperty()
+  lease_expiration = db.DateTimeProperty()
+
+  @classmethod
+  def acquire(cls, master, builder, test_type):
+    """Returns the lease of a log, or None if another merge holds it."""
+    key = PendingResults.log_key(master, builder, test_type)
+    owner = uuid.uuid4().hex
+
+    def txn():
+      now = datetime.datetime.utcnow()
+      lease = cls.get(key)
+      if lease and lease.lease_expiration > now:
+        return None
+      lease = cls(key=key, owner=owner,
+                  lease_expiration=now + cls.LEASE_DURATION)
+      lease.put()
+      return lease
+
+    return db.run_in_transaction(txn)
+
+  def release(self):
+    def txn():
+      lease = PendingResultsLog.get(self.key())
+      if lease and lease.owner == self.owner:
+        lease.delete()
+
+    db.run_in_transaction(txn)
@@ -91,6 +91,16 @@ class StepResult(ndb.Model):
   # '<n>B', where <n> is the number of actual results.
   TEST_PACK_FORMAT = '>IfBB'
   TEST_PACK_FORMAT_SIZE = struct.calcsize(TEST_PACK_FORMAT)
+  TEST_PACK_STRUCT = struct.Struct(TEST_PACK_FORMAT)
+
+  # Actual results that are failures, unless they are the expected result.
+  FAILURE_RESULTS = frozenset([
+      FAIL, CRASH, TIMEOUT, MISSING, LEAK, TEXT, AUDIO, IMAGE, IMAGETEXT])
+
+  # Outcomes of a test in a build, see getTestOutcomes.
+  TEST_PASSED = 'PASSED'
+  TEST_FAILED = 'FAILED'
+  TEST_FLAKY = 'FLAKY'
 
   master = ndb.StringProperty('m')
   builder_name = ndb.StringProperty('b')
@@ -106,12 +116,13 @@ class StepResult(ndb.Model):
   @classmethod
   def _encodeTests(cls, test_json):
     result = ''
+    try:
+      test_name_keys = TestName.getKeys(test_json.keys())
+    except:  # pragma: no cover
+      logging.error('Could not get global keys for test names')
+      raise
     for test_name, test_result in test_json.iteritems():
-      try:
-        test_name_key = TestName.getKey(test_name)
-      except:  # pragma: no cover
-        logging.error('Could not get global key for test name %s', test_name)
-        raise
+      test_name_key = test_name_keys[test_name]
       try:
         expected = cls.STR2RESULT[test_result['expected']]
         actual = tuple(
@@ -129,28 +140,117 @@ class StepResult(ndb.Model):
         raise
     return result
 
-  def _decodeTests(self):
-    results = {}
-    failures = [0] * len(self.RESULT2STR)
+  def _iterPackedTests(self):
+    """Yields (test name key, elapsed, expected, actual) for each test.
+
+    Reads the packed struct in place; actual is a str with one byte per
+    actual result.
+    """
+    tests = self.tests or ''
     i = 0
-    while i + self.TEST_PACK_FORMAT_SIZE < len(self.tests):
-      test_name_key, elapsed, expected, num_actual = struct.unpack(
-          self.TEST_PACK_FORMAT, self.tests[i:i+self.TEST_PACK_FORMAT_SIZE])
+    while i + self.TEST_PACK_FORMAT_SIZE <= len(tests):
+      test_name_key, elapsed, expected, num_actual = (
+          self.TEST_PACK_STRUCT.unpack_from(tests, i))
       i += self.TEST_PACK_FORMAT_SIZE
-      assert i + num_actual <= len(self.tests)
-      test_name = TestName.getTestName(test_name_key)
-      actual = struct.unpack('%dB' % num_actual, self.tests[i:i+num_actual])
+      assert i + num_actual <= len(tests)
+      yield test_name_key, elapsed, expected, tests[i:i+num_actual]
       i += num_actual
+    assert i == len(tests)
+
+  def _decodeTests(self):
+    entries = []
+    failures = [0] * len(self.RESULT2STR)
+    for test_name_key, elapsed, expected, actual in self._iterPackedTests():
+      actual = tuple(bytearray(actual))
       for a in actual:
         failures[a] += 1
+      entries.append((test_name_key, elapsed, expected, actual))
+
+    # Look up all test names at once.
+    test_names = TestName.getTestNames([e[0] for e in entries])
+    results = {}
+    for test_name, (_, elapsed, expected, actual) in zip(test_names, entries):
       results[str(test_name)] = {
           'expected': self.RESULT2STR[expected],
           'actual': ' '.join([self.RESULT2STR[a] for a in actual]),
           'time': str(elapsed)
       }
-    assert i == len(self.tests)
     return results, failures
 
+  @classmethod
+  def _getOutcome(cls, expected, actual):
+    failed = passed = False
+    for a in bytearray(actual):
+      if a == cls.PASS:
+        passed = True
+      elif a in cls.FAILURE_RESULTS and a != expected:
+        failed = True
+    if failed:
+      return cls.TEST_FLAKY if passed else cls.TEST_FAILED
+    return cls.TEST_PASSED if passed else None
+
+  def getTestOutcomes(self, test_keys):
+    """Return a dict of test name keys to their outcome in this step.
+
+    Only the given test name keys are looked at, without decoding the other
+    tests. A test failed if it had unexpected failures only, and is flaky if
+    it also passed when retried. Tests that neither passed nor failed, e.g.
+    skipped tests, are left out.
+    """
+    test_keys = set(test_keys)
+    outcomes = {}
+    for test_name_key, _, expected, actual in self._iterPackedTests():
+      if test_name_key in test_keys:
+        outcome = self._getOutcome(expected, actual)
+        if outcome:
+          outcomes[test_name_key] = outcome
+    return outcomes
+
+  @classmethod
+  def getLatest(cls, master, builder_name, test_type, num_builds):
+    """Return StepResults of the last num_builds builds, newest first."""
+    q = cls.query(cls.master == master,
+                  cls.builder_name == builder_name,
+                  cls.test_type == test_type)
+    return q.order(-cls.build_number).fetch(num_builds)
+
+  @classmethod
+  def getTestHistories(cls, step_results, test_keys):
+    """Return a dict of test name keys to [(build number, outcome)].
+
+    Builds are in the order of step_results, builds in which a test has no
+    outcome are left out.
+    """
+    histories = dict((k, []) for k in test_keys)
+    for step_result in step_results:
+      outcomes = step_result.getTestOutcomes(test_keys)
+      for test_name_key, outcome in outcomes.iteritems():
+        histories[test_name_key].append((step_result.build_number, outcome))
+    return histories
+
+  @classmethod
+  def getFailedTests(cls, step_results, test_keys):
+    """Return the set of test name keys that failed in any of step_results."""
+    histories = cls.getTestHistories(step_results, test_keys)
+    return set(k for k, history in histories.iteritems()
+               if any(o == cls.TEST_FAILED for _, o in history))
+
+  @classmethod
+  def getFlakyTests(cls, step_results, test_keys):
+    """Return the set of test name keys that are flaky in step_results.
+
+    A test is flaky if it was flaky in a build, or if it both failed and
+    passed across builds.
+    """
+    histories = cls.getTestHistories(step_results, test_keys)
+    flaky = set()
+    for test_name_key, history in histories.iteritems():
+      outcomes = set(o for _, o in history)
+      if (cls.TEST_FLAKY in outcomes or
+          outcomes >= set([cls.TEST_FAILED, cls.TEST_PASSED])):
+        flaky.add(test_name_key)
+    return flaky
+
   @classmethod
   def fromJson(cls, master, test_type, data):
     """Instantiate a new StepResult from parsed json.
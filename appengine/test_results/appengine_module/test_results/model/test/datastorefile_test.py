@@ -26,7 +26,9 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import os
 import unittest
+import zlib
 
 from appengine_module.test_results.model import datastorefile
 
@@ -45,6 +47,7 @@ class DataStoreFileTest(unittest.TestCase):
     self.testbed.init_datastore_v3_stub()
 
     self.test_file = datastorefile.DataStoreFile()
+    datastorefile._chunk_cache.clear()
 
   def tearDown(self):
     self.testbed.deactivate()
@@ -112,6 +115,94 @@ class DataStoreFileTest(unittest.TestCase):
     self.assertEqual(nkeys_after, nchunks)
     self.assertNotEqual(nkeys_before, nkeys_after)
 
+  def testSaveDataCompressed(self):
+    test_data = 'x' * datastorefile.MAX_ENTRY_LEN * 5
+    self.assertTrue(self.test_file.save_data(test_data))
+    self.assertTrue(self.test_file.compressed)
+    entries = datastorefile.DataEntry.all().fetch(10)
+    self.assertEqual(1, len(entries))
+    self.assertEqual(test_data, zlib.decompress(entries[0].data))
+
+  def testSaveDataIncompressible(self):
+    test_data = os.urandom(datastorefile.MAX_ENTRY_LEN * 3)
+    self.assertTrue(self.test_file.save_data(test_data))
+    entries = datastorefile.DataEntry.all().fetch(10)
+    self.assertTrue(len(entries) > 3)
+    for entry in entries:
+      self.assertTrue(len(entry.data) <= datastorefile.MAX_ENTRY_LEN)
+
+    self.test_file.load_data()
+    self.assertEqual(test_data, self.test_file.data)
+
+  def testSaveDataUnchangedChunks(self):
+    self.mock_raw_chunk_len(10)
+    self.assertTrue(self.test_file.save_data('a' * 10 + 'b' * 10))
+    old_keys = self.test_file.data_keys
+
+    self.assertTrue(self.test_file.save_data('a' * 10 + 'c' * 10))
+    self.assertEqual(old_keys[0], self.test_file.data_keys[0])
+    self.assertNotEqual(old_keys[1], self.test_file.data_keys[1])
+    self.assertEqual([old_keys[1]], self.test_file.new_data_keys)
+    self.assertEqual(3, datastorefile.DataEntry.all().count())
+
+    self.assertTrue(self.test_file.save_data('c' * 10 + 'a' * 10))
+    self.assertEqual(2, datastorefile.DataEntry.all().count())
+    self.test_file.load_data()
+    self.assertEqual('c' * 10 + 'a' * 10, self.test_file.data)
+
+  def testSaveDataChunksNotShared(self):
+    self.assertTrue(self.test_file.save_data('data'))
+    other_file = datastorefile.DataStoreFile()
+    self.assertTrue(other_file.save_data('data'))
+    self.assertNotEqual(self.test_file.data_keys, other_file.data_keys)
+
+    other_file.delete_data()
+    self.test_file.load_data()
+    self.assertEqual('data', self.test_file.data)
+
+  def testLoadDataCached(self):
+    self.mock_raw_chunk_len(10)
+    test_data = 'a' * 10 + 'b' * 10
+    self.assertTrue(self.test_file.save_data(test_data))
+    self.test_file.load_data()
+
+    get_async = datastorefile.DataEntry.get_async
+    datastorefile.DataEntry.get_async = None
+    try:
+      self.test_file.load_data()
+    finally:
+      datastorefile.DataEntry.get_async = get_async
+    self.assertEqual(test_data, self.test_file.data)
+
+  def testLoadDataUncompressed(self):
+    entries = [datastorefile.DataEntry(data=d) for d in ('abc', 'def')]
+    self.test_file.data_keys = [entry.put() for entry in entries]
+    self.test_file.load_data()
+    self.assertEqual('abcdef', self.test_file.data)
+
+    self.assertTrue(self.test_file.save_data('xyz'))
+    self.test_file.load_data()
+    self.assertEqual('xyz', self.test_file.data)
+
+  def testIterData(self):
+    self.mock_raw_chunk_len(2)
+    test_data = 'abcdefghijklmnopqrstuvwxyz'
+    self.assertTrue(self.test_file.save_data(test_data))
+    parts = list(self.test_file.iter_data())
+    self.assertEqual(13, len(parts))
+    self.assertEqual(test_data, ''.join(parts))
+
+  def testIterDataMissingChunk(self):
+    self.assertTrue(self.test_file.save_data('data'))
+    self.test_file.delete_data()
+    with self.assertRaises(datastorefile.MissingDataError):
+      list(self.test_file.iter_data())
+
+  def mock_raw_chunk_len(self, length):
+    old_length = datastorefile.MAX_RAW_CHUNK_LEN
+    datastorefile.MAX_RAW_CHUNK_LEN = length
+    self.addCleanup(setattr, datastorefile, 'MAX_RAW_CHUNK_LEN', old_length)
+
   def testGetChunkIndices(self):
     data_length = datastorefile.MAX_ENTRY_LEN * 3
     chunk_indices = self.test_file._get_chunk_indices(data_length)
@@ -36,6 +36,7 @@ import unittest
 from appengine_module.test_results.model import jsonresults
 from appengine_module.test_results.model.jsonresults import (
     JsonResults,
+    PackedResults,
     TEXT,
     FAIL,
     LEAK,
@@ -328,8 +329,85 @@ class JsonResultsTest(unittest.TestCase):
 
     self.assertTrue(JsonResults.update_files(small_file.builder,
         incremental_json, small_file, large_file, is_full_results_format=False))
-    self.assert_json_equal(small_file.data, incremental_string)
-    self.assert_json_equal(large_file.data, incremental_string)
+    self.assertTrue(PackedResults.is_packed(small_file.data))
+    self.assert_json_equal(
+        JsonResults.get_json_data(small_file.data), incremental_string)
+    self.assert_json_equal(
+        JsonResults.get_json_data(large_file.data), incremental_string)
+
+  def test_update_files_packed_aggregate_data(self):
+    small_file = MockFile(name='results-small.json')
+    large_file = MockFile(name='results.json')
+
+    def update(incremental_data):
+      incremental_json = JsonResults.load_json(self._make_test_json(
+          incremental_data, builder_name=small_file.builder))
+      return JsonResults.update_files(small_file.builder, incremental_json,
+          small_file, large_file, is_full_results_format=False)
+
+    update({
+        "builds": ["1"],
+        "tests": {
+            "dir": {
+                "001.html": {
+                    "results": [[1, TEXT]],
+                    "times": [[1, 5]],
+                    "expected": "FAIL",
+                    "bugs": ["crbug.com/1"],
+                },
+            },
+            "002.html": {
+                "results": [[1, PASS]],
+                "times": [[1, 0]],
+            },
+        }
+    })
+    self.assertEqual(('Saved file. %s' % large_file.file_information, 200),
+        update({
+            "builds": ["2"],
+            "tests": {
+                "dir": {
+                    "001.html": {
+                        "results": [[1, TEXT]],
+                        "times": [[1, 4]],
+                    },
+                },
+                "003.html": {
+                    "results": [[1, CRASH]],
+                    "times": [[1, 0]],
+                },
+            }
+        }))
+
+    expected_results = self._make_test_json({
+        "builds": ["2", "1"],
+        "tests": {
+            "dir": {
+                "001.html": {
+                    "results": [[2, TEXT]],
+                    "times": [[1, 4], [1, 5]],
+                },
+            },
+            "003.html": {
+                "results": [[1, CRASH]],
+                "times": [[1, 0]],
+            },
+        }
+    }, builder_name=small_file.builder)
+    for f in (small_file, large_file):
+      self.assertTrue(PackedResults.is_packed(f.data))
+      merged = json.loads(JsonResults.get_json_data(f.data))
+      expected = json.loads(expected_results)
+      # Only one build was merged into the files, its counts were not.
+      expected[small_file.builder]["num_failures_by_type"] = merged[
+          small_file.builder]["num_failures_by_type"]
+      self.assert_json_equal(merged, expected)
+
+    self.assert_json_equal(
+        JsonResults.get_test_list(small_file.builder, small_file.data),
+        {small_file.builder: {"tests": {"dir": {"001.html": {}},
+                                        "003.html": {}}}})
+    self.assertIsNone(JsonResults.get_test_list('Other', small_file.data))
 
   def test_update_files_null_incremental_data(self):
     small_file = MockFile(name='results-small.json')
@@ -1265,7 +1343,7 @@ class JsonResultsTest(unittest.TestCase):
         master['url_name'], builder, test_type, None, None, limit=3)
     self.assertEqual(len(files), 2)
     for f in files:
-      j = json.loads(f.data)
+      j = json.loads(JsonResults.get_json_data(f.data))
       self.assertItemsEqual(j[builder]['chromeRevision'],
                             ['761b2a4cbc3103ef5e48cc7e77184f57eb50f6d4',
                              '761b2a4cbc3103ef5e48cc7e77184f57eb50f6d5'])
@@ -1411,7 +1489,91 @@ class JsonResultsTest(unittest.TestCase):
                                 'times': [(1, 1)]}},
         }
     }
-    JsonResults._normalize_results(aggregated_json, 1, 2)
+    PackedResults.from_json(
+        'Webkit', {'Webkit': {'tests': aggregated_json}}).normalize(1, 2)
+
+  def test_packed_results_round_trip(self):
+    aggregated_json = json.loads(self._make_test_json({
+        "builds": ["2", "1"],
+        "tests": {
+            "foo": {
+                "001.html": {
+                    "results": [[1, TEXT], [1, FAIL + PASS]],
+                    "times": [[2, 7]],
+                    "expected": "FAIL",
+                },
+                "002.html": {
+                    "results": [[2, CRASH]],
+                    "times": [[2, 0]],
+                    "bugs": ["crbug.com/1234"],
+                },
+            },
+            "003.html": {
+                "results": [[2, PASS]],
+                "times": [[1, 1], [1, 0]],
+            },
+        }
+    }))
+    packed = PackedResults.from_json('Webkit', aggregated_json)
+    self.assertEqual(3, packed.num_tests)
+    data = packed.to_string()
+    self.assertTrue(PackedResults.is_packed(data))
+    self.assertFalse(PackedResults.is_packed(json.dumps(aggregated_json)))
+
+    unpacked = PackedResults.from_string(data)
+    self.assertEqual('Webkit', unpacked.builder)
+    self.assert_json_equal(unpacked.to_json(), aggregated_json)
+    self.assertEqual(data, unpacked.to_string())
+
+    # Merging into packed or json aggregate results gives the same result.
+    incremental_json = json.loads(self._make_test_json({
+        "builds": ["3"],
+        "tests": {
+            "foo": {
+                "001.html": {
+                    "results": [[1, TEXT]],
+                    "times": [[1, 7]],
+                },
+            },
+            "004.html": {
+                "results": [[1, TIMEOUT]],
+                "times": [[1, 0]],
+            },
+        }
+    }))
+    from_packed, status_code = JsonResults.merge(
+        'Webkit', data, incremental_json, num_runs=2)
+    self.assertEqual(200, status_code)
+    from_json, status_code = JsonResults.merge(
+        'Webkit', json.dumps(aggregated_json), incremental_json, num_runs=2)
+    self.assertEqual(200, status_code)
+    self.assert_json_equal(from_packed, from_json)
+    self.assertEqual({
+        "001.html": {"results": [[2, TEXT]], "times": [[2, 7]]},
+        "002.html": {
+            "results": [[1, NO_DATA], [2, CRASH]],
+            "times": [[2, 0]],
+        },
+    }, json.loads(from_packed)["Webkit"]["tests"]["foo"])
+
+  def test_packed_results_corrupted(self):
+    data = PackedResults.from_json('Webkit', json.loads(self._make_test_json({
+        "builds": ["1"],
+        "tests": {"001.html": {"results": [[1, TEXT]], "times": [[1, 0]]}},
+    }))).to_string()
+    for corrupted in ('{}', data[:-1], data + '\0', data[:20]):
+      with self.assertRaises(ValueError):
+        PackedResults.from_string(corrupted)
+
+    # Corrupted aggregate results are replaced, like unparsable json ones.
+    incremental_string = self._make_test_json({
+        "builds": ["2"],
+        "tests": {"002.html": {"results": [[1, TEXT]], "times": [[1, 0]]}},
+    })
+    merged, status_code = JsonResults.merge('Webkit', data[:-1],
+        JsonResults.load_json(incremental_string), num_runs=10)
+    self.assertEqual(200, status_code)
+    self.assert_json_equal(merged, incremental_string)
 
 
 if __name__ == '__main__':
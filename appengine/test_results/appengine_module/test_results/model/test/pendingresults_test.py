@@ -0,0 +1,179 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import datetime
+import json
+import unittest
+
+from appengine_module.testing_utils import testing
+from appengine_module.test_results.model import jsonresults
+from appengine_module.test_results.model.jsonresults import JsonResults
+from appengine_module.test_results.model.pendingresults import (
+    PendingResults,
+    PendingResultsLog,
+)
+from appengine_module.test_results.model.testfile import TestFile
+
+
+def full_results(build_number, tests):
+  return {
+      'tests': tests,
+      'build_number': str(build_number),
+      'version': jsonresults.JSON_RESULTS_HIERARCHICAL_VERSION,
+      'builder_name': 'builder',
+      'seconds_since_epoch': 1406123456 + build_number,
+      'num_failures_by_type': {'FAIL': 1, 'PASS': 1},
+      'chromium_revision': '%040d' % build_number,
+  }
+
+
+class PendingResultsTest(testing.AppengineTestCase):
+
+  def test_log(self):
+    first = PendingResults.add('master', 'builder', 'test', None, '{"a":1}')
+    PendingResults.add('master', 'builder', 'test', 'old', '{"a":2}')
+    PendingResults.add('master', 'builder', 'other', None, '{"a":3}')
+
+    self.assertEqual(2, PendingResults.count('master', 'builder', 'test', 10))
+    self.assertEqual(1, PendingResults.count('master', 'builder', 'test', 1))
+    log = PendingResults.get_log('master', 'builder', 'test', 10)
+    self.assertEqual(['{"a":1}', '{"a":2}'], [e.data for e in log])
+    self.assertEqual([None, 'old'], [e.deprecated_master for e in log])
+
+    first.delete_all()
+    log = PendingResults.get_log('master', 'builder', 'test', 10)
+    self.assertEqual(['{"a":2}'], [e.data for e in log])
+
+  def test_add_no_data(self):
+    self.assertIsNone(
+        PendingResults.add('master', 'builder', 'test', None, ''))
+
+  def test_lease(self):
+    lease = PendingResultsLog.acquire('master', 'builder', 'test')
+    self.assertTrue(lease)
+    self.assertIsNone(PendingResultsLog.acquire('master', 'builder', 'test'))
+    self.assertTrue(PendingResultsLog.acquire('master', 'builder', 'other'))
+    lease.release()
+    self.assertTrue(PendingResultsLog.acquire('master', 'builder', 'test'))
+
+  def test_lease_expired(self):
+    lease = PendingResultsLog.acquire('master', 'builder', 'test')
+    lease.lease_expiration = datetime.datetime(2016, 1, 1)
+    lease.put()
+    # E.g. the merge task was killed.
+    self.assertTrue(PendingResultsLog.acquire('master', 'builder', 'test'))
+    # Doesn't release the lease of the new owner.
+    lease.release()
+    self.assertIsNone(PendingResultsLog.acquire('master', 'builder', 'test'))
+
+
+class QueueUpdateTest(testing.AppengineTestCase):
+
+  def queue_update(self, build_number, tests):
+    return JsonResults.queue_update('master', 'builder', 'test',
+        full_results(build_number, tests), None, is_full_results_format=True)
+
+  def get_aggregate_json(self, name=jsonresults.JSON_RESULTS_FILE):
+    files = TestFile.get_files('master', 'builder', 'test', None, name)
+    if not files:
+      return None
+    return json.loads(JsonResults.get_json_data(files[0].data))
+
+  def test_queue_and_merge(self):
+    _, status_code = self.queue_update(1, {
+        'a.html': {'expected': 'PASS', 'actual': 'FAIL', 'time': 1},
+    })
+    self.assertEqual(200, status_code)
+    _, status_code = self.queue_update(2, {
+        'a.html': {'expected': 'PASS', 'actual': 'FAIL', 'time': 1},
+        'b.html': {'expected': 'PASS', 'actual': 'CRASH', 'time': 1},
+    })
+    self.assertEqual(200, status_code)
+
+    # Both uploads are merged by one task.
+    tasks = self.taskqueue_stub.get_filtered_tasks(
+        url=jsonresults.MERGE_PENDING_URL)
+    self.assertEqual(1, len(tasks))
+    self.assertIsNone(self.get_aggregate_json())
+
+    _, status_code = JsonResults.merge_pending('master', 'builder', 'test')
+    self.assertEqual(200, status_code)
+    self.assertEqual(
+        0, PendingResults.count('master', 'builder', 'test', 10))
+    expected_tests = {
+        'a.html': {'results': [[2, jsonresults.FAIL]], 'times': [[2, 1]]},
+        'b.html': {'results': [[1, jsonresults.CRASH]], 'times': [[1, 1]]},
+    }
+    for name in (jsonresults.JSON_RESULTS_FILE,
+                 jsonresults.JSON_RESULTS_FILE_SMALL):
+      files = TestFile.get_files('master', 'builder', 'test', None, name)
+      self.assertTrue(jsonresults.PackedResults.is_packed(files[0].data))
+      aggregate_json = self.get_aggregate_json(name)
+      self.assertEqual(expected_tests, aggregate_json['builder']['tests'])
+      self.assertEqual(['2', '1'], aggregate_json['builder']['buildNumbers'])
+
+    self.assertEqual(
+        ('No pending results.', 200),
+        JsonResults.merge_pending('master', 'builder', 'test'))
+
+  def test_merge_skips_merged_builds(self):
+    tests = {'a.html': {'expected': 'PASS', 'actual': 'FAIL', 'time': 1}}
+    self.queue_update(1, tests)
+    JsonResults.merge_pending('master', 'builder', 'test')
+    # E.g. merge_pending failed to delete pending results last time.
+    self.queue_update(1, tests)
+    self.queue_update(2, tests)
+    JsonResults.merge_pending('master', 'builder', 'test')
+
+    aggregate_json = self.get_aggregate_json()
+    self.assertEqual(['2', '1'], aggregate_json['builder']['buildNumbers'])
+    self.assertEqual(
+        {'results': [[2, jsonresults.FAIL]], 'times': [[2, 1]]},
+        aggregate_json['builder']['tests']['a.html'])
+
+  def test_too_many_pending_results(self):
+    self.mock(jsonresults, 'MAX_PENDING_RESULTS', 2)
+    tests = {'a.html': {'expected': 'PASS', 'actual': 'FAIL', 'time': 1}}
+    self.queue_update(1, tests)
+    status_string, status_code = self.queue_update(2, tests)
+    self.assertEqual(200, status_code)
+    self.assertTrue(status_string.startswith('Merged 2 pending results.'))
+    self.assertTrue(TestFile.get_files('master', 'builder', 'test', None,
+                                       jsonresults.JSON_RESULTS_FILE))
+
+  def test_merge_in_progress(self):
+    tests = {'a.html': {'expected': 'PASS', 'actual': 'FAIL', 'time': 1}}
+    self.queue_update(1, tests)
+    lease = PendingResultsLog.acquire('master', 'builder', 'test')
+
+    _, status_code = JsonResults.merge_pending('master', 'builder', 'test')
+    self.assertEqual(503, status_code)
+    self.assertEqual(1, PendingResults.count('master', 'builder', 'test', 10))
+
+    # Uploads leave the merge to a task.
+    self.mock(jsonresults, 'MAX_PENDING_RESULTS', 2)
+    status_string, status_code = self.queue_update(2, tests)
+    self.assertEqual(200, status_code)
+    self.assertTrue(status_string.startswith('Queued results for merging.'))
+
+    lease.release()
+    _, status_code = JsonResults.merge_pending('master', 'builder', 'test')
+    self.assertEqual(200, status_code)
+    self.assertEqual(
+        ['2', '1'], self.get_aggregate_json()['builder']['buildNumbers'])
+
+  def test_invalid_results(self):
+    self.assertEqual(
+        ('Invalid full_results.json file.', 403),
+        JsonResults.queue_update('master', 'builder', 'test', {}, None,
+                                 is_full_results_format=True))
+    self.assertEqual(
+        ('No incremental JSON data to merge.', 403),
+        JsonResults.queue_update('master', 'builder', 'test', None, None,
+                                 is_full_results_format=False))
+    self.assertEqual(0, PendingResults.count('master', 'builder', 'test', 10))
+
+
+if __name__ == '__main__':
+  unittest.main()
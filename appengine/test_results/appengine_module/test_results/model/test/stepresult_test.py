@@ -11,6 +11,7 @@ import unittest
 from appengine_module.testing_utils import testing
 from appengine_module.test_results.model.stepresult import StepResult
 from appengine_module.test_results.model.testfile import TestFile
+from appengine_module.test_results.model.testname import TestName
 
 
 class StepResultTest(testing.AppengineTestCase):
@@ -104,5 +105,59 @@ class StepResultTest(testing.AppengineTestCase):
     self.assertEqual(self._massage_json(copy.deepcopy(self.test_json_1)),
                      self._massage_json(copy.deepcopy(json_out)))
 
+  def _put_step_result(self, build_number, actual_results):
+    data = copy.deepcopy(self.test_json_1)
+    data['build_number'] = str(build_number)
+    data['tests'] = dict(
+        (name, {'expected': 'PASS', 'actual': actual, 'time': '1'})
+        for name, actual in actual_results.iteritems())
+    step_result = StepResult.fromJson('test_master', 'test_step', data)
+    step_result.put()
+    return step_result
+
+  def testGetTestOutcomes(self):
+    step_result = StepResult.fromJson(
+        'test_master', 'test_step', self.test_json_1)
+    keys = [TestName.getKey('test_name_%d' % i) for i in (1, 2, 3)]
+    self.assertEqual({keys[0]: StepResult.TEST_FAILED},
+                     step_result.getTestOutcomes(keys))
+    self.assertEqual({}, step_result.getTestOutcomes(keys[1:]))
+
+    step_result = self._put_step_result(
+        1, {'a': 'PASS', 'b': 'TIMEOUT PASS', 'c': 'SKIP'})
+    keys = TestName.getKeys(['a', 'b', 'c'])
+    self.assertEqual(
+        {keys['a']: StepResult.TEST_PASSED, keys['b']: StepResult.TEST_FLAKY},
+        step_result.getTestOutcomes(keys.values()))
+
+  def testFailedAndFlakyTests(self):
+    self._put_step_result(1, {'a': 'PASS', 'b': 'FAIL', 'c': 'PASS',
+                              'd': 'FAIL'})
+    self._put_step_result(2, {'a': 'PASS', 'b': 'FAIL', 'c': 'CRASH PASS',
+                              'd': 'PASS'})
+    self._put_step_result(3, {'a': 'PASS', 'b': 'PASS', 'c': 'PASS'})
+    keys = TestName.getKeys(['a', 'b', 'c', 'd'])
+
+    step_results = StepResult.getLatest(
+        'test_master', 'test_builder_name', 'test_step', 2)
+    self.assertEqual([3, 2], [s.build_number for s in step_results])
+    histories = StepResult.getTestHistories(step_results, keys.values())
+    self.assertEqual(
+        [(3, StepResult.TEST_PASSED), (2, StepResult.TEST_FLAKY)],
+        histories[keys['c']])
+    self.assertEqual([(2, StepResult.TEST_PASSED)], histories[keys['d']])
+    self.assertEqual(
+        set([keys['b']]),
+        StepResult.getFailedTests(step_results, keys.values()))
+    self.assertEqual(
+        set([keys['b'], keys['c']]),
+        StepResult.getFlakyTests(step_results, keys.values()))
+
+    step_results = StepResult.getLatest(
+        'test_master', 'test_builder_name', 'test_step', 3)
+    self.assertEqual(
+        set([keys['b'], keys['c'], keys['d']]),
+        StepResult.getFlakyTests(step_results, keys.values()))
+
 if __name__ == '__main__':
   unittest.main()
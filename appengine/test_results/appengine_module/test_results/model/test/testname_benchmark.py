@@ -0,0 +1,103 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Benchmark of TestName lookups on a cold instance.
+
+Compares loading the whole test name dict before the first lookup, as
+TestName used to do, with the memcache snapshot, with and without the
+snapshot in memcache.
+
+Usage (from appengine/test_results, with the App Engine SDK in PYTHONPATH):
+  python -m appengine_module.test_results.model.test.testname_benchmark \\
+      --names 100000 --step-names 5000
+"""
+
+import argparse
+import collections
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from appengine_module.test_results.model.testname import TestName
+
+
+def put_names(count):
+  names = ['test_%d.html' % i for i in xrange(count)]
+  for start in xrange(0, count, 1000):
+    TestName.getKeys(names[start:start + 1000])
+  return names
+
+
+def full_load(_names):
+  TestName._resetLocalCache()  # pylint: disable=W0212
+  TestName.query().map(
+      lambda e: TestName._insertCacheEntry(  # pylint: disable=W0212
+          e.key.integer_id(), e.name))
+
+
+def cold_memcache(_names):
+  TestName._resetLocalCache()  # pylint: disable=W0212
+  memcache.flush_all()
+
+
+def warm_memcache(_names):
+  TestName._resetLocalCache()  # pylint: disable=W0212
+
+
+MODES = collections.OrderedDict([
+    ('full_load', full_load),
+    ('cold_memcache', cold_memcache),
+    ('warm_memcache', warm_memcache),
+])
+
+
+def run_benchmark(args):
+  """Returns {mode: seconds to look up the names of a step, cold}.
+
+  The time includes loading the dict in full_load mode.
+  """
+  tb = testbed.Testbed()
+  tb.activate()
+  try:
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+
+    names = put_names(args.names)
+    step_names = random.sample(names, args.step_names)
+    step_keys = TestName.getKeys(step_names).values()
+    # Warm memcache for warm_memcache, as a previous instance would have.
+    TestName._resetLocalCache()  # pylint: disable=W0212
+    TestName.getTestNames(step_keys)
+
+    results = collections.OrderedDict()
+    for mode, prepare in MODES.iteritems():
+      start = time.time()
+      prepare(names)
+      TestName.getKeys(step_names)
+      TestName.getTestNames(step_keys)
+      results[mode] = time.time() - start
+    return results
+  finally:
+    tb.deactivate()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--names', type=int, default=100000,
+                      help='number of test names in the datastore')
+  parser.add_argument('--step-names', type=int, default=5000,
+                      help='number of test names in a step')
+  args = parser.parse_args()
+
+  print '%-14s %10s' % ('mode', 'seconds')
+  for mode, elapsed in run_benchmark(args).iteritems():
+    print '%-14s %10.3f' % (mode, elapsed)
+
+
+if __name__ == '__main__':
+  main()
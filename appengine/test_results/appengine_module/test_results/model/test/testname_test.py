@@ -5,11 +5,24 @@
 
 import unittest
 
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
 from appengine_module.testing_utils import testing
+from appengine_module.test_results.model import testname
 from appengine_module.test_results.model.testname import TestName
 
+
+# Allow this unittest to access _members.
+# pylint: disable=W0212
+
+
 class TestNameTest(testing.AppengineTestCase):
 
+  def setUp(self):
+    super(TestNameTest, self).setUp()
+    TestName._resetLocalCache()
+
   def testTestNameRoundTrip(self):
     self.assertFalse(TestName.hasTestName('foo'))
     self.assertRaises(AssertionError, TestName.getTestName, 123)
@@ -18,6 +31,100 @@ class TestNameTest(testing.AppengineTestCase):
     self.assertEqual(TestName.getAllKeys('bar'), [k])
     self.assertEquals(TestName.getTestName(k), 'bar')
 
+  def testGetKeys(self):
+    allocate_calls = []
+    allocate_ids = TestName.allocate_ids
+    def mock_allocate_ids(_cls, size):
+      allocate_calls.append(size)
+      return allocate_ids(size)
+    self.mock(TestName, 'allocate_ids', classmethod(mock_allocate_ids))
+
+    keys = TestName.getKeys(['a', 'b', 'c', 'a'])
+    self.assertEqual(['a', 'b', 'c'], sorted(keys))
+    self.assertEqual(3, len(set(keys.values())))
+    self.assertEqual([3], allocate_calls)
+
+    self.assertEqual(keys, TestName.getKeys(['a', 'b', 'c']))
+    self.assertEqual([3], allocate_calls)
+    self.assertEqual(['c', 'a'],
+                     TestName.getTestNames([keys['c'], keys['a']]))
+
+  def testColdInstance(self):
+    keys = TestName.getKeys(['a', 'b'])
+    # Adding names doesn't cache them, the first lookup does.
+    TestName._resetLocalCache()
+    TestName.getKeys(['a', 'b'])
+    TestName.getTestNames(keys.values())
+
+    # Another instance reads names from memcache only.
+    TestName._resetLocalCache()
+    self.mock(TestName, 'query', None)
+    self.mock(ndb, 'get_multi', None)
+    self.assertEqual(keys, TestName.getKeys(['a', 'b']))
+    self.assertEqual(['a', 'b'], TestName.getTestNames([keys['a'], keys['b']]))
+
+  def testColdMemcache(self):
+    keys = TestName.getKeys(['a', 'b'])
+    TestName._resetLocalCache()
+    memcache.flush_all()
+
+    self.assertEqual(['b', 'a'], TestName.getTestNames([keys['b'], keys['a']]))
+    self.assertTrue(TestName.hasTestName('a'))
+    self.assertFalse(TestName.hasTestName('c'))
+    self.assertEqual(keys, TestName.getKeys(['a', 'b']))
+
+  def testNameAddedConcurrently(self):
+    key_a = TestName.getKey('a')
+    TestName._resetLocalCache()
+    self.assertEqual([key_a], TestName.getAllKeys('a'))
+
+    # Another instance didn't see 'a' and adds it again.
+    TestName._resetLocalCache()
+    TestName._addTestNames(['a'])
+    key_a2 = TestName.NAME_CACHE['a'][0]
+
+    TestName._resetLocalCache()
+    self.assertEqual([key_a, key_a2], TestName.getAllKeys('a'))
+
+  def testShardOverMemcacheLimit(self):
+    self.mock(testname, 'SNAPSHOT_SHARD_SIZE', 2)
+    keys = TestName.getKeys(['a', 'b', 'c'])
+    self.assertEqual(
+        set([0, 1]),
+        set(k // testname.SNAPSHOT_SHARD_SIZE for k in keys.values()))
+    TestName._resetLocalCache()
+    memcache.flush_all()
+
+    version = TestName._snapshotVersion()
+    too_big = TestName._shardMemcacheKey(version, 0)
+    def mock_set_multi(_mapping):
+      raise ValueError('Values may not be more than 1000000 bytes in length')
+    set_value = memcache.set
+    def mock_set(key, value):
+      if key == too_big:
+        raise ValueError('Values may not be more than 1000000 bytes in length')
+      return set_value(key, value)
+    self.mock(memcache, 'set_multi', mock_set_multi)
+    self.mock(memcache, 'set', mock_set)
+
+    self.assertEqual(['a', 'b', 'c'],
+                     TestName.getTestNames([keys['a'], keys['b'], keys['c']]))
+    self.assertIsNone(memcache.get(too_big))
+    self.assertTrue(memcache.get(TestName._shardMemcacheKey(version, 1)))
+
+  def testNameAddedAfterShardLoaded(self):
+    key_a = TestName.getKey('a')
+
+    TestName._resetLocalCache()
+    self.assertEqual(['a'], TestName.getTestNames([key_a]))
+    self.assertIn(key_a // testname.SNAPSHOT_SHARD_SIZE,
+                  TestName.LOADED_SHARDS)
+
+    # Another instance adds a name in the same shard.
+    key_b = key_a + 1
+    TestName(name='b', key=ndb.Key(TestName, key_b)).put()
+    self.assertEqual(['b'], TestName.getTestNames([key_b]))
+
 
 if __name__ == '__main__':
   unittest.main()
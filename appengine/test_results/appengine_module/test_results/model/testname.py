@@ -2,8 +2,23 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
+# Snapshot shard n holds the names with ids in
+# [n * SNAPSHOT_SHARD_SIZE, (n + 1) * SNAPSHOT_SHARD_SIZE).
+SNAPSHOT_SHARD_SIZE = 4096
+# Memcache key of the snapshot version. All memcache entries of the snapshot
+# are keyed by version, so that they are dropped together when this key is
+# evicted.
+SNAPSHOT_VERSION_KEY = 'testname:version'
+# Number of test name queries run in parallel.
+QUERY_BATCH_SIZE = 100
+
 
 class TestName(ndb.Model):
   """A global dict of all known test names, mapped to unique integer keys.
@@ -17,58 +32,151 @@ class TestName(ndb.Model):
   simply allows multiple unique integers to be associated with a single test
   name.  To serve a query over all instances of a test name, the query must
   search for all integers associated with that test name.
+
+  The dict is shared between instances through a snapshot in memcache, and
+  each instance keeps the parts it used in NAME_CACHE and NAME_REVERSE_CACHE.
+  The snapshot has one entry per test name, for name to key lookups, and
+  shards by key range, for key to name lookups. Entries missing from memcache
+  are read from the datastore when they are needed, so an instance never
+  loads the whole dict.
   """
 
   name = ndb.StringProperty('n')
 
   NAME_CACHE = {}
   NAME_REVERSE_CACHE = {}
+  # Snapshot shards already loaded in NAME_REVERSE_CACHE.
+  LOADED_SHARDS = set()
 
   @classmethod
-  def _insertCacheEntry(cls, e):
-    cls.NAME_CACHE.setdefault(e.name, []).append(e.key.integer_id())
-    cls.NAME_REVERSE_CACHE[e.key.integer_id()] = e.name
+  def _resetLocalCache(cls):
+    cls.NAME_CACHE.clear()
+    cls.NAME_REVERSE_CACHE.clear()
+    cls.LOADED_SHARDS.clear()
 
   @classmethod
-  def _guaranteeNameCache(cls):  # pragma: no cover
-    if cls.NAME_CACHE:
-      return
-    q = cls.query()
-    q.map(cls._insertCacheEntry)
+  def _insertCacheEntry(cls, key, testName):
+    if key not in cls.NAME_REVERSE_CACHE:
+      cls.NAME_CACHE.setdefault(testName, []).append(key)
+      cls.NAME_REVERSE_CACHE[key] = testName
+
+  @staticmethod
+  def _snapshotVersion():
+    version = memcache.get(SNAPSHOT_VERSION_KEY)
+    if version is None:
+      # Not 1, so that entries of an evicted version are not reused.
+      memcache.add(SNAPSHOT_VERSION_KEY, int(time.time() * 1000))
+      version = memcache.get(SNAPSHOT_VERSION_KEY)
+    return version
+
+  @staticmethod
+  def _nameMemcacheKey(version, testName):
+    if isinstance(testName, unicode):
+      testName = testName.encode('utf-8')
+    return 'testname:%s:name:%s' % (
+        version, hashlib.sha1(testName).hexdigest())
+
+  @staticmethod
+  def _shardMemcacheKey(version, shard):
+    return 'testname:%s:shard:%d' % (version, shard)
 
   @classmethod
-  def _addTestName(cls, testName):
-    # If the test name was recently added by a different instance of the app,
-    # then it will be present in the DB but missing from the cache.
-    q = cls.query(cls.name == testName)
-    entity = q.get()
-    if entity is None:  # pragma: no branch
-      first, _ = cls.allocate_ids(1)
-      entity = cls(name=testName, key=ndb.Key(cls, first))
-      entity.put()
-    cls._insertCacheEntry(entity)
-    return entity
+  def _lookupTestNames(cls, testNames):
+    """Loads keys of test names in the local cache.
+
+    Returns the test names that are not in the database.
+    """
+    missing = [n for n in set(testNames) if n not in cls.NAME_CACHE]
+    if not missing:
+      return []
+
+    version = cls._snapshotVersion()
+    memcache_keys = dict(
+        (cls._nameMemcacheKey(version, n), n) for n in missing)
+    cached = memcache.get_multi(memcache_keys.keys())
+    for memcache_key, keys in cached.iteritems():
+      for key in keys:
+        cls._insertCacheEntry(key, memcache_keys[memcache_key])
+    missing = [n for n in missing if n not in cls.NAME_CACHE]
+
+    # If a test name was recently added by a different instance of the app,
+    # then it will be present in the DB but missing from memcache.
+    found = {}
+    for start in xrange(0, len(missing), QUERY_BATCH_SIZE):
+      batch = missing[start:start + QUERY_BATCH_SIZE]
+      futures = [cls.query(cls.name == n).fetch_async(keys_only=True)
+                 for n in batch]
+      for testName, future in zip(batch, futures):
+        keys = sorted(k.integer_id() for k in future.get_result())
+        for key in keys:
+          cls._insertCacheEntry(key, testName)
+        if keys:
+          found[cls._nameMemcacheKey(version, testName)] = keys
+    if found:
+      memcache.set_multi(found)
+    return [n for n in missing if n not in cls.NAME_CACHE]
 
   @classmethod
-  def hasTestName(cls, testName):
-    cls._guaranteeNameCache()
-    if testName in cls.NAME_CACHE:  # pragma: no cover
-      return True
-    q = cls.query(cls.name == testName)
-    return q.count(1) == 1
+  def _addTestNames(cls, testNames):
+    """Adds test names to the database, allocating their keys in one batch."""
+    first, last = cls.allocate_ids(len(testNames))
+    keys = range(first, last + 1)
+    ndb.put_multi([cls(name=n, key=ndb.Key(cls, k))
+                   for n, k in zip(testNames, keys)])
+    for key, testName in zip(keys, testNames):
+      cls._insertCacheEntry(key, testName)
+
+    # Names and shards are read from the datastore next time they are needed.
+    # Caching only the new keys of names would drop keys that other instances
+    # add for the same names concurrently.
+    version = cls._snapshotVersion()
+    shards = set(k // SNAPSHOT_SHARD_SIZE for k in keys)
+    cls.LOADED_SHARDS.difference_update(shards)
+    memcache.delete_multi(
+        [cls._nameMemcacheKey(version, n) for n in testNames] +
+        [cls._shardMemcacheKey(version, shard) for shard in shards])
 
   @classmethod
-  def getAllKeys(cls, testName):
-    """Return all integer keys associated with the testName.
+  def _loadShards(cls, shards):
+    """Loads snapshot shards in the local cache, from memcache or datastore."""
+    version = cls._snapshotVersion()
+    memcache_keys = dict(
+        (cls._shardMemcacheKey(version, shard), shard) for shard in shards)
+    cached = memcache.get_multi(memcache_keys.keys())
+
+    futures = {}
+    for memcache_key, shard in memcache_keys.iteritems():
+      if memcache_key not in cached:
+        start = max(1, shard * SNAPSHOT_SHARD_SIZE)
+        end = (shard + 1) * SNAPSHOT_SHARD_SIZE
+        futures[memcache_key] = cls.query(
+            cls.key >= ndb.Key(cls, start),
+            cls.key < ndb.Key(cls, end)).fetch_async()
+    loaded = {}
+    for memcache_key, future in futures.iteritems():
+      loaded[memcache_key] = [
+          (e.key.integer_id(), e.name) for e in future.get_result()]
+    if loaded:
+      try:
+        memcache.set_multi(loaded)
+      except ValueError:
+        # A shard with very long test names can be over the memcache limit,
+        # cache the other ones.
+        for memcache_key, entries in loaded.iteritems():
+          try:
+            memcache.set(memcache_key, entries)
+          except ValueError:
+            logging.warning('Could not cache test name snapshot shard %d',
+                            memcache_keys[memcache_key])
+
+    for entries in cached.values() + loaded.values():
+      for key, testName in entries:
+        cls._insertCacheEntry(key, testName)
+    cls.LOADED_SHARDS.update(shards)
 
-    If the testName is not yet in the database, it will be added.
-    """
-    cls._guaranteeNameCache()
-    if testName not in cls.NAME_CACHE:
-      entity = cls._addTestName(testName)
-      result = [entity.key.integer_id()]
-    else:
-      result = cls.NAME_CACHE[testName]
+  @classmethod
+  def _getCachedKeys(cls, testName):
+    result = cls.NAME_CACHE[testName]
     # AppEngine makes no hard guarantee about the integers it allocates for key
     # ID's, though in practice it increments a counter starting from one.
     # Since we only allot four bytes to store the key ID, let's be safe and
@@ -76,6 +184,20 @@ class TestName(ndb.Model):
     assert not any([True for x in result if x > 0xffffffff])
     return result
 
+  @classmethod
+  def hasTestName(cls, testName):
+    return not cls._lookupTestNames([testName])
+
+  @classmethod
+  def getAllKeys(cls, testName):
+    """Return all integer keys associated with the testName.
+
+    If the testName is not yet in the database, it will be added.
+    """
+    if cls._lookupTestNames([testName]):
+      cls._addTestNames([testName])
+    return cls._getCachedKeys(testName)
+
   @classmethod
   def getKey(cls, testName):
     """Return the arbitrary first integer key associated with the testName.
@@ -84,13 +206,34 @@ class TestName(ndb.Model):
     """
     return cls.getAllKeys(testName)[0]
 
+  @classmethod
+  def getKeys(cls, testNames):
+    """Return a dict of test names to their first integer keys.
+
+    Test names that are not yet in the database are added, all at once.
+    """
+    new_names = cls._lookupTestNames(testNames)
+    if new_names:
+      cls._addTestNames(new_names)
+    return dict((n, cls._getCachedKeys(n)[0]) for n in testNames)
+
   @classmethod
   def getTestName(cls, key):
     """Return the test name associated with an integer key."""
-    cls._guaranteeNameCache()
-    if key not in cls.NAME_REVERSE_CACHE:
-      ndb_key = ndb.Key(cls, key)
-      entity = ndb_key.get()
-      assert entity
-      cls._insertCacheEntry(entity)  # pragma: no cover
-    return cls.NAME_REVERSE_CACHE[key]
+    return cls.getTestNames([key])[0]
+
+  @classmethod
+  def getTestNames(cls, keys):
+    """Return the test names associated with a list of integer keys."""
+    missing = [k for k in set(keys) if k not in cls.NAME_REVERSE_CACHE]
+    shards = set(k // SNAPSHOT_SHARD_SIZE for k in missing) - cls.LOADED_SHARDS
+    if shards:
+      cls._loadShards(shards)
+      missing = [k for k in missing if k not in cls.NAME_REVERSE_CACHE]
+    if missing:
+      # E.g. added by a different instance after the shard was loaded.
+      entities = ndb.get_multi([ndb.Key(cls, k) for k in missing])
+      assert all(entities)
+      for entity in entities:
+        cls._insertCacheEntry(entity.key.integer_id(), entity.name)
+    return [cls.NAME_REVERSE_CACHE[k] for k in keys]
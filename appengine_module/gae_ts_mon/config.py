@@ -45,6 +45,10 @@ def _reset_cumulative_metrics():
 
 _flush_metrics_lock = threading.Lock()
 
+# Whether _flush_metrics uses memcache heartbeats instead of the Instance entity.
+# Set by initialize().
+_use_memcache_heartbeat = False
+
 
 def need_to_flush_metrics(time_now):
   """Check if metrics need flushing, and update the timestamp of last flush.
@@ -76,28 +80,39 @@ def flush_metrics_if_needed(time_now):
 def _flush_metrics(time_now):
   """Return True if metrics were actually sent."""
   datetime_now = datetime.datetime.utcfromtimestamp(time_now)
-  entity = shared.get_instance_entity()
-  if entity.task_num < 0:
-    if interface.state.target.task_num >= 0:
-      _reset_cumulative_metrics()
-    interface.state.target.task_num = -1
-    interface.state.last_flushed = entity.last_updated
-    updated_sec_ago = (datetime_now - entity.last_updated).total_seconds()
-    if updated_sec_ago > shared.INSTANCE_EXPECTED_TO_HAVE_TASK_NUM_SEC:
-      logging.warning('Instance %s is %d seconds old with no task_num.',
-                      shared.instance_key_id(), updated_sec_ago)
-    return False
-  interface.state.target.task_num = entity.task_num
+  task_num = None
+  entity_deferred = None
+  if _use_memcache_heartbeat:
+    task_num = shared.memcache_heartbeat(datetime_now)
+
+  if task_num is None:
+    # No lease in memcache (or memcache heartbeats disabled): the Instance
+    # entity is the source of truth. This also registers new instances for the
+    # cron job.
+    entity = shared.get_instance_entity()
+    if entity.task_num < 0:
+      if interface.state.target.task_num >= 0:
+        _reset_cumulative_metrics()
+      interface.state.target.task_num = -1
+      interface.state.last_flushed = entity.last_updated
+      updated_sec_ago = (datetime_now - entity.last_updated).total_seconds()
+      if updated_sec_ago > shared.INSTANCE_EXPECTED_TO_HAVE_TASK_NUM_SEC:
+        logging.warning('Instance %s is %d seconds old with no task_num.',
+                        shared.instance_key_id(), updated_sec_ago)
+      return False
+    task_num = entity.task_num
+    entity.last_updated = datetime_now
+    entity_deferred = entity.put_async()
 
-  entity.last_updated = datetime_now
-  entity_deferred = entity.put_async()
+  interface.state.target.task_num = task_num
 
   interface.flush()
 
   for metric in shared.global_metrics.itervalues():
     metric.reset()
 
-  entity_deferred.get_result()
+  if entity_deferred is not None:
+    entity_deferred.get_result()
   return True
 
 
@@ -111,6 +126,10 @@ def _shutdown_hook(time_fn=time.time):
                     shared.instance_key_id())
   with shared.instance_namespace_context():
     ndb.Key('Instance', shared.instance_key_id()).delete()
+  if _use_memcache_heartbeat:
+    for rpc in shared.update_task_num_leases_async(
+        {}, [shared.instance_key_id()]):
+      rpc.get_result()
 
 
 def _internal_callback():
@@ -125,7 +144,7 @@ def _internal_callback():
 
 
 def initialize(app=None, is_enabled_fn=None, cron_module='default',
-               is_local_unittest=None):
+               is_local_unittest=None, use_memcache_heartbeat=False):
   """Instruments webapp2 `app` with gae_ts_mon metrics.
 
   Instruments all the endpoints in `app` with basic metrics.
@@ -139,7 +158,13 @@ def initialize(app=None, is_enabled_fn=None, cron_module='default',
       /internal/cron/ts_mon/send endpoint. This allows moving the cron job
       to any module the user wants.
     is_local_unittest (bool or None): whether we are running in a unittest.
+    use_memcache_heartbeat (bool): when flushing metrics from a user request,
+      report liveness and read the task_num lease through memcache instead of
+      reading and writing the Instance entity in Datastore. Datastore is only
+      used when memcache has no lease for the instance.
   """
+  global _use_memcache_heartbeat
+
   if is_local_unittest is None:  # pragma: no cover
     # Since gae_ts_mon.initialize is called at module-scope by appengine apps,
     # AppengineTestCase.setUp() won't have run yet and none of the appengine
@@ -149,6 +174,7 @@ def initialize(app=None, is_enabled_fn=None, cron_module='default',
 
   if is_enabled_fn is not None:
     interface.state.flush_enabled_fn = is_enabled_fn
+  _use_memcache_heartbeat = use_memcache_heartbeat
 
   if app is not None:
     instrument_wsgi_application(app)
@@ -284,5 +310,7 @@ def instrument_endpoint(time_fn=time.time):
 
 
 def reset_for_unittest(disable=False):
+  global _use_memcache_heartbeat
+  _use_memcache_heartbeat = False
   shared.reset_for_unittest()
   interface.reset_for_unittest(disable=disable)
@@ -29,14 +29,50 @@ def find_gaps(num_iter):
     yield next_num
 
 
-def _assign_task_num(time_fn=datetime.datetime.utcnow):
+# Number of Instance entities fetched per Datastore RPC by the cron job.
+INSTANCE_PAGE_SIZE = 500
+
+
+def _iter_instances(page_size=INSTANCE_PAGE_SIZE):
+  """Yields (Instance entity, last heartbeat or None) for all the instances.
+
+  Entities are fetched page_size at a time, and the memcache heartbeats of each
+  page are fetched in a single call.
+  """
+  cursor = None
+  more = True
+  while more:
+    entities, cursor, more = shared.Instance.query().fetch_page(
+        page_size, start_cursor=cursor)
+    if not entities:
+      break
+    heartbeats = shared.get_memcache_heartbeats(
+        [entity.key.id() for entity in entities])
+    for entity in entities:
+      yield entity, heartbeats.get(entity.key.id())
+
+
+def _assign_task_num(time_fn=datetime.datetime.utcnow,
+                     page_size=INSTANCE_PAGE_SIZE):
   expired_keys = []
   unassigned = []
+  # Entities whose last_updated is refreshed from their memcache heartbeat.
+  refreshed = []
+  leases = {}
   used_task_nums = []
   time_now = time_fn()
   expired_time = time_now - datetime.timedelta(
       seconds=shared.INSTANCE_EXPIRE_SEC)
-  for entity in shared.Instance.query():
+  # Instances using memcache heartbeats don't update their entity. Persist the
+  # heartbeat when the entity gets this old, so that losing the heartbeat from
+  # memcache doesn't expire a live instance right away.
+  refresh_time = time_now - datetime.timedelta(
+      seconds=shared.INSTANCE_EXPIRE_SEC / 2)
+  for entity, heartbeat in _iter_instances(page_size):
+    if heartbeat is not None and heartbeat > entity.last_updated:
+      if entity.last_updated < refresh_time:
+        refreshed.append(entity)
+      entity.last_updated = heartbeat
     # Don't reassign expired task_num right away to avoid races.
     if entity.task_num >= 0:
       used_task_nums.append(entity.task_num)
@@ -51,6 +87,8 @@ def _assign_task_num(time_fn=datetime.datetime.utcnow):
     elif entity.task_num < 0:
       shared.started_counter.increment()
       unassigned.append(entity)
+    else:
+      leases[entity.key.id()] = entity.task_num
 
   logging.debug('Found %d expired and %d unassigned instances',
                 len(expired_keys), len(unassigned))
@@ -58,10 +96,18 @@ def _assign_task_num(time_fn=datetime.datetime.utcnow):
   used_task_nums = sorted(used_task_nums)
   for entity, task_num in zip(unassigned, find_gaps(used_task_nums)):
     entity.task_num = task_num
+    leases[entity.key.id()] = task_num
     logging.debug('Assigned %s task_num %d', entity.key.id(), task_num)
-  futures_unassigned = ndb.put_multi_async(unassigned)
+  expired_set = set(expired_keys)
+  to_put = {e.key: e for e in refreshed + unassigned
+            if e.key not in expired_set}.values()
+  futures_put = ndb.put_multi_async(to_put)
   futures_expired = ndb.delete_multi_async(expired_keys)
-  ndb.Future.wait_all(futures_unassigned + futures_expired)
+  memcache_rpcs = shared.update_task_num_leases_async(
+      leases, [key.id() for key in expired_keys])
+  ndb.Future.wait_all(futures_put + futures_expired)
+  for rpc in memcache_rpcs:
+    rpc.get_result()
   logging.debug('Committed all changes')
 
 
@@ -4,6 +4,7 @@
 
 import contextlib
 
+from google.appengine.api import memcache
 from google.appengine.api import modules
 from google.appengine.api import namespace_manager
 from google.appengine.ext import ndb
@@ -18,6 +19,11 @@ INSTANCE_NAMESPACE = 'ts_mon_instance_namespace'
 INSTANCE_EXPIRE_SEC = 30 * 60
 INSTANCE_EXPECTED_TO_HAVE_TASK_NUM_SEC = 5 * 60
 INTERNAL_CALLBACK_NAME = '__gae_ts_mon_callback'
+# Expiration of the task_num leases stored in memcache by the cron job. The cron
+# job refreshes them every minute, so they only expire if it stops running.
+TASK_NUM_LEASE_SEC = 5 * 60
+HEARTBEAT_KEY_PREFIX = 'heartbeat:'
+TASK_NUM_KEY_PREFIX = 'task_num:'
 
 
 appengine_default_version = metrics.StringMetric(
@@ -114,3 +120,57 @@ def instance_namespace_context():
 def get_instance_entity():
   with instance_namespace_context():
     return Instance.get_or_insert(instance_key_id())
+
+
+def memcache_heartbeat(time_now):
+  """Records that this instance is alive and returns its task_num lease.
+
+  The heartbeat write and the lease read are sent concurrently, so this costs
+  one memcache round-trip and no Datastore access. The cron job reads the
+  heartbeats when expiring instances (see handlers._assign_task_num).
+
+  Args:
+    time_now (datetime.datetime): the current time.
+
+  Returns:
+    The task_num leased to this instance, or None if memcache doesn't have one.
+    Callers should then fall back to get_instance_entity().
+  """
+  key_id = instance_key_id()
+  client = memcache.Client()
+  set_rpc = client.set_multi_async(
+      {key_id: time_now}, time=INSTANCE_EXPIRE_SEC,
+      key_prefix=HEARTBEAT_KEY_PREFIX, namespace=INSTANCE_NAMESPACE)
+  get_rpc = client.get_multi_async(
+      [key_id], key_prefix=TASK_NUM_KEY_PREFIX, namespace=INSTANCE_NAMESPACE)
+  set_rpc.get_result()
+  return get_rpc.get_result().get(key_id)
+
+
+def get_memcache_heartbeats(key_ids):
+  """Returns a dict {key_id: datetime of the last heartbeat} from memcache."""
+  return memcache.get_multi(key_ids, key_prefix=HEARTBEAT_KEY_PREFIX,
+                            namespace=INSTANCE_NAMESPACE)
+
+
+def update_task_num_leases_async(leases, expired_key_ids):
+  """Stores task_num leases in memcache and deletes the expired ones.
+
+  Args:
+    leases (dict): {key_id: task_num} to store.
+    expired_key_ids (list): key_ids whose lease and heartbeat must be deleted.
+
+  Returns:
+    A list of memcache RPCs to wait for with get_result().
+  """
+  client = memcache.Client()
+  rpcs = []
+  if leases:
+    rpcs.append(client.set_multi_async(
+        leases, time=TASK_NUM_LEASE_SEC, key_prefix=TASK_NUM_KEY_PREFIX,
+        namespace=INSTANCE_NAMESPACE))
+  if expired_key_ids:
+    for prefix in (TASK_NUM_KEY_PREFIX, HEARTBEAT_KEY_PREFIX):
+      rpcs.append(client.delete_multi_async(
+          expired_key_ids, key_prefix=prefix, namespace=INSTANCE_NAMESPACE))
+  return rpcs
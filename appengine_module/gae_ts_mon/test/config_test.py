@@ -182,6 +182,51 @@ class InitializeTest(testing.AppengineTestCase):
     self.assertEqual(None, test_global_metric.get())
     mock_flush.assert_called_once_with()
 
+  @mock.patch('infra_libs.ts_mon.common.interface.flush', autospec=True)
+  def test_flush_metrics_memcache_lease(self, mock_flush):
+    config.initialize(is_local_unittest=False, use_memcache_heartbeat=True)
+    time_now = 10000
+    datetime_now = datetime.datetime.utcfromtimestamp(time_now)
+    interface.state.last_flushed = datetime_now - datetime.timedelta(
+        seconds=61)
+    for rpc in shared.update_task_num_leases_async(
+        {shared.instance_key_id(): 3}, []):
+      rpc.get_result()
+
+    with mock.patch('infra_libs.ts_mon.shared.get_instance_entity',
+                    autospec=True) as mock_get_entity:
+      self.assertTrue(config.flush_metrics_if_needed(time_now))
+      self.assertFalse(mock_get_entity.called)
+    self.assertEqual(3, interface.state.target.task_num)
+    mock_flush.assert_called_once_with()
+    self.assertEqual(
+        {shared.instance_key_id(): datetime_now},
+        shared.get_memcache_heartbeats([shared.instance_key_id()]))
+
+  @mock.patch('infra_libs.ts_mon.common.interface.flush', autospec=True)
+  def test_flush_metrics_memcache_no_lease(self, mock_flush):
+    # Without a lease, the Instance entity is used.
+    config.initialize(is_local_unittest=False, use_memcache_heartbeat=True)
+    time_now = 10000
+    datetime_now = datetime.datetime.utcfromtimestamp(time_now)
+    interface.state.last_flushed = datetime_now - datetime.timedelta(
+        seconds=61)
+    entity = shared.get_instance_entity()
+    entity.task_num = 2
+    self.assertTrue(config.flush_metrics_if_needed(time_now))
+    self.assertEqual(2, interface.state.target.task_num)
+    self.assertEqual(datetime_now, shared.get_instance_entity().last_updated)
+    mock_flush.assert_called_once_with()
+
+  @mock.patch('gae_ts_mon.config.flush_metrics_if_needed', autospec=True,
+              return_value=True)
+  def test_shutdown_hook_memcache(self, _mock_flush):
+    config.initialize(is_local_unittest=False, use_memcache_heartbeat=True)
+    key_id = shared.instance_key_id()
+    shared.memcache_heartbeat(datetime.datetime(2016, 2, 8, 1, 0, 0))
+    config._shutdown_hook(time_fn=lambda: 10000)
+    self.assertEqual({}, shared.get_memcache_heartbeats([key_id]))
+
   @mock.patch('infra_libs.ts_mon.common.interface.flush', autospec=True)
   def test_flush_metrics_disabled(self, mock_flush):
     # We have task_num and due for sending metrics, but ts_mon is disabled.
@@ -73,6 +73,52 @@ class HandlersTest(testing.AppengineTestCase):
     self.assertEqual(2, current.task_num)
     self.assertEqual(1, new.task_num)
 
+  def test_assign_task_num_paged(self):
+    time_now = datetime.datetime(2016, 2, 8, 1, 0, 0)
+    time_current = time_now - datetime.timedelta(
+        seconds=shared.INSTANCE_EXPIRE_SEC-1)
+    for i in xrange(5):
+      shared.Instance(id='new%d' % i, last_updated=time_current).put()
+
+    handlers._assign_task_num(time_fn=lambda: time_now, page_size=2)
+
+    task_nums = sorted(
+        shared.Instance.get_by_id('new%d' % i).task_num for i in xrange(5))
+    self.assertEqual(range(5), task_nums)
+
+  def test_assign_task_num_memcache_heartbeats(self):
+    time_now = datetime.datetime(2016, 2, 8, 1, 0, 0)
+    time_stale = time_now - datetime.timedelta(
+        seconds=shared.INSTANCE_EXPIRE_SEC+1)
+    time_recent = time_now - datetime.timedelta(seconds=10)
+
+    shared.Instance(id='alive', task_num=0, last_updated=time_stale).put()
+    shared.Instance(id='new', task_num=-1, last_updated=time_stale).put()
+    shared.Instance(id='expired', task_num=1, last_updated=time_stale).put()
+    # Instances using memcache heartbeats only update memcache.
+    with mock.patch('infra_libs.ts_mon.shared.instance_key_id',
+                    side_effect=['alive', 'new']):
+      shared.memcache_heartbeat(time_recent)
+      shared.memcache_heartbeat(time_recent)
+    for rpc in shared.update_task_num_leases_async({'expired': 1}, []):
+      rpc.get_result()
+
+    handlers._assign_task_num(time_fn=lambda: time_now)
+
+    self.assertIsNone(shared.Instance.get_by_id('expired'))
+    alive = shared.Instance.get_by_id('alive')
+    new = shared.Instance.get_by_id('new')
+    self.assertEqual(0, alive.task_num)
+    self.assertEqual(time_recent, alive.last_updated)
+    self.assertEqual(2, new.task_num)
+    self.assertEqual(time_recent, new.last_updated)
+
+    with mock.patch('infra_libs.ts_mon.shared.instance_key_id',
+                    side_effect=['alive', 'new', 'expired']):
+      self.assertEqual(0, shared.memcache_heartbeat(time_now))
+      self.assertEqual(2, shared.memcache_heartbeat(time_now))
+      self.assertIsNone(shared.memcache_heartbeat(time_now))
+
   def test_unauthorized(self):
     request = webapp2.Request.blank('/internal/cron/ts_mon/send')
     response = request.get_response(handlers.app)
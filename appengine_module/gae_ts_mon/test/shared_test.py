@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import datetime
 import unittest
 
 import gae_ts_mon
@@ -47,3 +48,23 @@ class SharedTest(testing.AppengineTestCase):
 
     # Make sure it does not pollute the default namespace.
     self.assertIsNone(shared.Instance.get_by_id(entity.key.id()))
+
+  def test_memcache_heartbeat(self):
+    time_now = datetime.datetime(2016, 2, 8, 1, 0, 0)
+    key_id = shared.instance_key_id()
+    self.assertIsNone(shared.memcache_heartbeat(time_now))
+    self.assertEqual({key_id: time_now},
+                     shared.get_memcache_heartbeats([key_id, 'other']))
+
+    for rpc in shared.update_task_num_leases_async({key_id: 3}, []):
+      rpc.get_result()
+    self.assertEqual(3, shared.memcache_heartbeat(time_now))
+
+    for rpc in shared.update_task_num_leases_async({}, [key_id]):
+      rpc.get_result()
+    self.assertIsNone(shared.memcache_heartbeat(time_now))
+    # The expired instance's heartbeat is deleted, memcache_heartbeat above
+    # wrote a new one.
+    for rpc in shared.update_task_num_leases_async({}, [key_id]):
+      rpc.get_result()
+    self.assertEqual({}, shared.get_memcache_heartbeats([key_id]))
@@ -26,3 +26,5 @@ from infra_libs.event_mon.protos.chrome_infra_log_pb2 import CodeVersion
 from infra_libs.event_mon.protos.chrome_infra_log_pb2 import CQEvent
 
 from infra_libs.event_mon.protos.log_request_lite_pb2 import LogRequestLite
+
+from infra_libs.event_mon.router import iter_log_events
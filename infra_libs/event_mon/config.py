@@ -45,6 +45,22 @@ def add_argparse_options(parser):
   group.add_argument('--event-mon-output-file', default='event_mon.output',
                      help='File into which LogEventLite serialized protos are\n'
                      'written when --event-mon-run-type is "file"')
+  group.add_argument('--event-mon-append-output', default=False,
+                     action='store_true',
+                     help='When --event-mon-run-type is "file", append\n'
+                     'length-delimited records to the output file instead\n'
+                     'of overwriting it on each event.')
+  group.add_argument('--event-mon-output-max-bytes', type=int,
+                     help='With --event-mon-append-output, rotate the output\n'
+                     'file when it would grow beyond this size.')
+  group.add_argument('--event-mon-buffered', default=False,
+                     action='store_true',
+                     help='When sending to an http endpoint, buffer events\n'
+                     'and send them in batches from a background thread.')
+  group.add_argument('--event-mon-spill-file',
+                     help='With --event-mon-buffered, file where events that\n'
+                     'could not be sent are appended. They are sent again\n'
+                     'the next time the program starts.')
   group.add_argument('--event-mon-service-name',
                       help='Service name to use in log events.')
   group.add_argument('--event-mon-hostname',
@@ -80,7 +96,11 @@ def process_argparse_options(args):  # pragma: no cover
     service_account_creds=args.event_mon_service_account_creds,
     service_accounts_creds_root=args.event_mon_service_accounts_creds_root,
     output_file=args.event_mon_output_file,
-    dry_run=args.dry_run
+    append_output=args.event_mon_append_output,
+    output_max_bytes=args.event_mon_output_max_bytes,
+    dry_run=args.dry_run,
+    buffered=args.event_mon_buffered,
+    spill_file=args.event_mon_spill_file,
   )
 
 
@@ -91,7 +111,11 @@ def setup_monitoring(run_type='dry',
                      service_account_creds=None,
                      service_accounts_creds_root=None,
                      output_file=None,
-                     dry_run=False):
+                     append_output=False,
+                     output_max_bytes=None,
+                     dry_run=False,
+                     buffered=False,
+                     spill_file=None):
   """Initializes event monitoring.
 
   This function is mainly used to provide default global values which are
@@ -122,8 +146,21 @@ def setup_monitoring(run_type='dry',
     output_file (str): file where to write the output in run_type == 'file'
       mode.
 
+    append_output (bool): in run_type == 'file' mode, append length-delimited
+      records to output_file instead of overwriting it. See
+      event_mon.iter_log_events to read them.
+
+    output_max_bytes (int): with append_output, rotate output_file when it
+      would grow beyond this size.
+
     dry_run (bool): if True, the code has no side-effect, what would have been
       done is printed instead.
+
+    buffered (bool): if True and run_type is 'test' or 'prod', events are
+      buffered and sent in batches from a background thread.
+
+    spill_file (str): when buffered is True, file where events that could not
+      be sent are stored until the next call to setup_monitoring.
   """
   global _router
   logging.debug('event_mon: setting up monitoring.')
@@ -165,7 +202,14 @@ def setup_monitoring(run_type='dry',
         _router = ev_router._TextStreamRouter()
     elif run_type == 'file':
       _router = ev_router._LocalFileRouter(output_file,
-                                           dry_run=dry_run)
+                                           dry_run=dry_run,
+                                           append=append_output,
+                                           max_bytes=output_max_bytes)
+    elif buffered:
+      _router = ev_router._BufferedHttpRouter(_cache,
+                                              ENDPOINTS.get(run_type),
+                                              spill_file=spill_file,
+                                              dry_run=dry_run)
     else:
       _router = ev_router._HttpRouter(_cache,
                                       ENDPOINTS.get(run_type),
@@ -207,6 +251,9 @@ def close():
     success (bool): False if an error occured
   """
   global _router, _cache
+  success = True
+  if _router:
+    success = _router.close()
   _router = None
   _cache = {}
-  return True
+  return success
@@ -5,7 +5,9 @@
 import logging
 import os
 import random
+import struct
 import sys
+import threading
 import time
 
 import httplib2
@@ -20,6 +22,61 @@ def time_ms():
   return int(1000 * time.time())
 
 
+# Each record in an event_mon record file is a serialized LogRequestLite
+# prefixed by its length as a 4-byte big-endian unsigned integer.
+_RECORD_LENGTH = struct.Struct('>I')
+
+
+def write_record(f, request):
+  """Appends a length-delimited LogRequestLite to an open file.
+
+  Args:
+    f (file): file opened for (binary) writing.
+    request (LogRequestLite): the protobuf to write.
+  """
+  data = request.SerializeToString()
+  f.write(_RECORD_LENGTH.pack(len(data)) + data)
+
+
+def iter_records(f):
+  """Yields the LogRequestLite protos written to a file by write_record.
+
+  Only one record at a time is held in memory.  A truncated record at the end
+  of the file (e.g. if the writer crashed) is ignored.
+
+  Args:
+    f (file): file opened for (binary) reading.
+  """
+  while True:
+    header = f.read(_RECORD_LENGTH.size)
+    if not header:
+      return
+    if len(header) < _RECORD_LENGTH.size:
+      logging.warning('Ignoring truncated record header in %s', f.name)
+      return
+    length, = _RECORD_LENGTH.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+      logging.warning('Ignoring truncated record in %s', f.name)
+      return
+    yield LogRequestLite.FromString(data)
+
+
+def iter_log_events(filename):
+  """Yields the LogEventLite protos stored in a file of records.
+
+  The file is read one record at a time, so it can be much bigger than the
+  available memory.
+
+  Args:
+    filename (str): file written by a _LocalFileRouter in append mode.
+  """
+  with open(filename, 'rb') as f:
+    for request_p in iter_records(f):
+      for log_event in request_p.log_event:
+        yield log_event
+
+
 def backoff_time(attempt, retry_backoff=2., max_delay=30.):
   """Compute randomized exponential backoff time.
 
@@ -92,23 +149,65 @@ class _Router(object):
     """
     raise NotImplementedError('Please implement _send_to_endpoint().')
 
+  def close(self):
+    """Sends any buffered events and stops background work.
+
+    Returns:
+      success (bool): False if some events could not be sent.
+    """
+    return True
+
 
 class _LocalFileRouter(_Router):
-  def __init__(self, output_file, dry_run=False):
+  def __init__(self, output_file, dry_run=False, append=False, max_bytes=None,
+               backup_count=1):
     """Initialize the router.
 
-    Writes a serialized LogRequestLite protobuf in a local file. File is
-    created/truncated before writing (no append).
+    By default writes a serialized LogRequestLite protobuf in a local file. File
+    is created/truncated before writing (no append).
+
+    With append=True, each push_event appends a length-delimited record to the
+    file instead (see write_record), which can be read back one request at a
+    time with iter_log_events.
 
     Args:
       output_file(str): path to file where to write the protobuf.
 
     Keyword Args:
       dry_run(bool): if True, the file is not written.
+      append(bool): if True, append records instead of overwriting the file.
+      max_bytes(int or None): in append mode, when writing a record would make
+        the file bigger than this, it's renamed to output_file.1 (shifting
+        older ones to .2, ...) first.  None means no rotation.
+      backup_count(int): number of rotated files to keep.
     """
     _Router.__init__(self)
     self.output_file = output_file
     self._dry_run = dry_run
+    self._append = append
+    self._max_bytes = max_bytes
+    self._backup_count = backup_count
+    self._lock = threading.Lock()
+
+  def _rotate(self, record_size):
+    """Renames the output file if adding record_size bytes makes it too big."""
+    if not self._max_bytes or not os.path.exists(self.output_file):
+      return
+    size = os.path.getsize(self.output_file)
+    if size == 0 or size + record_size <= self._max_bytes:
+      return
+
+    for i in xrange(self._backup_count - 1, 0, -1):
+      src = '%s.%d' % (self.output_file, i)
+      if os.path.exists(src):
+        dst = '%s.%d' % (self.output_file, i + 1)
+        if os.path.exists(dst):
+          os.remove(dst)
+        os.rename(src, dst)
+    dst = self.output_file + '.1'
+    if os.path.exists(dst):
+      os.remove(dst)
+    os.rename(self.output_file, dst)
 
   def _send_to_endpoint(self, events):
     try:
@@ -117,6 +216,11 @@ class _LocalFileRouter(_Router):
                       'not exist: %s' % os.path.dirname(self.output_file))
       if self._dry_run:
         logging.info('Would have written in %s', self.output_file)
+      elif self._append:
+        with self._lock:
+          self._rotate(_RECORD_LENGTH.size + events.ByteSize())
+          with open(self.output_file, 'ab') as f:
+            write_record(f, events)
       else:
         with open(self.output_file, 'wb') as f:
           f.write(events.SerializeToString())  # pragma: no branch
@@ -267,3 +371,171 @@ class _HttpRouter(_Router):
     logging.error('failed to POST data after %d attempts, giving up.',
                   attempt+1)
     return False
+
+
+class _BufferedHttpRouter(_HttpRouter):
+  """Sends events to an http endpoint in batches, from a background thread.
+
+  push_event() only appends events to an in-memory buffer.  A background thread
+  POSTs the buffer when it reaches max_batch_size events, or every
+  flush_interval_secs seconds, so the caller never waits for the endpoint or
+  for retries.
+
+  If spill_file is given, events that couldn't be sent (or that didn't fit in
+  the buffer) are appended to it, and the file is replayed when the router
+  starts up.
+  """
+
+  def __init__(self, cache, endpoint, spill_file=None, max_batch_size=500,
+               max_buffered_events=10000, flush_interval_secs=10.,
+               **kwargs):
+    """Initialize the router.
+
+    Args:
+      cache(dict): This must be config._cache.
+      endpoint(str): see _HttpRouter.
+      spill_file(str or None): path of the file in which events that can't be
+        sent are stored.  None means they are dropped.
+      max_batch_size(int): maximum number of events sent in one request.
+      max_buffered_events(int): events pushed while this many are already
+        buffered go straight to spill_file (or are dropped).
+      flush_interval_secs(float): maximum time events wait in the buffer.
+
+    Other keyword arguments are passed to _HttpRouter.
+    """
+    _HttpRouter.__init__(self, cache, endpoint, **kwargs)
+    self.spill_file = spill_file
+    self.max_batch_size = max_batch_size
+    self.max_buffered_events = max_buffered_events
+    self.flush_interval_secs = flush_interval_secs
+
+    self._buffer = []
+    self._lock = threading.Lock()
+    self._spill_lock = threading.Lock()
+    self._wake_event = threading.Event()
+    self._stopping = False
+    # Whether some events were neither sent nor spilled.
+    self._dropped_events = False
+
+    self._thread = threading.Thread(target=self._run, name='event_mon',
+                                    args=(self._claim_spill_file(),))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _send_to_endpoint(self, events):
+    with self._lock:
+      if len(self._buffer) < self.max_buffered_events:
+        self._buffer.extend(events.log_event)
+        if len(self._buffer) >= self.max_batch_size:
+          self._wake_event.set()
+        return True
+
+    logging.warning('event_mon: buffer is full.')
+    return self._spill([events])
+
+  def _take_batch(self):
+    with self._lock:
+      batch = self._buffer[:self.max_batch_size]
+      del self._buffer[:self.max_batch_size]
+      return batch
+
+  def _send_batch(self, log_events):
+    request_p = LogRequestLite()
+    request_p.log_source_name = 'CHROME_INFRA'
+    request_p.log_event.extend(log_events)
+    self._send_request(request_p)
+
+  def _send_request(self, request_p):
+    if _HttpRouter._send_to_endpoint(self, request_p):
+      return True
+    return self._spill([request_p])
+
+  def _flush(self):
+    """Sends everything in the buffer."""
+    while True:
+      batch = self._take_batch()
+      if not batch:
+        return
+      self._send_batch(batch)
+
+  def _spill(self, requests):
+    """Appends requests to the spill file.
+
+    Returns:
+      success (bool): False if the events were dropped.
+    """
+    num_events = sum(len(r.log_event) for r in requests)
+    if not self.spill_file:
+      logging.error('event_mon: dropping %d events.', num_events)
+      self._dropped_events = True
+      return False
+
+    try:
+      with self._spill_lock:
+        with open(self.spill_file, 'ab') as f:
+          for request_p in requests:
+            write_record(f, request_p)
+    except Exception:
+      logging.exception('event_mon: failed to write %d events to %s',
+                        num_events, self.spill_file)
+      self._dropped_events = True
+      return False
+    logging.info('event_mon: wrote %d events to %s', num_events,
+                 self.spill_file)
+    return True
+
+  def _claim_spill_file(self):
+    """Moves the spill file left by a previous run out of the way.
+
+    Events that fail again are then appended to a new spill file instead of the
+    one being replayed.  A replay file left behind by a crash is replayed
+    instead of the spill file (which is replayed next time).
+
+    Returns:
+      The path of the file to replay, or None.
+    """
+    if not self.spill_file:
+      return None
+
+    replay_file = self.spill_file + '.replay'
+    try:
+      if not os.path.exists(replay_file):
+        if not os.path.exists(self.spill_file):
+          return None
+        os.rename(self.spill_file, replay_file)
+    except OSError:
+      logging.exception('event_mon: failed to move %s', self.spill_file)
+      return None
+    return replay_file
+
+  def _replay(self, replay_file):
+    """Sends the events left in a spill file by a previous run."""
+    logging.info('event_mon: replaying events from %s', replay_file)
+    try:
+      with open(replay_file, 'rb') as f:
+        for request_p in iter_records(f):
+          self._send_request(request_p)
+      os.remove(replay_file)
+    except Exception:
+      logging.exception('event_mon: failed to replay %s', replay_file)
+
+  def _run(self, replay_file):
+    if replay_file:
+      self._replay(replay_file)
+
+    while not self._stopping:
+      self._wake_event.wait(self.flush_interval_secs)
+      self._wake_event.clear()
+      self._flush()
+
+  def close(self):
+    """Stops the background thread and sends the remaining events.
+
+    Returns:
+      success (bool): False if some events were neither sent nor spilled.
+    """
+    self._stopping = True
+    self._wake_event.set()
+    self._thread.join()
+    self._flush()
+    return not self._dropped_events
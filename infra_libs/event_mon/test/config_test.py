@@ -71,6 +71,16 @@ class ConfigTest(unittest.TestCase):
       traceback.print_exc()
       raise
 
+  def test_run_type_file_append(self):
+    with infra_libs.temporary_directory(prefix='config_test-') as tempdir:
+      filename = os.path.join(tempdir, 'output.db')
+      self._set_up_args(args=['--event-mon-run-type', 'file',
+                              '--event-mon-output-file', filename,
+                              '--event-mon-append-output',
+                              '--event-mon-output-max-bytes', '1000'])
+      self.assertTrue(config._router._append)
+      self.assertEqual(config._router._max_bytes, 1000)
+
   # Direct setup_monitoring testing below this line.
   def test_default_event(self):
     # The protobuf structure is actually an API not an implementation detail
@@ -139,6 +149,10 @@ class ConfigTest(unittest.TestCase):
     event_mon.setup_monitoring(run_type='test', service_account_creds='creds')
     self.assertEquals(config._cache['service_account_creds'], 'creds')
 
+  def test_run_type_test_buffered(self):
+    event_mon.setup_monitoring(run_type='test', buffered=True, dry_run=True)
+    self.assertIsInstance(config._router, router._BufferedHttpRouter)
+
   def test_run_type_invalid(self):
     event_mon.setup_monitoring(run_type='invalid.')
     self.assertFalse(isinstance(config._router, router._HttpRouter))
@@ -113,6 +113,178 @@ class HttpRouterTests(unittest.TestCase):
     self.assertEquals(len(sleep.call_args_list), 2)
 
 
+def _make_event(code=1):
+  event = LogRequestLite.LogEventLite()
+  event.event_time_ms = router.time_ms()
+  event.event_code = code
+  event.event_flow_id = 2
+  return event
+
+
+def _make_request(codes):
+  request = LogRequestLite()
+  request.log_event.extend(_make_event(code) for code in codes)
+  return request
+
+
+class BufferedHttpRouterTests(unittest.TestCase):
+  def setUp(self):
+    self.sleep = mock.create_autospec(time.sleep, auto_set=True)
+
+  def _router(self, **kwargs):
+    kwargs.setdefault('flush_interval_secs', 3600)
+    return router._BufferedHttpRouter({}, 'https://bla.bla',
+                                      _sleep_fn=self.sleep, **kwargs)
+
+  def _sent_codes(self, http):
+    return [[ev.event_code for ev in LogRequestLite.FromString(r.body).log_event]
+            for r in http.requests_made]
+
+  def test_push_is_buffered(self):
+    r = self._router()
+    r._http = infra_libs.HttpMock([('https://bla.bla', {'status': 200}, '')])
+    self.assertTrue(r.push_event(_make_event(1)))
+    self.assertTrue(r.push_event([_make_event(2), _make_event(3)]))
+    self.assertEqual([], r._http.requests_made)
+
+    self.assertTrue(r.close())
+    self.assertEqual([[1, 2, 3]], self._sent_codes(r._http))
+
+  def test_flush_by_size(self):
+    r = self._router(max_batch_size=2)
+    r._http = infra_libs.HttpMock([('https://bla.bla', {'status': 200}, '')])
+    for code in xrange(5):
+      self.assertTrue(r.push_event(_make_event(code)))
+    self.assertTrue(r.close())
+    self.assertEqual([0, 1, 2, 3, 4], sum(self._sent_codes(r._http), []))
+    self.assertTrue(all(len(c) <= 2 for c in self._sent_codes(r._http)))
+
+  def test_flush_by_time(self):
+    r = self._router(flush_interval_secs=0.01)
+    r._http = infra_libs.HttpMock([('https://bla.bla', {'status': 200}, '')])
+    self.assertTrue(r.push_event(_make_event(1)))
+    for _ in xrange(500):  # pragma: no branch
+      if r._http.requests_made:
+        break
+      time.sleep(0.01)  # pragma: no cover
+    self.assertEqual([[1]], self._sent_codes(r._http))
+    self.assertTrue(r.close())
+
+  def test_failure_without_spill_file_drops(self):
+    r = self._router()
+    r._http = infra_libs.HttpMock([('https://bla.bla', {'status': 500}, '')])
+    self.assertTrue(r.push_event(_make_event(1)))
+    self.assertFalse(r.close())
+    self.assertEqual(r.try_num - 1, len(r._http.requests_made))
+
+  def test_failure_spills_and_replays(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      spill_file = os.path.join(tempdir, 'spill')
+      r = self._router(spill_file=spill_file)
+      r._http = infra_libs.HttpMock([('https://bla.bla', {'status': 500}, '')])
+      self.assertTrue(r.push_event(_make_event(1)))
+      self.assertTrue(r.push_event(_make_event(2)))
+      self.assertTrue(r.close())
+
+      with open(spill_file, 'rb') as f:
+        self.assertEqual(
+            [[1, 2]],
+            [[ev.event_code for ev in req.log_event]
+             for req in router.iter_records(f)])
+
+      # A new router sends the spilled events when it starts.
+      sent = []
+      def send(_self, request):
+        sent.append([ev.event_code for ev in request.log_event])
+        return True
+      with mock.patch.object(router._HttpRouter, '_send_to_endpoint', send):
+        r = self._router(spill_file=spill_file)
+        self.assertTrue(r.close())
+      self.assertEqual([[1, 2]], sent)
+      self.assertFalse(os.path.exists(spill_file))
+      self.assertFalse(os.path.exists(spill_file + '.replay'))
+
+  def test_replay_failure_spills_again(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      spill_file = os.path.join(tempdir, 'spill')
+      with open(spill_file + '.replay', 'wb') as f:
+        router.write_record(f, _make_request([1]))
+      with open(spill_file, 'wb') as f:
+        router.write_record(f, _make_request([2]))
+
+      with mock.patch.object(router._HttpRouter, '_send_to_endpoint',
+                             return_value=False):
+        r = self._router(spill_file=spill_file)
+        self.assertTrue(r.close())
+
+      # The leftover replay file was processed and its events spilled again.
+      self.assertFalse(os.path.exists(spill_file + '.replay'))
+      with open(spill_file, 'rb') as f:
+        self.assertEqual(
+            [[2], [1]],
+            [[ev.event_code for ev in req.log_event]
+             for req in router.iter_records(f)])
+
+  def test_replay_error(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      spill_file = os.path.join(tempdir, 'spill')
+      with open(spill_file, 'wb') as f:
+        router.write_record(f, _make_request([1]))
+
+      with mock.patch('os.rename', side_effect=OSError()):
+        r = self._router(spill_file=spill_file)
+        self.assertTrue(r.close())
+      self.assertTrue(os.path.exists(spill_file))
+
+  def test_buffer_full_spills(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      spill_file = os.path.join(tempdir, 'spill')
+      r = self._router(spill_file=spill_file, max_buffered_events=1)
+      r._http = infra_libs.HttpMock([('https://bla.bla', {'status': 200}, '')])
+      self.assertTrue(r.push_event(_make_event(1)))
+      self.assertTrue(r.push_event(_make_event(2)))
+      self.assertTrue(r.close())
+
+      self.assertEqual([[1]], self._sent_codes(r._http))
+      with open(spill_file, 'rb') as f:
+        self.assertEqual(
+            [[2]],
+            [[ev.event_code for ev in req.log_event]
+             for req in router.iter_records(f)])
+
+  def test_spill_write_error(self):
+    r = self._router(spill_file=os.path.join('non_existing_d1r_31401789', 'f'),
+                     max_buffered_events=0)
+    self.assertFalse(r.push_event(_make_event(1)))
+    self.assertFalse(r.close())
+
+
+class RecordsTests(unittest.TestCase):
+  def test_write_and_iter(self):
+    f = StringIO.StringIO()
+    router.write_record(f, _make_request([1, 2]))
+    router.write_record(f, _make_request([3]))
+    f.seek(0)
+    self.assertEqual(
+        [[1, 2], [3]],
+        [[ev.event_code for ev in req.log_event]
+         for req in router.iter_records(f)])
+
+  def test_truncated(self):
+    f = StringIO.StringIO()
+    router.write_record(f, _make_request([1]))
+    router.write_record(f, _make_request([2]))
+    data = f.getvalue()
+
+    for truncated in (data[:-1], data[:len(data) / 2 + 2]):
+      f = StringIO.StringIO(truncated)
+      f.name = 'file'
+      self.assertEqual(
+          [[1]],
+          [[ev.event_code for ev in req.log_event]
+           for req in router.iter_records(f)])
+
+
 class TextStreamRouterTests(unittest.TestCase):
   def test_stdout_smoke(self):
     event = LogRequestLite.LogEventLite()
@@ -192,6 +364,67 @@ class LocalFileRouterTests(unittest.TestCase):
       os.path.join('non_existing_d1r_31401789', 'output.db'), dry_run=False)
     self.assertFalse(r.push_event(req))
 
+  def _event(self, code):
+    event = LogRequestLite.LogEventLite()
+    event.event_time_ms = router.time_ms()
+    event.event_code = code
+    return event
+
+  def test_append(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      filename = os.path.join(tempdir, 'output.db')
+      r = router._LocalFileRouter(filename, append=True)
+      for code in xrange(3):
+        self.assertTrue(r.push_event(self._event(code)))
+
+      self.assertEqual([0, 1, 2], [e.event_code for e in
+                                   router.iter_log_events(filename)])
+      # A new router keeps appending to the same file.
+      r = router._LocalFileRouter(filename, append=True)
+      self.assertTrue(r.push_event([self._event(3), self._event(4)]))
+      self.assertEqual([0, 1, 2, 3, 4], [e.event_code for e in
+                                         router.iter_log_events(filename)])
+
+  def test_append_rotation(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      filename = os.path.join(tempdir, 'output.db')
+      request = LogRequestLite(log_source_name='CHROME_INFRA',
+                               request_time_ms=router.time_ms())
+      request.log_event.extend([self._event(0)])
+      record_size = router._RECORD_LENGTH.size + request.ByteSize()
+      # Room for two records per file.
+      r = router._LocalFileRouter(filename, append=True,
+                                  max_bytes=record_size * 2 + 5,
+                                  backup_count=2)
+      for code in xrange(7):
+        self.assertTrue(r.push_event(self._event(code)))
+
+      def codes(name):
+        return [e.event_code for e in router.iter_log_events(name)]
+      self.assertEqual([6], codes(filename))
+      self.assertEqual([4, 5], codes(filename + '.1'))
+      self.assertEqual([2, 3], codes(filename + '.2'))
+      self.assertFalse(os.path.exists(filename + '.3'))
+
+  def test_append_rotation_single_backup(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      filename = os.path.join(tempdir, 'output.db')
+      r = router._LocalFileRouter(filename, append=True, max_bytes=1)
+      for code in xrange(3):
+        self.assertTrue(r.push_event(self._event(code)))
+      self.assertEqual([2], [e.event_code for e in
+                             router.iter_log_events(filename)])
+      self.assertEqual([1], [e.event_code for e in
+                             router.iter_log_events(filename + '.1')])
+      self.assertFalse(os.path.exists(filename + '.2'))
+
+  def test_append_dry_run(self):
+    with infra_libs.temporary_directory(prefix='event-mon-') as tempdir:
+      filename = os.path.join(tempdir, 'output.db')
+      r = router._LocalFileRouter(filename, dry_run=True, append=True)
+      self.assertTrue(r.push_event(self._event(1)))
+      self.assertFalse(os.path.exists(filename))
+
 
 class BackoffTest(unittest.TestCase):
   def test_backoff_time_first_value(self):
@@ -14,16 +14,29 @@ This library offers two styles of memoization:
    per-function memo dictionary. If this is used on an instance method, the
    'self' parameter is included in the key.
 2) Instance memoization (memo_i) uses a per-instance memoization dictionary.
-   The dictionary is stored as a member ('_memo__dict') of of the instance.
+   The dictionaries of the instance's memoized methods are stored in a member
+   ('_memo__dict') of the instance.
    Consequently, the 'self' parameter is no longer needed/used in the
    memoization key, removing the need to have the instance itself support being
    hashed.
 
 Memoized function state can be cleared by calling the memoized function's
 'memo_clear' method.
+
+By default memoized values are kept forever. Long-running processes that
+memoize on per-request arguments should bound the memo dictionary with the
+'max_size' (least recently used values are evicted first) and/or 'ttl'
+(values expire after that many seconds) arguments to 'memo'.
+
+Concurrent callers asking for the same key wait for a single invocation of the
+function instead of all computing it. With 'stats=True', hits, misses and
+evictions are counted in the 'infra_libs/memoize/*' ts_mon metrics.
 """
 
+import collections
 import inspect
+import threading
+import time
 
 
 # Instance variable added to class instances that use memoization to
@@ -31,6 +44,106 @@ import inspect
 MEMO_INSTANCE_VARIABLE = '_memo__dict'
 
 
+_StatsMetrics = collections.namedtuple(
+    '_StatsMetrics', ['hits', 'misses', 'evictions'])
+_stats_metrics = None
+_stats_metrics_lock = threading.Lock()
+
+
+def get_stats_metrics():
+  """Returns the ts_mon metrics of memoized functions with 'stats=True'.
+
+  The metrics are only created (and ts_mon imported) the first time a memoized
+  function records stats, so memoize doesn't depend on ts_mon otherwise.
+  """
+  global _stats_metrics
+  if _stats_metrics is None:
+    with _stats_metrics_lock:
+      if _stats_metrics is None:
+        from infra_libs.ts_mon.common import metrics
+        _stats_metrics = _StatsMetrics(
+            hits=metrics.CounterMetric('infra_libs/memoize/hits',
+                description='Number of calls to a memoized function that '
+                            'returned a memoized value.'),
+            misses=metrics.CounterMetric('infra_libs/memoize/misses',
+                description='Number of calls to a memoized function that '
+                            'invoked the function.'),
+            evictions=metrics.CounterMetric('infra_libs/memoize/evictions',
+                description='Number of memoized values dropped because the '
+                            'memo dictionary was full or the value had '
+                            'expired.'))
+  return _stats_metrics
+
+
+class _BoundedMemoDict(object):
+  """A memo dictionary holding at most max_size values for at most ttl seconds.
+
+  Implements the subset of the dict interface used by MemoizedFunction.
+  Looking up a value reorders the entries, so every method takes the
+  dictionary's lock.
+  """
+
+  def __init__(self, max_size=None, ttl=None, on_evict=None):
+    """
+    Args:
+      max_size: (int) maximum number of values to keep. When full, the least
+          recently used value is evicted. None means unbounded.
+      ttl: (float) number of seconds after which a value expires. None means
+          values never expire.
+      on_evict: (function) called with the number of evicted values.
+    """
+    self.max_size = max_size
+    self.ttl = ttl
+    self._on_evict = on_evict or (lambda count: None)
+    self._values = collections.OrderedDict()  # key -> (expiration, value)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._values)
+
+  def __contains__(self, key):
+    return self.get(key, MemoizedFunction.EMPTY) is not MemoizedFunction.EMPTY
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._values.pop(key, None)
+      if entry is None:
+        return default
+      expiration, value = entry
+      if expiration is None or expiration > time.time():
+        # Re-inserting the entry marks it as the most recently used.
+        self._values[key] = entry
+        return value
+    self._on_evict(1)
+    return default
+
+  def __setitem__(self, key, value):
+    expiration = None
+    if self.ttl is not None:
+      expiration = time.time() + self.ttl
+    evicted = 0
+    with self._lock:
+      self._values.pop(key, None)
+      self._values[key] = (expiration, value)
+      if self.max_size is not None:
+        while len(self._values) > self.max_size:
+          self._values.popitem(last=False)
+          evicted += 1
+    if evicted:
+      self._on_evict(evicted)
+
+  def pop(self, key, default=None):
+    with self._lock:
+      entry = self._values.pop(key, None)
+    if entry is None:
+      return default
+    return entry[1]
+
+  def clear(self):
+    with self._lock:
+      self._values.clear()
+
+
 class MemoizedFunction(object):
   """Handles the memoization state of a given memoized function."""
 
@@ -40,20 +153,47 @@ class MemoizedFunction(object):
     pass
   EMPTY = _EMPTY()
 
-  def __init__(self, func, ignore=None, memo_dict=None):
+  def __init__(self, func, ignore=None, memo_dict=None, max_size=None,
+               ttl=None, stats=False):
     """
     Args:
       func: (function) The function to memoize
       ignore: (container) The names of 'func' parameters to ignore when
           generating its memo key. Only parameters that have no effect on the
           output of the function should be included.
+      memo_dict: (dict) The dictionary to store memoized values in. Can't be
+          combined with 'max_size' or 'ttl'.
+      max_size: (int) The maximum number of memoized values to keep (per
+          instance for bound methods). The least recently used values are
+          evicted first.
+      ttl: (float) The number of seconds a memoized value is valid for.
+      stats: (bool) If True, count hits, misses and evictions in the
+          ts_mon metrics returned by get_stats_metrics().
     """
+    if memo_dict is not None and (max_size is not None or ttl is not None):
+      raise ValueError('memo_dict cannot be combined with max_size or ttl')
+    if max_size is not None and max_size < 1:
+      raise ValueError('max_size must be at least 1, got %r' % (max_size,))
+    if ttl is not None and ttl <= 0:
+      raise ValueError('ttl must be positive, got %r' % (ttl,))
+
     self.func = func
     self.ignore = frozenset(ignore or ())
     self.memo_dict = memo_dict
+    self.max_size = max_size
+    self.ttl = ttl
+    self.stats = stats
     self.im_self = None
     self.im_class = None
 
+    self._metric_fields = {'function': '%s.%s' % (
+        getattr(func, '__module__', None), getattr(func, '__name__', func))}
+    # Protects the creation of memo dictionaries and '_in_flight'.
+    self._lock = threading.Lock()
+    # (id(memo_dict), memo_key) -> (threading.Event, thread ident) for the
+    # values being computed.
+    self._in_flight = {}
+
   def __repr__(self):
     properties = [str(self.func)]
     if self.im_self is not None:
@@ -77,20 +217,45 @@ class MemoizedFunction(object):
       return (self.im_self,) + args
     return args
 
+  def _new_memo_dict(self):
+    if self.max_size is None and self.ttl is None:
+      return {}
+    return _BoundedMemoDict(
+        self.max_size, self.ttl,
+        on_evict=self._record_evictions if self.stats else None)
+
+  def _record_evictions(self, count):
+    get_stats_metrics().evictions.increment_by(
+        count, fields=self._metric_fields)
+
+  def _count(self, metric_name):
+    if self.stats:
+      getattr(get_stats_metrics(), metric_name).increment(
+          fields=self._metric_fields)
+
   def _get_memo_dict(self):
     """Returns: (dict) the memoization dictionary to store return values in."""
     memo_dict = None
     if self.im_self is not None:
-      # Is the instance dictionary defined?
-      memo_dict = getattr(self.im_self, MEMO_INSTANCE_VARIABLE, None)
+      # The instance keeps one memo dictionary per memoized method, created
+      # with that method's settings.
+      memo_dicts = getattr(self.im_self, MEMO_INSTANCE_VARIABLE, None)
+      if memo_dicts is not None:
+        memo_dict = memo_dicts.get(self)
       if memo_dict is None:
-        memo_dict = {}
-        setattr(self.im_self, MEMO_INSTANCE_VARIABLE, memo_dict)
+        with self._lock:
+          memo_dicts = getattr(self.im_self, MEMO_INSTANCE_VARIABLE, None)
+          if memo_dicts is None:
+            memo_dicts = {}
+            setattr(self.im_self, MEMO_INSTANCE_VARIABLE, memo_dicts)
+          memo_dict = memo_dicts.setdefault(self, self._new_memo_dict())
       return memo_dict
 
     # No instance dict; use our local 'memo_dict'.
     if self.memo_dict is None:
-      self.memo_dict = {}
+      with self._lock:
+        if self.memo_dict is None:
+          self.memo_dict = self._new_memo_dict()
     return self.memo_dict
 
   def _key(self, args, kwargs):
@@ -111,7 +276,9 @@ class MemoizedFunction(object):
     """Retrieves the memoized function result.
 
     If the memoized function has not been memoized, it will be invoked;
-    otherwise, the memoized value will be returned.
+    otherwise, the memoized value will be returned. If another thread is
+    already invoking the function with the same memoization key, this waits for
+    its result instead.
 
     Args:
       memo_key: The generated memoization key for this invocation.
@@ -122,10 +289,49 @@ class MemoizedFunction(object):
 
     memo_dict = self._get_memo_dict()
     memo_key = self._key(args, kwargs)
+    # Memo dictionaries are safe to read without the lock.
     result = memo_dict.get(memo_key, self.EMPTY)
-    if result is self.EMPTY:
-      args = self._get_call_args(args)
-      result = memo_dict[memo_key] = self.func(*args, **kwargs)
+    if result is not self.EMPTY:
+      self._count('hits')
+      return result
+
+    flight_key = (id(memo_dict), memo_key)
+    thread_id = threading.current_thread().ident
+    while True:
+      with self._lock:
+        result = memo_dict.get(memo_key, self.EMPTY)
+        if result is not self.EMPTY:
+          break
+        flight = self._in_flight.get(flight_key)
+        if flight is None:
+          flight = (threading.Event(), thread_id)
+          self._in_flight[flight_key] = flight
+          break
+      if flight[1] == thread_id:
+        # The function is (indirectly) calling itself with the same arguments;
+        # waiting would deadlock.
+        flight = None
+        break
+      # If the other thread failed, its event is set without a memoized value
+      # and we try again.
+      flight[0].wait()
+
+    if result is not self.EMPTY:
+      self._count('hits')
+      return result
+
+    self._count('misses')
+    args = self._get_call_args(args)
+    if flight is None:
+      return self.func(*args, **kwargs)
+
+    try:
+      result = self.func(*args, **kwargs)
+      memo_dict[memo_key] = result
+    finally:
+      with self._lock:
+        del self._in_flight[flight_key]
+      flight[0].set()
     return result
 
   def memo_clear(self, *args, **kwargs):
@@ -145,13 +351,15 @@ class MemoizedFunction(object):
 
     if args or kwargs:
       memo_key = self._key(args, kwargs)
-      memo_dict.pop(memo_key, None)
+      with self._lock:
+        memo_dict.pop(memo_key, None)
     else:
-      memo_dict.clear()
+      with self._lock:
+        memo_dict.clear()
 
 
 
-def memo(ignore=None, memo_dict=None):
+def memo(ignore=None, memo_dict=None, max_size=None, ttl=None, stats=False):
   """Generic function memoization decorator.
 
   This memoizes a specific function using a function key.
@@ -177,13 +385,28 @@ def memo(ignore=None, memo_dict=None):
             (param1, param2, result)
     return result
 
+  The following example keeps at most 100 results, each for at most a minute:
+
+  @memo.memo(max_size=100, ttl=60)
+  def my_method(param1):
+    return fetch_remote_value(param1)
+
   Args:
     ignore: (list) The names of parameters to ignore when memoizing.
+    memo_dict: (dict) The dictionary to store memoized values in.
+    max_size: (int) The maximum number of memoized values to keep. The least
+        recently used values are evicted first.
+    ttl: (float) The number of seconds after which a memoized value expires.
+    stats: (bool) Whether to count hits, misses and evictions in the
+        'infra_libs/memoize/*' ts_mon metrics.
   """
   def wrap(func):
     return MemoizedFunction(
         func,
         ignore=ignore,
         memo_dict=memo_dict,
+        max_size=max_size,
+        ttl=ttl,
+        stats=stats,
     )
   return wrap
@@ -7,8 +7,12 @@
 Collection of unit tests for 'infra.libs.memoize' library.
 """
 
+import threading
+import time
 import unittest
 
+import mock
+
 from infra_libs import memoize
 
 class MemoTestCase(unittest.TestCase):
@@ -472,3 +476,232 @@ class MemoClassMethodTestCase(MemoTestCase):
 
 if __name__ == '__main__':
   unittest.main()
+
+
+class BoundedMemoTestCase(MemoTestCase):
+
+  def setUp(self):
+    super(BoundedMemoTestCase, self).setUp()
+    self.time = 1000.0
+    patcher = mock.patch('time.time', side_effect=lambda: self.time)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.metrics = memoize.get_stats_metrics()
+    for metric in self.metrics:
+      metric.reset()
+
+  def testInvalidArguments(self):
+    with self.assertRaises(ValueError):
+      memoize.memo(memo_dict={}, max_size=1)(lambda: None)
+    with self.assertRaises(ValueError):
+      memoize.memo(max_size=0)(lambda: None)
+    with self.assertRaises(ValueError):
+      memoize.memo(ttl=0)(lambda: None)
+
+  def testMaxSizeEvictsLeastRecentlyUsed(self):
+    @memoize.memo(max_size=2, stats=True)
+    def func(a):
+      self.tag(a)
+      return a
+
+    self.assertEqual(func(1), 1)
+    self.assertEqual(func(2), 2)
+    self.assertEqual(func(1), 1)  # 2 is now the least recently used.
+    self.assertEqual(func(3), 3)
+    self.assertEqual(len(func.memo_dict), 2)
+    self.assertTagged(1, 2, 3)
+
+    self.clearTagged()
+    self.assertEqual(func(1), 1)
+    self.assertEqual(func(3), 3)
+    self.assertEqual(func(2), 2)
+    self.assertTagged(2)
+
+    fields = {'function': '%s.func' % __name__}
+    self.assertEqual(self.metrics.hits.get(fields), 3)
+    self.assertEqual(self.metrics.misses.get(fields), 4)
+    self.assertEqual(self.metrics.evictions.get(fields), 2)
+
+  def testTtl(self):
+    @memoize.memo(ttl=10, stats=True)
+    def func(a):
+      self.tag(self.time)
+      return a
+
+    self.assertEqual(func(1), 1)
+    self.time += 9
+    self.assertEqual(func(1), 1)
+    self.assertTagged(1000.0)
+
+    self.time += 1
+    self.assertEqual(func(1), 1)
+    self.assertTagged(1000.0, 1010.0)
+    self.assertNotIn(((('a', 1),),), func.memo_dict)
+    self.assertIn((('a', 1),), func.memo_dict)
+
+    fields = {'function': '%s.func' % __name__}
+    self.assertEqual(self.metrics.evictions.get(fields), 1)
+
+  def testNoStatsByDefault(self):
+    @memoize.memo(max_size=1)
+    def func(a):
+      return a
+
+    func(1)
+    func(1)
+    func(2)
+    fields = {'function': '%s.func' % __name__}
+    for metric in self.metrics:
+      self.assertIsNone(metric.get(fields))
+
+  def testMemoClear(self):
+    @memoize.memo(max_size=10, ttl=10)
+    def func(a):
+      self.tag(a)
+      return a
+
+    func(1)
+    func(2)
+    func.memo_clear(1)
+    func.memo_clear(3)
+    self.assertEqual(len(func.memo_dict), 1)
+    func.memo_clear()
+    self.assertEqual(len(func.memo_dict), 0)
+
+  def testBoundMethodsUsePerInstanceBoundedDicts(self):
+    test_case = self
+
+    class Test(object):
+      def __init__(self, name):
+        self.name = name
+
+      @memoize.memo(max_size=1)
+      def func(self, a):
+        test_case.tag((self.name, a))
+        return a
+
+    t0, t1 = Test('t0'), Test('t1')
+    for _ in xrange(3):
+      self.assertEqual(t0.func(1), 1)
+      self.assertEqual(t1.func(1), 1)
+    self.assertEqual(t0.func(2), 2)
+    self.assertEqual(t1.func(1), 1)
+    self.assertTagged(('t0', 1), ('t1', 1), ('t0', 2))
+
+  def testBoundMethodsKeepTheirOwnSettings(self):
+    calls = []
+
+    class Test(object):
+      @memoize.memo()
+      def unbounded(self, a):
+        calls.append(('unbounded', a))
+        return a
+
+      @memoize.memo(max_size=1)
+      def bounded(self, a):
+        calls.append(('bounded', a))
+        return a
+
+    t = Test()
+    # The unbounded method creates the instance's memo dictionaries first.
+    for a in (1, 2, 1, 2):
+      self.assertEqual(t.unbounded(a), a)
+      self.assertEqual(t.bounded(a), a)
+    self.assertEqual(2, calls.count(('unbounded', 1)) +
+                        calls.count(('unbounded', 2)))
+    self.assertEqual(4, calls.count(('bounded', 1)) +
+                        calls.count(('bounded', 2)))
+
+
+class SingleFlightTestCase(MemoTestCase):
+
+  def testConcurrentCallersShareOneCall(self):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    @memoize.memo()
+    def func(a):
+      calls.append(a)
+      started.set()
+      release.wait()
+      return a * 2
+
+    results = []
+    def call():
+      results.append(func(21))
+
+    threads = [threading.Thread(target=call) for _ in xrange(4)]
+    threads[0].start()
+    started.wait()
+    for t in threads[1:]:
+      t.start()
+    # Give the other callers time to block on the first call.
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+      t.join()
+
+    self.assertEqual([21], calls)
+    self.assertEqual([42] * 4, results)
+
+  def testFailureIsNotMemoized(self):
+    attempts = []
+
+    @memoize.memo()
+    def func():
+      attempts.append(None)
+      if len(attempts) == 1:
+        raise ValueError('first call fails')
+      return 'foo'
+
+    with self.assertRaises(ValueError):
+      func()
+    self.assertEqual(func(), 'foo')
+    self.assertEqual(func(), 'foo')
+    self.assertEqual(2, len(attempts))
+    self.assertEqual({}, func._in_flight)
+
+  def testWaiterRetriesWhenOwnerFails(self):
+    started = threading.Event()
+    release = threading.Event()
+    attempts = []
+
+    @memoize.memo()
+    def func():
+      attempts.append(None)
+      if len(attempts) == 1:
+        started.set()
+        release.wait()
+        raise ValueError('first call fails')
+      return 'foo'
+
+    def failing_call():
+      with self.assertRaises(ValueError):
+        func()
+
+    owner = threading.Thread(target=failing_call)
+    owner.start()
+    started.wait()
+
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(func()))
+    waiter.start()
+    release.set()
+    owner.join()
+    waiter.join()
+
+    self.assertEqual(['foo'], results)
+    self.assertEqual(2, len(attempts))
+
+  def testRecursiveCallWithSameKeyDoesNotDeadlock(self):
+    @memoize.memo()
+    def func(depth):
+      if len(calls) < 3:
+        calls.append(depth)
+        return func(depth)
+      return 'done'
+    calls = []
+
+    self.assertEqual(func(0), 'done')
+    self.assertEqual([0, 0, 0], calls)
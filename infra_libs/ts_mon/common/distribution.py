@@ -5,6 +5,16 @@
 import bisect
 import collections
 
+try:
+  import numpy
+except ImportError:  # pragma: no cover
+  numpy = None
+
+
+# Distribution.add_many only uses numpy for sequences at least this long - for
+# shorter ones converting the values to an array costs more than it saves.
+NUMPY_MIN_VALUES = 64
+
 
 class Bucketer(object):
   """Bucketing function for histograms recorded by the Distribution class."""
@@ -116,9 +126,66 @@ class Distribution(object):
     self.bucketer = bucketer
     self.sum = 0
     self.count = 0
-    self.buckets = collections.defaultdict(int)
+    # The number of values in each bucket, indexed by bucket number.
+    self.bucket_counts = [0] * bucketer.total_buckets
+
+  @property
+  def buckets(self):
+    """A dict mapping the index of each non-empty bucket to its count.
+
+    This is a copy: modifying it doesn't change the distribution, assign it
+    back to do that.
+    """
+    return collections.defaultdict(int, (
+        (i, count) for i, count in enumerate(self.bucket_counts) if count))
+
+  @buckets.setter
+  def buckets(self, value):
+    bucket_counts = [0] * self.bucketer.total_buckets
+    for i, count in value.iteritems():
+      bucket_counts[i] = count
+    self.bucket_counts = bucket_counts
 
   def add(self, value):
-    self.buckets[self.bucketer.bucket_for_value(value)] += 1
+    self.bucket_counts[self.bucketer.bucket_for_value(value)] += 1
     self.sum += value
     self.count += 1
+
+  def add_many(self, values):
+    """Adds every value in the sequence to the distribution.
+
+    This is equivalent to calling add() for each value, but buckets all the
+    values at once.
+    """
+    values = list(values)
+    if not values:
+      return
+
+    if numpy is not None and len(values) >= NUMPY_MIN_VALUES:
+      counts = self._numpy_bucket_counts(values)
+    else:
+      counts = self._sorted_bucket_counts(values)
+
+    for i, count in enumerate(counts):
+      self.bucket_counts[i] += count
+    self.sum += sum(values)
+    self.count += len(values)
+
+  def _numpy_bucket_counts(self, values):
+    # Like bucket_for_value: buckets are of [lower, upper) form.
+    indices = numpy.searchsorted(
+        self.bucketer._lower_bounds, values, side='right') - 1
+    return numpy.bincount(
+        indices, minlength=self.bucketer.total_buckets).tolist()
+
+  def _sorted_bucket_counts(self, values):
+    values = sorted(values)
+    counts = []
+    previous = 0
+    for lower_bound in self.bucketer._lower_bounds[1:]:
+      # The number of values less than the lower bound of the next bucket.
+      position = bisect.bisect_left(values, lower_bound, previous)
+      counts.append(position - previous)
+      previous = position
+    counts.append(len(values) - previous)
+    return counts
@@ -0,0 +1,78 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Metrics describing the cost of ts_mon's own flushes."""
+
+import collections
+import logging
+
+from infra_libs.ts_mon.common import metrics
+
+
+metric_serialize_durations = metrics.FloatMetric(
+    'ts_mon/flush/metric_serialize_durations',
+    description='Time spent serializing the values of each metric during the '
+                'last flush, in milliseconds.')
+flush_durations = metrics.CumulativeDistributionMetric(
+    'ts_mon/flush/durations',
+    description='Wall time of each flush, including sending, in milliseconds.')
+send_durations = metrics.CumulativeDistributionMetric(
+    'ts_mon/flush/send_durations',
+    description='Time taken by the monitor to send each chunk of a flush, in '
+                'milliseconds.')
+flushed_cells = metrics.CounterMetric(
+    'ts_mon/flush/cells',
+    description='Number of metric values serialized by flushes.')
+flushed_chunks = metrics.CounterMetric(
+    'ts_mon/flush/chunks',
+    description='Number of MetricsCollections sent by flushes.')
+flushed_bytes = metrics.CounterMetric(
+    'ts_mon/flush/bytes',
+    description='Size of the serialized MetricsCollections sent by flushes, in '
+                'bytes.')
+
+
+def record_serialize_durations(durations):
+  """Records the time spent serializing each metric.
+
+  Args:
+    durations (dict): map of metric name to seconds.
+  """
+  for name, secs in durations.iteritems():
+    metric_serialize_durations.set(secs * 1000, fields={'metric_name': name})
+
+
+class FlushStats(object):
+  """Accumulates what a single flush cost. All durations are in seconds."""
+
+  def __init__(self):
+    self.duration = 0.
+    self.cells = 0
+    self.chunks = 0
+    self.bytes = 0
+    self.send_durations = []
+    self.serialize_durations = collections.defaultdict(float)
+    self.cell_counts = collections.defaultdict(int)
+
+  def record(self):
+    """Sets the ts_mon/flush/* metrics from these stats."""
+    record_serialize_durations(self.serialize_durations)
+    flush_durations.add(self.duration * 1000)
+    for secs in self.send_durations:
+      send_durations.add(secs * 1000)
+    flushed_cells.increment_by(self.cells)
+    flushed_chunks.increment_by(self.chunks)
+    flushed_bytes.increment_by(self.bytes)
+
+  def log_slowest(self, count):
+    """Logs a summary of the flush and the count slowest metrics to serialize."""
+    logging.info(
+        'ts_mon flush took %.1fms: %d values in %d chunks (%d bytes), '
+        '%.1fms sending', self.duration * 1000, self.cells, self.chunks,
+        self.bytes, sum(self.send_durations) * 1000)
+    slowest = sorted(self.serialize_durations.iteritems(),
+                     key=lambda (_, secs): secs, reverse=True)[:count]
+    for name, secs in slowest:
+      logging.info('  %8.2fms %6d values  %s', secs * 1000,
+                   self.cell_counts[name], name)
@@ -45,6 +45,10 @@ from infra_libs.ts_mon.protos import metrics_pb2
 # MetricsCollections larger than this will be split into multiple requests.
 METRICS_DATA_LENGTH_LIMIT = 1000
 
+# How often all values are sent when State.delta_flush is enabled, so the
+# backend still sees every stream regularly even if it didn't change.
+DEFAULT_FULL_FLUSH_INTERVAL_SECS = 10 * 60
+
 
 class State(object):
   """Package-level state is stored here so that it is easily accessible.
@@ -77,10 +81,21 @@ class State(object):
     self.store = store_ctor(self)
     # Cached time of the last flush. Useful mostly in AppEngine apps.
     self.last_flushed = datetime.datetime.utcfromtimestamp(0)
+    # If True, flush() only sends the values that changed since the previous
+    # flush, except for a full flush every full_flush_interval_secs seconds.
+    self.delta_flush = False
+    self.full_flush_interval_secs = DEFAULT_FULL_FLUSH_INTERVAL_SECS
+    # time.time() of the last flush that sent every value.  None if there
+    # hasn't been one yet.
+    self.last_full_flush = None
+    # If positive, flush() logs its cost and this many of the metrics that
+    # were the slowest to serialize.
+    self.debug_profile = 0
 
   def reset_for_unittest(self):
     self.metrics = {}
     self.last_flushed = datetime.datetime.utcfromtimestamp(0)
+    self.last_full_flush = None
     self.store.reset_for_unittest()
 
 state = State()
@@ -95,18 +110,73 @@ def flush():
     logging.debug('ts_mon: sending metrics is disabled.')
     return
 
+  # Imported here because flush_metrics defines metrics, and metrics.py imports
+  # this module.
+  from infra_libs.ts_mon.common import flush_metrics
+
+  flush_start = time.time()
+  changed_only = _is_delta_flush()
+
   proto = metrics_pb2.MetricsCollection()
+  stats = flush_metrics.FlushStats()
+
+  # (fields_values, fields of the cells read from it), to mark the cells
+  # changed again if sending fails.
+  read_cells = []
+  try:
+    for target, metric, start_time, fields_values in state.store.get_all():
+      start = time.time()
+      items = list(fields_values.iteritems(changed_only=changed_only))
+      read_cells.append((fields_values, [fields for fields, _ in items]))
+      for fields, value in items:
+        if len(proto.data) >= METRICS_DATA_LENGTH_LIMIT:
+          send_start = time.time()
+          _send(proto, stats)
+          del proto.data[:]
+          # Only count the time spent serializing this metric.
+          start += time.time() - send_start
+
+        metric.serialize_to(proto, start_time, fields, value, target)
+      stats.serialize_durations[metric.name] += time.time() - start
+      stats.cell_counts[metric.name] += len(items)
+      stats.cells += len(items)
+
+    _send(proto, stats)
+  except Exception:
+    # Send these values again with the next flush, even a delta one.
+    for fields_values, fields_list in read_cells:
+      fields_values.mark_changed(fields_list)
+    if not changed_only:
+      state.last_full_flush = None
+    raise
+  state.last_flushed = datetime.datetime.utcnow()
 
-  for target, metric, start_time, fields_values in state.store.get_all():
-    for fields, value in fields_values.iteritems():
-      if len(proto.data) >= METRICS_DATA_LENGTH_LIMIT:
-        state.global_monitor.send(proto)
-        del proto.data[:]
+  stats.duration = time.time() - flush_start
+  stats.record()
+  if state.debug_profile > 0:
+    stats.log_slowest(state.debug_profile)
 
-      metric.serialize_to(proto, start_time, fields, value, target)
 
+def _send(proto, stats):
+  """Sends one chunk of a flush and records its size and latency in stats."""
+  stats.bytes += proto.ByteSize()
+  start = time.time()
   state.global_monitor.send(proto)
-  state.last_flushed = datetime.datetime.utcnow()
+  stats.send_durations.append(time.time() - start)
+  stats.chunks += 1
+
+
+def _is_delta_flush():
+  """Returns True if this flush should only send the values that changed.
+
+  Otherwise records the current time as the time of the last full flush.
+  """
+  now = time.time()
+  if (state.delta_flush and state.last_full_flush is not None and
+      now - state.last_full_flush < state.full_flush_interval_secs):
+    return True
+  state.last_full_flush = now
+  return False
 
 
 def register(metric):
@@ -135,6 +205,8 @@ def close():
   """Stops any background threads and waits for them to exit."""
   if state.flush_thread is not None:
     state.flush_thread.stop()
+  if state.global_monitor is not None:
+    state.global_monitor.close()
 
 
 def reset_for_unittest(disable=False):
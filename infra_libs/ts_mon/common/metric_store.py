@@ -80,6 +80,11 @@ class MetricStore(object):
 
     The iterator yields 4-tuples:
       (target, metric, start_time, field_values)
+
+    field_values.iteritems(changed_only=True) yields only the values that were
+    set since the previous iteration over field_values, and
+    field_values.mark_changed(fields) makes values that could not be sent
+    count as changed again.
     """
     raise NotImplementedError
 
@@ -163,33 +168,66 @@ class MetricFieldsValues(object):
   def __init__(self):
     # Map normalized fields to single metric values.
     self._values = {}
+    # Normalized fields of the values that were set since the last iteration.
+    self._changed = set()
     self._thread_lock = threading.Lock()
 
   def get_value(self, fields, default=None):
     return self._values.get(fields, default)
 
   def set_value(self, fields, value):
-    self._values[fields] = value
+    with self._thread_lock:
+      self._values[fields] = value
+      self._changed.add(fields)
+
+  def iteritems(self, changed_only=False):
+    """Yields (fields, value) tuples.
 
-  def iteritems(self):
+    Every call starts a new round of change tracking: a later call with
+    changed_only=True will only yield the values set after this one.
+
+    Args:
+      changed_only: if True, only yield the values that were set since the
+          previous call to iteritems.
+    """
     # Make a copy of the metric values in case another thread (or this
     # generator's consumer) modifies them while we're iterating.
     with self._thread_lock:
       values = copy.copy(self._values)
-    for fields, value in values.iteritems():
-      yield fields, value
+      changed = self._changed
+      self._changed = set()
+    if changed_only:
+      for fields in changed:
+        yield fields, values[fields]
+    else:
+      for fields, value in values.iteritems():
+        yield fields, value
+
+  def mark_changed(self, fields_list):
+    """Makes the next iteritems(changed_only=True) yield these values again.
+
+    Used when values returned by iteritems could not be sent.
+    """
+    with self._thread_lock:
+      self._changed.update(f for f in fields_list if f in self._values)
 
 
 class TargetFieldsValues(object):
   def __init__(self, store):
     # Map normalized target fields to MetricFieldsValues.
-    self._values = collections.defaultdict(MetricFieldsValues)
+    self._values = {}
     self._store = store
     self._thread_lock = threading.Lock()
 
   def get_target_values(self, target_fields):
     key = self._store._normalize_target_fields(target_fields)
-    return self._values[key]
+    values = self._values.get(key)
+    if values is None:
+      # Two threads may race to create the same entry - make sure they both end
+      # up using the same one.
+      with self._thread_lock:
+        values = self._values.setdefault(key, MetricFieldsValues())
+    return values
 
   def get_value(self, fields, target_fields, default=None):
     return self.get_target_values(target_fields).get_value(
@@ -277,8 +315,9 @@ class InProcessMetricStore(MetricStore):
       modify_fn = default_modify_fn(name)
 
     with self._thread_lock:
-      self._entry(name).set_value(fields, target_fields, modify_fn(
-          self.get(name, fields, target_fields, 0), delta))
+      entry = self._entry(name)
+      entry.set_value(fields, target_fields, modify_fn(
+          entry.get_value(fields, target_fields, 0), delta))
 
   def modify_multi(self, modifications):
     # This is only used by DeferredMetricStore on top of MemcacheMetricStore,
@@ -294,3 +333,67 @@ class InProcessMetricStore(MetricStore):
 
   def _reset(self, name):
     self._values[name] = MetricValues(self, self._start_time(name))
+
+
+class ShardedInProcessMetricStore(InProcessMetricStore):
+  """An in-memory metric store that doesn't serialize all updates on one lock.
+
+  InProcessMetricStore holds a single lock for every set() and incr(), which
+  becomes heavily contended when many threads update metrics at once.  This
+  store instead picks one of num_shards locks based on the cell being modified
+  (the metric name and fields), so updates to different cells
+  rarely wait for each other.  The global lock is only taken when a new metric
+  entry has to be created or when the store is reset.
+
+  Use it by passing it to interface.State:
+    State(store_ctor=metric_store.ShardedInProcessMetricStore)
+  """
+
+  DEFAULT_NUM_SHARDS = 64
+
+  def __init__(self, state, time_fn=None, num_shards=DEFAULT_NUM_SHARDS):
+    super(ShardedInProcessMetricStore, self).__init__(state, time_fn=time_fn)
+
+    if num_shards < 1:
+      raise ValueError('num_shards must be >= 1 (was %d)' % num_shards)
+    self._shard_locks = [threading.Lock() for _ in xrange(num_shards)]
+
+  def _entry(self, name):
+    entry = self._values.get(name)
+    if entry is None:
+      with self._thread_lock:
+        if name not in self._values:
+          self._reset(name)
+        entry = self._values[name]
+    return entry
+
+  def _shard_lock(self, name, fields):
+    # Cells that differ only by their target fields share a lock - it saves
+    # normalizing the target fields on every update.
+    return self._shard_locks[hash((name, fields)) % len(self._shard_locks)]
+
+  def set(self, name, fields, target_fields, value, enforce_ge=False):
+    entry = self._entry(name)
+    with self._shard_lock(name, fields):
+      if enforce_ge:
+        old_value = entry.get_value(fields, target_fields, 0)
+        if value < old_value:
+          raise errors.MonitoringDecreasingValueError(name, old_value, value)
+
+      entry.set_value(fields, target_fields, value)
+
+  def incr(self, name, fields, target_fields, delta, modify_fn=None):
+    if delta < 0:
+      raise errors.MonitoringDecreasingValueError(name, None, delta)
+
+    if modify_fn is None:
+      modify_fn = default_modify_fn(name)
+
+    entry = self._entry(name)
+    with self._shard_lock(name, fields):
+      entry.set_value(fields, target_fields, modify_fn(
+          entry.get_value(fields, target_fields, 0), delta))
+
+  def reset_for_unittest(self, name=None):
+    with self._thread_lock:
+      super(ShardedInProcessMetricStore, self).reset_for_unittest(name=name)
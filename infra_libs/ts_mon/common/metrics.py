@@ -18,6 +18,10 @@ from infra_libs.ts_mon.common import interface
 
 MICROSECONDS_PER_SECOND = 1000000
 
+# Maximum number of cached MetricsData templates per metric.  The cache is
+# cleared when it grows beyond this.
+MAX_CACHED_TEMPLATES = 10000
+
 
 class Metric(object):
   """Abstract base class for a metric.
@@ -64,6 +68,9 @@ class Metric(object):
     self._fields = fields
     self._normalized_fields = self._normalize_fields(self._fields)
     self._description = description
+    # Map (normalized fields, target key) to a MetricsData with everything but
+    # the value filled in.
+    self._templates = {}
 
     interface.register(self)
 
@@ -96,16 +103,32 @@ class Metric(object):
       target (Target): a Target to use.
     """
 
+    template = self._template(fields, target)
     metric_pb = collection_pb.data.add()
-    metric_pb.metric_name_prefix = '/chrome/infra/'
-    metric_pb.name = self._name
-    if self._description is not None:
-      metric_pb.description = self._description
-
+    metric_pb.CopyFrom(template)
     self._populate_value(metric_pb, value, start_time)
-    self._populate_fields(metric_pb, fields)
 
-    target._populate_target_pb(metric_pb)
+  def _template(self, fields, target):
+    """Returns a MetricsData with the name, fields and target populated.
+
+    Building the field and target protos for every value on every flush is
+    expensive, so the result is cached for each unique fields tuple and target.
+    """
+    key = (fields, target.cache_key())
+    template = self._templates.get(key)
+    if template is None:
+      template = metrics_pb2.MetricsData()
+      template.metric_name_prefix = '/chrome/infra/'
+      template.name = self._name
+      if self._description is not None:
+        template.description = self._description
+      self._populate_fields(template, fields)
+      target._populate_target_pb(template)
+
+      if len(self._templates) >= MAX_CACHED_TEMPLATES:
+        self._templates.clear()
+      self._templates[key] = template
+    return template
 
   def _populate_fields(self, metric, fields):
     """Fill in the fields attribute of a metric protocol buffer.
@@ -196,6 +219,7 @@ class Metric(object):
     """
 
     interface.state.store.reset_for_unittest(self.name)
+    self._templates.clear()
 
   def _set(self, fields, target_fields, value, enforce_ge=False):
     interface.state.store.set(self.name, self._normalize_fields(fields),
@@ -369,14 +393,15 @@ class DistributionMetric(Metric):
     # Copy the distribution bucket values.  Only include the finite buckets, not
     # the overflow buckets on each end.
     pb.bucket.extend(self._running_zero_generator(
-        value.buckets.get(i, 0) for i in
-        xrange(1, value.bucketer.total_buckets - 1)))
+        value.bucket_counts[1:value.bucketer.total_buckets - 1]))
 
     # Add the overflow buckets if present.
-    if value.bucketer.underflow_bucket in value.buckets:
-      pb.underflow = value.buckets[value.bucketer.underflow_bucket]
-    if value.bucketer.overflow_bucket in value.buckets:
-      pb.overflow = value.buckets[value.bucketer.overflow_bucket]
+    underflow = value.bucket_counts[value.bucketer.underflow_bucket]
+    if underflow:
+      pb.underflow = underflow
+    overflow = value.bucket_counts[value.bucketer.overflow_bucket]
+    if overflow:
+      pb.overflow = overflow
 
     if value.count != 0:
       pb.mean = float(value.sum) / value.count
@@ -408,6 +433,21 @@ class DistributionMetric(Metric):
 
     self._incr(fields, target_fields, value, modify_fn=modify_fn)
 
+  def add_many(self, values, fields=None, target_fields=None):
+    """Adds every value in the sequence to the distribution.
+
+    This is much faster than calling add() for each value.
+    """
+    values = list(values)
+
+    def modify_fn(dist, _count):
+      if dist == 0:
+        dist = distribution.Distribution(self.bucketer)
+      dist.add_many(values)
+      return dist
+
+    self._incr(fields, target_fields, len(values), modify_fn=modify_fn)
+
   def set(self, value, fields=None, target_fields=None):
     """Replaces the distribution with the given fields with another one.
 
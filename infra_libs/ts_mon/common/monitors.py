@@ -5,10 +5,13 @@
 """Classes representing the monitoring interface for tasks or devices."""
 
 
+import Queue
 import base64
 import json
 import logging
 import socket
+import threading
+import time
 import traceback
 
 from googleapiclient import discovery
@@ -20,6 +23,7 @@ import httplib2
 
 from infra_libs import httplib2_utils
 from infra_libs.ts_mon.common import http_metrics
+from infra_libs.ts_mon.common import metrics
 from infra_libs.ts_mon.protos import metrics_pb2
 
 
@@ -59,6 +63,19 @@ class Monitor(object):
   def send(self, metric_pb):
     raise NotImplementedError()
 
+  def send_multi(self, metric_pbs):
+    """Sends several metric protos, in as few requests as the Monitor can.
+
+    Args:
+      metric_pbs (list): MetricsData, lists of MetricsData or MetricsCollections.
+    """
+    for metric_pb in metric_pbs:
+      self.send(metric_pb)
+
+  def close(self):
+    """Sends any pending metrics and releases resources held by the Monitor."""
+    pass
+
 
 class PubSubMonitor(Monitor):
   """Class which publishes metrics to a Cloud Pub/Sub topic."""
@@ -146,13 +163,25 @@ class PubSubMonitor(Monitor):
     Args:
       metric_pb (MetricsData or MetricsCollection): the metric protobuf to send
     """
+    self.send_multi([metric_pb])
+
+  def send_multi(self, metric_pbs):
+    """Publish several metric protos in a single Pub/Sub request.
+
+    Each proto becomes a separate message of the request.
+
+    Args:
+      metric_pbs (list): MetricsData, lists of MetricsData or MetricsCollections.
+    """
     if not self._check_initialize():
       return
-    proto = self._wrap_proto(metric_pb)
-    logging.debug('ts_mon: sending %d metrics to PubSub', len(proto.data))
+    protos = [self._wrap_proto(metric_pb) for metric_pb in metric_pbs]
+    logging.debug('ts_mon: sending %d metrics to PubSub in %d messages',
+                  sum(len(proto.data) for proto in protos), len(protos))
     body = {
         'messages': [
-          {'data': base64.b64encode(proto.SerializeToString())},
+          {'data': base64.b64encode(proto.SerializeToString())}
+          for proto in protos
         ],
     }
     # Occasionally, client fails to receive a proper internal JSON
@@ -191,3 +220,125 @@ class NullMonitor(Monitor):
   """Class that doesn't send metrics anywhere."""
   def send(self, metric_pb):
     pass
+
+
+async_queue_size = metrics.GaugeMetric('ts_mon/async_monitor/queue_size',
+    description='Number of metric collections waiting to be sent by an '
+                'AsyncMonitor.')
+async_dropped_collections = metrics.CounterMetric(
+    'ts_mon/async_monitor/dropped_collections',
+    description='Number of metric collections dropped by an AsyncMonitor '
+                'because its queue was full.')
+async_dropped_data = metrics.CounterMetric(
+    'ts_mon/async_monitor/dropped_data',
+    description='Number of individual metric values dropped by an AsyncMonitor '
+                'because its queue was full.')
+async_batch_size = metrics.CumulativeDistributionMetric(
+    'ts_mon/async_monitor/batch_size',
+    description='Number of metric collections sent together by an '
+                'AsyncMonitor.')
+async_send_durations = metrics.CumulativeDistributionMetric(
+    'ts_mon/async_monitor/send_durations',
+    description='Time taken by an AsyncMonitor to send one batch of metric '
+                'collections, in milliseconds.')
+
+
+class AsyncMonitor(Monitor):
+  """Class which sends metrics from a background thread through another Monitor.
+
+  send() copies the metrics into a bounded queue and returns immediately, so a
+  slow endpoint doesn't stall flush().  The background thread takes up to
+  max_batch_size collections from the queue at a time and passes them all to
+  the wrapped Monitor's send_multi().  When the queue is full new collections
+  are dropped and counted in the ts_mon/async_monitor/dropped_* metrics.
+  """
+
+  # Put in the queue by close() to stop the background thread.
+  _STOP = object()
+
+  def __init__(self, monitor, max_queue_size=100, max_batch_size=10):
+    """
+    Args:
+      monitor (Monitor): the monitor that actually sends the metrics.
+      max_queue_size (int): how many collections can be waiting to be sent
+          before new ones get dropped.
+      max_batch_size (int): the maximum number of collections passed to a single
+          monitor.send_multi() call.
+    """
+    if max_batch_size < 1:
+      raise ValueError('max_batch_size must be >= 1 (was %d)' % max_batch_size)
+
+    self._monitor = monitor
+    self._max_batch_size = max_batch_size
+    self._queue = Queue.Queue(maxsize=max_queue_size)
+    self._thread = None
+    self._thread_lock = threading.Lock()
+
+  def _ensure_thread(self):
+    with self._thread_lock:
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, name='ts_mon_send')
+        self._thread.daemon = True
+        self._thread.start()
+
+  def send(self, metric_pb):
+    self._ensure_thread()
+
+    # The caller is free to modify metric_pb as soon as we return (flush()
+    # reuses the same proto for every chunk), so queue a copy.
+    proto = metrics_pb2.MetricsCollection()
+    proto.CopyFrom(self._wrap_proto(metric_pb))
+    try:
+      self._queue.put_nowait(proto)
+    except Queue.Full:
+      logging.warning('ts_mon: AsyncMonitor queue is full, dropping %d metrics',
+                      len(proto.data))
+      async_dropped_collections.increment()
+      async_dropped_data.increment_by(len(proto.data))
+    async_queue_size.set(self._queue.qsize())
+
+  def _next_batch(self):
+    """Blocks until there is something in the queue and returns a batch of it.
+
+    Returns:
+      A (batch, stop) tuple.  stop is True if close() was called.
+    """
+    item = self._queue.get()
+    if item is self._STOP:
+      return [], True
+
+    batch = [item]
+    while len(batch) < self._max_batch_size:
+      try:
+        item = self._queue.get_nowait()
+      except Queue.Empty:
+        break
+      if item is self._STOP:
+        return batch, True
+      batch.append(item)
+    return batch, False
+
+  def _send_batch(self, batch):
+    start = time.time()
+    try:
+      self._monitor.send_multi(batch)
+    except Exception:
+      logging.exception('ts_mon: AsyncMonitor failed to send metrics.')
+    async_send_durations.add((time.time() - start) * 1000)
+    async_batch_size.add(len(batch))
+
+  def _run(self):
+    stop = False
+    while not stop:
+      batch, stop = self._next_batch()
+      if batch:
+        self._send_batch(batch)
+
+  def close(self):
+    """Sends all the queued metrics and stops the background thread."""
+    with self._thread_lock:
+      thread, self._thread = self._thread, None
+    if thread is not None:
+      self._queue.put(self._STOP)
+      thread.join()
+    self._monitor.close()
@@ -21,6 +21,24 @@ class Target(object):
   def __init__(self):
     # Subclasses should list the updatable target fields here.
     self._fields = tuple()
+    # Cached result of cache_key(), cleared whenever an attribute is set.
+    self._cache_key = None
+
+  def __setattr__(self, name, value):
+    if not name.startswith('_'):
+      self.__dict__['_cache_key'] = None
+    super(Target, self).__setattr__(name, value)
+
+  def cache_key(self):
+    """Returns a hashable value that identifies the target's contents.
+
+    Two targets with the same cache key populate the same target proto.
+    """
+    if self._cache_key is None:
+      self._cache_key = (type(self),) + tuple(sorted(
+          (k, v) for k, v in self.__dict__.iteritems()
+          if not k.startswith('_')))
+    return self._cache_key
 
   def _populate_target_pb(self, metric):
     """Populate the 'target' embedded message field of a metric protobuf."""
@@ -0,0 +1,66 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Micro-benchmark comparing Distribution.add with Distribution.add_many.
+
+Usage:
+  python -m infra_libs.ts_mon.common.test.distribution_benchmark \\
+      --sizes 10 1000 100000
+"""
+
+import argparse
+import random
+import timeit
+
+from infra_libs.ts_mon.common import distribution
+
+
+def _add_each(bucketer, values):
+  d = distribution.Distribution(bucketer)
+  for value in values:
+    d.add(value)
+
+
+def _add_many(bucketer, values):
+  distribution.Distribution(bucketer).add_many(values)
+
+
+def run_benchmark(size, repeat=3):
+  """Returns the best time in seconds of (add, add_many, add_many w/o numpy)."""
+  bucketer = distribution.GeometricBucketer()
+  values = [random.expovariate(1 / 200.0) for _ in xrange(size)]
+
+  def best(fn):
+    return min(timeit.repeat(lambda: fn(bucketer, values),
+                             repeat=repeat, number=1))
+
+  add_time = best(_add_each)
+  add_many_time = best(_add_many)
+
+  numpy = distribution.numpy
+  distribution.numpy = None
+  try:
+    sorted_time = best(_add_many)
+  finally:
+    distribution.numpy = numpy
+  return add_time, add_many_time, sorted_time
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--sizes', type=int, nargs='+',
+                      default=[10, 100, 1000, 10000, 100000])
+  args = parser.parse_args()
+
+  print 'numpy available: %s' % (distribution.numpy is not None)
+  print '%10s %12s %14s %18s' % ('values', 'add (ms)', 'add_many (ms)',
+                                 'sorted-merge (ms)')
+  for size in args.sizes:
+    times = run_benchmark(size)
+    print '%10d %12.3f %14.3f %18.3f' % ((size,) + tuple(
+        t * 1000 for t in times))
+
+
+if __name__ == '__main__':
+  main()
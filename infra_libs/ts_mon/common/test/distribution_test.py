@@ -4,6 +4,8 @@
 
 import unittest
 
+import mock
+
 from infra_libs.ts_mon.common import distribution
 
 
@@ -162,3 +164,83 @@ class DistributionTest(unittest.TestCase):
     self.assertEqual(1000100, d.sum)
     self.assertEqual(2, d.count)
     self.assertEqual({11: 2}, d.buckets)
+
+  def test_bucket_counts(self):
+    d = distribution.Distribution(
+        distribution.FixedWidthBucketer(width=10, num_finite_buckets=3))
+    d.add(-1)
+    d.add(15)
+    d.add(15)
+    d.add(1000)
+    self.assertEqual([1, 0, 2, 0, 1], d.bucket_counts)
+    self.assertEqual(0, d.buckets[1])
+
+  def test_set_buckets(self):
+    d = distribution.Distribution(
+        distribution.FixedWidthBucketer(width=10, num_finite_buckets=3))
+    d.add(15)
+    d.buckets = {0: 1, 3: 2}
+    self.assertEqual([1, 0, 0, 2, 0], d.bucket_counts)
+    self.assertEqual({0: 1, 3: 2}, d.buckets)
+
+    buckets = d.buckets
+    buckets[4] += 1
+    d.buckets = buckets
+    self.assertEqual([1, 0, 0, 2, 1], d.bucket_counts)
+
+
+class DistributionAddManyTest(unittest.TestCase):
+  VALUES = [-5, 0, 1, 9.9, 10, 10, 55, 99, 100, 1000000, 3]
+
+  def assertSameAsAdd(self, bucketer, values):
+    expected = distribution.Distribution(bucketer)
+    for value in values:
+      expected.add(value)
+
+    d = distribution.Distribution(bucketer)
+    d.add_many(values)
+
+    self.assertEqual(expected.bucket_counts, d.bucket_counts)
+    self.assertEqual(expected.sum, d.sum)
+    self.assertEqual(expected.count, d.count)
+
+  def test_empty(self):
+    d = distribution.Distribution(distribution.GeometricBucketer())
+    d.add_many([])
+    self.assertEqual(0, d.count)
+    self.assertEqual({}, d.buckets)
+
+  def test_sorted_merge(self):
+    with mock.patch.object(distribution, 'numpy', None):
+      self.assertSameAsAdd(
+          distribution.FixedWidthBucketer(width=10, num_finite_buckets=10),
+          self.VALUES)
+      self.assertSameAsAdd(distribution.GeometricBucketer(), self.VALUES)
+      self.assertSameAsAdd(
+          distribution.FixedWidthBucketer(width=10, num_finite_buckets=0),
+          self.VALUES)
+
+  def test_sorted_merge_many(self):
+    with mock.patch.object(distribution, 'numpy', None):
+      self.assertSameAsAdd(distribution.GeometricBucketer(),
+                           [x * 0.7 for x in xrange(-100, 1000)])
+
+  def test_numpy(self):
+    if distribution.numpy is None:  # pragma: no cover
+      return
+    with mock.patch.object(distribution, 'NUMPY_MIN_VALUES', 1):
+      self.assertSameAsAdd(
+          distribution.FixedWidthBucketer(width=10, num_finite_buckets=10),
+          self.VALUES)
+      self.assertSameAsAdd(distribution.GeometricBucketer(), self.VALUES)
+      self.assertSameAsAdd(
+          distribution.FixedWidthBucketer(width=10, num_finite_buckets=0),
+          self.VALUES)
+
+  def test_accumulates(self):
+    d = distribution.Distribution(distribution.FixedWidthBucketer(width=10))
+    d.add(5)
+    d.add_many(iter([5, 15]))
+    self.assertEqual({1: 2, 2: 1}, d.buckets)
+    self.assertEqual(25, d.sum)
+    self.assertEqual(3, d.count)
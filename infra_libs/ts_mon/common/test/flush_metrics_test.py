@@ -0,0 +1,59 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from infra_libs.ts_mon.common import flush_metrics
+from infra_libs.ts_mon.common import interface
+from infra_libs.ts_mon.common import targets
+from infra_libs import ts_mon
+
+
+class FlushMetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    interface.state.target = targets.TaskTarget(
+        'test_service', 'test_job', 'test_region', 'test_host')
+    ts_mon.reset_for_unittest()
+
+  def test_record_serialize_durations(self):
+    flush_metrics.record_serialize_durations({'foo': 0.5, 'bar': 0.002})
+    self.assertEqual(500, flush_metrics.metric_serialize_durations.get(
+        fields={'metric_name': 'foo'}))
+    self.assertEqual(2, flush_metrics.metric_serialize_durations.get(
+        fields={'metric_name': 'bar'}))
+
+  def test_record_stats(self):
+    stats = flush_metrics.FlushStats()
+    stats.duration = 0.25
+    stats.cells = 1500
+    stats.chunks = 2
+    stats.bytes = 12345
+    stats.send_durations = [0.1, 0.05]
+    stats.serialize_durations['foo'] = 0.01
+    stats.record()
+
+    self.assertEqual(1, flush_metrics.flush_durations.get().count)
+    self.assertEqual(250, flush_metrics.flush_durations.get().sum)
+    self.assertEqual(2, flush_metrics.send_durations.get().count)
+    self.assertAlmostEqual(150, flush_metrics.send_durations.get().sum)
+    self.assertEqual(1500, flush_metrics.flushed_cells.get())
+    self.assertEqual(2, flush_metrics.flushed_chunks.get())
+    self.assertEqual(12345, flush_metrics.flushed_bytes.get())
+    self.assertEqual(10, flush_metrics.metric_serialize_durations.get(
+        fields={'metric_name': 'foo'}))
+
+  @mock.patch('logging.info', autospec=True)
+  def test_log_slowest(self, log_info):
+    stats = flush_metrics.FlushStats()
+    for name, secs in (('fast', 0.001), ('slow', 0.1), ('medium', 0.01)):
+      stats.serialize_durations[name] = secs
+      stats.cell_counts[name] = 3
+    stats.log_slowest(2)
+
+    self.assertEqual(3, log_info.call_count)
+    logged = [call[0][-1] for call in log_info.call_args_list[1:]]
+    self.assertEqual(['slow', 'medium'], logged)
@@ -55,6 +55,52 @@ class GlobalsTest(unittest.TestCase):
     self.assertEqual(1, len(proto.data))
     self.assertEqual('foo', proto.data[0].name)
 
+  @mock.patch('infra_libs.ts_mon.common.flush_metrics.'
+              'record_serialize_durations', autospec=True)
+  def test_flush_records_serialize_durations(self, record):
+    interface.state.global_monitor = stubs.MockMonitor()
+
+    counter = metrics.CounterMetric('counter')
+    counter.increment()
+    interface.flush()
+
+    record.assert_called_once_with(mock.ANY)
+    self.assertEqual(['counter'], record.call_args[0][0].keys())
+
+  def test_flush_records_stats(self):
+    interface.state.global_monitor = stubs.MockMonitor()
+
+    counter = metrics.CounterMetric('counter')
+    for i in xrange(interface.METRICS_DATA_LENGTH_LIMIT + 1):
+      counter.increment(fields={'i': i})
+
+    recorded = []
+    with mock.patch('infra_libs.ts_mon.common.flush_metrics.FlushStats.record',
+                    autospec=True, side_effect=recorded.append):
+      interface.flush()
+
+    stats = recorded[0]
+    self.assertEqual(interface.METRICS_DATA_LENGTH_LIMIT + 1, stats.cells)
+    self.assertEqual(interface.METRICS_DATA_LENGTH_LIMIT + 1,
+                     stats.cell_counts['counter'])
+    self.assertEqual(2, stats.chunks)
+    self.assertEqual(2, len(stats.send_durations))
+    self.assertGreater(stats.bytes, 0)
+    self.assertGreaterEqual(stats.duration, sum(stats.send_durations))
+
+  @mock.patch('infra_libs.ts_mon.common.flush_metrics.FlushStats.log_slowest',
+              autospec=True)
+  def test_flush_debug_profile(self, log_slowest):
+    interface.state.global_monitor = stubs.MockMonitor()
+    metrics.CounterMetric('counter').increment()
+
+    interface.flush()
+    self.assertFalse(log_slowest.called)
+
+    interface.state.debug_profile = 5
+    interface.flush()
+    log_slowest.assert_called_once_with(mock.ANY, 5)
+
   def test_flush_disabled(self):
     interface.reset_for_unittest(disable=True)
     interface.state.global_monitor = stubs.MockMonitor()
@@ -95,6 +141,87 @@ class GlobalsTest(unittest.TestCase):
     self.assertEqual(1000, data_lengths[0])
     self.assertEqual(1, data_lengths[1])
 
+  @mock.patch('time.time', autospec=True)
+  def test_delta_flush(self, fake_time):
+    fake_time.return_value = 1000
+    interface.state.global_monitor = stubs.MockMonitor()
+    interface.state.delta_flush = True
+    interface.state.full_flush_interval_secs = 600
+
+    sent = []
+    def send(proto):
+      sent.append(sorted(d.counter for d in proto.data if d.name == 'counter'))
+    interface.state.global_monitor.send.side_effect = send
+
+    counter = metrics.CounterMetric('counter')
+    counter.increment_by(1, fields={'f': 'a'})
+    counter.increment_by(2, fields={'f': 'b'})
+
+    # The first flush is always a full flush.
+    interface.flush()
+    self.assertEqual([1, 2], sent[-1])
+
+    # Only the changed cell is sent.
+    fake_time.return_value = 1060
+    counter.increment_by(5, fields={'f': 'b'})
+    interface.flush()
+    self.assertEqual([7], sent[-1])
+
+    # Nothing changed.
+    fake_time.return_value = 1120
+    interface.flush()
+    self.assertEqual([], sent[-1])
+
+    # Full resync after full_flush_interval_secs.
+    fake_time.return_value = 1600
+    interface.flush()
+    self.assertEqual([1, 7], sent[-1])
+    self.assertEqual(1600, interface.state.last_full_flush)
+
+  @mock.patch('time.time', autospec=True)
+  def test_delta_flush_after_failed_send(self, fake_time):
+    fake_time.return_value = 1000
+    interface.state.global_monitor = stubs.MockMonitor()
+    interface.state.delta_flush = True
+    interface.state.full_flush_interval_secs = 600
+
+    sent = []
+    failures = []
+    def send(proto):
+      if failures:
+        raise failures.pop()
+      sent.append(sorted(d.counter for d in proto.data if d.name == 'counter'))
+    interface.state.global_monitor.send.side_effect = send
+
+    counter = metrics.CounterMetric('counter')
+    counter.increment_by(1, fields={'f': 'a'})
+    counter.increment_by(2, fields={'f': 'b'})
+    interface.flush()
+    self.assertEqual([1, 2], sent[-1])
+
+    # The changed cell isn't lost when sending it fails.
+    fake_time.return_value = 1060
+    counter.increment_by(5, fields={'f': 'b'})
+    failures.append(IOError())
+    with self.assertRaises(IOError):
+      interface.flush()
+
+    fake_time.return_value = 1120
+    interface.flush()
+    self.assertEqual([7], sent[-1])
+
+    # A failed full flush is retried by the next flush.
+    fake_time.return_value = 1600
+    failures.append(IOError())
+    with self.assertRaises(IOError):
+      interface.flush()
+    self.assertIsNone(interface.state.last_full_flush)
+
+    fake_time.return_value = 1660
+    interface.flush()
+    self.assertEqual([1, 7], sent[-1])
+    self.assertEqual(1660, interface.state.last_full_flush)
+
   def test_send_modifies_metric_values(self):
     interface.state.global_monitor = stubs.MockMonitor()
     interface.state.target = stubs.MockTarget()
@@ -158,6 +285,11 @@ class GlobalsTest(unittest.TestCase):
     interface.close()
     self.assertFalse(interface.state.flush_thread.is_alive())
 
+  def test_close_closes_monitor(self):
+    interface.state.global_monitor = stubs.MockMonitor()
+    interface.close()
+    interface.state.global_monitor.close.assert_called_once_with()
+
   def test_reset_for_unittest(self):
     metric = metrics.CounterMetric('foo')
     metric.increment()
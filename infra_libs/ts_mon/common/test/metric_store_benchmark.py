@@ -0,0 +1,87 @@
+# Copyright 2016 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Micro-benchmark comparing MetricStore implementations under many threads.
+
+Usage:
+  python -m infra_libs.ts_mon.common.test.metric_store_benchmark \\
+      --threads 1 4 16 --increments 20000
+"""
+
+import argparse
+import threading
+import time
+
+from infra_libs.ts_mon.common import interface
+from infra_libs.ts_mon.common import metric_store
+from infra_libs.ts_mon.common import metrics
+from infra_libs.ts_mon.common import targets
+
+
+STORES = {
+    'in_process': metric_store.InProcessMetricStore,
+    'sharded': metric_store.ShardedInProcessMetricStore,
+}
+
+
+def run_benchmark(store_ctor, num_threads, increments, num_metrics=4,
+                  num_field_values=16):
+  """Returns the number of seconds it took to perform all the increments."""
+  state = interface.State(
+      store_ctor=store_ctor,
+      target=targets.TaskTarget('service', 'job', 'region', 'host'))
+  old_state = interface.state
+  interface.state = state
+  try:
+    counters = [metrics.CounterMetric('benchmark/counter/%d' % i)
+                for i in xrange(num_metrics)]
+    fields = [{'value': str(i)} for i in xrange(num_field_values)]
+    barrier = threading.Event()
+
+    def worker(thread_index):
+      barrier.wait()
+      for i in xrange(increments):
+        counter = counters[(thread_index + i) % num_metrics]
+        counter.increment(fields=fields[i % num_field_values])
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in xrange(num_threads)]
+    for thread in threads:
+      thread.start()
+
+    start = time.time()
+    barrier.set()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - start
+
+    total = sum(value
+                for _, _, _, fields_values in state.store.get_all()
+                for _, value in fields_values.iteritems())
+    assert total == num_threads * increments, total
+    return elapsed
+  finally:
+    interface.state = old_state
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16, 32])
+  parser.add_argument('--increments', type=int, default=20000,
+                      help='number of increments performed by each thread')
+  parser.add_argument('--stores', nargs='+', choices=sorted(STORES),
+                      default=sorted(STORES))
+  args = parser.parse_args()
+
+  print '%-12s %8s %10s %14s' % ('store', 'threads', 'seconds', 'incr/sec')
+  for num_threads in args.threads:
+    for name in args.stores:
+      elapsed = run_benchmark(STORES[name], num_threads, args.increments)
+      print '%-12s %8d %10.3f %14.0f' % (
+          name, num_threads, elapsed,
+          num_threads * args.increments / max(elapsed, 1e-9))
+
+
+if __name__ == '__main__':
+  main()
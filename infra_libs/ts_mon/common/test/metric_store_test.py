@@ -4,6 +4,7 @@
 
 import functools
 import operator
+import threading
 import time
 import unittest
 
@@ -37,6 +38,36 @@ class MetricFieldsValuesTest(unittest.TestCase):
     mfv.set_value(fields, 84)
     self.assertEqual([(fields, 84)], list(mfv.iteritems()))
 
+  def test_iteritems_changed_only(self):
+    mfv = metric_store.MetricFieldsValues()
+    fields1 = (('field', 'value1'),)
+    fields2 = (('field', 'value2'),)
+    mfv.set_value(fields1, 1)
+    mfv.set_value(fields2, 2)
+    self.assertEqual(
+        [(fields1, 1), (fields2, 2)], sorted(mfv.iteritems(changed_only=True)))
+    self.assertEqual([], list(mfv.iteritems(changed_only=True)))
+
+    mfv.set_value(fields2, 3)
+    self.assertEqual([(fields2, 3)], list(mfv.iteritems(changed_only=True)))
+
+    # A full iteration also resets the set of changed values.
+    mfv.set_value(fields1, 4)
+    self.assertEqual([(fields1, 4), (fields2, 3)], sorted(mfv.iteritems()))
+    self.assertEqual([], list(mfv.iteritems(changed_only=True)))
+
+  def test_mark_changed(self):
+    mfv = metric_store.MetricFieldsValues()
+    fields1 = (('field', 'value1'),)
+    fields2 = (('field', 'value2'),)
+    mfv.set_value(fields1, 1)
+    mfv.set_value(fields2, 2)
+    self.assertEqual(2, len(list(mfv.iteritems(changed_only=True))))
+
+    mfv.mark_changed([fields1, (('field', 'unknown'),)])
+    self.assertEqual([(fields1, 1)], list(mfv.iteritems(changed_only=True)))
+    self.assertEqual([], list(mfv.iteritems(changed_only=True)))
+
 
 class MetricStoreTestBase(object):
   """Abstract base class for testing MetricStore implementations.
@@ -179,3 +210,36 @@ class MetricStoreTestBase(object):
 
 class InProcessMetricStoreTest(MetricStoreTestBase, unittest.TestCase):
   METRIC_STORE_CLASS = metric_store.InProcessMetricStore
+
+
+class ShardedInProcessMetricStoreTest(MetricStoreTestBase, unittest.TestCase):
+  METRIC_STORE_CLASS = metric_store.ShardedInProcessMetricStore
+
+  def test_invalid_num_shards(self):
+    with self.assertRaises(ValueError):
+      metric_store.ShardedInProcessMetricStore(self.state, num_shards=0)
+
+  def test_concurrent_incr(self):
+    fields = (('field', 'value'),)
+
+    def worker():
+      for _ in xrange(1000):
+        self.store.incr('foo', fields, None, 1)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEquals(8000, self.store.get('foo', fields, None))
+
+  def test_single_shard(self):
+    store = metric_store.ShardedInProcessMetricStore(self.state, num_shards=1)
+    store.set('foo', (('field', 'value'),), None, 42)
+    store.incr('foo', (('field', 'value'),), None, 1)
+    store.set('foo', (('field', 'value2'),), {'region': 'rrr'}, 7)
+
+    self.assertEquals(43, store.get('foo', (('field', 'value'),), None))
+    self.assertEquals(
+        7, store.get('foo', (('field', 'value2'),), {'region': 'rrr'}))
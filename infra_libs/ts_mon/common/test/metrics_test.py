@@ -62,6 +62,41 @@ class MetricTest(TestBase):
     m.serialize_to(p, 1234, (('bar', 1), ('baz', False)), m.get(), t)
     return str(p).splitlines()
 
+  def test_serialize_uses_template_cache(self):
+    t1 = targets.DeviceTarget('reg', 'role', 'net', 'host')
+    t2 = targets.DeviceTarget('reg', 'role', 'net', 'host2')
+    m = metrics.GaugeMetric('test')
+    p = metrics_pb2.MetricsCollection()
+    with mock.patch.object(m, '_populate_fields',
+                           wraps=m._populate_fields) as populate_fields:
+      m.serialize_to(p, 1234, (('bar', 1),), 1, t1)
+      m.serialize_to(p, 1234, (('bar', 1),), 2, t1)
+      self.assertEqual(1, populate_fields.call_count)
+
+      # A different target or different fields need their own template.
+      m.serialize_to(p, 1234, (('bar', 1),), 3, t2)
+      m.serialize_to(p, 1234, (('bar', 2),), 4, t1)
+      self.assertEqual(3, populate_fields.call_count)
+
+      # reset() evicts the cached templates.
+      m.reset()
+      m.serialize_to(p, 1234, (('bar', 1),), 5, t1)
+      self.assertEqual(4, populate_fields.call_count)
+
+    self.assertEqual([1, 2, 3, 4, 5], [d.gauge for d in p.data])
+    self.assertEqual(['host', 'host', 'host2', 'host', 'host'],
+                     [d.network_device.hostname for d in p.data])
+    self.assertEqual([1, 1, 1, 2, 1], [d.fields[0].int_value for d in p.data])
+
+  def test_serialize_template_cache_limit(self):
+    t = targets.DeviceTarget('reg', 'role', 'net', 'host')
+    m = metrics.GaugeMetric('test')
+    p = metrics_pb2.MetricsCollection()
+    with mock.patch.object(metrics, 'MAX_CACHED_TEMPLATES', 2):
+      for i in xrange(3):
+        m.serialize_to(p, 1234, (('bar', i),), i, t)
+    self.assertEqual(1, len(m._templates))
+
   def test_serialize_too_many_fields(self):
     m = metrics.StringMetric('test', fields={'a': 1, 'b': 2, 'c': 3, 'd': 4})
     m.set('val', fields={'e': 5, 'f': 6, 'g': 7})
@@ -468,6 +503,14 @@ class DistributionMetricTest(TestBase):
     self.assertEquals(111, m.get().sum)
     self.assertEquals(3, m.get().count)
 
+  def test_add_many(self):
+    m = metrics.DistributionMetric('test')
+    m.add_many([1, 10])
+    m.add_many([100])
+    self.assertEquals({2: 1, 6: 1, 11: 1}, m.get().buckets)
+    self.assertEquals(111, m.get().sum)
+    self.assertEquals(3, m.get().count)
+
   def test_add_custom_bucketer(self):
     m = metrics.DistributionMetric('test',
         bucketer=distribution.FixedWidthBucketer(10))
@@ -25,6 +25,15 @@ class MonitorTest(unittest.TestCase):
     with self.assertRaises(NotImplementedError):
       m.send(metric1)
 
+  def test_send_multi(self):
+    m = monitors.Monitor()
+    m.send = mock.Mock()
+    metric1 = metrics_pb2.MetricsData(name='m1')
+    metric2 = metrics_pb2.MetricsData(name='m2')
+    m.send_multi([metric1, metric2])
+    m.send.assert_has_calls([mock.call(metric1), mock.call(metric2)])
+    m.close()
+
 
 class PubSubMonitorTest(unittest.TestCase):
 
@@ -195,6 +204,101 @@ class PubSubMonitorTest(unittest.TestCase):
         ])
 
 
+  @mock.patch('infra_libs.ts_mon.common.monitors.PubSubMonitor.'
+              '_load_credentials', autospec=True)
+  @mock.patch('googleapiclient.discovery.build', autospec=True)
+  def test_send_multi(self, _discovery, _load_creds):
+    mon = monitors.PubSubMonitor('/path/to/creds.p8.json', 'myproject',
+                                 'mytopic')
+    mon._api = mock.MagicMock()
+    topic = 'projects/myproject/topics/mytopic'
+
+    metric1 = metrics_pb2.MetricsData(name='m1')
+    metric2 = metrics_pb2.MetricsData(name='m2')
+    collection = metrics_pb2.MetricsCollection(data=[metric1, metric2])
+    mon.send_multi([metric1, collection])
+
+    def data(pb):
+      pb = monitors.Monitor._wrap_proto(pb)
+      return {'data': base64.b64encode(pb.SerializeToString())}
+    publish = mon._api.projects.return_value.topics.return_value.publish
+    publish.assert_has_calls([
+        mock.call(topic=topic,
+                  body={'messages': [data(metric1), data(collection)]}),
+        mock.call().execute(num_retries=5),
+        ])
+
+
+class AsyncMonitorTest(unittest.TestCase):
+
+  def setUp(self):
+    super(AsyncMonitorTest, self).setUp()
+    interface.state.reset_for_unittest()
+    self.wrapped = mock.create_autospec(monitors.Monitor, spec_set=True)
+    self.sent = []
+    self.wrapped.send_multi.side_effect = (
+        lambda pbs: self.sent.append([pb.data[0].name for pb in pbs]))
+
+  def tearDown(self):
+    interface.state.reset_for_unittest()
+    super(AsyncMonitorTest, self).tearDown()
+
+  def test_invalid_batch_size(self):
+    with self.assertRaises(ValueError):
+      monitors.AsyncMonitor(self.wrapped, max_batch_size=0)
+
+  def test_send(self):
+    m = monitors.AsyncMonitor(self.wrapped)
+    proto = metrics_pb2.MetricsCollection()
+    proto.data.add(name='m1')
+    m.send(proto)
+    # The caller is allowed to reuse the proto.
+    del proto.data[:]
+    proto.data.add(name='m2')
+    m.send(proto)
+    m.close()
+
+    self.assertEqual(['m1', 'm2'], sum(self.sent, []))
+    self.wrapped.close.assert_called_once_with()
+
+  def test_close_without_send(self):
+    m = monitors.AsyncMonitor(self.wrapped)
+    m.close()
+    self.assertFalse(self.wrapped.send_multi.called)
+    self.wrapped.close.assert_called_once_with()
+
+  def test_batches(self):
+    m = monitors.AsyncMonitor(self.wrapped, max_batch_size=2)
+    for i in xrange(5):
+      m._queue.put(metrics_pb2.MetricsCollection(
+          data=[metrics_pb2.MetricsData(name='m%d' % i)]))
+    m._queue.put(m._STOP)
+    m._run()
+
+    self.assertEqual([['m0', 'm1'], ['m2', 'm3'], ['m4']], self.sent)
+    self.assertEqual(3, monitors.async_batch_size.get().count)
+
+  def test_drops_when_full(self):
+    m = monitors.AsyncMonitor(self.wrapped, max_queue_size=1)
+    # Don't start the background thread so that the queue fills up.
+    m._ensure_thread = mock.Mock()
+    m.send(metrics_pb2.MetricsData(name='m1'))
+    m.send([metrics_pb2.MetricsData(name='m2'),
+            metrics_pb2.MetricsData(name='m3')])
+
+    self.assertEqual(1, monitors.async_dropped_collections.get())
+    self.assertEqual(2, monitors.async_dropped_data.get())
+    self.assertEqual(1, monitors.async_queue_size.get())
+
+  def test_send_fails(self):
+    self.wrapped.send_multi.side_effect = Exception('uncaught')
+    m = monitors.AsyncMonitor(self.wrapped)
+    m.send(metrics_pb2.MetricsData(name='m1'))
+    m.send(metrics_pb2.MetricsData(name='m2'))
+    # Exceptions don't stop the background thread.
+    m.close()
+    self.assertTrue(self.wrapped.send_multi.called)
+
 
 class DebugMonitorTest(unittest.TestCase):
 
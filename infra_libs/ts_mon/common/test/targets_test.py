@@ -87,3 +87,17 @@ class TaskTargetTest(unittest.TestCase):
     target._fields += ('bad',)
     with self.assertRaises(AttributeError):
       target.update({'bad': 'boo'})
+
+  def test_cache_key(self):
+    target = targets.TaskTarget('serv', 'job', 'reg', 'host')
+    key = target.cache_key()
+    self.assertEqual(
+        key, targets.TaskTarget('serv', 'job', 'reg', 'host').cache_key())
+    self.assertNotEqual(
+        key, targets.DeviceTarget('serv', 'job', 'reg', 'host').cache_key())
+
+    target.update({'hostname': 'guest'})
+    self.assertNotEqual(key, target.cache_key())
+    key = target.cache_key()
+    target.task_num = 3
+    self.assertNotEqual(key, target.cache_key())
@@ -101,6 +101,38 @@ def add_argparse_options(parser):
       default=60,
       help=('automatically push metrics on this interval if '
             '--ts-mon-flush=auto.'))
+  parser.add_argument(
+      '--ts-mon-async-send',
+      action='store_true',
+      help=('send metrics from a background thread so a slow endpoint '
+            'doesn\'t block flushes. Metrics are dropped if more than '
+            '--ts-mon-async-queue-size collections are waiting to be sent.'))
+  parser.add_argument(
+      '--ts-mon-async-queue-size',
+      type=int,
+      default=100,
+      help=('maximum number of metric collections waiting to be sent if '
+            '--ts-mon-async-send is set. (default: %(default)s)'))
+  parser.add_argument(
+      '--ts-mon-delta-flush',
+      action='store_true',
+      help=('only send the metric values that changed since the previous '
+            'flush, and send all values every '
+            '--ts-mon-full-flush-interval-secs seconds.'))
+  parser.add_argument(
+      '--ts-mon-full-flush-interval-secs',
+      type=int,
+      default=interface.DEFAULT_FULL_FLUSH_INTERVAL_SECS,
+      help=('send all metric values on this interval if --ts-mon-delta-flush '
+            'is set. (default: %(default)s)'))
+
+  parser.add_argument(
+      '--ts-mon-debug-profile',
+      type=int,
+      default=0,
+      metavar='N',
+      help=('log the cost of each flush and the N metrics that were the '
+            'slowest to serialize. (default: %(default)s, disabled)'))
 
   parser.add_argument(
       '--ts-mon-target-type',
@@ -220,7 +252,16 @@ def process_argparse_options(args):
     logging.error('ts_mon monitoring is disabled because the endpoint provided'
                   ' is invalid or not supported: %s', endpoint)
 
+  if args.ts_mon_async_send:
+    interface.state.global_monitor = monitors.AsyncMonitor(
+        interface.state.global_monitor,
+        max_queue_size=args.ts_mon_async_queue_size)
+
   interface.state.flush_mode = args.ts_mon_flush
+  interface.state.delta_flush = args.ts_mon_delta_flush
+  interface.state.full_flush_interval_secs = (
+      args.ts_mon_full_flush_interval_secs)
+  interface.state.debug_profile = args.ts_mon_debug_profile
 
   if args.ts_mon_flush == 'auto':
     interface.state.flush_thread = interface._FlushThread(
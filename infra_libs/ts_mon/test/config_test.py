@@ -134,6 +134,38 @@ class GlobalsTest(auto_stub.TestCase):
 
     config.process_argparse_options(args)
     self.assertIsNone(interface.state.flush_thread)
+    self.assertFalse(interface.state.delta_flush)
+
+  @mock.patch('requests.get', autospec=True)
+  @mock.patch('socket.getfqdn', autospec=True)
+  def test_delta_flush(self, fake_fqdn, fake_get):
+    fake_fqdn.return_value = 'foo'
+    fake_get.return_value.side_effect = requests.exceptions.ConnectionError
+    p = argparse.ArgumentParser()
+    config.add_argparse_options(p)
+    args = p.parse_args(['--ts-mon-flush', 'manual',
+                         '--ts-mon-delta-flush',
+                         '--ts-mon-full-flush-interval-secs', '300'])
+
+    config.process_argparse_options(args)
+    self.assertTrue(interface.state.delta_flush)
+    self.assertEqual(300, interface.state.full_flush_interval_secs)
+
+  @mock.patch('requests.get', autospec=True)
+  @mock.patch('socket.getfqdn', autospec=True)
+  def test_debug_profile(self, fake_fqdn, fake_get):
+    fake_fqdn.return_value = 'foo'
+    fake_get.return_value.side_effect = requests.exceptions.ConnectionError
+    p = argparse.ArgumentParser()
+    config.add_argparse_options(p)
+    args = p.parse_args(['--ts-mon-flush', 'manual'])
+    config.process_argparse_options(args)
+    self.assertEqual(0, interface.state.debug_profile)
+
+    args = p.parse_args(['--ts-mon-flush', 'manual',
+                         '--ts-mon-debug-profile', '10'])
+    config.process_argparse_options(args)
+    self.assertEqual(10, interface.state.debug_profile)
 
   @mock.patch('infra_libs.ts_mon.common.monitors.PubSubMonitor', autospec=True)
   def test_pubsub_args(self, fake_monitor):
@@ -163,6 +195,22 @@ class GlobalsTest(auto_stub.TestCase):
     config.process_argparse_options(args)
     self.assertIsInstance(interface.state.global_monitor, monitors.NullMonitor)
 
+  @mock.patch('infra_libs.ts_mon.common.monitors.DebugMonitor', auto_spec=True)
+  def test_async_send_args(self, fake_monitor):
+    singleton = mock.Mock()
+    fake_monitor.return_value = singleton
+    p = argparse.ArgumentParser()
+    config.add_argparse_options(p)
+    args = p.parse_args(['--ts-mon-endpoint', 'file://foo.txt',
+                         '--ts-mon-flush', 'manual',
+                         '--ts-mon-async-send',
+                         '--ts-mon-async-queue-size', '5'])
+    config.process_argparse_options(args)
+    self.assertIsInstance(interface.state.global_monitor,
+                          monitors.AsyncMonitor)
+    self.assertIs(interface.state.global_monitor._monitor, singleton)
+    self.assertEqual(5, interface.state.global_monitor._queue.maxsize)
+
   @mock.patch('infra_libs.ts_mon.common.monitors.DebugMonitor', auto_spec=True)
   def test_dryrun_args(self, fake_monitor):
     singleton = mock.Mock()